@@ -0,0 +1,342 @@
+import time
+import pickle
+import asyncio
+import collections
+
+from . import ioproto
+from .iohub import IO_MSG_LEN
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__all__ = [
+    'IOEvent',
+    'AsyncIOClient',
+    'connectAll',
+    'merge',
+]
+
+
+# Maximum number of objects combined into one message
+DEFAULT_MAX_BATCH = 1024
+
+
+class IOEvent(collections.namedtuple('IOEvent', ['timestamp', 'client', 'obj'])):
+    '''
+    An object received from an emulator peripheral. The timestamp is the
+    host time.time() value when the message containing the object was
+    received.
+    '''
+    pass
+
+
+class AsyncIOClient:
+    '''
+    asyncio version of ExternalIOClient that can be used to exchange messages
+    with many emulator peripherals from one event loop.
+
+    send() does not wait for the message to be written, all objects sent
+    during the same event loop iteration (up to max_batch objects) are
+    combined into one message. If the peripheral signals that its receive
+    queue is full no more messages are written until it signals that it can
+    accept messages again.
+
+    Received objects can be read with recv() or by iterating over the client:
+
+        async with AsyncIOClient('localhost', 10001, name='can0') as client:
+            client.send(CanMsg(...))
+            async for event in client:
+                print(event.timestamp, event.client.name, event.obj)
+    '''
+    def __init__(self, host, port, protocol='binary', name=None, max_batch=DEFAULT_MAX_BATCH):
+        '''
+        Constructor for AsyncIOClient, if port is None the host is the path of
+        a Unix domain socket. The protocol must match the protocol configured
+        for the peripheral.
+        '''
+        if protocol not in ioproto.IO_PROTOCOLS:
+            raise ValueError('Invalid IO protocol: %s (valid protocols are %s)' %
+                             (protocol, ', '.join(ioproto.IO_PROTOCOLS)))
+        self._protocol = protocol
+        self.max_batch = max_batch
+
+        if port is None:
+            self._addr = host
+        else:
+            if host is None:
+                host = 'localhost'
+            self._addr = (host, port)
+
+        if name is None:
+            name = str(self._addr)
+        self.name = name
+
+        self._sock = None
+        self._reader = None
+        self._writer = None
+        self._tasks = []
+
+        # Objects waiting to be sent, and received events. A received value of
+        # None indicates the connection was closed.
+        self._tx = collections.deque()
+        self._tx_ready = None
+        self._tx_idle = None
+        self._rx = None
+
+        # Cleared while the peripheral's receive queue is full
+        self._resumed = None
+
+        # Counters that are useful to measure throughput
+        self.sent = 0
+        self.received = 0
+
+    @classmethod
+    def fromSocket(cls, sock, protocol='binary', name=None, max_batch=DEFAULT_MAX_BATCH):
+        '''
+        Create a client that uses an already connected socket, such as the
+        socket returned by ExternalIOPeripheral.connect(). open() must still
+        be called to start the client.
+        '''
+        client = cls(None, None, protocol, name=name, max_batch=max_batch)
+        client._addr = sock.getsockname()
+        if name is None:
+            client.name = str(client._addr)
+        client._sock = sock
+        return client
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.name)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def isOpen(self):
+        return self._writer is not None
+
+    async def open(self):
+        '''
+        Opens the client connection and starts the read and write tasks
+        '''
+        if self._writer is not None:
+            return
+
+        if self._sock is not None:
+            sock = self._sock
+            self._sock = None
+            sock.setblocking(False)
+            self._reader, self._writer = await asyncio.open_connection(sock=sock)
+        elif isinstance(self._addr, str):
+            self._reader, self._writer = await asyncio.open_unix_connection(self._addr)
+        else:
+            self._reader, self._writer = await asyncio.open_connection(*self._addr)
+
+        self._tx_ready = asyncio.Event()
+        self._tx_idle = asyncio.Event()
+        self._resumed = asyncio.Event()
+        self._resumed.set()
+        self._rx = asyncio.Queue()
+        if self._tx:
+            self._tx_ready.set()
+        else:
+            self._tx_idle.set()
+
+        self._tasks = [
+            asyncio.ensure_future(self._readTask()),
+            asyncio.ensure_future(self._writeTask()),
+        ]
+
+    async def close(self):
+        '''
+        Sends any queued objects and closes the client connection
+        '''
+        if self._writer is None:
+            return
+
+        try:
+            await self.flush()
+        except (OSError, asyncio.CancelledError):
+            pass
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except OSError:
+            pass
+        self._writer = None
+        self._reader = None
+
+    def send(self, obj):
+        '''
+        Queue an object to be sent to the peripheral, this does not wait for
+        the object to be written.
+        '''
+        self._tx.append(obj)
+        if self._tx_ready is not None:
+            self._tx_idle.clear()
+            self._tx_ready.set()
+
+    def sendBatch(self, objs):
+        '''
+        Queue a sequence of objects to be sent to the peripheral
+        '''
+        self._tx.extend(objs)
+        if self._tx_ready is not None:
+            self._tx_idle.clear()
+            self._tx_ready.set()
+
+    async def flush(self):
+        '''
+        Wait until all queued objects have been written to the connection
+        '''
+        if self._writer is None:
+            return
+
+        # Stop waiting if the write task fails
+        idle = asyncio.ensure_future(self._tx_idle.wait())
+        await asyncio.wait([idle, self._tasks[1]], return_when=asyncio.FIRST_COMPLETED)
+        idle.cancel()
+
+    def isPaused(self):
+        '''
+        Returns True if the peripheral has signaled that its receive queue is
+        full, queued objects are not sent until the peripheral resumes.
+        '''
+        return self._resumed is not None and not self._resumed.is_set()
+
+    async def recv(self):
+        '''
+        Returns the next received IOEvent or None if the connection has been
+        closed.
+        '''
+        if self._rx is None:
+            return None
+        event = await self._rx.get()
+        if event is None:
+            # Leave the closed indication for any other readers
+            self._rx.put_nowait(None)
+        return event
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.recv()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    def _encode(self, objs):
+        if self._protocol == 'pickle':
+            data = [pickle.dumps(obj) for obj in objs]
+        else:
+            data = [ioproto.encode(objs)]
+        return b''.join(IO_MSG_LEN.pack(len(d)) + d for d in data)
+
+    def _decode(self, data):
+        if self._protocol == 'pickle':
+            return [pickle.loads(data)]
+        return ioproto.decode(data)
+
+    async def _writeTask(self):
+        while True:
+            await self._tx_ready.wait()
+
+            # Let any other tasks that are ready to run queue up objects so
+            # they can be sent in the same message
+            await asyncio.sleep(0)
+            await self._resumed.wait()
+
+            objs = []
+            while self._tx and len(objs) < self.max_batch:
+                objs.append(self._tx.popleft())
+            if not self._tx:
+                self._tx_ready.clear()
+
+            if objs:
+                self._writer.write(self._encode(objs))
+                self.sent += len(objs)
+                await self._writer.drain()
+
+            if not self._tx:
+                self._tx_idle.set()
+
+    async def _readTask(self):
+        try:
+            while True:
+                hdr = await self._reader.readexactly(IO_MSG_LEN.size)
+                data = await self._reader.readexactly(IO_MSG_LEN.unpack(hdr)[0])
+                timestamp = time.time()
+
+                for obj in self._decode(data):
+                    if isinstance(obj, ioproto.FlowControl):
+                        logger.debug('Flow control from %s: %s', self.name, obj)
+                        if obj.paused:
+                            self._resumed.clear()
+                        else:
+                            self._resumed.set()
+                    else:
+                        self.received += 1
+                        self._rx.put_nowait(IOEvent(timestamp, self, obj))
+        except (OSError, EOFError, asyncio.IncompleteReadError, ioproto.IOProtocolError,
+                pickle.UnpicklingError):
+            logger.debug('Connection closed %s', self.name, exc_info=1)
+        finally:
+            # Don't leave the writer waiting for a resume signal that won't
+            # come
+            self._resumed.set()
+            self._rx.put_nowait(None)
+
+
+async def connectAll(addrs, protocol='binary', max_batch=DEFAULT_MAX_BATCH):
+    '''
+    Open clients to many peripherals concurrently. addrs is a dictionary of
+    client names and (host, port) tuples or Unix domain socket paths, returns
+    a dictionary of the open clients.
+    '''
+    clients = {}
+    for name, addr in addrs.items():
+        if isinstance(addr, str):
+            clients[name] = AsyncIOClient(addr, None, protocol, name=name, max_batch=max_batch)
+        else:
+            clients[name] = AsyncIOClient(addr[0], addr[1], protocol, name=name, max_batch=max_batch)
+
+    await asyncio.gather(*(c.open() for c in clients.values()))
+    return clients
+
+
+async def merge(*clients):
+    '''
+    Async iterator over the events received by several clients in the order
+    they are received, ends when all clients have been closed.
+    '''
+    rx = asyncio.Queue()
+
+    async def forward(client):
+        try:
+            async for event in client:
+                rx.put_nowait(event)
+        finally:
+            rx.put_nowait(None)
+
+    tasks = [asyncio.ensure_future(forward(c)) for c in clients]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            event = await rx.get()
+            if event is None:
+                remaining -= 1
+            else:
+                yield event
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,476 @@
+import time
+import bisect
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__all__ = [
+    'Checkpoint',
+    'CheckpointManager',
+]
+
+
+# Default checkpoint configuration values
+DEFAULT_INTERVAL = 100000
+DEFAULT_MAX_MEMORY = 256 * 1024 * 1024
+DEFAULT_MAX_LATENCY = 0.5
+
+
+def _snapSize(value):
+    '''
+    Rough estimate of the amount of memory used by a snapshot value, this is
+    only used to decide when checkpoints need to be discarded.
+    '''
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        return 8 * len(value) + sum(_snapSize(v) for v in value)
+    elif isinstance(value, dict):
+        return 16 * len(value) + sum(_snapSize(v) for v in value.values())
+    return 8
+
+
+class Checkpoint:
+    '''
+    The state of the emulator at a specific position.  The position is the
+    number of instructions that have been executed, a checkpoint holds the
+    state at the start of that instruction step (before any IO for that step is
+    delivered).  If "io_done" is set the IO for that step had already been
+    delivered when the checkpoint was saved.
+    '''
+    def __init__(self, position, snap, parts, io_done=False):
+        self.position = position
+        self.snap = snap
+        self.io_done = io_done
+
+        # The large components of the snapshot (memory and peripheral state),
+        # along with their approximate size.  Components that did not change
+        # since the previous checkpoint are shared with the previous checkpoint.
+        self.parts = parts
+
+    def __repr__(self):
+        return '%s(%d)' % (self.__class__.__name__, self.position)
+
+
+class CheckpointManager:
+    '''
+    Saves periodic checkpoints of the emulator state and a history of all IO
+    delivered to peripherals.  Any earlier position can then be reached by
+    restoring the closest prior checkpoint and deterministically re-executing
+    instructions until the target position.  This is used by the GDB stub to
+    support reverse stepping and continuing.
+
+    While the emulator is at an earlier position the instructions that are
+    executed are "replayed": IO is delivered from the history and no new
+    checkpoints are created until the emulator reaches the furthest position
+    that has been executed (the end of the history).
+
+    The checkpoint interval adapts to the configured limits: if the
+    checkpoints use more than max_memory every other checkpoint is discarded
+    and the interval is doubled, if re-executing one interval takes longer
+    than max_latency seconds and there is memory available the interval is
+    halved (but never below the initial interval).
+
+    The IO history is also counted against max_memory.  If most of the memory
+    is used by the IO history the oldest checkpoint is discarded instead,
+    along with the IO history before the next checkpoint.
+    '''
+    def __init__(self, emu, interval=DEFAULT_INTERVAL,
+                 max_memory=DEFAULT_MAX_MEMORY, max_latency=DEFAULT_MAX_LATENCY):
+        if interval < 1:
+            raise ValueError('Invalid checkpoint interval: %s' % interval)
+
+        self.emu = emu
+        self.base_interval = int(interval)
+        self.interval = self.base_interval
+        self.max_memory = max_memory
+        self.max_latency = max_latency
+
+        # Checkpoints ordered by position
+        self.checkpoints = []
+        self._positions = []
+        self.memory = 0
+
+        # IO delivered to peripherals: (position, devname, obj), along with
+        # the approximate memory used by the history and the number of
+        # history entries that have been included in that size
+        self.history = []
+        self._history_memory = 0
+        self._history_counted = 0
+
+        # The furthest position executed when the emulator has been moved to
+        # an earlier position, and the index of the next IO history entry to
+        # deliver.
+        self.end = None
+        self._replay_idx = 0
+
+        # The position the next checkpoint should be saved at
+        self._next = emu.getStepCount()
+
+        # Re-execution state, the measured rate (instructions per second) is
+        # used to adapt the checkpoint interval
+        self._reexec = False
+        self._halted = False
+        self._rate = None
+        self._latency_warned = False
+
+    def clear(self):
+        self.checkpoints = []
+        self._positions = []
+        self.memory = 0
+        self.history.clear()
+        self._history_memory = 0
+        self._history_counted = 0
+        self.end = None
+
+    def replaying(self):
+        '''
+        Returns True if the emulator is executing instructions that have
+        already been executed.
+        '''
+        return self.end is not None
+
+    def reexecuting(self):
+        '''
+        Returns True if instructions are being executed to move the emulator
+        to a different position for the debugger.
+        '''
+        return self._reexec
+
+    def debugHalt(self):
+        '''
+        Called by the GDB stub if a debug event occurs while re-executing,
+        this stops the re-execution at the current position.
+        '''
+        self._halted = True
+
+    def position(self):
+        return self.emu.getStepCount()
+
+    def first(self):
+        '''
+        The earliest position that can be reached
+        '''
+        return self._positions[0] if self._positions else None
+
+    def last(self):
+        '''
+        The furthest position that has been executed
+        '''
+        return self.end if self.end is not None else self.emu.getStepCount()
+
+    def take(self, io_done=False):
+        '''
+        Save a checkpoint at the current position.
+        '''
+        emu = self.emu
+        pos = emu.getStepCount()
+
+        # Breakpoint instructions written by the GDB stub are not part of the
+        # emulator state
+        gdbstub = emu.gdbstub
+        bps_in_place = gdbstub._bps_in_place
+        if bps_in_place:
+            gdbstub._pullUpBreakpoints()
+        try:
+            snap = emu.getEmuSnap()
+        finally:
+            if bps_in_place:
+                gdbstub._putDownBreakpoints()
+
+        # Share any memory or peripheral state that hasn't changed since the
+        # previous checkpoint
+        idx = bisect.bisect_left(self._positions, pos)
+        if idx:
+            prev = self.checkpoints[idx - 1].snap
+            prev_mem = dict(prev['mem'])
+            snap['mem'] = tuple((va, prev_mem[va] if prev_mem.get(va) == data else data)
+                                for va, data in snap['mem'])
+
+            prev_mods = prev['modules']
+            snap['modules'] = dict((name, prev_mods[name] if name in prev_mods and prev_mods[name] == msnap else msnap)
+                                   for name, msnap in snap['modules'].items())
+
+        parts = [(data, len(data)) for _, data in snap['mem']]
+        parts.extend((msnap, _snapSize(msnap)) for msnap in snap['modules'].values())
+
+        ckpt = Checkpoint(pos, snap, parts, io_done)
+        if idx < len(self._positions) and self._positions[idx] == pos:
+            self.checkpoints[idx] = ckpt
+        else:
+            self.checkpoints.insert(idx, ckpt)
+            self._positions.insert(idx, pos)
+        logger.debug('Saved checkpoint at %d', pos)
+
+        self._next = pos + self.interval
+        self._recalcMemory()
+        self._enforceLimits()
+        self._updateHook()
+
+    def stepHook(self):
+        '''
+        Called by the emulator at the start of an instruction step when the
+        emulator step count reaches the current step hook.
+        '''
+        pos = self.emu.getStepCount()
+        if self.end is not None:
+            # Deliver the IO that was delivered at this position originally
+            history = self.history
+            while self._replay_idx < len(history) and history[self._replay_idx][0] <= pos:
+                _, devname, obj = history[self._replay_idx]
+                self.emu.modules[devname].processReceivedData(obj)
+                self._replay_idx += 1
+
+            if pos >= self.end:
+                self._goLive()
+        elif pos >= self._next:
+            self.take()
+
+        self._updateHook()
+
+    def _updateHook(self):
+        if self.end is not None:
+            hook = self.end
+            if self._replay_idx < len(self.history):
+                hook = min(hook, self.history[self._replay_idx][0])
+            self.emu._step_hook = hook
+        else:
+            self.emu._step_hook = self._next
+
+    def _goLive(self):
+        logger.debug('Reached end of execution history at %d', self.end)
+        self.end = None
+        self.emu._io_history = self.history
+
+        # If the next checkpoint position was passed while replaying take one
+        # at the next step
+        self._next = max(self._next, self.emu.getStepCount())
+
+    def stateModified(self):
+        '''
+        Called when the emulator state is modified by something other than
+        normal execution (such as a debugger changing registers or memory).
+        If the emulator is at an earlier position the rest of the execution
+        history no longer applies and is discarded.  A checkpoint is saved so
+        that the modification is preserved when moving back to this position.
+        '''
+        pos = self.emu.getStepCount()
+        if self.end is not None:
+            idx = bisect.bisect_right(self._positions, pos)
+            del self.checkpoints[idx:]
+            del self._positions[idx:]
+            self._discardHistory(self._replay_idx, len(self.history))
+            logger.info('Execution diverged at %d, discarding history up to %d', pos, self.end)
+            self._goLive()
+            self.take()
+        else:
+            # The debugger can only modify the emulator while it is halted,
+            # which happens after the IO for the current step is delivered.
+            self.take(io_done=True)
+
+    def gotoPosition(self, target):
+        '''
+        Move the emulator to the specified position by restoring the closest
+        checkpoint and re-executing instructions.  The target is limited to the
+        range of the execution history.  Returns the position reached which
+        may be earlier than the target if a debug event occurred.
+        '''
+        return self._run(target)[0]
+
+    def reverseStepi(self):
+        '''
+        Move the emulator back by one instruction.
+        '''
+        pos = self.emu.getStepCount()
+        if not self.checkpoints or pos <= self.first():
+            return pos
+        return self.gotoPosition(pos - 1)
+
+    def reverseContinue(self, breakpoints=(), watchpoints=()):
+        '''
+        Move the emulator back to the most recent position where a breakpoint
+        would have been hit or a watched memory location was written.  If none
+        are found the emulator is moved to the earliest position in the
+        execution history.
+
+        Arguments:
+            breakpoints     Instruction addresses
+            watchpoints     (address, size) tuples of memory to watch for writes
+
+        Returns a tuple of (reason, address), the reason is 'breakpoint',
+        'watchpoint', or None when the start of the history was reached.
+        '''
+        start = self.emu.getStepCount()
+        if not self.checkpoints or start <= self.first():
+            return (None, None)
+
+        if breakpoints or watchpoints:
+            # Search backwards through the history one checkpoint interval at
+            # a time
+            idx = bisect.bisect_left(self._positions, start) - 1
+            end = start
+            while idx >= 0:
+                _, hits = self._run(end, self.checkpoints[idx], breakpoints, watchpoints)
+                hits = [h for h in hits if h[0] < start]
+                if hits:
+                    hit_pos, reason, addr = hits[-1]
+                    self.gotoPosition(hit_pos)
+                    return (reason, addr)
+                end = self._positions[idx]
+                idx -= 1
+
+        self.gotoPosition(self.first())
+        return (None, None)
+
+    def _historyIndex(self, position):
+        # History entries are (position, devname, obj) tuples, a 1-element
+        # tuple sorts before any entry at the same position.
+        return bisect.bisect_left(self.history, (position,))
+
+    def _run(self, target, ckpt=None, breakpoints=(), watchpoints=()):
+        '''
+        Execute until the target position, restoring the specified checkpoint
+        first (or the closest checkpoint before the target if needed).
+        Breakpoint and watchpoint hits are returned as a list of:
+            (position, reason, address)
+
+        Watchpoint hits are reported at the position before the instruction
+        that wrote to the memory.
+        '''
+        emu = self.emu
+        pos = emu.getStepCount()
+        if not self.checkpoints:
+            return (pos, [])
+
+        target = max(self.first(), min(target, self.last()))
+        if self.end is None:
+            if ckpt is None and target >= pos:
+                return (pos, [])
+
+            # Moving back from the end of the history
+            self.end = pos
+            emu._io_history = None
+
+        # If the target is ahead of the current position and there are no
+        # closer checkpoints, keep going from the current position
+        if ckpt is None:
+            ckpt = self.checkpoints[bisect.bisect_right(self._positions, target) - 1]
+            restore = not ckpt.position <= pos <= target
+        else:
+            restore = True
+
+        if restore:
+            emu.setEmuSnap(ckpt.snap)
+            if ckpt.io_done:
+                self._replay_idx = self._historyIndex(ckpt.position + 1)
+            else:
+                self._replay_idx = self._historyIndex(ckpt.position)
+            self._updateHook()
+
+        hits = []
+        values = [self._readWatch(addr, size) for addr, size in watchpoints]
+
+        steps = emu.getStepCount()
+        timestamp = time.monotonic()
+        self._reexec = True
+        self._halted = False
+        try:
+            while emu.getStepCount() < target:
+                pos = emu.getStepCount()
+                if breakpoints:
+                    pc = emu.getProgramCounter()
+                    if pc in breakpoints:
+                        hits.append((pos, 'breakpoint', pc))
+
+                emu.stepi()
+                if self._halted:
+                    break
+
+                for i, (addr, size) in enumerate(watchpoints):
+                    value = self._readWatch(addr, size)
+                    if value != values[i]:
+                        hits.append((pos, 'watchpoint', addr))
+                        values[i] = value
+        finally:
+            self._reexec = False
+
+        # If the end of the history was reached normal execution resumes with
+        # the next step
+        pos = emu.getStepCount()
+        self._updateRate(pos - steps, time.monotonic() - timestamp)
+        return (pos, hits)
+
+    def _readWatch(self, addr, size):
+        try:
+            return self.emu.readMemory(addr, size, skipcallbacks=True)
+        except Exception:
+            return None
+
+    def _updateRate(self, steps, elapsed):
+        if steps < 1000 or elapsed <= 0:
+            return
+
+        self._rate = steps / elapsed
+
+        # If re-executing a full interval would take too long, and there is
+        # memory available, save checkpoints more often
+        if self.interval > self.base_interval and \
+                self.interval > self._rate * self.max_latency and \
+                self.memory < self.max_memory // 2:
+            self.interval = max(self.base_interval, self.interval // 2)
+            logger.debug('Decreasing checkpoint interval to %d', self.interval)
+
+    def _recalcMemory(self):
+        # Count shared snapshot components only once
+        sizes = {}
+        for ckpt in self.checkpoints:
+            for part, size in ckpt.parts:
+                sizes[id(part)] = size
+
+        # The IO history is only added to while executing so only the entries
+        # added since the last calculation need to be counted
+        for entry in self.history[self._history_counted:]:
+            self._history_memory += _snapSize(entry)
+        self._history_counted = len(self.history)
+
+        self.memory = sum(sizes.values()) + self._history_memory
+
+    def _discardHistory(self, start, end):
+        # Remove a range of IO history entries, the history list is shared
+        # with the emulator so it is modified in place.  Only the entries that
+        # have been counted are subtracted from the history memory.
+        counted = self.history[start:min(end, self._history_counted)]
+        self._history_memory -= sum(_snapSize(e) for e in counted)
+        self._history_counted -= len(counted)
+        del self.history[start:end]
+
+    def _enforceLimits(self):
+        while self.memory > self.max_memory and len(self.checkpoints) > 1:
+            if len(self.checkpoints) == 2 or self._history_memory > self.memory // 2:
+                # Discard the oldest checkpoint, the IO history before the next
+                # checkpoint can no longer be replayed
+                del self.checkpoints[0]
+                del self._positions[0]
+                count = self._historyIndex(self._positions[0])
+                logger.debug('Checkpoint memory %d exceeds %d, discarding history before %d',
+                             self.memory, self.max_memory, self._positions[0])
+                self._discardHistory(0, count)
+                self._replay_idx = max(self._replay_idx - count, 0)
+            else:
+                # Discard every other checkpoint, the first and last
+                # checkpoints are always kept.
+                keep = self.checkpoints[:-1:2] + self.checkpoints[-1:]
+                logger.debug('Checkpoint memory %d exceeds %d, discarding %d checkpoints',
+                             self.memory, self.max_memory, len(self.checkpoints) - len(keep))
+                self.checkpoints = keep
+                self._positions = [c.position for c in keep]
+                self.interval *= 2
+                self._next = self._positions[-1] + self.interval
+            self._recalcMemory()
+
+        if self._rate is not None and not self._latency_warned and \
+                self.interval > self._rate * self.max_latency:
+            logger.warning('Checkpoint interval %d exceeds latency limit of %.2f sec (%d instructions/sec), increase the memory limit',
+                           self.interval, self.max_latency, self._rate)
+            self._latency_warned = True
@@ -61,6 +61,10 @@ class e200GDB(ppc_peripherals.Module, vtp_gdb.GdbBaseEmuServer):
         self._bpdata = {}
         self._bps_in_place = False
 
+        # Write watchpoints, the watched address is mapped to the physical
+        # address and size
+        self._watchdata = {}
+
         # There is no real filename for the firmware image
         self.supported_features[b'qXfer:exec-file:read'] = None
         self.xfer_read_handlers[b'exec-file'] = None
@@ -72,6 +76,14 @@ class e200GDB(ppc_peripherals.Module, vtp_gdb.GdbBaseEmuServer):
         # Signal the run thread that it's time to exit
         self.shutdownServer()
 
+    def getSnap(self):
+        # The debugger state is not part of the emulated system so it is not
+        # saved or restored with emulator checkpoints
+        return None
+
+    def setSnap(self, snap):
+        pass
+
     def getTargetXml(self, reggrps=None, haltregs=None):
         # Hardcoded register format and XML
         self._gdb_reg_fmt = e200z759n3.reg_fmt
@@ -123,6 +135,13 @@ class e200GDB(ppc_peripherals.Module, vtp_gdb.GdbBaseEmuServer):
         # TODO: emulate the PPC debug control registers that can disable/enable 
         # some things?
 
+        # If instructions are being re-executed to move to an earlier position
+        # the emulator is already halted, just stop the re-execution.
+        ckpts = self.emu.checkpoints
+        if ckpts is not None and ckpts.reexecuting():
+            ckpts.debugHalt()
+            return
+
         # If there is a debugger connected halt execution, otherwise queue the 
         # debug exception so it can be processed by the normal PPC exception 
         # handler.
@@ -173,6 +192,37 @@ class e200GDB(ppc_peripherals.Module, vtp_gdb.GdbBaseEmuServer):
         # Continue execution
         self.emu.resume_exec()
 
+    def _serverReverseStepi(self):
+        '''
+        Move execution back by one instruction using the emulator checkpoints.
+        '''
+        ckpts = self.emu.checkpoints
+        if ckpts is None:
+            logger.warning('Cannot reverse step: checkpoints are not enabled')
+        else:
+            ckpts.reverseStepi()
+            logger.info('Reverse step to %x', self.emu.getProgramCounter())
+
+        self._halt_reason = signal.SIGTRAP
+
+    def _serverReverseCont(self):
+        '''
+        Move execution back to the last breakpoint hit or watchpoint write, or
+        the start of the execution history if there are none.
+        '''
+        ckpts = self.emu.checkpoints
+        if ckpts is None:
+            logger.warning('Cannot reverse continue: checkpoints are not enabled')
+        else:
+            watches = [(addr, size) for addr, (_, size) in self._watchdata.items()]
+            reason, addr = ckpts.reverseContinue(set(self._bpdata), watches)
+            if reason is None:
+                logger.info('Reached start of execution history at %x', self.emu.getProgramCounter())
+            else:
+                logger.info('Reverse %s @ 0x%x hit at %x', reason, addr, self.emu.getProgramCounter())
+
+        self._halt_reason = signal.SIGTRAP
+
     def _installBreakpoint(self, addr):
         ea, vle, _, _, breakbytes, breakop = self._bpdata[addr]
 
@@ -273,6 +323,34 @@ class e200GDB(ppc_peripherals.Module, vtp_gdb.GdbBaseEmuServer):
 
         return b'OK'
 
+    def _serverSetWriteWatch(self, addr, size):
+        if addr in self._watchdata:
+            return b'E02'
+
+        try:
+            ea = self.emu.mmu.translateDataAddr(addr)
+        except intc_exc.DataTlbException:
+            return b'E%02d' % signal.SIGBUS
+
+        logger.debug('Adding new write watchpoint: 0x%x (%d)', addr, size)
+        self._watchdata[addr] = (ea, size)
+        self.emu.installWriteCallback(ea, ea + size, self._watchHandler)
+        return b'OK'
+
+    def _serverRemoveWriteWatch(self, addr, size):
+        if addr not in self._watchdata:
+            return b'E02'
+
+        logger.debug('Removing write watchpoint: 0x%x', addr)
+        ea, _ = self._watchdata.pop(addr)
+        self.emu.removeWriteCallback(ea)
+        return b'OK'
+
+    def _watchHandler(self, src, addr, data, instr=False):
+        # Halt after the instruction that wrote to the watched memory
+        self._halt_reason = signal.SIGTRAP
+        self.emu.halt_exec()
+
     def _serverDetach(self):
         vtp_gdb.GdbBaseEmuServer._serverDetach(self)
 
@@ -281,6 +359,10 @@ class e200GDB(ppc_peripherals.Module, vtp_gdb.GdbBaseEmuServer):
         self._bpdata = {}
         self._bps_in_place = False
 
+        for ea, _ in self._watchdata.values():
+            self.emu.removeWriteCallback(ea)
+        self._watchdata = {}
+
         # Since the client has detached let the core start executing.
         self.emu.resume_exec()
 
@@ -334,7 +416,9 @@ class e200GDB(ppc_peripherals.Module, vtp_gdb.GdbBaseEmuServer):
         exceptions into standard error types.
         """
         try:
-            return vtp_gdb.GdbBaseEmuServer._serverWriteMem(self, addr, val)
+            result = vtp_gdb.GdbBaseEmuServer._serverWriteMem(self, addr, val)
+            self._stateModified()
+            return result
 
         except intc_exc.MceWriteBusError:
             return b'E%02d' % signal.SIGSEGV
@@ -355,8 +439,15 @@ class e200GDB(ppc_peripherals.Module, vtp_gdb.GdbBaseEmuServer):
             logger.warning("Attempted Bad Register Write: %d -> %d", reg_idx, envi_idx)
             return 0
 
+        self._stateModified()
         return b'OK'
 
+    def _stateModified(self):
+        # Let the checkpoint manager know that the emulator state was changed
+        # by the debugger
+        if self.emu.checkpoints is not None:
+            self.emu.checkpoints.stateModified()
+
     def _serverReadRegVal(self, reg_idx):
         try:
             _, size, envi_idx, mask = self._gdb_to_envi_map[reg_idx]
@@ -59,6 +59,23 @@ class e200INTC(Module):
         # Exceptions that may be activated after the MSR state changes
         self.saved = []
 
+    # Exception objects are not modified once queued
+    _snap_refs = ('stack', 'pending', 'saved')
+    _snap_ignore = ('_callbacks',)
+
+    def getSnap(self):
+        with self.lock:
+            snap = Module.getSnap(self)
+
+        # Debugger halt requests are not part of the emulated system state
+        snap['pending'] = [e for e in snap['pending'] if not isinstance(e, intc_exc.DebugException)]
+        snap['hasInterrupt'] = bool(snap['pending']) and snap['curlvl'] > snap['pending'][0].prio
+        return snap
+
+    def setSnap(self, snap):
+        with self.lock:
+            Module.setSnap(self, snap)
+
     def registerExtINTC(self, extintc):
         '''
         Register interrupt controller for External Interrupts
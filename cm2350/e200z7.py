@@ -25,14 +25,17 @@ logger = logging.getLogger(__name__)
 import envi
 import envi.bits as e_bits
 import envi.memory as e_mem
+from envi.common import MIRE
 
 # PPC registers
 import envi.archs.ppc.regs as eapr
-from .ppc_vstructs import v_const, v_w1c, v_bits, BitFieldSPR, PpcSprCallbackWrapper
+from .ppc_vstructs import v_const, v_w1c, v_bits, BitFieldSPR, PpcSprCallbackWrapper, \
+        isVstructType, vsGetSnap, vsSetSnap
 
 # PPC Specific packages
-from . import emutimers, clocks, ppc_time, mmio, ppc_mmu, ppc_xbar, e200_intc, \
-        intc_exc, e200_gdb
+from . import emutimers, clocks, ppc_time, ppc_cycles, mmio, ppc_mmu, ppc_xbar, \
+        e200_intc, intc_exc, e200_gdb, iolog, checkpoints, iohub, \
+        iofrontend, ioqueue, workqueue, predecode
 
 
 __all__ = [
@@ -230,6 +233,51 @@ class PPC_e200z7(mmio.ComplexMemoryMap, vimp_emu.WorkspaceEmulator,
         # cache
         self.opcache = ({}, {})
 
+        # Decoded instructions saved from previous runs that are used to
+        # populate the opcache without calling the disassembler
+        self.instr_store = None
+
+        # Instructions being decoded ahead of time by worker processes, the
+        # results are added to the opcache when they are ready
+        self._predecoder = None
+
+        # The instruction timing model, by default every instruction takes 1
+        # system clock cycle. The number of cycles is saved with each decoded
+        # instruction when it is added to the opcache.
+        self._cycle_model = ppc_cycles.PpcCycleModel()
+
+        # External IO record/replay state. The IO epoch is the number of times
+        # the processor has been reset since recording or replay started, along
+        # with the system tick count it identifies exactly when an IO message
+        # was delivered.
+        self._io_epoch = 0
+        self._io_recorder = None
+        self._io_replayer = None
+
+        # The tick that the next replayed IO message should be delivered at, or
+        # None if there are no IO messages to deliver in the current epoch.
+        self._io_replay_next = None
+
+        # The IO hub that services all external IO peripheral connections,
+        # created when the first external IO peripheral is initialized
+        self._iohub = None
+
+        # When the out-of-process IO frontend is enabled it replaces the IO
+        # hub, and the receive ring is checked every time the poll count
+        # reaches 0
+        self._io_frontend = None
+        self._io_poll_count = 0
+
+        # The number of instructions that have been executed, this is used to
+        # identify positions in the execution history for checkpoints and
+        # reverse execution.  When checkpoints are enabled the step hook is the
+        # next step count that the checkpoint manager needs to be notified of,
+        # and each IO message delivered is added to the IO history.
+        self._step_count = 0
+        self._step_hook = None
+        self._io_history = None
+        self.checkpoints = None
+
         # Some cache information about the current instruction that makes it
         # faster to parse/create PPC-specific exception information.  This is a
         # tuple consisting of:
@@ -255,10 +303,11 @@ class PPC_e200z7(mmio.ComplexMemoryMap, vimp_emu.WorkspaceEmulator,
                                       (name, module))
 
         # Ensure that installing this module won't overwrite one that is already 
-        # installed
-        if name in self.modules:
+        # installed. A module may be installed again by the same object (when
+        # a LazyPeripheral placeholder is constructed).
+        if name in self.modules and self.modules[name] is not module:
             raise KeyError('Cannot install peripheral %s: %s already installed, cannot install %s' %
-                           (name, self.modules[name], peripheral))
+                           (name, self.modules[name], module))
 
         self.modules[name] = module
 
@@ -288,6 +337,9 @@ class PPC_e200z7(mmio.ComplexMemoryMap, vimp_emu.WorkspaceEmulator,
         # Call the emutime shutdown function
         emutimers.EmuTimeCore.shutdown(self)
 
+        # Ensure any recorded IO is flushed to disk
+        self.stopIORecord()
+
         # Go through each peripheral and if any of them have a server thread
         # running, stop it now, use a duplicate list because the modules will be 
         # deleting themselves from the list after they are shutdown
@@ -296,6 +348,47 @@ class PPC_e200z7(mmio.ComplexMemoryMap, vimp_emu.WorkspaceEmulator,
             self.modules[mname].shutdown()
             del self.modules[mname]
 
+        # Now close all external IO connections
+        if self._iohub is not None:
+            self._iohub.shutdown()
+            self._iohub = None
+            self._io_frontend = None
+
+        # Stop decoding instructions ahead of time
+        if self._predecoder is not None:
+            self._predecoder.stop()
+            self._predecoder = None
+
+        # Save any newly decoded instructions
+        if self.instr_store is not None:
+            self.instr_store.save()
+
+    def getIOHub(self):
+        if self._iohub is None:
+            self._iohub = iohub.IOHub()
+        return self._iohub
+
+    def enableIOFrontend(self, ring_size=iofrontend.DEFAULT_RING_SIZE,
+                         poll_interval=iofrontend.DEFAULT_POLL_INTERVAL):
+        '''
+        Use a separate IO frontend process to service external IO
+        connections instead of the IO hub thread.  This must be done before
+        the emulator is initialized.
+
+        Arguments:
+            ring_size       (optional) Size (in bytes) of the shared memory
+                            ring buffers used to exchange messages with the
+                            frontend process
+            poll_interval   (optional) Number of instructions executed between
+                            checks for new messages from the frontend
+        '''
+        if self._iohub is not None:
+            raise RuntimeError('Cannot enable IO frontend after IO has been initialized')
+
+        self._io_frontend = iofrontend.IOFrontend(ring_size, poll_interval)
+        self._io_poll_count = poll_interval
+        self._iohub = self._io_frontend
+
     def _mcuWDTHandler(self):
         # From "Figure 8-1. Watchdog State Machine" (EREF_RM.pdf page 886)
         if not self.tsr.enw:
@@ -419,21 +512,27 @@ class PPC_e200z7(mmio.ComplexMemoryMap, vimp_emu.WorkspaceEmulator,
         # Create a queue to use for any extra processing that must occur before
         # instructions are processed. This should be more efficient than having
         # required checks each cycle.
-        self.extra_processing = []
-        self.extra_processing_lock = threading.RLock()
+        self.deferred_work = workqueue.DeferredWorkQueue(self.systicks)
 
         # Create the queue that external IO threads can use to queue up message
-        # for processing
-        self.external_io = queue.Queue()
+        # for processing, each IO peripheral configures the size and policy of
+        # its own queue when it is initialized
+        self.external_io = ioqueue.ExternalIOQueue()
+        self.external_io.setFlowCallback(self._ioFlowControl)
 
         # reset the system emulation time, then init all modules
         self.systimeReset()
 
         # initialize the various modules on this chip.
-        for key, module in self.modules.items():
+        for key, module in list(self.modules.items()):
             logger.debug("init: Initializing %s...", key)
             module.init(self)
 
+        # All IO servers have been added, so the IO frontend process (if
+        # enabled) can be started
+        if self._io_frontend is not None:
+            self._io_frontend.start()
+
         # Start the core emulator time now
         self.resume_time()
 
@@ -451,15 +550,19 @@ class PPC_e200z7(mmio.ComplexMemoryMap, vimp_emu.WorkspaceEmulator,
         self._cur_instr = (None, 0, 0, False)
 
         # Clear out all pending extra processing
-        with self.extra_processing_lock:
-            self.extra_processing = []
+        self.deferred_work.clear()
 
         # First reset the system emulation time, then reset all modules
         self.systimeReset()
-        for key, module in self.modules.items():
+        for key, module in list(self.modules.items()):
             logger.debug("reset: Resetting %s...", key)
             module.reset(self)
 
+        # The system tick count has been reset, move to the next IO epoch
+        self._io_epoch += 1
+        if self._io_replayer is not None:
+            self._updateIOReplayNext()
+
         # Start the core emulator time now
         self.resume_time()
 
@@ -706,7 +809,101 @@ class PPC_e200z7(mmio.ComplexMemoryMap, vimp_emu.WorkspaceEmulator,
         if perm & e_mem.MM_READ_WRITE:
             self.clearOpcache(ea, len(bytez))
 
+    def setCycleModel(self, model):
+        '''
+        Change the instruction timing model used to determine how many system
+        clock cycles each executed instruction takes.  Because the number of
+        cycles is cached with each decoded instruction the opcache is cleared.
+        '''
+        logger.debug('Setting instruction cycle model: %r', model)
+        self._cycle_model = model
+        for cache in self.opcache:
+            cache.clear()
+
+    def getCycleModel(self):
+        return self._cycle_model
+
+    def setInstructionStore(self, store):
+        '''
+        Set the InstructionStore used to populate the opcache, if the store has
+        saved instructions they are loaded now.
+        '''
+        if store is not None:
+            store.load()
+        self.instr_store = store
+
+    def startPredecode(self, ranges, workers=None, region_size=predecode.DEFAULT_REGION_SIZE):
+        '''
+        Start decoding the instructions in a list of (start, end) physical
+        address ranges in worker processes.  Each region is decoded as full
+        PPC or VLE instructions based on the current instruction TLB entries,
+        regions that are not identity mapped by the TLB or are erased are
+        skipped.  The decoded instructions are added to the opcache the first
+        time an instruction is not found in the opcache after decoding is
+        complete.
+        '''
+        if self._predecoder is not None:
+            self._predecoder.stop()
+            self._predecoder = None
+
+        regions = []
+        for start, end in ranges:
+            for addr in range(start, end, region_size):
+                size = min(region_size, end - addr)
+
+                ts, pid, entry = self.mmu.getInstrEntry(addr)
+                if entry is None or (entry.rpn | (addr & ~entry.mask)) != addr or \
+                        ((addr + size - 1) & entry.mask) != (addr & entry.mask):
+                    continue
+
+                off, b = mmio.ComplexMemoryMap.getByteDef(self, addr)
+                data = bytes(b[off:off+size])
+                if data.count(b'\xff') == len(data):
+                    continue
+
+                regions.append((addr, entry.vle, data))
+
+        if regions:
+            self._predecoder = predecode.Predecoder(workers)
+            self._predecoder.start(regions)
+
+    def _mergePredecoded(self, wait=False):
+        '''
+        Add the instructions decoded by the predecoder to the opcache (and the
+        instruction store) if decoding is complete. Regions that have been
+        modified since decoding was started are ignored.
+        '''
+        results = self._predecoder.results(wait)
+        if results is None:
+            return
+        self._predecoder = None
+
+        count = 0
+        for start, vle, data, ops in results:
+            off, b = mmio.ComplexMemoryMap.getByteDef(self, start)
+            if b[off:off+len(data)] != data:
+                logger.debug('Ignoring decoded instructions for modified region 0x%08x', start)
+                continue
+
+            cache = self.opcache[vle]
+            for ea, op in ops:
+                if ea in cache:
+                    continue
+
+                op.cycles = self._cycle_model.getCycles(op)
+                cache[ea] = op
+                count += 1
+
+                if self.instr_store is not None:
+                    idx = ea - start
+                    self.instr_store.add(ea, vle, ea, data[idx:idx+op.size], op)
+
+        logger.debug('Added %d decoded instructions to the opcache', count)
+
     def updateOpcache(self, ea, vle, op):
+        # Save the number of cycles this instruction takes to execute with
+        # the decoded instruction
+        op.cycles = self._cycle_model.getCycles(op)
         self.opcache[vle][ea] = op
 
     def clearOpcache(self, ea, size):
@@ -740,6 +937,17 @@ class PPC_e200z7(mmio.ComplexMemoryMap, vimp_emu.WorkspaceEmulator,
         #
         # statement in the first loop below.
 
+        # For large ranges (such as when RAM is cleared during reset) it is
+        # much faster to scan the cached instructions than it is to check every
+        # address in the modified range.
+        if size > len(self.opcache[0]) + len(self.opcache[1]):
+            start = ea - 16
+            end = ea + size
+            for cache in self.opcache:
+                for addr in [a for a in cache if start <= a < end]:
+                    del cache[addr]
+            return
+
         # Go backwards the max expected max instruction size and delete any 
         # cached instructions if they overlap the modified memory area.
         for addr in range(ea - 1, ea - 16, -1):
@@ -759,6 +967,46 @@ class PPC_e200z7(mmio.ComplexMemoryMap, vimp_emu.WorkspaceEmulator,
             if addr in self.opcache[1]:
                 del self.opcache[1][addr]
 
+    def clearMemory(self, ea, size):
+        """
+        Reset fast path to zero a range of physical memory.  Unlike
+        writeMemory() this does not do MMU translation or check for write
+        callbacks, the backing memory is cleared in place and any cached
+        instructions in the range are removed.
+        """
+        mmio.ComplexMemoryMap.clearMemory(self, ea, size)
+        self.clearOpcache(ea, size)
+
+    def getMemoryBuffer(self, va, size, write=False):
+        """
+        Fast path for bus masters (such as the eDMA) that copy large blocks of
+        memory. Translates the virtual address range and returns a tuple of
+        the physical address, the offset, and the backing buffer that contains
+        the entire range (see ComplexMemoryMap.getMemoryBuffer()).
+
+        If the range can't be accessed directly because it is not mapped to a
+        single contiguous physical range, it is not in a normal memory region,
+        or read or write callbacks are installed for the range (None, None,
+        None) is returned and the normal readMemory() or writeMemory()
+        functions must be used.
+        """
+        if size <= 0 or not self.isValidPointer(va) or \
+                not self.isValidPointer(va + size - 1):
+            return None, None, None
+
+        ea = self.mmu.translateDataAddr(va)
+        if self.mmu.translateDataAddr(va + size - 1) != ea + size - 1:
+            return None, None, None
+
+        callbacks = self._write_callbacks if write else self._read_callbacks
+        if any(s < ea + size and ea < e for s, e, _ in callbacks.values()):
+            return None, None, None
+
+        offset, mbytes = mmio.ComplexMemoryMap.getMemoryBuffer(self, ea, size, write)
+        if mbytes is None:
+            return None, None, None
+        return ea, offset, mbytes
+
     def getByteDef(self, va):
         ea = self.mmu.translateDataAddr(va)
         return mmio.ComplexMemoryMap.getByteDef(self, ea)
@@ -798,19 +1046,71 @@ class PPC_e200z7(mmio.ComplexMemoryMap, vimp_emu.WorkspaceEmulator,
         else:
             return sprobj.write(self, value)
 
-    def putIO(self, devname, obj):
+    def putIO(self, devname, obj, block=True):
         """
         enqueue new IO data to be processed by a peripheral
         """
-        self.external_io.put_nowait((devname, obj))
+        # When replaying recorded IO all messages come from the IO log
+        if self._io_replayer is not None:
+            logger.log(MIRE, 'replay: ignoring IO for %s: %r', devname, obj)
+            return
+
+        # When re-executing previously executed instructions the IO comes from
+        # the checkpoint IO history
+        if self.checkpoints is not None and self.checkpoints.replaying():
+            logger.log(MIRE, 'history: ignoring IO for %s: %r', devname, obj)
+            return
+
+        # If the peripheral's queue is full and the queue policy is "block"
+        # this waits until the emulator processes queued messages (unless this
+        # is called by the emulator thread or block is False)
+        self.external_io.put((devname, obj), block=block)
+
+        # If the emulator is sleeping to keep pace with the wall clock wake it
+        # up so the new data is processed
+        self.paceWakeup()
+
+    def _ioFlowControl(self, devname, paused):
+        module = self.modules.get(devname)
+        if module is not None and hasattr(module, 'setFlowControl'):
+            module.setFlowControl(paused)
+
+    def getIOQueueStats(self, devname=None):
+        '''
+        Return the external IO queue statistics of a peripheral, or of all
+        peripherals if devname is None. See ExternalIOQueue.getStats() for
+        details.
+        '''
+        return self.external_io.getStats(devname)
+
+    def resetIOQueueStats(self):
+        self.external_io.resetStats()
 
     def processIO(self):
         """
         process new IO data
         """
+        # Deliver any recorded IO messages that are due. The EmuTimeCore tick
+        # count is checked directly because this happens every instruction.
+        if self._io_replay_next is not None and self._ticks >= self._io_replay_next:
+            self._replayIO()
+
+        # Move any messages received by the IO frontend into the external IO
+        # queue
+        if self._io_frontend is not None:
+            self._io_poll_count -= 1
+            if self._io_poll_count <= 0:
+                self._io_poll_count = self._io_frontend.poll_interval
+                self._io_frontend.poll()
+
         try:
             while True:
                 devname, obj = self.external_io.get_nowait()
+                if self._io_recorder is not None:
+                    self._io_recorder.record(self._io_epoch, self._ticks, devname, obj)
+                if self._io_history is not None:
+                    self._io_history.append((self._step_count, devname, obj))
+
                 # TODO: may be a faster way to do this than with string/hash
                 # lookups
                 #logger.debug('processing %s:%r', devname, obj)
@@ -818,27 +1118,209 @@ class PPC_e200z7(mmio.ComplexMemoryMap, vimp_emu.WorkspaceEmulator,
         except queue.Empty:
             pass
 
-        # Only do one extra processing function call per tick.  If this
+        # Only do one extra processing function call per tick (unless the
+        # function has a budget that allows it to do more work).  If this
         # function needs to be run in future cycles it should requeue
         # itself.
-        with self.extra_processing_lock:
-            try:
-                self.extra_processing.pop(0)()
-            except IndexError:
-                pass
+        self.deferred_work.run()
+
+    def startIORecord(self, filename):
+        '''
+        Record every IO message delivered to a peripheral, along with the
+        emulated time it was delivered, to the specified file.  The file can be
+        used with startIOReplay() to deterministically re-run the same
+        sequence of IO without any external IO clients.
+        '''
+        if self._io_replayer is not None:
+            raise RuntimeError('Cannot record IO while replaying IO from %s' % self._io_replayer.filename)
+
+        self.stopIORecord()
+        logger.info('Recording IO to %s', filename)
+        self._io_recorder = iolog.IORecorder(filename)
+
+        # IO epochs are counted from when recording starts
+        self._io_epoch = 0
+
+    def stopIORecord(self):
+        if self._io_recorder is not None:
+            self._io_recorder.close()
+            self._io_recorder = None
+
+    def startIOReplay(self, filename):
+        '''
+        Replay the IO messages recorded with startIORecord().  Each message is
+        delivered at the same emulated time it was originally delivered, while
+        replaying IO any new IO messages sent to the emulator are ignored.
+
+        Replay must be started at the same point in the emulator lifecycle
+        that recording was started for the message timing to match.
+        '''
+        if self._io_recorder is not None:
+            raise RuntimeError('Cannot replay IO while recording IO to %s' % self._io_recorder.filename)
+
+        self.stopIOReplay()
+        logger.info('Replaying IO from %s', filename)
+        self._io_replayer = iolog.IOReplayer(filename)
+
+        # IO epochs are counted from when replay starts
+        self._io_epoch = 0
+        self._updateIOReplayNext()
+
+    def stopIOReplay(self):
+        if self._io_replayer is not None:
+            self._io_replayer.close()
+            self._io_replayer = None
+        self._io_replay_next = None
+
+    def ioReplayEnabled(self):
+        return self._io_replayer is not None
+
+    def _updateIOReplayNext(self):
+        rec = self._io_replayer.next
+        if rec is None:
+            self._io_replay_next = None
+        elif rec[0] == self._io_epoch:
+            self._io_replay_next = rec[1]
+        elif rec[0] < self._io_epoch:
+            # This message should have been delivered before the last reset,
+            # deliver it now.
+            logger.warning('replay: late IO message for %s (epoch %d, tick %d)',
+                           rec[2], rec[0], rec[1])
+            self._io_replay_next = 0
+        else:
+            # Wait until the processor is reset
+            self._io_replay_next = None
+
+    def _replayIO(self):
+        while self._io_replay_next is not None and self._ticks >= self._io_replay_next:
+            _, _, devname, obj = self._io_replayer.pop()
+            self.modules[devname].processReceivedData(obj)
+            self._updateIOReplayNext()
+
+    def getEmuSnap(self):
+        '''
+        Return a snapshot of the complete state of the emulated system:
+        registers, memory, system time and timers, and the state of all
+        peripherals.  The snapshot can be restored with setEmuSnap().
+        '''
+        modules = {}
+        for name, module in list(self.modules.items()):
+            if isVstructType(module):
+                modules[name] = vsGetSnap(module)
+            else:
+                modules[name] = module.getSnap()
+
+        extra = self.deferred_work.getSnap()
+
+        return {
+            'regs': self.getRegisterSnap(),
+            'mem': self.getMemorySnap(),
+            'time': self.getTimeSnap(),
+            'modules': modules,
+            'sprs': dict((reg, vsGetSnap(spr)) for reg, spr in self.sprs.items()
+                         if isVstructType(spr)),
+            'core': (self._cur_instr, extra, self._step_count, self._io_epoch),
+        }
+
+    def setEmuSnap(self, snap):
+        '''
+        Restore the state of the emulated system saved with getEmuSnap().
+        '''
+        self.setRegisterSnap(snap['regs'])
+        self.setMemorySnap(snap['mem'])
+        self.setTimeSnap(snap['time'])
+
+        for name, msnap in snap['modules'].items():
+            module = self.modules[name]
+            if isVstructType(module):
+                vsSetSnap(module, msnap)
+            elif msnap is None:
+                # Modules that had not been constructed when the snapshot was
+                # taken (see LazyPeripheral) were in their reset state
+                module.reset(self)
+            else:
+                module.setSnap(msnap)
+
+        for reg, spr_snap in snap['sprs'].items():
+            vsSetSnap(self.sprs[reg], spr_snap)
+
+        self._cur_instr, extra, self._step_count, self._io_epoch = snap['core']
+        self.deferred_work.setSnap(extra)
+
+        # Memory may have changed so any decoded instructions must be discarded
+        for cache in self.opcache:
+            cache.clear()
+
+    def getStepCount(self):
+        return self._step_count
+
+    def enableCheckpoints(self, interval=checkpoints.DEFAULT_INTERVAL,
+                          max_memory=checkpoints.DEFAULT_MAX_MEMORY,
+                          max_latency=checkpoints.DEFAULT_MAX_LATENCY):
+        '''
+        Start saving periodic checkpoints of the emulator state, along with the
+        history of IO delivered to peripherals, so that execution can be
+        reversed by the debugger.  See checkpoints.CheckpointManager for the
+        argument details.
+        '''
+        self.disableCheckpoints()
+        self.checkpoints = checkpoints.CheckpointManager(self, interval, max_memory, max_latency)
+        self._io_history = self.checkpoints.history
+
+        # Save the initial state
+        self.checkpoints.take()
+
+    def disableCheckpoints(self):
+        if self.checkpoints is not None:
+            self.checkpoints.clear()
+            self.checkpoints = None
+        self._step_hook = None
+        self._io_history = None
 
     def addExtraProcessing(self, func):
-        with self.extra_processing_lock:
-            # Don't double-add extra processing functions
-            if func not in self.extra_processing:
-                self.extra_processing.append(func)
+        '''
+        Queue a function to be run before the next instruction is executed,
+        functions that are already queued are not added again.
+        '''
+        self.deferred_work.add(func)
+
+    def configureExtraProcessing(self, func, name=None, priority=workqueue.PRIORITY_NORMAL, budget=None):
+        '''
+        Set the priority and per-step work budget of an extra processing
+        function, see DeferredWorkQueue for details.
+        '''
+        self.deferred_work.configure(func, name, priority, budget)
+
+    def getExtraProcessingStats(self, func=None):
+        return self.deferred_work.getStats(func)
+
+    def resetExtraProcessingStats(self):
+        self.deferred_work.resetStats()
+
+    @property
+    def extra_processing(self):
+        '''
+        The list of queued extra processing functions in the order they will
+        be run.
+        '''
+        return self.deferred_work.pending()
+
+    @extra_processing.setter
+    def extra_processing(self, funcs):
+        self.deferred_work.clear()
+        for func in funcs:
+            self.deferred_work.add(func)
 
     def stepi(self):
         """
         First see if there are any incoming messages that need to be processed
         into their corresponding peripheral registers
         """
+        if self._step_hook is not None and self._step_count >= self._step_hook:
+            self.checkpoints.stepHook()
+
         self.processIO()
+        self._step_count += 1
 
         try:
             # See if there are any exceptions that need to start being handled
@@ -852,17 +1334,19 @@ class PPC_e200z7(mmio.ComplexMemoryMap, vimp_emu.WorkspaceEmulator,
             # support here?
             self.executeOpcode(op)
 
-            # Increment the tick counter
-            self.tick()
+            # Move system time forward by the number of cycles this
+            # instruction takes
+            self.tick(op.cycles)
 
         except intc_exc.ResetException as exc:
             # Reset the entire CPU
             self.reset()
 
             # If any peripherals have registered a "setResetSource" function 
-            # call it now.
-            for key, module in self.modules.items():
-                if hasattr(module, 'setResetSource'):
+            # call it now. Check the module class so peripherals that have not
+            # been constructed yet (see LazyPeripheral) are left alone.
+            for key, module in list(self.modules.items()):
+                if hasattr(type(module), 'setResetSource'):
                     logger.debug("system reset: setting reset source %s in %s", exc.source, key)
                     module.setResetSource(exc.source)
 
@@ -882,6 +1366,9 @@ class PPC_e200z7(mmio.ComplexMemoryMap, vimp_emu.WorkspaceEmulator,
             #       handling is set this instruction generates a debug 
             #       exception, otherwise it is a no-op.
 
+            # Halting in the debugger is not an executed instruction
+            self._step_count -= 1
+
             # Pass this to the GDB stub (the emulator equivalent of the Debug 
             # APU) for processing.
             self.gdbstub.handleInterrupts(exc)
@@ -979,12 +1466,23 @@ class PPC_e200z7(mmio.ComplexMemoryMap, vimp_emu.WorkspaceEmulator,
         else:
             op = self.opcache[vle].get(ea)
 
+            if op is None and self._predecoder is not None:
+                self._mergePredecoded()
+                op = self.opcache[vle].get(ea)
+
         if op is None:
             off, b = mmio.ComplexMemoryMap.getByteDef(self, ea)
-            if vle:
-                op = self._arch_vle_dis.disasm(b, off, va)
-            else:
-                op = self._arch_dis.disasm(b, off, va)
+            if self.instr_store is not None and not skipcache:
+                op = self.instr_store.get(ea, vle, va, b, off)
+
+            if op is None:
+                if vle:
+                    op = self._arch_vle_dis.disasm(b, off, va)
+                else:
+                    op = self._arch_dis.disasm(b, off, va)
+
+                if self.instr_store is not None:
+                    self.instr_store.add(ea, vle, va, b[off:off+op.size], op)
 
             self.updateOpcache(ea, vle, op)
 
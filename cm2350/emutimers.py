@@ -197,6 +197,20 @@ class EmuTimer:
         # updated
         self._emutime.timerUpdated()
 
+    def getSnap(self):
+        '''
+        Return the current timer configuration and state
+        '''
+        return (getattr(self, 'freq', None), self._freq, self._timerfreq_to_sysfreq,
+                self._ticks, self._duration, self.target, self._remaining)
+
+    def setSnap(self, snap):
+        '''
+        Restore the timer configuration and state saved with getSnap()
+        '''
+        self.freq, self._freq, self._timerfreq_to_sysfreq, self._ticks, \
+                self._duration, self.target, self._remaining = snap
+
     def time(self):
         '''
         Return the amount of seconds remaining before this timer should expire
@@ -272,6 +286,22 @@ class EmuTimeCore:
 
         self._running = False
 
+        # Real-time pacing is disabled by default. When enabled the system
+        # time is allowed to run ahead of the wall clock by at most _pace_lead
+        # seconds before the emulator sleeps to let the wall clock catch up.
+        # The pacing check is only done when the system ticks reach
+        # _pace_next so the cost of pacing is very small when it is disabled.
+        self._pacing = False
+        self._pace_scaling = 1.0
+        self._pace_lead = None
+        self._pace_burst = None
+        self._pace_next = None
+        self._pace_start_ticks = None
+        self._pace_start_wall = None
+        self._pace_last_wall = None
+        self._pace_wakeup = threading.Event()
+        self._pace_stats = None
+
     def shutdown(self):
         # Stop all the timers, probably not necessary
         if hasattr(self, '_timers'):
@@ -292,9 +322,17 @@ class EmuTimeCore:
 
         self.timerUpdated()
 
+        # The system ticks have been reset so the pacing reference point must
+        # be updated
+        self._paceAnchor()
+
     def setSystemFreq(self, freq):
         self._systemFreq = float(freq)
 
+        # The number of ticks per second has changed, so restart the pacing
+        # reference point from the current time
+        self._paceAnchor()
+
     def getSystemFreq(self):
         if self._systemFreq is None:
             return 0.0
@@ -319,6 +357,29 @@ class EmuTimeCore:
         '''
         self._timers.sort()
 
+    def getTimeSnap(self):
+        '''
+        Return the current system time and the state of all registered timers
+        so they can be restored later with setTimeSnap().
+        '''
+        return (self._ticks, self._systemFreq,
+                tuple((t, t.getSnap()) for t in self._timers))
+
+    def setTimeSnap(self, snap):
+        '''
+        Restore the system time and timer states saved with getTimeSnap().
+        '''
+        self._ticks, self._systemFreq, timers = snap
+        for timer, tsnap in timers:
+            timer.setSnap(tsnap)
+
+        # Restore the timer order as well
+        self._timers = [t for t, _ in timers]
+
+        # The system ticks have changed so the pacing reference point must be
+        # updated
+        self._paceAnchor()
+
     def _handle_expired(self, expired_timer):
         '''
         Call the timer's callback handler
@@ -367,13 +428,147 @@ class EmuTimeCore:
 
     def resume_time(self):
         self._running = True
+        self._paceAnchor()
 
     def halt_time(self):
         self._running = False
 
+        # Don't pace the emulator while time is halted (such as when a debugger
+        # is single stepping), pacing will restart when time is resumed.
+        self._pace_next = None
+
     def systimeRunning(self):
         return self._running
 
+    def enablePacing(self, scaling=1.0, max_lead=0.01):
+        '''
+        Enable real-time pacing. The emulator runs as fast as possible in
+        bursts of max_lead seconds of emulated time, after each burst if the
+        emulated time is ahead of the wall clock the emulator sleeps until the
+        wall clock catches up.  External IO can wake the emulator early by
+        calling paceWakeup().
+
+        Arguments:
+            scaling     (optional) Default is 1.0 which means that emulated
+                        time should track the wall clock. If emulated time
+                        should move slower than the wall clock a lower value
+                        should be used.
+            max_lead    (optional) The maximum amount of emulated time (in
+                        seconds) the emulator is allowed to run ahead of the
+                        wall clock.
+        '''
+        if scaling <= 0 or max_lead <= 0:
+            raise ValueError('Invalid pacing configuration: scaling=%s, max_lead=%s' % (scaling, max_lead))
+
+        self._pacing = True
+        self._pace_scaling = scaling
+        self._pace_lead = max_lead
+        self.resetPacingStats()
+        self._paceAnchor()
+
+    def disablePacing(self):
+        self._pacing = False
+        self._pace_next = None
+
+    def pacingEnabled(self):
+        return self._pacing
+
+    def paceWakeup(self):
+        '''
+        Wake the emulator early if it is sleeping to let the wall clock catch
+        up, used to ensure that external IO is processed promptly.
+        '''
+        if self._pacing:
+            self._pace_wakeup.set()
+
+    def resetPacingStats(self):
+        self._pace_stats = {
+            'wall_time': 0.0,
+            'sleep_time': 0.0,
+            'behind_time': 0.0,
+            'max_lag': 0.0,
+        }
+
+    def getPacingStats(self):
+        '''
+        Return the drift statistics collected while pacing is enabled:
+            wall_time       Amount of wall clock time spent running paced
+            sleep_time      Amount of time spent waiting for the wall clock
+            behind_time     Amount of time emulated time was behind the wall
+                            clock
+            behind_percent  Percent of time that emulated time was behind the
+                            wall clock
+            max_lag         The largest amount of time that emulated time was
+                            behind the wall clock
+
+        If the behind_percent or max_lag values are large the host is too slow
+        to run the emulated system in real time.
+        '''
+        if self._pace_stats is None:
+            return None
+
+        stats = dict(self._pace_stats)
+        if stats['wall_time']:
+            stats['behind_percent'] = stats['behind_time'] / stats['wall_time'] * 100.0
+        else:
+            stats['behind_percent'] = 0.0
+        return stats
+
+    def _paceAnchor(self):
+        '''
+        Set the reference point used to compare emulated time against the wall
+        clock to the current time and system ticks.
+        '''
+        freq = self.getSystemFreq()
+        if not (self._pacing and self._running and freq):
+            self._pace_next = None
+            return
+
+        now = time.monotonic()
+        self._pace_start_ticks = self._ticks
+        self._pace_start_wall = now
+        self._pace_last_wall = now
+        self._pace_burst = max(1, int(self._pace_lead * freq))
+        self._pace_next = self._ticks + self._pace_burst
+
+    def _pace(self):
+        '''
+        Compare the emulated time to the wall clock time, if the emulator is
+        ahead sleep until the wall clock catches up, if the emulator is behind
+        record how far behind it is.
+        '''
+        now = time.monotonic()
+        emu_elapsed = (self._ticks - self._pace_start_ticks) / self.getSystemFreq()
+        lead = emu_elapsed / self._pace_scaling - (now - self._pace_start_wall)
+
+        stats = self._pace_stats
+        stats['wall_time'] += now - self._pace_last_wall
+
+        woken = False
+        if lead > 0:
+            woken = self._pace_wakeup.wait(lead)
+            if woken:
+                self._pace_wakeup.clear()
+            wake = time.monotonic()
+            stats['sleep_time'] += wake - now
+            stats['wall_time'] += wake - now
+            now = wake
+
+        elif lead < 0:
+            stats['behind_time'] += now - self._pace_last_wall
+            if -lead > stats['max_lag']:
+                stats['max_lag'] = -lead
+
+        self._pace_last_wall = now
+
+        # If the emulator was woken early check again on the next tick so
+        # that the rest of the lead time is still accounted for after the
+        # incoming IO has been processed.
+        if woken:
+            self._pace_next = self._ticks + 1
+        else:
+            self._pace_next = self._ticks + self._pace_burst
+
     def getNextEvent(self):
         '''
         Return the amount of time to wait before the next event should occur
@@ -393,14 +588,24 @@ class EmuTimeCore:
         else:
             return None
 
-    def tick(self):
-        self._ticks += 1
+    def tick(self, cycles=1):
+        '''
+        Move system time forward by the specified number of system clock
+        cycles, by default the core moves time forward by 1 cycle for each
+        instruction executed.
+        '''
+        self._ticks += cycles
 
         # Determine if any timers should expire
         expired_timer = self.getExpiredTimer()
         if expired_timer is not None:
             self._handle_expired(expired_timer)
 
+        # If real-time pacing is enabled check if the emulator is too far
+        # ahead of the wall clock
+        if self._pace_next is not None and self._ticks >= self._pace_next:
+            self._pace()
+
 
 class ScaledEmuTimeCore(EmuTimeCore):
     '''
@@ -526,6 +731,12 @@ class ScaledEmuTimeCore(EmuTimeCore):
         self._breakstart = self._sysoffset
         EmuTimeCore.systimeReset(self)
 
+    def getTimeSnap(self):
+        raise NotImplementedError('%s does not support time snapshots' % self.__class__.__name__)
+
+    def setTimeSnap(self, snap):
+        raise NotImplementedError('%s does not support time snapshots' % self.__class__.__name__)
+
     def getSystemScaling(self):
         '''
         Returns the configured scaling factor for the emulation clock.
@@ -611,8 +822,8 @@ class ScaledEmuTimeCore(EmuTimeCore):
         else:
             return None
 
-    def tick(self):
-        self._ticks += 1
+    def tick(self, cycles=1):
+        self._ticks += cycles
 
     def _tb_run(self):
         '''
@@ -0,0 +1,110 @@
+import os
+import pickle
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__all__ = [
+    'InstructionStore',
+]
+
+
+# Version of the saved instruction store format, saved stores with a different
+# version are ignored.
+STORE_VERSION = 1
+
+
+class InstructionStore:
+    '''
+    Decoded instructions saved between emulator runs so the opcache can be
+    populated without calling the disassembler.
+
+    Instructions are indexed by physical address and whether they are VLE
+    instructions, the same as the opcache.  Each instruction is saved with the
+    virtual address it was decoded at and its instruction bytes, a saved
+    instruction is only used if it was decoded at the same virtual address and
+    the bytes in memory have not changed.  Only instructions in the address
+    ranges the store was created with (such as flash) are saved.
+    '''
+    def __init__(self, filename, ranges):
+        self.filename = filename
+        self.ranges = tuple(ranges)
+
+        # Dictionaries of physical address -> (va, instruction bytes, opcode)
+        # for full PPC and VLE instructions
+        self._instrs = ({}, {})
+        self._modified = False
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._instrs[0]) + len(self._instrs[1])
+
+    def contains(self, ea):
+        for start, end in self.ranges:
+            if start <= ea < end:
+                return True
+        return False
+
+    def load(self):
+        '''
+        Load the saved instructions, returns True if the saved instructions
+        were loaded.
+        '''
+        try:
+            with open(self.filename, 'rb') as f:
+                version, instrs = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as exc:
+            logger.warning('Unable to load instruction store %s: %s', self.filename, exc)
+            return False
+
+        if version != STORE_VERSION:
+            logger.debug('Ignoring instruction store %s version %s', self.filename, version)
+            return False
+
+        self._instrs = instrs
+        self._modified = False
+        logger.debug('Loaded %d instructions from %s', len(self), self.filename)
+        return True
+
+    def save(self):
+        '''
+        Save the instructions if any have been added since the store was
+        loaded, errors writing the file are ignored.
+        '''
+        if not self._modified:
+            return
+
+        tmp_filename = self.filename + '.tmp'
+        try:
+            with open(tmp_filename, 'wb') as f:
+                pickle.dump((STORE_VERSION, self._instrs), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_filename, self.filename)
+            self._modified = False
+            logger.debug('Saved %d instructions to %s', len(self), self.filename)
+        except Exception as exc:
+            logger.warning('Unable to save instruction store %s: %s', self.filename, exc)
+
+    def get(self, ea, vle, va, bytez, offset):
+        '''
+        Return the saved instruction at a physical address if it was decoded
+        at the same virtual address from the same bytes, otherwise None.
+        '''
+        entry = self._instrs[vle].get(ea)
+        if entry is not None:
+            saved_va, instrbytes, op = entry
+            if saved_va == va and bytez[offset:offset+len(instrbytes)] == instrbytes:
+                self.hits += 1
+                return op
+
+        self.misses += 1
+        return None
+
+    def add(self, ea, vle, va, instrbytes, op):
+        if self.contains(ea):
+            self._instrs[vle][ea] = (va, bytes(instrbytes), op)
+            self._modified = True
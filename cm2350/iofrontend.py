@@ -0,0 +1,530 @@
+import os
+import socket
+import struct
+import selectors
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+
+from . import ioproto
+from . import iohub
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__all__ = [
+    'ShmRing',
+    'IOFrontend',
+]
+
+
+# Default size (in bytes) of the data area of each ring buffer
+DEFAULT_RING_SIZE = 0x100000
+
+# Default number of instructions executed between checks of the receive ring
+DEFAULT_POLL_INTERVAL = 1000
+
+# How long the frontend process waits for client data before checking the
+# transmit ring again
+FRONTEND_POLL_TIME = 0.0005
+
+# Ring buffer layout: the producer index, consumer index and flags are each
+# placed in a separate cache line, followed by the data area. The indexes are
+# free-running byte counts, each record in the data area is a 4-byte length
+# followed by the record data.
+RING_HEAD = 0
+RING_TAIL = 8
+RING_FLAGS = 16
+RING_DATA_OFF = 192
+RING_REC_LEN = struct.Struct('<I')
+
+# A record length that indicates the rest of the data area is unused and the
+# next record starts at the beginning of the data area
+RING_WRAP = 0xFFFFFFFF
+
+# Ring flags
+RING_FLAG_CLOSED = 0x1
+
+
+class ShmRing:
+    '''
+    A single-producer/single-consumer ring buffer of variable-length records
+    in a multiprocessing.shared_memory segment.
+
+    No locks are used, the producer only updates the head index after a
+    record has been completely written and the consumer only updates the tail
+    index after a record has been completely read. The indexes are accessed
+    as aligned 64-bit values so checking if the ring has data to read does not
+    require any system calls.
+    '''
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.name = shm.name
+        self.owner = owner
+        self.size = shm.size - RING_DATA_OFF
+
+        # Records must be small enough that a record that wraps around to the
+        # start of the data area always fits
+        self.max_record = self.size // 2 - RING_REC_LEN.size
+
+        # Index values are accessed through a uint64 view so each access is a
+        # single load or store
+        self._idx = shm.buf[:RING_DATA_OFF].cast('Q')
+        self._data = shm.buf[RING_DATA_OFF:]
+
+    @classmethod
+    def create(cls, size=DEFAULT_RING_SIZE):
+        shm = shared_memory.SharedMemory(create=True, size=RING_DATA_OFF + size)
+        shm.buf[:RING_DATA_OFF] = bytes(RING_DATA_OFF)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before python 3.13 attached segments are always registered with
+            # the resource tracker, the frontend process shares the tracker of
+            # the emulator process that created the segment so this is only
+            # a duplicate registration.
+            shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, owner=False)
+
+    def close(self):
+        if self.shm is None:
+            return
+
+        self._idx.release()
+        self._data.release()
+        self._idx = None
+        self._data = None
+
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+        self.shm = None
+
+    def pending(self):
+        '''
+        Returns True if there are records available to read
+        '''
+        idx = self._idx
+        return idx[RING_HEAD // 8] != idx[RING_TAIL // 8]
+
+    def isClosed(self):
+        return bool(self._idx[RING_FLAGS // 8] & RING_FLAG_CLOSED)
+
+    def setClosed(self):
+        self._idx[RING_FLAGS // 8] |= RING_FLAG_CLOSED
+
+    def put(self, data):
+        '''
+        Write a record to the ring, returns False if there is not enough free
+        space for the record.
+        '''
+        if len(data) > self.max_record:
+            raise ValueError('Cannot write %d byte record to %d byte ring' % (len(data), self.size))
+
+        need = RING_REC_LEN.size + len(data)
+        idx = self._idx
+        head = idx[RING_HEAD // 8]
+        free = self.size - (head - idx[RING_TAIL // 8])
+
+        pos = head % self.size
+        to_end = self.size - pos
+        if to_end < need:
+            # The record doesn't fit in the rest of the data area, skip to the
+            # start
+            if free < to_end + need:
+                return False
+            if to_end >= RING_REC_LEN.size:
+                RING_REC_LEN.pack_into(self._data, pos, RING_WRAP)
+            head += to_end
+            pos = 0
+        elif free < need:
+            return False
+
+        RING_REC_LEN.pack_into(self._data, pos, len(data))
+        self._data[pos+RING_REC_LEN.size:pos+need] = data
+        idx[RING_HEAD // 8] = head + need
+        return True
+
+    def get(self):
+        '''
+        Read the next record from the ring, returns None if the ring is empty
+        '''
+        idx = self._idx
+        tail = idx[RING_TAIL // 8]
+        if tail == idx[RING_HEAD // 8]:
+            return None
+
+        pos = tail % self.size
+        to_end = self.size - pos
+        if to_end < RING_REC_LEN.size or \
+                RING_REC_LEN.unpack_from(self._data, pos)[0] == RING_WRAP:
+            tail += to_end
+            pos = 0
+
+        size = RING_REC_LEN.unpack_from(self._data, pos)[0]
+        start = pos + RING_REC_LEN.size
+        data = bytes(self._data[start:start+size])
+        idx[RING_TAIL // 8] = tail + RING_REC_LEN.size + size
+        return data
+
+
+class IOFrontend:
+    '''
+    An alternative to the IOHub where all server and client sockets are owned
+    by a separate process so socket IO does not compete with the emulator for
+    the GIL.
+
+    Messages are exchanged with the frontend process through two ShmRing
+    buffers, each record is a 1-byte peripheral ID followed by a message
+    payload.  The emulator checks the receive ring from processIO() every
+    poll_interval instructions, transmitted messages are written directly to
+    the transmit ring.
+
+    The emulator never waits for a full peripheral queue, instead it stops
+    reading from the receive ring until the emulator has processed enough
+    messages that there is space again.  Once the receive ring is full the
+    frontend process stops reading from its clients.
+
+    The frontend process is started once all peripherals have added their
+    servers during emulator initialization.  In-process client connections
+    created with connectPair() are passed to the frontend process over a
+    control socket.
+    '''
+    def __init__(self, ring_size=DEFAULT_RING_SIZE, poll_interval=DEFAULT_POLL_INTERVAL):
+        if poll_interval < 1:
+            raise ValueError('Invalid IO frontend poll interval: %s' % poll_interval)
+
+        self.poll_interval = poll_interval
+        self._rx = ShmRing.create(ring_size)
+        self._tx = ShmRing.create(ring_size)
+        self._proc = None
+
+        # Used to pass in-process client connections to the frontend process
+        self._ctrl, self._ctrl_child = socket.socketpair()
+
+        self._periphs = {}
+        self._servers = []
+
+        # Number of transmitted messages dropped because the transmit ring was
+        # full
+        self.tx_dropped = 0
+
+        # Set when the receive ring is not being read because a peripheral
+        # queue is full
+        self._paused = False
+
+    def register(self, periph):
+        '''
+        Register a peripheral with the frontend, returns the peripheral ID. If
+        the peripheral is already registered its existing ID is returned.
+        '''
+        for io_id, registered in self._periphs.items():
+            if registered is periph:
+                return io_id
+
+        io_id = len(self._periphs) + 1
+        if io_id > 0xFF:
+            raise ValueError('Cannot register %s: too many IO peripherals' % periph.devname)
+        self._periphs[io_id] = periph
+        return io_id
+
+    def addServer(self, periph, addr):
+        '''
+        Add a server that the frontend process creates when it starts, see
+        IOHub.addServer() for the address format.
+        '''
+        if self._proc is not None:
+            raise RuntimeError('Cannot add server for %s: IO frontend already started' % periph.devname)
+
+        logger.debug('IO frontend will listen on %r for IO module %s', addr, periph.devname)
+        self._servers.append((periph.io_id, addr, periph.batchTransmitData()))
+
+    def connectPair(self, periph):
+        '''
+        Create an in-process client connection to the peripheral, returns the
+        client end of the connection.  The other end of the connection is
+        serviced by the frontend process the same as clients that connect to
+        a peripheral server.
+        '''
+        if self._proc is None:
+            self._startProcess()
+
+        client_sock, frontend_sock = socket.socketpair()
+        try:
+            info = bytes((periph.io_id, periph.batchTransmitData()))
+            socket.send_fds(self._ctrl, [info], [frontend_sock.fileno()])
+        finally:
+            frontend_sock.close()
+        return client_sock
+
+    def send(self, periph, data):
+        '''
+        Write encoded data to be sent to all clients of a peripheral to the
+        transmit ring.
+        '''
+        if not self._tx.put(bytes((periph.io_id,)) + data):
+            self.tx_dropped += 1
+            logger.log(logging.WARNING if self.tx_dropped == 1 else logging.DEBUG,
+                       '%s: IO frontend transmit ring full, message dropped', periph.devname)
+
+    def poll(self):
+        '''
+        Deliver the messages in the receive ring to their peripherals.  If a
+        peripheral queue becomes full the remaining messages are left in the
+        ring until there is space in the queue.
+        '''
+        rx = self._rx
+        while not self._paused and rx.pending():
+            data = rx.get()
+            periph = self._periphs.get(data[0])
+            if periph is None:
+                logger.warning('IO frontend: message for unknown peripheral ID %d', data[0])
+                continue
+
+            try:
+                targets = iohub.deliverRecords(self._periphs, periph, data[1:], block=False)
+            except ioproto.IOProtocolError as exc:
+                logger.warning('%s: invalid message from IO frontend client: %s',
+                               periph.devname, exc)
+                continue
+
+            # The emulator thread resumes reading the ring once the queue has
+            # space
+            for target in targets:
+                if not target.notifyWhenReady(self._resume):
+                    logger.debug('%s: IO queue full, pausing IO frontend', target.devname)
+                    self._paused = True
+                    break
+
+    def _resume(self):
+        self._paused = False
+
+    def isRunning(self):
+        return self._proc is not None
+
+    def start(self):
+        if self._proc is None and self._servers:
+            self._startProcess()
+
+    def _startProcess(self):
+        # Use the spawn method so the frontend doesn't inherit the emulator's
+        # threads or state
+        ctx = multiprocessing.get_context('spawn')
+        self._proc = ctx.Process(name='IO-frontend', target=_frontendMain,
+                                 args=(self._rx.name, self._tx.name, self._servers,
+                                       os.getpid(), self._ctrl_child),
+                                 daemon=True)
+        self._proc.start()
+
+    def shutdown(self):
+        if self._proc is not None:
+            self._tx.setClosed()
+            self._proc.join(1)
+            if self._proc.is_alive():
+                logger.error('Failed to stop IO frontend process')
+                self._proc.terminate()
+            self._proc = None
+
+        if self._rx is not None:
+            self._rx.close()
+            self._tx.close()
+            self._rx = None
+            self._tx = None
+            self._ctrl.close()
+            self._ctrl_child.close()
+
+        for io_id, addr, _ in self._servers:
+            if isinstance(addr, str):
+                try:
+                    os.unlink(addr)
+                except OSError:
+                    pass
+        self._servers = []
+
+
+class IOFrontendProcess:
+    '''
+    The socket handling half of the IOFrontend that runs in the frontend
+    process.  Client messages are not decoded, they are forwarded to the
+    emulator with the ID of the peripheral server they were received on.
+
+    Client sockets are non-blocking, data that a client is not ready to
+    receive is kept in a per-client buffer and sent when the socket becomes
+    writable so a slow client does not hold up the other clients or stop the
+    transmit ring from being read.
+    '''
+    def __init__(self, rx_name, tx_name, servers, parent_pid, ctrl):
+        # The receive ring of the emulator is the transmit ring of the
+        # frontend and vice versa
+        self._tx = ShmRing.attach(rx_name)
+        self._rx = ShmRing.attach(tx_name)
+        self._parent_pid = parent_pid
+
+        self._sel = selectors.DefaultSelector()
+        self._clients = collections.defaultdict(list)
+        self._batch = {}
+        for io_id, addr, batch in servers:
+            sock = iohub.createServer(addr)
+            self._sel.register(sock, selectors.EVENT_READ, io_id)
+            self._batch[io_id] = batch
+
+        # In-process client connections are received on the control socket
+        self._ctrl = ctrl
+        self._sel.register(ctrl, selectors.EVENT_READ, None)
+
+        # Messages waiting for space in the ring, client sockets are not read
+        # while there are pending messages so backpressure is applied to the
+        # clients instead of dropping messages.
+        self._pending = collections.deque()
+        self._paused = False
+
+    def run(self):
+        while not self._rx.isClosed() and os.getppid() == self._parent_pid:
+            self._forwardPending()
+
+            timeout = 0 if self._rx.pending() else FRONTEND_POLL_TIME
+            for key, events in self._sel.select(timeout):
+                if key.data is None:
+                    self._handleControl()
+                elif isinstance(key.data, iohub.IOHubClient):
+                    client = key.data
+                    if events & selectors.EVENT_READ:
+                        self._handleClient(client)
+                    if events & selectors.EVENT_WRITE and self._isConnected(client):
+                        self._sendClient(client)
+                else:
+                    self._accept(key)
+
+            self._handleTransmit()
+
+        self._rx.close()
+        self._tx.close()
+
+    def _forwardPending(self):
+        pending = self._pending
+        while pending and self._tx.put(pending[0]):
+            pending.popleft()
+
+        # Stop reading from the clients while messages are waiting for space
+        # in the ring, and start again once they have all been forwarded
+        paused = bool(pending)
+        if paused != self._paused:
+            self._paused = paused
+            for clients in self._clients.values():
+                for client in clients:
+                    client.paused = paused
+                    self._updateEvents(client)
+
+    def _accept(self, key):
+        try:
+            sock, _ = key.fileobj.accept()
+        except BlockingIOError:
+            return
+        self._addClient(key.data, sock)
+
+    def _addClient(self, io_id, sock):
+        sock.setblocking(False)
+        client = iohub.IOHubClient(io_id, sock)
+        client.paused = self._paused
+        self._clients[io_id].append(client)
+        self._updateEvents(client)
+
+    def _isConnected(self, client):
+        return client in self._clients[client.periph]
+
+    def _updateEvents(self, client):
+        # Read from the client unless it is paused, and wait for the socket to
+        # be writable only while there is data waiting to be sent
+        events = 0
+        if not client.paused:
+            events |= selectors.EVENT_READ
+        if client.outbuf:
+            events |= selectors.EVENT_WRITE
+
+        if events != client.events:
+            if not client.events:
+                self._sel.register(client.sock, events, client)
+            elif not events:
+                self._sel.unregister(client.sock)
+            else:
+                self._sel.modify(client.sock, events, client)
+            client.events = events
+
+    def _sendClient(self, client):
+        try:
+            client.flush()
+        except OSError:
+            self._removeClient(client)
+            return
+
+        if len(client.outbuf) > iohub.IO_SEND_BUFFER_MAX:
+            logger.warning('IO frontend: client sock %r for peripheral ID %d is not receiving data, '
+                           'disconnecting', client.sock, client.periph)
+            self._removeClient(client)
+            return
+
+        self._updateEvents(client)
+
+    def _handleControl(self):
+        try:
+            info, fds, _, _ = socket.recv_fds(self._ctrl, 2, 1)
+        except OSError:
+            info = None
+        if not info:
+            # The emulator has closed the control socket
+            self._sel.unregister(self._ctrl)
+            return
+
+        io_id, batch = info
+        self._batch[io_id] = bool(batch)
+        self._addClient(io_id, socket.socket(fileno=fds[0]))
+
+    def _removeClient(self, client):
+        if client.events:
+            self._sel.unregister(client.sock)
+            client.events = 0
+        self._clients[client.periph].remove(client)
+        client.sock.close()
+
+    def _handleClient(self, client):
+        msgs = client.readMessages()
+        if msgs is None:
+            self._removeClient(client)
+            return
+
+        prefix = bytes((client.periph,))
+        for data in msgs:
+            # Messages that are too large for the ring are dropped
+            if len(data) < self._tx.max_record:
+                self._pending.append(prefix + data)
+            else:
+                logger.warning('IO frontend: dropping %d byte message from client sock %r for '
+                               'peripheral ID %d, messages must be smaller than %d bytes',
+                               len(data), client.sock, client.periph, self._tx.max_record)
+        self._forwardPending()
+
+    def _handleTransmit(self):
+        batches = collections.OrderedDict()
+        while self._rx.pending():
+            data = self._rx.get()
+            batches.setdefault(data[0], []).append(data[1:])
+
+        for io_id, msgs in batches.items():
+            if self._batch.get(io_id):
+                msgs = [b''.join(msgs)]
+            for client in list(self._clients[io_id]):
+                for data in msgs:
+                    client.queueMessage(data)
+                self._sendClient(client)
+
+
+def _frontendMain(rx_name, tx_name, servers, parent_pid, ctrl):
+    IOFrontendProcess(rx_name, tx_name, servers, parent_pid, ctrl).run()
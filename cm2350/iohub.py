@@ -0,0 +1,469 @@
+import os
+import atexit
+import socket
+import struct
+import weakref
+import functools
+import selectors
+import threading
+import collections
+
+from envi.common import MIRE
+
+from . import ioproto
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__all__ = [
+    'IOHub',
+    'createServer',
+    'deliverRecords',
+]
+
+
+# Every message exchanged with a client is prefixed with a 4-byte length
+IO_MSG_LEN = struct.Struct('>I')
+
+# Maximum number of bytes to read from a client at once
+IO_RECV_SIZE = 0x10000
+
+# Maximum number of bytes waiting to be sent to a client, clients that fall
+# further behind than this are disconnected
+IO_SEND_BUFFER_MAX = 0x1000000
+
+
+class IOHubClient:
+    '''
+    Connection state for a client connected to a peripheral through the hub
+    '''
+    def __init__(self, periph, sock):
+        self.periph = periph
+        self.sock = sock
+        self.buf = bytearray()
+
+        # Data waiting to be sent to the client
+        self.outbuf = bytearray()
+
+        # Set when the client is not being read from because a peripheral
+        # queue is full
+        self.paused = False
+
+        # The selector events the client socket is registered for
+        self.events = 0
+
+    def readMessages(self):
+        '''
+        Read available data from the client socket, returns a list of the
+        complete messages received or None if the client has disconnected.
+        '''
+        try:
+            data = self.sock.recv(IO_RECV_SIZE)
+        except BlockingIOError:
+            return []
+        except OSError:
+            data = None
+        if not data:
+            return None
+
+        buf = self.buf
+        buf += data
+
+        msgs = []
+        offset = 0
+        while len(buf) - offset >= IO_MSG_LEN.size:
+            size = IO_MSG_LEN.unpack_from(buf, offset)[0]
+            end = offset + IO_MSG_LEN.size + size
+            if len(buf) < end:
+                break
+            msgs.append(bytes(buf[offset+IO_MSG_LEN.size:end]))
+            offset = end
+
+        del buf[:offset]
+        return msgs
+
+    def queueMessage(self, data):
+        '''
+        Add a message to the data waiting to be sent to the client
+        '''
+        self.outbuf += IO_MSG_LEN.pack(len(data))
+        self.outbuf += data
+
+    def flush(self):
+        '''
+        Send as much of the waiting data as the client socket will accept
+        without blocking, returns True if all data has been sent.  OSError is
+        raised if the client has disconnected.
+        '''
+        while self.outbuf:
+            try:
+                sent = self.sock.send(self.outbuf)
+            except BlockingIOError:
+                break
+            del self.outbuf[:sent]
+        return not self.outbuf
+
+
+def createServer(addr):
+    '''
+    Create a non-blocking server socket. If addr is a string it is the path of
+    a Unix domain socket, otherwise it is a TCP (host, port) tuple.
+    '''
+    if isinstance(addr, str):
+        # Remove any stale socket file left over from a previous run
+        try:
+            os.unlink(addr)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(addr)
+    else:
+        # TODO: support IPv6 (AF_INET6)?
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.bind(addr)
+    sock.listen(0)
+    sock.setblocking(False)
+    return sock
+
+
+def deliverRecords(periphs, periph, data, block=True):
+    '''
+    Decode data received from a client of periph and pass the objects to the
+    receive() function of the target peripheral. periphs is the dictionary of
+    registered peripherals used to route records with a non-zero peripheral
+    ID.
+
+    Returns the set of peripherals that objects were delivered to.
+    '''
+    targets = set()
+    for io_id, objs in periph.decodeRecords(data):
+        if io_id == 0:
+            target = periph
+        else:
+            try:
+                target = periphs[io_id]
+            except KeyError:
+                raise ioproto.IOProtocolError('Unknown peripheral ID %d' % io_id)
+
+        for obj in objs:
+            target.receive(obj, block=block)
+        targets.add(target)
+
+    return targets
+
+
+def _shutdownHubs():
+    # Python does not always clean up the IO threads when ipython exits, so
+    # ensure that all client connections are shutdown cleanly.
+    for hub in list(IOHub._hubs):
+        hub.shutdown()
+
+
+class IOHub:
+    '''
+    A single IO thread that services the server and client sockets of all
+    ExternalIOPeripherals in an emulator.
+
+    Data received from clients is decoded and passed to the receive()
+    function of the target peripheral, which places it in the emulator's
+    external IO queue.  Data transmitted by peripherals is queued with send()
+    and the hub thread is woken up through a socketpair to forward the data to
+    all clients of that peripheral.
+
+    Client sockets are non-blocking, data that a client is not ready to
+    receive is kept in a per-client buffer and sent when the socket becomes
+    writable so a slow client does not hold up the other clients.
+
+    Peripheral servers can listen on a TCP address (a (host, port) tuple) or a
+    Unix domain socket (a path string), in-process clients can also connect
+    to a peripheral directly with connectPair().
+
+    Each registered peripheral is assigned an ID, records from any client
+    with a non-zero peripheral ID are routed to that peripheral.  A peripheral
+    ID of 0 refers to the peripheral that owns the connection.
+
+    The hub thread never waits for a full peripheral queue, instead it stops
+    reading from the client that filled the queue until the emulator has
+    processed enough messages that there is space again.
+    '''
+    _hubs = None
+
+    def __init__(self):
+        if IOHub._hubs is None:
+            IOHub._hubs = weakref.WeakSet()
+            atexit.register(_shutdownHubs)
+        IOHub._hubs.add(self)
+
+        self._sel = selectors.DefaultSelector()
+        self._thread = None
+        self._running = False
+
+        # Registered peripherals
+        self._periphs = {}
+        self._servers = []
+        self._clients = collections.defaultdict(list)
+        self._unix_paths = []
+
+        # Data to send to clients and commands for the hub thread, these are
+        # used from other threads so they are protected by a lock
+        self._lock = threading.Lock()
+        self._tx = collections.deque()
+        self._cmds = collections.deque()
+        self._wake_pending = False
+
+        # The socketpair used to wake up the hub thread
+        self._wake_rx, self._wake_tx = socket.socketpair()
+        self._wake_rx.setblocking(False)
+        self._sel.register(self._wake_rx, selectors.EVENT_READ, None)
+
+    def register(self, periph):
+        '''
+        Register a peripheral with the hub, returns the peripheral ID. If
+        the peripheral is already registered its existing ID is returned.
+        '''
+        for io_id, registered in self._periphs.items():
+            if registered is periph:
+                return io_id
+
+        io_id = len(self._periphs) + 1
+        if io_id > 0xFF:
+            raise ValueError('Cannot register %s: too many IO peripherals' % periph.devname)
+        self._periphs[io_id] = periph
+        return io_id
+
+    def addServer(self, periph, addr):
+        '''
+        Create a server socket that clients can use to connect to the
+        peripheral.  If addr is a string it is the path of a Unix domain
+        socket, otherwise it is a TCP (host, port) tuple.
+        '''
+        sock = createServer(addr)
+        if isinstance(addr, str):
+            self._unix_paths.append(addr)
+
+        logger.debug('Listening on %r for IO module %s', addr, periph.devname)
+        self._servers.append(sock)
+        self._command(self._sel.register, sock, selectors.EVENT_READ, periph)
+        self.start()
+
+    def connectPair(self, periph):
+        '''
+        Create an in-process client connection to the peripheral, returns the
+        client end of the connection.
+        '''
+        client_sock, hub_sock = socket.socketpair()
+        hub_sock.setblocking(False)
+        self._command(self._addClient, periph, hub_sock)
+        self.start()
+        return client_sock
+
+    def send(self, periph, data):
+        '''
+        Queue encoded data to be sent to all clients of a peripheral
+        '''
+        with self._lock:
+            self._tx.append((periph, data))
+            self._wakeup()
+
+    def isRunning(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(name='IO-hub', target=self._run, daemon=True)
+            self._thread.start()
+
+    def shutdown(self):
+        if self._thread is not None:
+            self._running = False
+            with self._lock:
+                self._wakeup()
+            self._thread.join(1)
+            if self._thread.is_alive():
+                logger.error('Failed to stop IO hub thread')
+            self._thread = None
+
+        for clients in self._clients.values():
+            for client in clients:
+                self._close(client.sock)
+        self._clients.clear()
+
+        for sock in self._servers:
+            self._close(sock)
+        self._servers = []
+
+        for path in self._unix_paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        self._unix_paths = []
+
+        self._wake_rx.close()
+        self._wake_tx.close()
+
+    def _close(self, sock):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+    def _command(self, func, *args):
+        # The selector is only modified by the hub thread once it is running
+        if self._thread is None:
+            func(*args)
+        else:
+            with self._lock:
+                self._cmds.append((func, args))
+                self._wakeup()
+
+    def _wakeup(self):
+        # Must be called with the lock held
+        if not self._wake_pending:
+            self._wake_pending = True
+            self._wake_tx.send(b'\x00')
+
+    def _addClient(self, periph, sock):
+        if sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = IOHubClient(periph, sock)
+        self._clients[periph].append(client)
+        self._updateEvents(client)
+
+    def _removeClient(self, client):
+        logger.log(MIRE, 'client sock %r disconnected', client.sock)
+        if client.events:
+            self._sel.unregister(client.sock)
+            client.events = 0
+        self._clients[client.periph].remove(client)
+        self._close(client.sock)
+
+    def _isConnected(self, client):
+        return client in self._clients[client.periph]
+
+    def _updateEvents(self, client):
+        # Read from the client unless it is paused, and wait for the socket to
+        # be writable only while there is data waiting to be sent
+        events = 0
+        if not client.paused:
+            events |= selectors.EVENT_READ
+        if client.outbuf:
+            events |= selectors.EVENT_WRITE
+
+        if events != client.events:
+            if not client.events:
+                self._sel.register(client.sock, events, client)
+            elif not events:
+                self._sel.unregister(client.sock)
+            else:
+                self._sel.modify(client.sock, events, client)
+            client.events = events
+
+    def _pauseClient(self, client):
+        logger.debug('%s: IO queue full, pausing client sock %r', client.periph.devname, client.sock)
+        client.paused = True
+        self._updateEvents(client)
+
+    def _resumeClient(self, client):
+        # The client may have disconnected while it was paused
+        if client.paused and self._isConnected(client):
+            logger.debug('%s: resuming client sock %r', client.periph.devname, client.sock)
+            client.paused = False
+            self._updateEvents(client)
+
+    def _sendClient(self, client):
+        try:
+            client.flush()
+        except OSError:
+            self._removeClient(client)
+            return
+
+        if len(client.outbuf) > IO_SEND_BUFFER_MAX:
+            logger.warning('%s: client sock %r is not receiving data, disconnecting',
+                           client.periph.devname, client.sock)
+            self._removeClient(client)
+            return
+
+        self._updateEvents(client)
+
+    def _run(self):
+        while self._running:
+            for key, events in self._sel.select():
+                if key.data is None:
+                    self._handleWakeup()
+                elif isinstance(key.data, IOHubClient):
+                    client = key.data
+                    if events & selectors.EVENT_READ:
+                        self._handleClient(client)
+                    if events & selectors.EVENT_WRITE and self._isConnected(client):
+                        self._sendClient(client)
+                else:
+                    # New connection to a peripheral server
+                    try:
+                        sock, _ = key.fileobj.accept()
+                    except BlockingIOError:
+                        continue
+                    sock.setblocking(False)
+                    self._addClient(key.data, sock)
+
+    def _handleWakeup(self):
+        try:
+            self._wake_rx.recv(IO_RECV_SIZE)
+        except BlockingIOError:
+            pass
+
+        with self._lock:
+            self._wake_pending = False
+            cmds = list(self._cmds)
+            self._cmds.clear()
+            tx = list(self._tx)
+            self._tx.clear()
+
+        for func, args in cmds:
+            func(*args)
+
+        # Combine the queued data for each peripheral so binary protocol
+        # messages are batched into a single send
+        batches = collections.OrderedDict()
+        for periph, data in tx:
+            batches.setdefault(periph, []).append(data)
+
+        for periph, msgs in batches.items():
+            if periph.batchTransmitData():
+                msgs = [b''.join(msgs)]
+            for client in list(self._clients[periph]):
+                for data in msgs:
+                    client.queueMessage(data)
+                self._sendClient(client)
+
+    def _handleClient(self, client):
+        msgs = client.readMessages()
+        if msgs is None:
+            self._removeClient(client)
+            return
+
+        targets = set()
+        try:
+            for data in msgs:
+                targets.update(deliverRecords(self._periphs, client.periph, data, block=False))
+        except ioproto.IOProtocolError as exc:
+            # Don't accept any more data from a client that sends invalid
+            # messages
+            logger.warning('%s: invalid message from client sock %r, disconnecting: %s',
+                           client.periph.devname, client.sock, exc)
+            self._removeClient(client)
+            return
+
+        # If any of the peripheral queues are now full stop reading from this
+        # client, the emulator thread resumes the client once the queue has
+        # space so other clients are not held up waiting for the queue.
+        for target in targets:
+            resume = functools.partial(self._command, self._resumeClient, client)
+            if not target.notifyWhenReady(resume):
+                self._pauseClient(client)
+                break
@@ -0,0 +1,90 @@
+import pickle
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__all__ = [
+    'IORecorder',
+    'IOReplayer',
+]
+
+
+# Header written at the start of every IO log file, used to make sure that a
+# file being replayed was created by a compatible recorder.
+IOLOG_MAGIC = 'cm2350-iolog'
+IOLOG_VERSION = 1
+
+
+class IORecorder:
+    '''
+    Records each external IO message delivered to a peripheral along with the
+    emulated time (reset count and system tick) that it was delivered.  Each
+    record is a pickled tuple of:
+        (epoch, tick, devname, obj)
+
+    The "epoch" is the number of times the processor has been reset, the system
+    tick count is reset to 0 when the processor is reset so the tick alone is
+    not enough to identify when a message was delivered.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.count = 0
+        self._file = open(filename, 'wb')
+        pickle.dump((IOLOG_MAGIC, IOLOG_VERSION), self._file)
+
+    def record(self, epoch, tick, devname, obj):
+        pickle.dump((epoch, tick, devname, obj), self._file)
+        self.count += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            logger.info('Recorded %d IO messages to %s', self.count, self.filename)
+
+
+class IOReplayer:
+    '''
+    Reads back the IO messages saved by an IORecorder in the order they were
+    recorded.  The next record to deliver is available in the "next" attribute
+    which is None once all records have been delivered.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.count = 0
+        self.next = None
+
+        self._file = open(filename, 'rb')
+        try:
+            header = pickle.load(self._file)
+        except EOFError:
+            header = None
+
+        if header != (IOLOG_MAGIC, IOLOG_VERSION):
+            self._file.close()
+            raise ValueError('Invalid IO log file %s: unsupported header %r' % (filename, header))
+
+        self._advance()
+
+    def _advance(self):
+        try:
+            self.next = pickle.load(self._file)
+        except EOFError:
+            self.next = None
+            self.close()
+
+    def pop(self):
+        '''
+        Return the next record and advance to the following record.
+        '''
+        rec = self.next
+        self.count += 1
+        self._advance()
+        return rec
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            logger.info('Replayed %d IO messages from %s', self.count, self.filename)
@@ -0,0 +1,178 @@
+import struct
+import collections
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__all__ = [
+    'IOProtocolError',
+    'FlowControl',
+    'registerCodec',
+    'encode',
+    'decode',
+    'decodeRecords',
+]
+
+
+# Wire protocol used to exchange messages with external IO clients. Each
+# message sent over a connection is a (4-byte) length-prefixed payload that
+# contains one or more records. Each record is a fixed-size header followed by
+# an array of fixed-size items:
+#
+#   version     1 byte
+#   type        1 byte, identifies the item format (IO_MSG_*)
+#   peripheral  1 byte, 0 is the peripheral that owns the connection
+#   count       2 bytes, number of items that follow the header
+#
+# Consecutive objects of the same type are packed into the same record so many
+# CAN frames or ADC samples can be batched into a single message.
+IO_PROTO_VERSION = 1
+IO_RECORD_HDR = struct.Struct('>BBBH')
+IO_RECORD_MAX_ITEMS = 0xFFFF
+
+# Supported protocols, "pickle" is the legacy protocol where each message is a
+# single pickled object. It should only be used with trusted clients.
+IO_PROTOCOLS = ('binary', 'pickle')
+
+# Message types
+IO_MSG_CAN = 1
+IO_MSG_ADC = 2
+IO_MSG_FLOW = 3
+
+
+class IOProtocolError(ValueError):
+    pass
+
+
+class IOCodec:
+    '''
+    Converts objects of a specific class to and from the fixed-size items of a
+    wire protocol record.
+    '''
+    def __init__(self, msgtype, cls, fmt, to_fields=None, from_fields=None):
+        '''
+        Arguments:
+            msgtype     The record type value
+            cls         Class of the objects handled by this codec
+            fmt         struct format of each item
+            to_fields   Function that returns a tuple of values to pack for an
+                        object, if None the object is packed as a tuple
+            from_fields Function that creates an object from the tuple of
+                        unpacked values, if None the tuple is returned
+        '''
+        self.msgtype = msgtype
+        self.cls = cls
+        self.item = struct.Struct(fmt)
+        self.to_fields = to_fields
+        self.from_fields = from_fields
+
+    def encode(self, objs, periph=0):
+        hdr = IO_RECORD_HDR.pack(IO_PROTO_VERSION, self.msgtype, periph, len(objs))
+        pack = self.item.pack
+        if self.to_fields is None:
+            return hdr + b''.join(pack(*o) for o in objs)
+        else:
+            to_fields = self.to_fields
+            return hdr + b''.join(pack(*to_fields(o)) for o in objs)
+
+    def decode(self, data, offset, count):
+        end = offset + count * self.item.size
+        if end > len(data):
+            raise IOProtocolError('Truncated record: %d bytes needed, %d available' %
+                                  (end - offset, len(data) - offset))
+
+        items = self.item.iter_unpack(data[offset:end])
+        if self.from_fields is None:
+            return list(items), end
+        else:
+            return list(map(self.from_fields, items)), end
+
+
+_codecs_by_type = {}
+_codecs_by_cls = {}
+
+
+def registerCodec(msgtype, cls, fmt, to_fields=None, from_fields=None):
+    '''
+    Register the wire format of a message class, see IOCodec for argument
+    details.
+    '''
+    if msgtype in _codecs_by_type and _codecs_by_type[msgtype].cls is not cls:
+        raise KeyError('Cannot register codec for %s: message type %d already used by %s' %
+                       (cls.__name__, msgtype, _codecs_by_type[msgtype].cls.__name__))
+
+    codec = IOCodec(msgtype, cls, fmt, to_fields, from_fields)
+    _codecs_by_type[msgtype] = codec
+    _codecs_by_cls[cls] = codec
+
+
+def encode(objs, periph=0):
+    '''
+    Encode a sequence of objects into a wire protocol payload.
+    '''
+    parts = []
+    codec = None
+    group = []
+    for obj in objs:
+        obj_codec = _codecs_by_cls.get(type(obj))
+        if obj_codec is None:
+            raise IOProtocolError('No wire format registered for %s' % type(obj).__name__)
+
+        if obj_codec is not codec or len(group) == IO_RECORD_MAX_ITEMS:
+            if group:
+                parts.append(codec.encode(group, periph))
+            codec = obj_codec
+            group = []
+        group.append(obj)
+
+    if group:
+        parts.append(codec.encode(group, periph))
+
+    return b''.join(parts)
+
+
+def decodeRecords(data):
+    '''
+    Decode a wire protocol payload into a list of (peripheral, objects)
+    tuples, one for each record.
+    '''
+    data = memoryview(data)
+    records = []
+    offset = 0
+    while offset < len(data):
+        if offset + IO_RECORD_HDR.size > len(data):
+            raise IOProtocolError('Truncated record header at offset %d' % offset)
+
+        version, msgtype, periph, count = IO_RECORD_HDR.unpack_from(data, offset)
+        if version != IO_PROTO_VERSION:
+            raise IOProtocolError('Unsupported protocol version %d' % version)
+
+        try:
+            codec = _codecs_by_type[msgtype]
+        except KeyError:
+            raise IOProtocolError('Unknown message type %d' % msgtype)
+
+        objs, offset = codec.decode(data, offset + IO_RECORD_HDR.size, count)
+        records.append((periph, objs))
+
+    return records
+
+
+def decode(data):
+    '''
+    Decode a wire protocol payload into a list of objects.
+    '''
+    return [obj for _, objs in decodeRecords(data) for obj in objs]
+
+
+class FlowControl(collections.namedtuple('FlowControl', ['paused'])):
+    '''
+    Sent by a peripheral to its clients when its receive queue becomes full
+    (paused=True) and when it can accept messages again (paused=False).
+    '''
+    pass
+
+
+registerCodec(IO_MSG_FLOW, FlowControl, '>B',
+              from_fields=lambda fields: FlowControl(bool(fields[0])))
@@ -0,0 +1,284 @@
+import time
+import queue
+import threading
+import collections
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__all__ = [
+    'IO_QUEUE_POLICIES',
+    'ExternalIOQueue',
+]
+
+
+# Policies for handling new messages when a peripheral's queue is full:
+#   block           The sender waits until there is space in the queue, senders
+#                   that cannot wait use notifyWhenReady() to stop sending
+#                   until there is space
+#   drop_oldest     The oldest message in the queue is discarded
+#   drop_newest     The new message is discarded
+IO_QUEUE_POLICIES = ('block', 'drop_oldest', 'drop_newest')
+
+# Default maximum number of queued messages for each peripheral, 0 means
+# unbounded
+DEFAULT_QUEUE_SIZE = 0
+DEFAULT_QUEUE_POLICY = 'block'
+
+
+class IOQueueState:
+    '''
+    The messages queued for one peripheral and the queue statistics
+    '''
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE, policy=DEFAULT_QUEUE_POLICY):
+        self.items = collections.deque()
+        self.maxsize = maxsize
+        self.policy = policy
+        self.paused = False
+
+        # Functions to call once the queue is no longer full
+        self.waiters = []
+
+        self.resetStats()
+
+    def resetStats(self):
+        self.enqueued = 0
+        self.dropped = 0
+        self.high_water = len(self.items)
+
+    def full(self):
+        return self.maxsize and len(self.items) >= self.maxsize
+
+    def getStats(self):
+        return {
+            'size': len(self.items),
+            'maxsize': self.maxsize,
+            'policy': self.policy,
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+            'high_water': self.high_water,
+        }
+
+
+class ExternalIOQueue:
+    '''
+    Queue of external IO messages waiting to be processed by the emulator,
+    with a separate bounded queue for each peripheral.  Messages are returned
+    in the order they were queued.
+
+    The put/get functions follow the queue.Queue API so this can be used in
+    place of an unbounded queue.Queue.
+
+    When a peripheral's queue becomes full the flow control callback (if set)
+    is called with the peripheral name and True, once the queue has drained to
+    half of its maximum size the callback is called again with False.  The
+    callback is used to signal clients to stop sending.
+
+    Senders that service several peripherals (such as the IO hub thread) must
+    not wait for one peripheral's queue, they put messages with block=False
+    and use notifyWhenReady() to stop sending until the queue has space.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+        # The peripheral name of each queued message in the order they were
+        # queued, the messages themselves are in the per-peripheral queues
+        self._order = collections.deque()
+        self._queues = {}
+
+        self._flow_callback = None
+
+        # The thread that processes queued messages, this thread cannot block
+        # when putting messages into a full queue.
+        self._consumer = None
+
+    def configure(self, devname, maxsize=DEFAULT_QUEUE_SIZE, policy=DEFAULT_QUEUE_POLICY):
+        '''
+        Set the maximum queue size and the policy used when the queue is full
+        for a peripheral.  A maxsize of 0 means the queue is unbounded.
+        '''
+        if policy not in IO_QUEUE_POLICIES:
+            raise ValueError('Invalid IO queue policy for %s: %s (valid policies are %s)' %
+                             (devname, policy, ', '.join(IO_QUEUE_POLICIES)))
+        if maxsize < 0:
+            raise ValueError('Invalid IO queue size for %s: %s' % (devname, maxsize))
+
+        with self._lock:
+            state = self._getState(devname)
+            state.maxsize = maxsize
+            state.policy = policy
+            self._not_full.notify_all()
+            waiters = self._takeWaiters(state)
+
+        for func in waiters:
+            func()
+
+    def setFlowCallback(self, callback):
+        self._flow_callback = callback
+
+    def _getState(self, devname):
+        # Must be called with the lock held
+        state = self._queues.get(devname)
+        if state is None:
+            state = IOQueueState()
+            self._queues[devname] = state
+        return state
+
+    def _takeWaiters(self, state):
+        # Must be called with the lock held
+        if state.waiters and not state.full():
+            waiters = state.waiters
+            state.waiters = []
+            return waiters
+        return ()
+
+    def put(self, item, block=True, timeout=None):
+        '''
+        Queue a (peripheral name, message) tuple. Returns False if a message
+        was dropped because the peripheral's queue is full.
+
+        If the queue policy is "block" and block is False the message is
+        queued even if the queue is full, the sender should then use
+        notifyWhenReady() to wait for space without blocking.
+        '''
+        devname, obj = item
+        accepted = True
+        with self._lock:
+            state = self._getState(devname)
+
+            if state.full():
+                if state.policy == 'block' and block and \
+                        threading.get_ident() != self._consumer:
+                    if timeout is None:
+                        while state.full():
+                            self._not_full.wait()
+                    else:
+                        deadline = time.monotonic() + timeout
+                        while state.full():
+                            remaining = deadline - time.monotonic()
+                            if remaining <= 0.0:
+                                break
+                            self._not_full.wait(remaining)
+
+            if not state.full() or (state.policy == 'block' and not block):
+                state.items.append(obj)
+                self._order.append(devname)
+            elif state.policy == 'drop_oldest':
+                # Replace the oldest message, the new message takes the place
+                # of the discarded message in the delivery order
+                state.items.popleft()
+                state.items.append(obj)
+                state.dropped += 1
+            else:
+                state.dropped += 1
+                accepted = False
+
+            state.enqueued += 1
+            if len(state.items) > state.high_water:
+                state.high_water = len(state.items)
+
+            pause = state.full() and not state.paused
+            if pause:
+                state.paused = True
+
+            self._not_empty.notify()
+
+        if pause and self._flow_callback is not None:
+            self._flow_callback(devname, True)
+
+        if not accepted:
+            logger.log(logging.WARNING if state.dropped == 1 else logging.DEBUG,
+                       '%s: IO queue full, message dropped', devname)
+        return accepted
+
+    def put_nowait(self, item):
+        return self.put(item, block=False)
+
+    def notifyWhenReady(self, devname, callback):
+        '''
+        Returns True if a peripheral's queue has space for new messages.  If
+        the queue is full False is returned and callback is called (from the
+        thread that removes messages from the queue) once there is space.
+        '''
+        with self._lock:
+            state = self._getState(devname)
+            if not state.full():
+                return True
+            state.waiters.append(callback)
+            return False
+
+    def get(self, block=True, timeout=None):
+        '''
+        Return the next (peripheral name, message) tuple
+        '''
+        with self._lock:
+            if not block:
+                if not self._order:
+                    raise queue.Empty
+            elif timeout is None:
+                while not self._order:
+                    self._not_empty.wait()
+            else:
+                deadline = time.monotonic() + timeout
+                while not self._order:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0.0:
+                        raise queue.Empty
+                    self._not_empty.wait(remaining)
+
+            self._consumer = threading.get_ident()
+            devname = self._order.popleft()
+            state = self._queues[devname]
+            obj = state.items.popleft()
+
+            resume = state.paused and len(state.items) <= state.maxsize // 2
+            if resume:
+                state.paused = False
+            if state.policy == 'block':
+                self._not_full.notify_all()
+            waiters = self._takeWaiters(state)
+
+        for func in waiters:
+            func()
+
+        if resume and self._flow_callback is not None:
+            self._flow_callback(devname, False)
+
+        return devname, obj
+
+    def get_nowait(self):
+        # Checking if there are queued messages doesn't need the lock, this
+        # is called by the emulator every instruction
+        if not self._order:
+            raise queue.Empty
+        return self.get(block=False)
+
+    def empty(self):
+        return not self._order
+
+    def qsize(self):
+        return len(self._order)
+
+    def getStats(self, devname=None):
+        '''
+        Return the queue statistics for a peripheral, or a dictionary of the
+        statistics of all peripherals if devname is None:
+            size        Number of messages currently queued
+            maxsize     Maximum number of queued messages (0 is unbounded)
+            policy      Policy used when the queue is full
+            enqueued    Number of messages queued (including dropped messages)
+            dropped     Number of messages dropped because the queue was full
+            high_water  Largest number of messages that have been queued
+        '''
+        with self._lock:
+            if devname is None:
+                return dict((name, state.getStats()) for name, state in self._queues.items())
+            return self._getState(devname).getStats()
+
+    def resetStats(self):
+        with self._lock:
+            for state in self._queues.values():
+                state.resetStats()
@@ -53,6 +53,17 @@ class ComplexMemoryMap(e_mem.MemoryObject):
         hlpr = [va, va+msize, mmap, (mmio_read, mmio_write, mmio_bytes)]
         self._map_defs.append(hlpr)
 
+    def delMMIO(self, va):
+        '''
+        Remove the MMIO map that starts at va
+        '''
+        for idx, (mva, mmaxva, mmap, mbytes) in enumerate(self._map_defs):
+            if mva == va and mmap[2] & PERM_MMIO:
+                del self._map_defs[idx]
+                return
+
+        raise envi.SegmentationViolation(va)
+
     def readMemory(self, va, size):
         for mva, mmaxva, mmap, mbytes in self._map_defs:
             if va >= mva and va + size <= mmaxva:
@@ -93,6 +104,24 @@ class ComplexMemoryMap(e_mem.MemoryObject):
 
         raise envi.SegmentationViolation(va)
 
+    def clearMemory(self, va, size):
+        '''
+        Set a range of standard byte-backed memory to 0 in place without going
+        through the normal writeMemory() path.  Primarily used to quickly clear
+        RAM during a reset.  The entire range must be contained in a single
+        non-MMIO memory map.
+        '''
+        for mva, mmaxva, mmap, mbytes in self._map_defs:
+            if va >= mva and va + size <= mmaxva:
+                if mmap[2] & PERM_MMIO:
+                    raise envi.SegmentationViolation(va)
+
+                offset = va - mva
+                mbytes[offset:offset+size] = bytes(size)
+                return
+
+        raise envi.SegmentationViolation(va)
+
     def getByteDef(self, va):
         '''
         Return bytes representing the entire memory block.  Used mostly for
@@ -124,11 +153,76 @@ class ComplexMemoryMap(e_mem.MemoryObject):
 
         raise envi.SegmentationViolation(va)
 
+    def getMemoryBuffer(self, va, size, write=False):
+        '''
+        Return the backing buffer of the memory map that contains the entire
+        range of size bytes at va, and the offset of va in that buffer.  The
+        buffer can be accessed directly (with slices) instead of through the
+        normal readMemory() and writeMemory() functions.
+
+        Normal memory maps can be read or written, MMIO maps that provide a
+        "getBytesDef" support function (such as flash) can only be read.  If
+        the range is not contained in a memory map that supports direct access
+        (None, None) is returned.
+        '''
+        for mva, mmaxva, mmap, mbytes in self._map_defs:
+            if va >= mva and va < mmaxva:
+                mperms = mmap[2]
+                if va + size > mmaxva:
+                    break
+
+                if write:
+                    if mperms & PERM_MMIO or not (mperms & e_mem.MM_WRITE or self._supervisor):
+                        break
+                    return va - mva, mbytes
+
+                if not (mperms & e_mem.MM_READ or self._supervisor):
+                    break
+
+                if mperms & PERM_MMIO:
+                    get_bytes_func = mbytes[MMIO_BYTES_REF]
+                    if get_bytes_func is None:
+                        break
+                    return va - mva, get_bytes_func()
+
+                return va - mva, mbytes
+
+        return None, None
+
+    def getMMIODevice(self, va):
+        '''
+        Return the MMIO device that handles an address and the offset of the
+        address in the device's memory map.  If the address is not part of an
+        MMIO memory map (None, None) is returned.
+        '''
+        for mva, mmaxva, mmap, mbytes in self._map_defs:
+            if va >= mva and va < mmaxva:
+                if mmap[2] & PERM_MMIO:
+                    handler = mbytes[MMIO_WRITE_HANDLER]
+                    return getattr(handler, '__self__', None), va - mva
+                break
+
+        return None, None
+
     def getMemorySnap(self):
-        raise NotImplementedError('Implement this method to support memory snapshots')
+        '''
+        Return a copy of the contents of all normal (non-MMIO) memory maps.
+        The state of MMIO memory regions is saved by the device that owns them.
+        '''
+        return tuple((mva, bytes(mbytes)) for mva, _, mmap, mbytes in self._map_defs
+                     if not mmap[2] & PERM_MMIO)
 
     def setMemorySnap(self, snap):
-        raise NotImplementedError('Implement this method to support memory snapshots')
+        '''
+        Restore the contents of the memory maps saved with getMemorySnap().
+        '''
+        maps = dict((mva, mbytes) for mva, _, mmap, mbytes in self._map_defs
+                    if not mmap[2] & PERM_MMIO)
+        for va, data in snap:
+            try:
+                maps[va][:] = data
+            except KeyError:
+                raise envi.SegmentationViolation(va)
 
 
 class supervisorMode(ContextDecorator):
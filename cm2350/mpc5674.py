@@ -144,20 +144,21 @@ import envi.archs.ppc.const as ppc_const
 import vivisect.const as viv_const
 import vivisect.impemu.monitor as viv_imp_monitor
 
-from . import project, e200z7, intc_exc, mmio
+from . import project, e200z7, intc_exc, mmio, ppc_cycles, instrstore, workqueue
+from .ppc_peripherals import LazyPeripheral
 
 # Peripherals
 from .peripherals.bam import BAM
-from .peripherals.flash import FLASH, FlashDevice, getFlashOffsets
+from .peripherals.flash import FLASH, FlashDevice, getFlashOffsets, FLASH_DEVICE_MMIO_SIZE
 from .peripherals.swt import SWT
 from .peripherals.siu import SIU
 from .peripherals.fmpll import FMPLL
-from .peripherals.flexcan import FlexCAN
+from .peripherals.flexcan import FlexCAN, FLEXCAN_MMIO_SIZE
 from .peripherals.intc import INTC
-from .peripherals.dspi import DSPI
+from .peripherals.dspi import DSPI, DSPI_MMIO_SIZE
 from .peripherals.sim import SIM
-from .peripherals.eqadc import eQADC
-from .peripherals.decfilt import DECFILT
+from .peripherals.eqadc import eQADC, EQADC_MMIO_SIZE
+from .peripherals.decfilt import DECFILT, DECFILT_MMIO_SIZE
 from .peripherals.ebi import EBI
 from .peripherals.ecsm import ECSM
 from .peripherals.xbar import XBAR
@@ -165,7 +166,7 @@ from .peripherals.pbridge import PBRIDGE
 from .peripherals.edma import eDMA
 from .peripherals.etpu2 import eTPU2
 from .peripherals.emios200 import eMIOS200
-from .peripherals.esci import eSCI
+from .peripherals.esci import eSCI, ESCI_MMIO_SIZE
 from .peripherals.pit import PIT
 
 
@@ -352,6 +353,9 @@ class MPC5674_Emulator(e200z7.PPC_e200z7, project.VivProject):
                     'shadowBFilename': None,
                     'shadowBOffset': 0,
                     'backup': 'backup.flash',
+                    # Seconds between syncs of the backup file, None only
+                    # syncs the backup file on shutdown
+                    'sync_interval': 1.0,
                 },
                 'SRAM': {
                     # SRAM size depends on the specific MPC5674 part in use
@@ -360,29 +364,104 @@ class MPC5674_Emulator(e200z7.PPC_e200z7, project.VivProject):
                     # Indicates how much of the ram is preserved during resets
                     'standby_size': 0x8000,
                 },
+                'CPI': {
+                    # Default number of system clock cycles per instruction
+                    'default': 1,
+                    # Instruction class-specific cycle counts, None means the
+                    # default value is used
+                    'branch': None,
+                    'load': None,
+                    'store': None,
+                    'mul': None,
+                    'div': None,
+                    'sync': None,
+                },
+                'Pacing': {
+                    # Real-time pacing is disabled by default, emulated time
+                    # is only based on the number of instructions executed
+                    'enabled': False,
+                    'scaling': 1.0,
+                    'max_lead': 0.01,
+                },
+                'Checkpoints': {
+                    # Checkpoints used for reverse debugging are disabled by
+                    # default
+                    'enabled': False,
+                    'interval': 100000,
+                    'max_memory': 256 * 1024 * 1024,
+                    'max_latency': 0.5,
+                },
+                'IOFrontend': {
+                    # External IO connections are serviced by a thread in the
+                    # emulator process by default
+                    'enabled': False,
+                    'ring_size': 0x100000,
+                    'poll_interval': 1000,
+                },
+                'Predecode': {
+                    # Instructions are only decoded as they are executed by
+                    # default
+                    'enabled': False,
+                    'workers': None,
+                    'region_size': 0x10000,
+                },
+                'eDMA_A': {
+                    # By default one major loop is processed each
+                    # instruction
+                    'budget': None,
+                    'priority': workqueue.PRIORITY_NORMAL,
+                },
+                'eDMA_B': {
+                    'budget': None,
+                    'priority': workqueue.PRIORITY_NORMAL,
+                },
                 'FlexCAN_A': {
                     'host': None,
                     'port': None,
+                    'path': None,
+                    'protocol': 'binary',
+                    'queue_size': 1024,
+                    'queue_policy': 'block',
                 },
                 'FlexCAN_B': {
                     'host': None,
                     'port': None,
+                    'path': None,
+                    'protocol': 'binary',
+                    'queue_size': 1024,
+                    'queue_policy': 'block',
                 },
                 'FlexCAN_C': {
                     'host': None,
                     'port': None,
+                    'path': None,
+                    'protocol': 'binary',
+                    'queue_size': 1024,
+                    'queue_policy': 'block',
                 },
                 'FlexCAN_D': {
                     'host': None,
                     'port': None,
+                    'path': None,
+                    'protocol': 'binary',
+                    'queue_size': 1024,
+                    'queue_policy': 'block',
                 },
                 'eQADC_A': {
                     'host': None,
                     'port': None,
+                    'path': None,
+                    'protocol': 'binary',
+                    'queue_size': 1024,
+                    'queue_policy': 'block',
                 },
                 'eQADC_B': {
                     'host': None,
                     'port': None,
+                    'path': None,
+                    'protocol': 'binary',
+                    'queue_size': 1024,
+                    'queue_policy': 'block',
                 },
             }
         }
@@ -407,35 +486,98 @@ class MPC5674_Emulator(e200z7.PPC_e200z7, project.VivProject):
                     'shadowBFilename': 'File that contains the initial contents of shadow flash B',
                     'shadowBOffset': 'Memory offset to load the contents of shadowBFilename into',
                     'backup': 'File used to save the contents of flash',
+                    'sync_interval': 'Seconds between writing changes to the flash backup file to disk (None only writes changes on shutdown)',
                 },
                 'SRAM': {
                     'size': 'Amount of SRAM available (differs depending on specific MPC5674 version)',
                     'addr': 'Physical address of SRAM',
                     'standby_size': 'Size of SRAM that is preserved across device resets',
                 },
+                'CPI': {
+                    'default': 'Number of system clock cycles each instruction takes',
+                    'branch': 'Number of cycles for branch instructions (None uses default)',
+                    'load': 'Number of cycles for load instructions (None uses default)',
+                    'store': 'Number of cycles for store instructions (None uses default)',
+                    'mul': 'Number of cycles for multiply instructions (None uses default)',
+                    'div': 'Number of cycles for divide instructions (None uses default)',
+                    'sync': 'Number of cycles for sync/barrier instructions (None uses default)',
+                },
+                'Pacing': {
+                    'enabled': 'Pace emulated time to track the wall clock',
+                    'scaling': 'Ratio of emulated time to wall clock time when pacing is enabled',
+                    'max_lead': 'Maximum time (in seconds) emulated time may run ahead of the wall clock',
+                },
+                'Checkpoints': {
+                    'enabled': 'Save periodic checkpoints to support reverse execution in the debugger',
+                    'interval': 'Initial number of instructions between checkpoints',
+                    'max_memory': 'Maximum amount of memory (in bytes) used by checkpoints',
+                    'max_latency': 'Target maximum time (in seconds) to re-execute from a checkpoint',
+                },
+                'IOFrontend': {
+                    'enabled': 'Service external IO connections from a separate process',
+                    'ring_size': 'Size (in bytes) of the shared memory buffers used to exchange IO messages with the frontend process',
+                    'poll_interval': 'Number of instructions executed between checks for IO messages from the frontend process',
+                },
+                'Predecode': {
+                    'enabled': 'Decode the instructions in main flash in worker processes during initialization when there are no cached instructions',
+                    'workers': 'Number of worker processes used to decode instructions (None uses one per CPU)',
+                    'region_size': 'Size (in bytes) of the flash regions decoded by each worker task',
+                },
+                'eDMA_A': {
+                    'budget': 'Number of bytes eDMA_A may transfer each instruction (None processes one major loop each instruction)',
+                    'priority': 'Priority of eDMA_A transfers relative to other deferred peripheral work (lower runs first)',
+                },
+                'eDMA_B': {
+                    'budget': 'Number of bytes eDMA_B may transfer each instruction (None processes one major loop each instruction)',
+                    'priority': 'Priority of eDMA_B transfers relative to other deferred peripheral work (lower runs first)',
+                },
                 'FlexCAN_A': {
                     'host': 'Host IP address for FlexCAN_A IO server',
                     'port': 'Host TCP port for FlexCAN_A IO server',
+                    'path': 'Unix domain socket path for FlexCAN_A IO server (used instead of host and port)',
+                    'protocol': 'IO wire protocol for FlexCAN_A clients (binary or pickle)',
+                    'queue_size': 'Maximum number of received messages queued for FlexCAN_A (0 is unbounded)',
+                    'queue_policy': 'Policy when the FlexCAN_A receive queue is full (block, drop_oldest or drop_newest)',
                 },
                 'FlexCAN_B': {
                     'host': 'Host IP address for FlexCAN_B IO server',
                     'port': 'Host TCP port for FlexCAN_B IO server',
+                    'path': 'Unix domain socket path for FlexCAN_B IO server (used instead of host and port)',
+                    'protocol': 'IO wire protocol for FlexCAN_B clients (binary or pickle)',
+                    'queue_size': 'Maximum number of received messages queued for FlexCAN_B (0 is unbounded)',
+                    'queue_policy': 'Policy when the FlexCAN_B receive queue is full (block, drop_oldest or drop_newest)',
                 },
                 'FlexCAN_C': {
                     'host': 'Host IP address for FlexCAN_C IO server',
-                    'port': 'Host TCP port for FlexCAN_C IO server'
+                    'port': 'Host TCP port for FlexCAN_C IO server',
+                    'path': 'Unix domain socket path for FlexCAN_C IO server (used instead of host and port)',
+                    'protocol': 'IO wire protocol for FlexCAN_C clients (binary or pickle)',
+                    'queue_size': 'Maximum number of received messages queued for FlexCAN_C (0 is unbounded)',
+                    'queue_policy': 'Policy when the FlexCAN_C receive queue is full (block, drop_oldest or drop_newest)',
                 },
                 'FlexCAN_D': {
                     'host': 'Host IP address for FlexCAN_D IO server',
                     'port': 'Host TCP port for FlexCAN_D IO server',
+                    'path': 'Unix domain socket path for FlexCAN_D IO server (used instead of host and port)',
+                    'protocol': 'IO wire protocol for FlexCAN_D clients (binary or pickle)',
+                    'queue_size': 'Maximum number of received messages queued for FlexCAN_D (0 is unbounded)',
+                    'queue_policy': 'Policy when the FlexCAN_D receive queue is full (block, drop_oldest or drop_newest)',
                 },
                 'eQADC_A': {
                     'host': 'Host IP address for eQADC_D IO server',
                     'port': 'Host TCP port for eQADC_D IO server',
+                    'path': 'Unix domain socket path for eQADC_A IO server (used instead of host and port)',
+                    'protocol': 'IO wire protocol for eQADC_A clients (binary or pickle)',
+                    'queue_size': 'Maximum number of received messages queued for eQADC_A (0 is unbounded)',
+                    'queue_policy': 'Policy when the eQADC_A receive queue is full (block, drop_oldest or drop_newest)',
                 },
                 'eQADC_B': {
                     'host': 'Host IP address for eQADC_B IO server',
                     'port': 'Host TCP port for eQADC_B IO server',
+                    'path': 'Unix domain socket path for eQADC_B IO server (used instead of host and port)',
+                    'protocol': 'IO wire protocol for eQADC_B clients (binary or pickle)',
+                    'queue_size': 'Maximum number of received messages queued for eQADC_B (0 is unbounded)',
+                    'queue_policy': 'Policy when the eQADC_B receive queue is full (block, drop_oldest or drop_newest)',
                 },
             }
         }
@@ -458,6 +600,11 @@ class MPC5674_Emulator(e200z7.PPC_e200z7, project.VivProject):
                            help='Copy binary flash image to configuration directory (-c)')
         group.add_argument('-R', '--reset-backup', action='store_true',
                            help='Reset backup file, undoing any cached changes to the state of flash.')
+        iogroup = parser.add_mutually_exclusive_group()
+        iogroup.add_argument('--record-io', metavar='FILE',
+                             help='Record all external IO delivered to peripherals to FILE')
+        iogroup.add_argument('--replay-io', metavar='FILE',
+                             help='Replay external IO recorded with --record-io from FILE, no IO servers are started')
 
         # Open up the workspace and read the project configuration
         project.VivProject.__init__(self, defconfig=defconfig, docconfig=docconfig, args=args, parser=parser)
@@ -471,6 +618,22 @@ class MPC5674_Emulator(e200z7.PPC_e200z7, project.VivProject):
         # leftover
         self._process_args()
 
+        # Configure the instruction timing model
+        cpi_cfg = self.get_project_config('project.MPC5674.CPI')
+        cycles = dict((name, cpi_cfg[name]) for name in ppc_cycles.INSTR_CLASSES)
+        self.setCycleModel(ppc_cycles.PpcCycleModel(cpi_cfg['default'], **cycles))
+
+        # Enable real-time pacing if configured
+        pace_cfg = self.get_project_config('project.MPC5674.Pacing')
+        if pace_cfg['enabled']:
+            self.enablePacing(pace_cfg['scaling'], pace_cfg['max_lead'])
+
+        # Service external IO from a separate process if configured, this must
+        # be done before the peripherals are initialized
+        fe_cfg = self.get_project_config('project.MPC5674.IOFrontend')
+        if fe_cfg['enabled']:
+            self.enableIOFrontend(fe_cfg['ring_size'], fe_cfg['poll_interval'])
+
         # The backup file is assumed to be located in the "project directory"
         self.flash = FLASH(self)
 
@@ -519,36 +682,40 @@ class MPC5674_Emulator(e200z7.PPC_e200z7, project.VivProject):
                 eDMA('eDMA_B', self, 0xFFF54000),
         )
         self.intc = INTC(self, 0xFFF48000)
+
+        # Peripherals that there are several of (and are not needed by BAM or
+        # the clock configuration) are constructed the first time they are
+        # used, firmware often only uses a few of them.
         self.eqadc = (
-            eQADC('eQADC_A', self, 0xFFF80000),
-            eQADC('eQADC_B', self, 0xFFF84000),
+            LazyPeripheral(eQADC, EQADC_MMIO_SIZE, 'eQADC_A', self, 0xFFF80000),
+            LazyPeripheral(eQADC, EQADC_MMIO_SIZE, 'eQADC_B', self, 0xFFF84000),
         )
         self.decfilt = (
-            DECFILT('DECFILT_A', self, 0xFFF88000),
-            DECFILT('DECFILT_B', self, 0xFFF88800),
-            DECFILT('DECFILT_C', self, 0xFFF89000),
-            DECFILT('DECFILT_D', self, 0xFFF89800),
-            DECFILT('DECFILT_E', self, 0xFFF8A000),
-            DECFILT('DECFILT_F', self, 0xFFF8A800),
-            DECFILT('DECFILT_G', self, 0xFFF8B000),
-            DECFILT('DECFILT_H', self, 0xFFF8B800),
+            LazyPeripheral(DECFILT, DECFILT_MMIO_SIZE, 'DECFILT_A', self, 0xFFF88000),
+            LazyPeripheral(DECFILT, DECFILT_MMIO_SIZE, 'DECFILT_B', self, 0xFFF88800),
+            LazyPeripheral(DECFILT, DECFILT_MMIO_SIZE, 'DECFILT_C', self, 0xFFF89000),
+            LazyPeripheral(DECFILT, DECFILT_MMIO_SIZE, 'DECFILT_D', self, 0xFFF89800),
+            LazyPeripheral(DECFILT, DECFILT_MMIO_SIZE, 'DECFILT_E', self, 0xFFF8A000),
+            LazyPeripheral(DECFILT, DECFILT_MMIO_SIZE, 'DECFILT_F', self, 0xFFF8A800),
+            LazyPeripheral(DECFILT, DECFILT_MMIO_SIZE, 'DECFILT_G', self, 0xFFF8B000),
+            LazyPeripheral(DECFILT, DECFILT_MMIO_SIZE, 'DECFILT_H', self, 0xFFF8B800),
         )
         self.dspi = (
-            DSPI('DSPI_A', self, 0xFFF90000),
-            DSPI('DSPI_B', self, 0xFFF94000),
-            DSPI('DSPI_C', self, 0xFFF98000),
-            DSPI('DSPI_D', self, 0xFFF9C000),
+            LazyPeripheral(DSPI, DSPI_MMIO_SIZE, 'DSPI_A', self, 0xFFF90000),
+            LazyPeripheral(DSPI, DSPI_MMIO_SIZE, 'DSPI_B', self, 0xFFF94000),
+            LazyPeripheral(DSPI, DSPI_MMIO_SIZE, 'DSPI_C', self, 0xFFF98000),
+            LazyPeripheral(DSPI, DSPI_MMIO_SIZE, 'DSPI_D', self, 0xFFF9C000),
         )
         self.sci = (
-            eSCI('eSCI_A', self, 0xFFFB0000),
-            eSCI('eSCI_B', self, 0xFFFB4000),
-            eSCI('eSCI_C', self, 0xFFFB8000),
+            LazyPeripheral(eSCI, ESCI_MMIO_SIZE, 'eSCI_A', self, 0xFFFB0000),
+            LazyPeripheral(eSCI, ESCI_MMIO_SIZE, 'eSCI_B', self, 0xFFFB4000),
+            LazyPeripheral(eSCI, ESCI_MMIO_SIZE, 'eSCI_C', self, 0xFFFB8000),
         )
         self.can = (
-            FlexCAN('FlexCAN_A', self, 0xFFFC0000),
-            FlexCAN('FlexCAN_B', self, 0xFFFC4000),
-            FlexCAN('FlexCAN_C', self, 0xFFFC8000),
-            FlexCAN('FlexCAN_D', self, 0xFFFCC000),
+            LazyPeripheral(FlexCAN, FLEXCAN_MMIO_SIZE, 'FlexCAN_A', self, 0xFFFC0000),
+            LazyPeripheral(FlexCAN, FLEXCAN_MMIO_SIZE, 'FlexCAN_B', self, 0xFFFC4000),
+            LazyPeripheral(FlexCAN, FLEXCAN_MMIO_SIZE, 'FlexCAN_C', self, 0xFFFC8000),
+            LazyPeripheral(FlexCAN, FLEXCAN_MMIO_SIZE, 'FlexCAN_D', self, 0xFFFCC000),
         )
         #self.flexray = FLEXRAY(self, 0xFFFE0000)
         self.sim = SIM(self, 0xFFFEC000)
@@ -582,6 +749,12 @@ class MPC5674_Emulator(e200z7.PPC_e200z7, project.VivProject):
         # Complete initialization of the e200z7 core
         self.init()
 
+        # Start saving checkpoints for reverse execution if configured
+        ckpt_cfg = self.get_project_config('project.MPC5674.Checkpoints')
+        if ckpt_cfg['enabled']:
+            self.enableCheckpoints(ckpt_cfg['interval'], ckpt_cfg['max_memory'],
+                                   ckpt_cfg['max_latency'])
+
     def overrideEntryPoint(self):
         # If one valid entrypoint defined, move the PC there now and set the 
         # stack pointer (r1) to the end of RAM - 16 bytes (standard PowerPC 
@@ -631,6 +804,14 @@ class MPC5674_Emulator(e200z7.PPC_e200z7, project.VivProject):
         else:
             self._wait_for_gdb_client = False
 
+        # Start recording or replaying external IO, this must be done before
+        # the peripherals are created so IO peripherals don't start IO servers
+        # while replaying.
+        if self.args.record_io:
+            self.startIORecord(self.args.record_io)
+        elif self.args.replay_io:
+            self.startIOReplay(self.args.replay_io)
+
         # Track if this is a new configuration directory or not (needed by
         # init_flash)
         if self.home and not os.path.isdir(self.home):
@@ -795,6 +976,14 @@ class MPC5674_Emulator(e200z7.PPC_e200z7, project.VivProject):
         # Indicate that initial loading of flash memory from files is complete
         self.flash.load_complete(self.get_project_path(flash_cfg['backup']))
 
+        # Instructions decoded from main flash are saved in the project
+        # directory so they don't need to be decoded again the next time the
+        # same firmware is run.
+        if self.flash.image_hash is not None and self.config.project.cache:
+            filename = self.get_project_path('instructions.%s' % self.flash.image_hash)
+            flash_size = FLASH_DEVICE_MMIO_SIZE[FlashDevice.FLASH_MAIN]
+            self.setInstructionStore(instrstore.InstructionStore(filename, [(0, flash_size)]))
+
     def gpio(self, pinid, val=None):
         if val is not None:
             self.siu.connectGPIO(pinid, val)
@@ -822,6 +1011,17 @@ class MPC5674_Emulator(e200z7.PPC_e200z7, project.VivProject):
         # Init the core
         super().init()
 
+        # Now that BAM has configured the TLB the instructions in main flash
+        # can be decoded as full PPC or VLE instructions in the background
+        # while the rest of initialization completes.  This isn't necessary if
+        # decoded instructions were loaded from the project cache.
+        predecode_cfg = self.get_project_config('project.MPC5674.Predecode')
+        if predecode_cfg['enabled'] and \
+                (self.instr_store is None or len(self.instr_store) == 0):
+            flash_size = FLASH_DEVICE_MMIO_SIZE[FlashDevice.FLASH_MAIN]
+            self.startPredecode([(0, flash_size)], predecode_cfg['workers'],
+                                predecode_cfg['region_size'])
+
         # After BAM has initialized, if a valid entrypoint override exists, 
         # modify the initial state of the emulator.
         self.overrideEntryPoint()
@@ -846,7 +1046,10 @@ class MPC5674_Emulator(e200z7.PPC_e200z7, project.VivProject):
         end = addr + size
         logger.debug("reset: clearing SRAM 0x%08x - 0x%08x",
                 addr + standby_size, addr + size)
-        self.writeMemory(start, b'\x00' * (end - start))
+
+        # SRAM is a plain byte-backed memory map so it can be cleared directly
+        # instead of going through the normal writeMemory() path.
+        self.clearMemory(start, end - start)
 
         # Reset the core
         super().reset()
@@ -864,6 +1067,11 @@ class MPC5674_Emulator(e200z7.PPC_e200z7, project.VivProject):
             print()
             logger.info('Execution stopped @ 0x%x', self._cur_instr[1])
 
+            if self.pacingEnabled():
+                stats = self.getPacingStats()
+                logger.info('Pacing: %.2f%% behind real time (max lag %.6f sec)',
+                            stats['behind_percent'], stats['max_lag'])
+
 
 ### special register hardware interfacing
 # hook particular registers such that they don't store data, but rather interface to a virtual device
@@ -1,6 +1,9 @@
-import io
+import os
 import enum
 import struct
+import hashlib
+import binascii
+import collections
 
 import logging
 logger = logging.getLogger(__name__)
@@ -8,10 +11,15 @@ logger = logging.getLogger(__name__)
 import envi.const as e_const
 import envi.common as e_common
 import vivisect.const as viv_const
-import vivisect.parsers as viv_parsers
 
 __all__ = [
     'parse_ihex',
+    'parseLines',
+    'parseImage',
+    'ParsedImage',
+    'fileDigest',
+    'loadCache',
+    'saveCache',
 
     # The vivisect parser module standard functions
     'parseFile',
@@ -19,6 +27,30 @@ __all__ = [
 ]
 
 
+# The parsed contents of an xcal file are cached in a file next to the xcal
+# file with this suffix
+CACHE_SUFFIX = '.parsed'
+CACHE_MAGIC = b'XCAL'
+CACHE_VERSION = 1
+
+# The size of the chunks the xcal file is read in when checking the MD5 digest
+# of a cached file
+CACHE_READ_SIZE = 0x100000
+
+# Cache header: magic, version, source file size, source file mtime (ns), md5,
+# sha256 and sha256 of the ihex lines of the source file, number of blocks and
+# number of entry points.  The size, mtime and md5 are used to check that the
+# cache matches the source file.  The header is followed by the entry points
+# and then the address, size and data of each block.
+CACHE_HDR = struct.Struct('>4sHQQ16s32s32sII')
+CACHE_ENTRY = struct.Struct('>I')
+CACHE_BLOCK = struct.Struct('>II')
+
+
+ParsedImage = collections.namedtuple('ParsedImage', [
+    'md5', 'sha256', 'sha256_ihex', 'blocks', 'entrypoints'])
+
+
 class CODE(enum.IntEnum):
     DATA = 0
     EOF = 1
@@ -32,18 +64,15 @@ def checksum(data, init=0):
     """
     Performs a simple 1-byte checksum as used by the ihex file format
     """
-    val = init
-    for i in range(len(data)):
-        val = (val + data[i]) & 0xFF
-    return val
+    return (init + sum(data)) & 0xFF
 
 
 def parse_ihex(filename):
     """
     Utility wrapper around the parse function
     """
-    with open(filename, 'r') as f:
-        blocks, _ = parse(f.read())
+    with open(filename, 'rb') as f:
+        blocks, _ = parseLines(f)
         return blocks
 
 
@@ -51,24 +80,28 @@ def parse(data):
     """
     Parses ihex files and ignores any invalid data
     """
+    return parseLines(data.splitlines())
+
+
+def parseLines(lines):
+    """
+    Parses ihex data one line at a time from an iterable of lines (str or
+    bytes, such as an open file), lines that are not ihex records are ignored.
+    Contiguous data records are combined into one block.
+    """
     blocks = {}
     entrypoints = []
     cur_block = None
     cur_offset = None
     offset = 0
 
-    # readlines is really useful for this and ihex files only use ascii 
-    # characters so treat the incoming bytes as string data
-    with io.StringIO(data) as f:
-        lines = f.readlines()
-
     for line in lines:
         # Check
-        if line[0] != ':':
+        if line[:1] not in (':', b':'):
             continue
 
         # convert the line to bytes (drop the ':' and newline)
-        line_data = bytes.fromhex(line.strip(':\r\n'))
+        line_data = binascii.unhexlify(line[1:].rstrip())
 
         # Validate the checksum
         assert checksum(line_data) == 0
@@ -104,7 +137,7 @@ def parse(data):
             logger.log(e_common.MIRE, '%s: 0x%04x -> 0x%08x', CODE(code).name, base, offset)
 
         elif code == CODE.START_SEG_ADDR:
-            cs, ip = struct.unpack_from('>HH', line_data, 4)[0]
+            cs, ip = struct.unpack_from('>HH', line_data, 4)
             offset = (cs << 4) + ip
             entrypoints.append(offset)
             logger.log(e_common.MIRE, '%s: 0x%04x, 0x%04x -> 0x%08x', CODE(code).name, cs, ip, offset)
@@ -128,14 +161,124 @@ def parse(data):
     return (blocks, entrypoints)
 
 
+def parseImage(filename):
+    """
+    Parses an xcal file in one pass, calculating the file hashes that vivisect
+    needs as the file is read. Returns a ParsedImage.
+    """
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    sha256_ihex = hashlib.sha256()
+
+    def _lines(f):
+        for line in f:
+            md5.update(line)
+            sha256.update(line)
+            if line[:1] == b':':
+                sha256_ihex.update(line)
+                yield line
+
+    with open(filename, 'rb') as f:
+        lines = _lines(f)
+        try:
+            blocks, entrypoints = parseLines(lines)
+        except ValueError:
+            # Not a valid ihex/xcal file
+            raise Exception('%s not a valid xcal (ihex) file' % filename)
+
+        # Any lines after the EOF record still need to be hashed
+        for _ in lines:
+            pass
+
+    return ParsedImage(md5.digest(), sha256.digest(), sha256_ihex.digest(), blocks, entrypoints)
+
+
+def fileDigest(filename):
+    """
+    Returns the MD5 digest of the contents of a file
+    """
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(CACHE_READ_SIZE), b''):
+            md5.update(chunk)
+    return md5.digest()
+
+
+def loadCache(filename):
+    """
+    Returns the ParsedImage saved in the cache file for an xcal file, or None
+    if there is no cache file or the cache file does not match the current
+    size, modification time and MD5 digest of the xcal file.  Hashing the
+    file is much faster than parsing it, and it ensures a file that was
+    changed without changing its size and modification time is re-parsed.
+    """
+    try:
+        info = os.stat(filename)
+        with open(filename + CACHE_SUFFIX, 'rb') as f:
+            hdr = f.read(CACHE_HDR.size)
+            if len(hdr) != CACHE_HDR.size:
+                return None
+
+            magic, version, size, mtime, md5, sha256, sha256_ihex, num_blocks, num_entries = \
+                    CACHE_HDR.unpack(hdr)
+            if magic != CACHE_MAGIC or version != CACHE_VERSION or \
+                    size != info.st_size or mtime != info.st_mtime_ns or \
+                    md5 != fileDigest(filename):
+                return None
+
+            entrypoints = [CACHE_ENTRY.unpack(f.read(CACHE_ENTRY.size))[0] for _ in range(num_entries)]
+            blocks = {}
+            for _ in range(num_blocks):
+                addr, blocksize = CACHE_BLOCK.unpack(f.read(CACHE_BLOCK.size))
+                data = f.read(blocksize)
+                if len(data) != blocksize:
+                    return None
+                blocks[addr] = data
+
+    except (OSError, struct.error):
+        return None
+
+    return ParsedImage(md5, sha256, sha256_ihex, blocks, entrypoints)
+
+
+def saveCache(filename, image):
+    """
+    Save a ParsedImage to the cache file for an xcal file, errors writing the
+    cache file are ignored.
+    """
+    cache_filename = filename + CACHE_SUFFIX
+    tmp_filename = cache_filename + '.tmp'
+    try:
+        info = os.stat(filename)
+        with open(tmp_filename, 'wb') as f:
+            f.write(CACHE_HDR.pack(CACHE_MAGIC, CACHE_VERSION, info.st_size,
+                                   info.st_mtime_ns, image.md5, image.sha256,
+                                   image.sha256_ihex, len(image.blocks),
+                                   len(image.entrypoints)))
+            for eva in image.entrypoints:
+                f.write(CACHE_ENTRY.pack(eva))
+            for addr, data in image.blocks.items():
+                f.write(CACHE_BLOCK.pack(addr, len(data)))
+                f.write(data)
+        os.replace(tmp_filename, cache_filename)
+    except OSError as exc:
+        logger.debug('Unable to save parsed xcal cache %s: %s', cache_filename, exc)
+
+
 def parseFile(vw, filename, baseaddr=None):
     """
     Designed to be used by vivisect as one of the file parser modules
     """
     logger.info('Loading XCAL file %s', filename)
 
-    with open(filename, 'rb') as f:
-        data = f.read()
+    # If the file has not changed since it was last loaded use the cached
+    # results
+    image = loadCache(filename)
+    if image is None:
+        image = parseImage(filename)
+        saveCache(filename, image)
+    else:
+        logger.debug('Using parsed xcal cache %s', filename + CACHE_SUFFIX)
 
     # Re-use the settings from the ihex parser, but don't throw an error if 
     # there is no arch set. the project will define an arch.
@@ -149,32 +292,18 @@ def parseFile(vw, filename, baseaddr=None):
     vw.setMeta('Format', 'ihex')
 
     # We need two SHA256 hashes to collect the information that should be 
-    # collected by a vivisect file parser. Also an MD5 is attached to the 
-    # filename
-    fname = vw.addFile(filename, 0, viv_parsers.md5Bytes(data))
-    vw.setFileMeta(fname, 'sha256', viv_parsers.sha256Bytes(data))
-
-    # Gather only the valid ihex data
-    with io.BytesIO(data) as f:
-        lines = f.readlines()
-        prefix = ord(b':')
-        ihex_data = b''.join(l for l in lines if l[0] == prefix)
-
-    vw.setFileMeta(fname, 'sha256_ihex', viv_parsers.sha256Bytes(ihex_data))
-
-    # ihex and xcal files should all be ascii
-    try:
-        blocks, entrypoints = parse(ihex_data.decode())
-    except UnicodeDecodeError:
-        # Not a valid ihex/xcal file
-        raise Exception('%s not a valid xcal (ihex) file' % filename)
+    # collected by a vivisect file parser (the second is of only the valid ihex
+    # data). Also an MD5 is attached to the filename
+    fname = vw.addFile(filename, 0, image.md5.hex())
+    vw.setFileMeta(fname, 'sha256', image.sha256.hex().upper())
+    vw.setFileMeta(fname, 'sha256_ihex', image.sha256_ihex.hex().upper())
 
-    for addr, data in blocks.items():
+    for addr, data in image.blocks.items():
         logger.info('adding memory map from IHEX: 0x%x - 0x%x', addr, addr + len(data))
         vw.addMemoryMap(addr, e_const.MM_RWX, '', data)
         vw.addSegment(addr, len(data), '%.8x' % addr, fname)
 
-    for eva in entrypoints:
+    for eva in image.entrypoints:
         if eva is not None:
             logger.info('adding function from IHEX metadata: 0x%x', eva)
             vw.addEntryPoint(eva)
@@ -1,5 +1,16 @@
+import enum
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import envi.bits as e_bits
+
 from ..ppc_vstructs import *
 from ..ppc_peripherals import *
+from ..intc_src import INTC_EVENT_MAP
+from ..intc_exc import INTC_EVENT, ExternalException
 
 import logging
 logger = logging.getLogger(__name__)
@@ -9,6 +20,9 @@ __all__  = [
 ]
 
 
+# Size of the DECFILT MMIO region
+DECFILT_MMIO_SIZE = 0x800
+
 DECFILT_MCR_OFFSET     = 0x0000
 DECFILT_MSR_OFFSET     = 0x0004
 DECFILT_MXCR_OFFSET    = 0x0008
@@ -31,6 +45,65 @@ DECFILT_COEF_SIGN_MASK = 0xFF000000
 DECFILT_NUM_COEF       = 9
 DECFILT_NUM_TAP        = 8
 
+# The coefficients are signed 24-bit fixed point values with 23 fractional
+# bits
+DECFILT_COEF_FRAC_BITS = 23
+
+# Input and output samples are signed 16-bit values
+DECFILT_SAMPLE_MIN     = -0x8000
+DECFILT_SAMPLE_MAX     = 0x7FFF
+
+# The integrator value is a signed 32-bit value and the count is unsigned
+DECFILT_INT_VALUE_MIN  = -0x80000000
+DECFILT_INT_VALUE_MAX  = 0x7FFFFFFF
+DECFILT_INT_COUNT_MAX  = 0xFFFFFFFF
+
+# The minimum number of samples in a burst before the NumPy filter is used, for
+# fewer samples the setup cost is higher than just filtering each sample
+DECFILT_BATCH_MIN      = 8
+
+
+class DECFILT_FTYPE(enum.IntEnum):
+    """
+    MCR[FTYPE] filter types. The FIR filter uses all 9 coefficients (the
+    current input and the previous 8 inputs in the TAP registers). The IIR
+    filter is a 4th order direct form I filter: COEF0-4 are the feed-forward
+    coefficients, COEF5-8 are the feedback coefficients, TAP0-3 hold the
+    previous inputs and TAP4-7 hold the previous filter outputs. The reserved
+    value 0b11 is treated as bypass.
+    """
+    FIR    = 0b00
+    IIR    = 0b01
+    BYPASS = 0b10
+
+
+# MCR[SCAL] output scaling factors
+DECFILT_SCALE = (1, 4, 8, 16)
+
+
+# The MSR status flags that have an INTC event, the event names for each
+# decimation filter follow the pattern DEC<x>_MSR_<FLAG>
+DECFILT_INT_FLAGS = ('idf', 'odf', 'ibif', 'obif', 'divr', 'ovr', 'ivr')
+
+DECFILT_INT_EVENTS = {
+    'DECFILT_%s' % x: {
+        f: getattr(INTC_EVENT, 'DEC%s_MSR_%s' % (x, f.upper())) for f in DECFILT_INT_FLAGS
+    } for x in 'ABCDEFGH'
+}
+
+
+# The MCR fields that enable each of the MSR events
+DECFILT_INT_ENABLE = {
+    'idf':  'iden',
+    'odf':  'oden',
+    'ibif': 'ibie',
+    'obif': 'obie',
+    'divr': 'erren',
+    'ovf':  'erren',
+    'ovr':  'erren',
+    'ivr':  'erren',
+}
+
 
 class DECFILT_x_MCR(PeriphRegister):
     def __init__(self):
@@ -228,6 +301,11 @@ class DECFILT_x_EDID(PeriphRegister):
         self._pad0 = v_const(16)
         self.samp_data = v_const(16)
 
+class DECFILT_x_COEF(PeriphRegister):
+    def __init__(self):
+        super().__init__()
+        self.value = v_bits(32)
+
 class DECFILT_x_VALUE(PeriphRegister):
     def __init__(self):
         super().__init__()
@@ -248,7 +326,7 @@ class DECFILT_REGISTERS(PeripheralRegisterSet):
         self.mxsr    = (DECFILT_MXSR_OFFSET,    DECFILT_x_MXSR())
         self.ib      = (DECFILT_IB_OFFSET,      DECFILT_x_IB())
         self.ob      = (DECFILT_OB_OFFSET,      DECFILT_x_OB())
-        self.coef    = (DECFILT_COEF_OFFSET,    VTuple([DECFILT_x_VALUE() for i in range(DECFILT_NUM_COEF)]))
+        self.coef    = (DECFILT_COEF_OFFSET,    VTuple([DECFILT_x_COEF() for i in range(DECFILT_NUM_COEF)]))
         self.tap     = (DECFILT_TAP_OFFSET,     VTuple([DECFILT_x_VALUE() for i in range(DECFILT_NUM_TAP)]))
         self.edid    = (DECFILT_EDID_OFFSET,    DECFILT_x_EDID())
         self.fintval = (DECFILT_FINTVAL_OFFSET, DECFILT_x_VALUE())
@@ -258,8 +336,22 @@ class DECFILT_REGISTERS(PeripheralRegisterSet):
 
 
 class DECFILT(MMIOPeripheral):
+    """
+    Decimation filter peripheral. Samples are received either from the IB
+    register or directly from an eQADC conversion (when the eQADC alternate
+    configuration DEST field selects a decimation filter). Outputs of IB
+    samples are written to the OB register, outputs of eQADC samples are
+    returned to the source eQADC by processSamples().
+
+    The filter state (TAPs, decimation counter and integrator) is held in the
+    peripheral registers so it is preserved by snapshots.
+    """
     def __init__(self, devname, emu, mmio_addr):
-        super().__init__(emu, devname, mmio_addr, 0x800, regsetcls=DECFILT_REGISTERS)
+        super().__init__(emu, devname, mmio_addr, DECFILT_MMIO_SIZE, regsetcls=DECFILT_REGISTERS)
+
+        # The MSR status flags are enabled by MCR fields with different names
+        # so the standard MMIOPeripheral event() function can't be used
+        self._events = DECFILT_INT_EVENTS[devname]
 
         self.registers.vsAddParseCallback('mcr', self.mcrUpdate)
         self.registers.vsAddParseCallback('mxcr', self.mxcrUpdate)
@@ -275,17 +367,17 @@ class DECFILT(MMIOPeripheral):
             vobj.reset()
 
     def mcrUpdate(self, thing):
-        if self.registers.msr.sres:
-            self.registers.msr.sres = 0
+        if self.registers.mcr.sres:
+            self.registers.mcr.sres = 0
             self.softReset()
 
     def mxcrUpdate(self, thing):
-        if self.registers.msr.srq:
-            self.registers.msr.srq = 0
+        if self.registers.mxcr.srq:
+            self.registers.mxcr.srq = 0
             self.integratorOutputRequest()
 
-        if self.registers.msr.szro:
-            self.registers.msr.szro = 0
+        if self.registers.mxcr.szro:
+            self.registers.mxcr.szro = 0
             self.integratorZero()
 
     def ibUpdate(self, thing):
@@ -299,11 +391,250 @@ class DECFILT(MMIOPeripheral):
         else:
             self.registers.coef[idx].value = coef & ~DECFILT_COEF_SIGN_MASK
 
+    def filterEvent(self, field):
+        """
+        Set an MSR status flag and if the event is enabled in the MCR send the
+        associated interrupt, or DMA request if MCR[DSEL] is set. Like the
+        MMIOPeripheral event() function the status flag is not set when a DMA
+        request is sent.
+        """
+        msr = self.registers.msr
+        if getattr(msr, field):
+            return
+
+        enabled = getattr(self.registers.mcr, DECFILT_INT_ENABLE[field])
+        intc_src, dma_req = INTC_EVENT_MAP.get(self._events.get(field), (None, None))
+        if enabled and dma_req is not None and self.registers.mcr.dsel:
+            logger.debug('[%s] sending DMA request %s for %s', self.devname, dma_req, field)
+            self.emu.dmaRequest(dma_req)
+        else:
+            msr.vsOverrideValue(field, 1)
+            if enabled and intc_src is not None:
+                logger.debug('[%s] queuing exception %s for %s', self.devname, intc_src, field)
+                self.emu.queueException(ExternalException(intc_src))
+
     def integratorOutputRequest(self):
-        raise NotImplementedError()
+        """
+        Copy the current integrator value and count to the CINTVAL and CINTCNT
+        registers
+        """
+        self.registers.cintval.vsOverrideValue('value', self.registers.fintval.value)
+        self.registers.cintcnt.vsOverrideValue('count', self.registers.fintcnt.count)
+        self.registers.mxsr.vsOverrideValue('sdf', 1)
 
     def integratorZero(self):
-        raise NotImplementedError()
+        self.registers.fintval.vsOverrideValue('value', 0)
+        self.registers.fintcnt.vsOverrideValue('count', 0)
 
     def newInput(self):
-        raise NotImplementedError()
+        """
+        Process a sample written to the IB register
+        """
+        if self.registers.mcr.mdis:
+            return
+
+        ib = self.registers.ib
+        value = ib.inpbuf
+        if self.registers.mcr.edme:
+            self.registers.edid.vsOverrideValue('samp_data', value)
+        self.filterEvent('idf')
+
+        if ib.flush:
+            # Discard the sample and clear the filter state
+            for _, vobj in self.registers.tap.vsGetFields():
+                vobj.reset()
+            self.registers.msr.vsOverrideValue('dec_counter', 0)
+
+        elif ib.prefill:
+            # Shift the sample into the TAPs without producing an output
+            self._filter([e_bits.signed(value, 2)], [ib.intag], prefill=True)
+
+        else:
+            for tag, result in self._filter([e_bits.signed(value, 2)], [ib.intag]):
+                self._writeOutput(tag, result)
+
+        # The input buffer is ready for the next sample
+        self.filterEvent('ibif')
+
+    def processSamples(self, samples, tags=None):
+        """
+        Filter a burst of 16-bit samples, such as the results of a CFIFO burst
+        of eQADC conversions. The tags are the result tags of each sample, if
+        not provided all samples use tag 0.
+
+        Returns a list of (tag, value) tuples of the decimated filter outputs,
+        the values are unsigned 16-bit integers.
+        """
+        if self.registers.mcr.mdis or not samples:
+            return []
+
+        if tags is None:
+            tags = [0] * len(samples)
+
+        if numpy is not None:
+            inputs = numpy.asarray(samples, dtype=numpy.int64)
+            inputs = ((inputs + 0x8000) & 0xFFFF) - 0x8000
+        else:
+            inputs = [e_bits.signed(s & 0xFFFF, 2) for s in samples]
+
+        if self.registers.mcr.edme:
+            self.registers.edid.vsOverrideValue('samp_data', int(samples[-1]) & 0xFFFF)
+
+        return [(tag, result & 0xFFFF) for tag, result in self._filter(inputs, tags)]
+
+    def _writeOutput(self, tag, value):
+        # If the previous output has not been read yet it is overwritten
+        if self.registers.msr.obif:
+            self.filterEvent('ovr')
+
+        self.registers.ob.vsOverrideValue('outtag', tag)
+        self.registers.ob.vsOverrideValue('outbuf', value & 0xFFFF)
+        self.filterEvent('odf')
+        self.filterEvent('obif')
+
+    def _filter(self, inputs, tags, prefill=False):
+        """
+        Run signed input samples through the filter and integrator, returns a
+        list of (tag, value) tuples of the signed decimated outputs. Bursts of
+        FIR filter samples are processed with NumPy if it is available.
+        """
+        mcr = self.registers.mcr
+        msr = self.registers.msr
+        ftype = mcr.ftype
+
+        coefs = [e_bits.signed(self.registers.coef[i].value, 4) for i in range(DECFILT_NUM_COEF)]
+        taps = [e_bits.signed(self.registers.tap[i].value, 4) for i in range(DECFILT_NUM_TAP)]
+
+        if prefill:
+            for x in inputs:
+                self._filterStep(ftype, coefs, taps, x)
+            self._saveTaps(taps)
+            return []
+
+        # Identify which inputs produce an output, the decimation counter
+        # counts the inputs received since the last output
+        period = mcr.dec_rate + 1
+        counter = msr.dec_counter
+        out_idx = range(max(period - counter - 1, 0), len(inputs), period)
+        msr.vsOverrideValue('dec_counter', (counter + len(inputs)) % period)
+
+        if numpy is not None and ftype == DECFILT_FTYPE.FIR and len(inputs) >= DECFILT_BATCH_MIN:
+            outputs = self._filterFIRBatch(coefs, taps, inputs, out_idx)
+        else:
+            outputs = []
+            for x in inputs:
+                outputs.append(self._filterStep(ftype, coefs, taps, int(x)))
+            outputs = self._scale([outputs[i] for i in out_idx])
+
+        self._saveTaps(taps)
+
+        if not mcr.idis:
+            if self.registers.mxcr.sisel:
+                self._integrate([int(x) for x in inputs])
+            else:
+                self._integrate(outputs)
+
+        return list(zip((tags[i] for i in out_idx), outputs))
+
+    def _filterStep(self, ftype, coefs, taps, x):
+        # Filter one sample, updates the taps list and returns the unscaled
+        # filter output
+        if ftype == DECFILT_FTYPE.FIR:
+            acc = coefs[0] * x
+            for c, t in zip(coefs[1:], taps):
+                acc += c * t
+            taps.insert(0, x)
+            del taps[DECFILT_NUM_TAP:]
+            return acc >> DECFILT_COEF_FRAC_BITS
+
+        elif ftype == DECFILT_FTYPE.IIR:
+            acc = coefs[0] * x
+            for c, t in zip(coefs[1:], taps):
+                acc += c * t
+            y = e_bits.signed((acc >> DECFILT_COEF_FRAC_BITS) & 0xFFFFFFFF, 4)
+            taps[:] = [x] + taps[0:3] + [y] + taps[4:7]
+            return y
+
+        else:
+            return x
+
+    def _filterFIRBatch(self, coefs, taps, inputs, out_idx):
+        # The previous inputs (oldest first) followed by the new inputs, the
+        # "valid" convolution produces one filter sum for each new input.  The
+        # 16-bit samples multiplied by 24-bit coefficients can't overflow
+        # 64-bit integers.
+        history = numpy.concatenate((numpy.array(taps[::-1], dtype=numpy.int64),
+                                     numpy.asarray(inputs, dtype=numpy.int64)))
+        acc = numpy.convolve(history, numpy.array(coefs, dtype=numpy.int64), 'valid')
+        taps[:] = history[-DECFILT_NUM_TAP:][::-1].tolist()
+
+        outputs = acc[out_idx.start::out_idx.step] >> DECFILT_COEF_FRAC_BITS
+        outputs *= DECFILT_SCALE[self.registers.mcr.scal]
+
+        overflow = (outputs > DECFILT_SAMPLE_MAX) | (outputs < DECFILT_SAMPLE_MIN)
+        if overflow.any():
+            self.filterEvent('ovf')
+            if self.registers.mcr.sat:
+                numpy.clip(outputs, DECFILT_SAMPLE_MIN, DECFILT_SAMPLE_MAX, out=outputs)
+            else:
+                outputs = ((outputs + 0x8000) & 0xFFFF) - 0x8000
+        return outputs.tolist()
+
+    def _scale(self, outputs):
+        # Apply the output scale factor and saturate or truncate the outputs to
+        # 16 bits
+        scale = DECFILT_SCALE[self.registers.mcr.scal]
+        sat = self.registers.mcr.sat
+        results = []
+        for y in outputs:
+            y *= scale
+            if y > DECFILT_SAMPLE_MAX or y < DECFILT_SAMPLE_MIN:
+                self.filterEvent('ovf')
+                if sat:
+                    y = max(DECFILT_SAMPLE_MIN, min(y, DECFILT_SAMPLE_MAX))
+                else:
+                    y = e_bits.signed(y & 0xFFFF, 2)
+            results.append(y)
+        return results
+
+    def _saveTaps(self, taps):
+        for i, t in enumerate(taps):
+            self.registers.tap[i].vsOverrideValue('value', t & 0xFFFFFFFF)
+
+    def _integrate(self, values):
+        if not values:
+            return
+
+        mxcr = self.registers.mxcr
+        mxsr = self.registers.mxsr
+        total = e_bits.signed(self.registers.fintval.value, 4)
+        count = self.registers.fintcnt.count + len(values)
+
+        if numpy is not None:
+            sums = total + numpy.cumsum(values, dtype=numpy.int64)
+            in_range = sums.max() <= DECFILT_INT_VALUE_MAX and sums.min() >= DECFILT_INT_VALUE_MIN
+            if in_range:
+                total = int(sums[-1])
+        else:
+            in_range = False
+
+        if not in_range:
+            # Accumulate each value so saturation happens at the right point
+            for value in values:
+                total += value
+                if total > DECFILT_INT_VALUE_MAX or total < DECFILT_INT_VALUE_MIN:
+                    mxsr.vsOverrideValue('ssovf', 1)
+                    if mxcr.ssat:
+                        total = max(DECFILT_INT_VALUE_MIN, min(total, DECFILT_INT_VALUE_MAX))
+                    else:
+                        total = e_bits.signed(total & 0xFFFFFFFF, 4)
+
+        if count > DECFILT_INT_COUNT_MAX:
+            mxsr.vsOverrideValue('scovf', 1)
+            if mxcr.scsat:
+                count = DECFILT_INT_COUNT_MAX
+            else:
+                count &= DECFILT_INT_COUNT_MAX
+
+        self.registers.fintval.vsOverrideValue('value', total & 0xFFFFFFFF)
+        self.registers.fintcnt.vsOverrideValue('count', count)
@@ -1,4 +1,5 @@
 import enum
+import collections
 
 import envi.bits as e_bits
 
@@ -19,6 +20,9 @@ __all__  = [
 
 
 
+# Size of the DSPI MMIO region
+DSPI_MMIO_SIZE = 0x4000
+
 DSPI_MCR_OFFSET     = 0x0000
 DSPI_TCR_OFFSET     = 0x0008
 DSPI_CTAR_OFFSET    = 0x000C
@@ -350,6 +354,21 @@ class SPIBus(BusPeripheral):
         else:
             logger.info('%s TRANSMIT PCS%d: 0x%x (NO DEVICE)', self.devname, cs, value)
 
+    def transmitBurst(self, cs, values):
+        """
+        Customization of the BusPeripheral.transmitBurst() function, to give
+        easier to read log messages.
+        """
+        device = self.devices.get(cs)
+        if device is not None:
+            logger.log(MIRE, '%s -> %s: %d frames', self.devname, device.name, len(values))
+            results = device.receiveBurst(values)
+            if results:
+                logger.log(MIRE, '%s <- %s: %d frames', self.devname, device.name, len(results))
+                device.transmitBurst(results)
+        else:
+            logger.info('%s TRANSMIT PCS%d: %d frames (NO DEVICE)', self.devname, cs, len(values))
+
 
 class DSPI(SPIBus):
     """
@@ -367,22 +386,28 @@ class DSPI(SPIBus):
 
     <tx/rx example tbd>
     """
+    _snap_objs = ('_tx_fifo', '_rx_fifo')
+    _snap_refs = ('_rx_backlog',)
+
     def __init__(self, devname, emu, mmio_addr):
         """
         DSPI constructor.  Each processor has multiple DSPI peripherals so the
         devname parameter must be unique.
         """
-        super().__init__(emu, devname, mmio_addr, 0x4000,
+        super().__init__(emu, devname, mmio_addr, DSPI_MMIO_SIZE,
                 regsetcls=DSPI_REGISTERS,
                 isrstatus='sr', isrflags='rser', isrevents=DSPI_INT_EVENTS)
 
         self.mode = None
         self._tx_fifo = None
+
+        # SR[RXCTR] does not include the "shift register" so the length of the
+        # Rx FIFO is used to keep track of the real Rx FIFO size
         self._rx_fifo = None
 
-        # We need a value other than SR[RXCTR] to keep track of the real Rx FIFO
-        # size
-        self._rx_fifo_size = 0
+        # Frames received in a burst that don't fit in the Rx FIFO while DMA
+        # is draining it, they are moved into the Rx FIFO as it is drained.
+        self._rx_backlog = collections.deque()
 
         # TODO: read from a fixed-log or buffer, for now we make this match
         # what the real CM2350 reads from the DSPI buses
@@ -408,10 +433,11 @@ class DSPI(SPIBus):
         super().reset(emu)
 
         # Set the Tx and Rx FIFOs to default sizes and values the FIFO region
-        # has 4 elements
-        self._tx_fifo = bytearray(DSPI_TX_FIFO_LEN)
-        self._rx_fifo = bytearray(DSPI_RX_FIFO_LEN)
-        self._rx_fifo_size = 0
+        # has 4 elements, the newest Tx FIFO entry is in TXFR0
+        fill = b'\x00' * DSPI_MSG_SIZE
+        self._tx_fifo = RingFIFO(DSPI_FIFO_SIZE, fill, newest_first=True)
+        self._rx_fifo = RingFIFO(DSPI_RX_FIFO_SIZE, fill)
+        self._rx_backlog.clear()
 
         self.updateMode()
 
@@ -419,7 +445,7 @@ class DSPI(SPIBus):
         """
         Customization of the standard ExternalIOPeripheral _getPeriphReg()
         function to allow custom handling of the PUSHR, POPR, TXFR, and RXFR
-        registers which are implemented with bytearray's outside of the standard
+        registers which are implemented with RingFIFO's outside of the standard
         PeripheralRegisterSet object.
         """
 
@@ -429,7 +455,7 @@ class DSPI(SPIBus):
         if offset in DSPI_PUSHR_RANGE:
             # Read the last item pushed, which is at offset 0
             idx = offset - DSPI_PUSHR_OFFSET
-            return bytes(self._tx_fifo[idx:idx+size])
+            return self._tx_fifo.readBytes(idx, size)
 
         elif offset in DSPI_POPR_RANGE:
             # Any size read in the POPR register address range causes a new
@@ -438,12 +464,14 @@ class DSPI(SPIBus):
             return self.popRx()[-size:]
 
         elif offset in DSPI_TXFR_RANGE:
+            # The newest item is in TXFR0, SR[TXNXTPTR] is the index of the
+            # oldest item
             idx = offset - DSPI_TXFR_OFFSET
-            return bytes(self._tx_fifo[idx:idx+size])
+            return self._tx_fifo.readBytes(idx, size)
 
         elif offset in DSPI_RXFR_RANGE:
             idx = offset - DSPI_RXFR_OFFSET
-            return bytes(self._rx_fifo[idx:idx+size])
+            return self._rx_fifo.readBytes(idx, size)
 
         else:
             return super()._getPeriphReg(offset, size)
@@ -482,26 +510,32 @@ class DSPI(SPIBus):
         If in peripheral mode, use the configuration in CTAR0 to send a reply.
         If in controller mode, add the incoming data to the Rx FIFO.
         """
+        # A list is the response to a burst of frames, those frames were
+        # transmitted while Tx/Rx was enabled so only discard the responses if
+        # the peripheral has been disabled since then.
+        if isinstance(obj, list):
+            if self.mode == DSPI_MODE.DISABLE:
+                logger.debug('[%s] %s: discarding %d msgs', self.devname, self.mode, len(obj))
+            else:
+                self.pushRxBurst(obj)
+
         # If the peripheral is disabled, just discard this data
-        if self.mode == DSPI_MODE.DISABLE or self.registers.sr.txrxs == 0:
+        elif self.mode == DSPI_MODE.DISABLE or self.registers.sr.txrxs == 0:
             logger.debug('[%s] %s: discarding msg %r', self.devname, self.mode, obj)
         else:
             # Add the received data to the Rx FIFO (convert to bytes first)
             value = e_bits.buildbytes(obj, DSPI_MSG_SIZE, bigend=self.emu.getEndian())
             self.pushRx(value)
 
-    def normalTx(self, data):
+    def _parsePushr(self, data):
         """
-        Accept a transmit buffer, decode into the relevant PUSHR register
-        fields, look up the corresponding CATRx register and the relevant
-        configuration values from that register, and return the data necessary
-        to transmit this data.
+        Decode a transmit buffer into the relevant PUSHR register fields and
+        use the frame size from the selected CTARx register to get the value
+        to transmit.
 
-        Returns an indication of if this Tx buffer is configured as the last
-        data in the Tx queue.
+        Returns a tuple of the chip select, value, EOQ and CTCNT flags.
         """
         pushr_value = e_bits.parsebytes(data, 0, DSPI_MSG_SIZE, bigend=self.emu.getEndian())
-        cont = (pushr_value & PUSHR_CONT_MASK) >> PUSHR_CONT_SHIFT
         ctas = (pushr_value & PUSHR_CTAS_MASK) >> PUSHR_CTAS_SHIFT
         eoq = (pushr_value & PUSHR_EOQ_MASK) >> PUSHR_EOQ_SHIFT
         ctcnt = (pushr_value & PUSHR_CTCNT_MASK) >> PUSHR_CTCNT_SHIFT
@@ -513,6 +547,20 @@ class DSPI(SPIBus):
         bits = ctar.fmsz + 1
         value = pushr_value & e_bits.b_masks[bits]
 
+        return pcs, value, eoq, ctcnt
+
+    def normalTx(self, data):
+        """
+        Accept a transmit buffer, decode into the relevant PUSHR register
+        fields, look up the corresponding CATRx register and the relevant
+        configuration values from that register, and return the data necessary
+        to transmit this data.
+
+        Returns an indication of if this Tx buffer is configured as the last
+        data in the Tx queue.
+        """
+        pcs, value, eoq, ctcnt = self._parsePushr(data)
+
         # If the PUSHR[CTCNT] flag is set, change the count to 0 before we
         # transmit
         if ctcnt == 1:
@@ -541,6 +589,106 @@ class DSPI(SPIBus):
 
         return eoq
 
+    def transmitFrames(self, frames):
+        """
+        Burst version of normalTx(), transmits a sequence of transmit buffers.
+        Consecutive frames sent to the same chip select are passed to the bus
+        device in one transmitBurst() call. Transmission stops after a frame
+        that has the EOQ flag set.
+
+        The TCR[SPI_TCNT] and the SR[TCF] and SR[EOQF] events are updated once
+        for the whole burst.
+
+        Returns the number of frames transmitted.
+        """
+        tcnt = self.registers.tcr.spi_tcnt
+        count = 0
+        eoq = 0
+        pcs = None
+        values = []
+        for data in frames:
+            frame_pcs, value, eoq, ctcnt = self._parsePushr(data)
+            if frame_pcs != pcs and values:
+                self.transmitBurst(pcs, values)
+                values = []
+            pcs = frame_pcs
+            values.append(value)
+
+            # If the PUSHR[CTCNT] flag is set the count is changed to 0
+            # before the frame is transmitted
+            if ctcnt == 1:
+                tcnt = 1
+            else:
+                tcnt = (tcnt + 1) & DSPI_MAX_TCNT
+
+            count += 1
+            if eoq:
+                break
+
+        if values:
+            self.transmitBurst(pcs, values)
+
+        self.registers.tcr.spi_tcnt = tcnt
+        self.event('tcf', 1)
+        self.event('eoqf', eoq)
+
+        if eoq:
+            self.registers.sr.vsOverrideValue('txrxs', 0)
+            self.registers.mcr.halt = 1
+
+        return count
+
+    def dmaBurstWrite(self, offsets, chunks):
+        """
+        Called by the eDMA peripheral to write a sequence of values to the
+        PUSHR register at once. The frames are only transmitted as a burst if
+        Tx/Rx is enabled and the Tx FIFO is empty, otherwise they must be
+        queued one at a time.
+
+        Returns the number of values written.
+        """
+        if self.registers.sr.txrxs == 0 or self._tx_fifo:
+            return 0
+
+        frames = []
+        for offset, bytez in zip(offsets, chunks):
+            if offset not in DSPI_PUSHR_RANGE:
+                break
+
+            # Pad partial writes out to 4 bytes the same way _setPeriphReg()
+            # does
+            idx = offset - DSPI_PUSHR_OFFSET
+            size = idx + len(bytez)
+            if size > DSPI_MSG_SIZE:
+                break
+            frames.append((b'\x00' * idx) + bytez + (b'\x00' * (DSPI_MSG_SIZE-size)))
+
+        if not frames:
+            return 0
+
+        count = self.transmitFrames(frames)
+
+        # The TFFF event should always be set here because more data can be
+        # sent.
+        self.event('tfff', 1)
+
+        return count
+
+    def dmaBurstRead(self, offsets, size):
+        """
+        Called by the eDMA peripheral to read a sequence of values from the
+        POPR register at once. Values are only returned while there is
+        received data available.
+
+        Returns a list of the values read.
+        """
+        values = []
+        for offset in offsets:
+            if offset not in DSPI_POPR_RANGE or not self._rx_fifo:
+                break
+            values.append(self.popRx()[-size:])
+        return values
+
     def pushTx(self, data):
         """
         Takes data written to the DSPI PUSH TX FIFO register (PUSHR) and
@@ -569,13 +717,9 @@ class DSPI(SPIBus):
                 max_fifo_size = 1
 
             # Add to the Tx FIFO (if it isn't full or disabled)
-            fifo_size = self.registers.sr.txctr
-            if fifo_size < max_fifo_size:
-                self._tx_fifo[DSPI_MSG_SIZE:] = self._tx_fifo[:-DSPI_MSG_SIZE]
-                self._tx_fifo[:DSPI_MSG_SIZE] = data
-
+            if self._tx_fifo.push(data, max_fifo_size):
                 # Increment the SR[TXCTR] and SR[TXNXTPTR] fields
-                fifo_size += 1
+                fifo_size = len(self._tx_fifo)
                 self.registers.sr.vsOverrideValue('txctr', fifo_size)
 
                 # The Tx pointer should point to the oldest item in the Tx FIFO
@@ -585,9 +729,9 @@ class DSPI(SPIBus):
 
     def isTxFifoFull(self):
         if self.registers.mcr.dis_txf == 0:
-            return self.registers.sr.txctr >= DSPI_FIFO_SIZE
+            return self._tx_fifo.isFull()
         else:
-            return self.registers.sr.txctr >= 1
+            return self._tx_fifo.isFull(1)
 
     def popRx(self):
         """
@@ -595,20 +739,19 @@ class DSPI(SPIBus):
         FIFO. If there are no more elements in the Rx FIFO then all 0's will be
         returned.
         """
-        fifo_size = self._rx_fifo_size
-        if fifo_size > 0:
+        if self._rx_fifo:
             # The oldest message is always at index 0
-            data = self._rx_fifo[:DSPI_MSG_SIZE]
-
-            # Now shift all of the items in the Rx FIFO left by 1 message
-            self._rx_fifo[:-DSPI_MSG_SIZE] = self._rx_fifo[DSPI_MSG_SIZE:]
+            data = self._rx_fifo.pop()
 
             # Decrement the SR[RXCTR] field (SR[RXNXTPTR]
-            fifo_size -= 1
-            self._rx_fifo_size = fifo_size
+            fifo_size = len(self._rx_fifo)
             self.registers.sr.vsOverrideValue('rxctr', fifo_size)
             self.event('rfdf', fifo_size != 0)
 
+            # Move the next frame of a received burst into the Rx FIFO
+            if self._rx_backlog:
+                self.pushRx(self._rx_backlog.popleft())
+
             return data
 
         else:
@@ -622,13 +765,12 @@ class DSPI(SPIBus):
         FIFO. If there are no more elements in the Rx FIFO then return None to
         indicate that an underflow has occured.
         """
-        fifo_size = self.registers.sr.txctr
-        if fifo_size > 0:
-            idx = self.registers.sr.txnxtptr * DSPI_MSG_SIZE
-            data = self._tx_fifo[idx:idx+DSPI_MSG_SIZE]
+        if self._tx_fifo:
+            # The oldest message is at SR[TXNXTPTR]
+            data = self._tx_fifo.pop()
 
-            # Decrement the SR[RXCTR] and SR[RXNXTPTR] fields
-            fifo_size -= 1
+            # Decrement the SR[TXCTR] and SR[TXNXTPTR] fields
+            fifo_size = len(self._tx_fifo)
             self.registers.sr.vsOverrideValue('txctr', fifo_size)
 
             # The Tx pointer should point to the oldest item in the Tx FIFO (if
@@ -654,16 +796,10 @@ class DSPI(SPIBus):
             max_fifo_size = 2
 
         # Add to the Rx FIFO (if it isn't full or disabled)
-        fifo_size = self._rx_fifo_size
-        if fifo_size < max_fifo_size:
-            # As long as the fifo_size is <= the Rx FIFO max (5) append the data
-            # to the Rx FIFO.
-            idx = fifo_size * DSPI_MSG_SIZE
-            self._rx_fifo[idx:idx+DSPI_MSG_SIZE] = data
-
-            # now increment the fifo size
-            fifo_size += 1
-            self._rx_fifo_size = fifo_size
+        if self._rx_fifo.push(data, max_fifo_size):
+            # As long as the fifo_size is <= the Rx FIFO max (5) the data is
+            # appended to the Rx FIFO.
+            fifo_size = len(self._rx_fifo)
 
             # update the SR[RXCTR] counter, make sure to cap the Rx FIFO size at
             # max FIFO size - 1 (so it doesn't include the hidden shift
@@ -682,18 +818,39 @@ class DSPI(SPIBus):
             # If the MCR[ROOE] bit is set then overwrite the last value in the
             # Rx FIFO (the "shift register") instead of discarding it.
             if self.registers.mcr.rooe == 1:
-                idx = (fifo_size-1) * DSPI_MSG_SIZE
-                self._rx_fifo[idx:idx+DSPI_MSG_SIZE] = data
+                self._rx_fifo[-1] = data
                 logger.debug('[%s] %s: Rx overflow, overwriting last msg with %r', self.devname, self.mode, data)
             else:
                 logger.debug('[%s] %s: Rx overflow, discarding msg %r', self.devname, self.mode, data)
 
+    def pushRxBurst(self, values):
+        """
+        Adds a burst of incoming data to the Rx FIFO. If RFDF DMA requests are
+        enabled the frames that do not fit in the Rx FIFO are held until the
+        Rx FIFO is drained, otherwise they overflow the Rx FIFO like frames
+        received one at a time.
+        """
+        endian = self.emu.getEndian()
+        dma = self.registers.rser.rfdf and self.registers.rser.rfdf_dirs
+        if self.registers.mcr.dis_rxf == 0:
+            max_fifo_size = DSPI_RX_FIFO_SIZE
+        else:
+            max_fifo_size = 2
+
+        for value in values:
+            data = e_bits.buildbytes(value, DSPI_MSG_SIZE, bigend=endian)
+            if dma and (self._rx_backlog or self._rx_fifo.isFull(max_fifo_size)):
+                self._rx_backlog.append(data)
+            else:
+                self.pushRx(data)
+
     def mcrUpdate(self, thing):
         """
         Process updates to the MCR register.
         """
         if self.registers.mcr.clr_txf == 1:
             # Clear the SR[TXCTR] count and set the SR[TFFF] flag
+            self._tx_fifo.clear()
             self.registers.sr.vsOverrideValue('txctr', 0)
             self.registers.sr.vsOverrideValue('txnxtptr', 0)
             self.registers.mcr.clr_txf = 0
@@ -703,6 +860,8 @@ class DSPI(SPIBus):
 
         if self.registers.mcr.clr_rxf == 1:
             # Clear the SR[RXCTR] count and the SR[RFDF] flag
+            self._rx_fifo.clear()
+            self._rx_backlog.clear()
             self.registers.sr.vsOverrideValue('rxctr', 0)
             self.registers.sr.vsOverrideValue('popnxtptr', 0)
             self.registers.mcr.clr_rxf = 0
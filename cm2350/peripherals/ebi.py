@@ -132,6 +132,11 @@ class EBI(MMIOPeripheral):
     physical address it does not modify any MMU entries to make external RAM be
     accessible.
     '''
+    _snap_objs = ('bank_config',)
+
+    # The bank register pairs are part of the peripheral registers
+    _snap_ignore = MMIOPeripheral._snap_ignore + ('bank_registers',)
+
     def __init__(self, emu, mmio_addr):
         # need to hook a MMIO mmiodev at 0xFFFEC000 of size 0x4000
         super().__init__(emu, 'EBI', mmio_addr, 0x4000, regsetcls=EBI_REGISTERS)
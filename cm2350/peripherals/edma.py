@@ -1,3 +1,4 @@
+import copy
 import enum
 
 from ..intc_exc import AlignmentException, MceWriteBusError, MceDataReadBusError
@@ -5,6 +6,7 @@ from ..intc_src import INTC_EVENT
 from ..ppc_vstructs import *
 from ..ppc_peripherals import PPC_MAX_READ_SIZE, MMIOPeripheral
 from ..ppc_xbar import *
+from ..workqueue import PRIORITY_NORMAL
 
 
 import envi.bits as e_bits
@@ -394,6 +396,18 @@ EDMA_INT_MASKS = tuple(2 ** i for i in range(32)) + tuple(2 ** i for i in range(
 BIT_POSITIONS_AND_MASKS = tuple((i, 2 ** i) for i in range(32))
 
 
+def _next_addr(addr, off, mod_mask):
+    '''
+    Returns the next source or destination address after adding the address
+    offset, if the address modulo mask is set only the masked bits of the
+    address are modified.
+    '''
+    addr_next = addr + off
+    if mod_mask:
+        return (addr & ~mod_mask) | (addr_next & mod_mask)
+    return addr_next
+
+
 def gen_set_bits(value):
     '''
     Returns channel/bit numbers that are set assuming 32-bit wide registers and
@@ -487,10 +501,29 @@ class TCDConfig:
             self.tcd.citer = value
 
 
+def _copyTransfers(pending, active):
+    # Copy the pending transfer configurations for a snapshot, the TCD
+    # registers are not copied so the copies refer to the same registers as the
+    # originals.  The active transfer is normally also pending, if so it should
+    # remain the same object as the pending transfer.
+    if pending is None:
+        return None, copy.copy(active)
+
+    copied = {c: copy.copy(config) for c, config in pending.items()}
+    if active is not None and pending.get(active.channel) is active:
+        return copied, copied[active.channel]
+    return copied, copy.copy(active)
+
+
 class eDMA(MMIOPeripheral):
     '''
     This is the Enhanced Direct Memory Access Controller module.
     '''
+    # The active and pending transfers are saved by getSnap(), the register
+    # write handlers are not part of the emulated state
+    _snap_ignore = MMIOPeripheral._snap_ignore + \
+            ('_convenience_handlers', '_active', '_pending')
+
     def __init__(self, devname, emu, mmio_addr):
         if devname == 'eDMA_A':
             super().__init__(emu, devname, mmio_addr, 0x4000,
@@ -556,6 +589,22 @@ class eDMA(MMIOPeripheral):
         self.registers.cpr.vsAddParseCallback('by_idx', self.cprUpdate)
         self.registers.tcd.vsAddParseCallback('by_idx', self.tcdUpdate)
 
+    def init(self, emu):
+        super().init(emu)
+
+        # The budget is the number of bytes that may be transferred each
+        # instruction step, by default one major loop is processed each step.
+        if self._config is not None:
+            budget = self._config.get('budget')
+            priority = self._config.get('priority', PRIORITY_NORMAL)
+        else:
+            budget = None
+            priority = PRIORITY_NORMAL
+
+        emu.configureExtraProcessing(self.processActiveTransfers,
+                                     name=self.devname, priority=priority,
+                                     budget=budget)
+
     def reset(self, emu):
         super().reset(emu)
 
@@ -566,6 +615,15 @@ class eDMA(MMIOPeripheral):
         # Reset the fixed and round robin priority lists to their defaults
         self._update_chan_priorities()
 
+    def getSnap(self):
+        snap = super().getSnap()
+        snap['_pending'], snap['_active'] = _copyTransfers(self._pending, self._active)
+        return snap
+
+    def setSnap(self, snap):
+        super().setSnap(snap)
+        self._pending, self._active = _copyTransfers(snap['_pending'], snap['_active'])
+
     def _update_chan_priorities(self):
         self._fixed_group_pri = self._get_group_fixed_priorities()
         self._fixed_channel_pri = [self._get_channel_fixed_priorities(r) for r, _ in self.groups]
@@ -1156,7 +1214,7 @@ class eDMA(MMIOPeripheral):
         # If this DMA channel is halted (stalled), do nothing, the transfers
         # will be resumed when this DMA channel is no longer halted.
         if self.registers.mcr.halt == 1:
-            return
+            return 0
 
         # Get the next transfer to process
         config = self._active
@@ -1166,9 +1224,9 @@ class eDMA(MMIOPeripheral):
 
         # If no pending transfer was found, there is nothing to do
         if config is None:
-            return
+            return 0
 
-        self._process_major_loop(config)
+        moved = self._process_major_loop(config)
 
         # If there are more major loops to process for the current channel, next
         # cycle it will need to go through arbitration again in case round-robin
@@ -1176,7 +1234,14 @@ class eDMA(MMIOPeripheral):
         # will help check if there are any more pending transfers.
         self.emu.addExtraProcessing(self.processActiveTransfers)
 
+        # Return the number of bytes transferred so the amount of DMA work done
+        # each step can be limited
+        return moved
+
     def _process_major_loop(self, config):
+        # Process the next major loop iteration (or a burst of iterations) of
+        # the transfer, returns the number of bytes transferred
+
         # Indicate that this channel is active
         config.tcd.start = 0
         config.tcd.done = 0
@@ -1187,6 +1252,34 @@ class eDMA(MMIOPeripheral):
                      config.tcd.biter, config.nbytes, config.tcd.saddr,
                      config.ssize, config.tcd.daddr, config.dsize)
 
+        # Transfers to or from a peripheral register that supports burst
+        # access can process all remaining iterations at once
+        if config.citer > 1:
+            count = self._process_burst(config)
+            if count is not None:
+                return count * config.nbytes
+
+        # Transfers between normal memory regions (RAM or flash) are done
+        # with slice copies instead of one access per minor loop chunk
+        if self._process_bulk(config):
+            return config.nbytes
+
+        data = self._read_minor_loop(config)
+        if data is None:
+            return 0
+
+        if not self._write_minor_loop(config, data):
+            return 0
+
+        logger.debug("%s[%d:%d] [%x:%r] -> %r -> [%x:%r]", self.devname,
+                        config.channel, config.citer, config.tcd.saddr,
+                        config.ssize, data, config.tcd.daddr,
+                        config.dsize)
+
+        self._end_major_iteration(config)
+        return config.nbytes
+
+    def _read_minor_loop(self, config):
         data = bytearray()
         try:
             # Strictly speaking we could just read a big chunk of data but I
@@ -1213,6 +1306,9 @@ class eDMA(MMIOPeripheral):
 
             return None
 
+        return data
+
+    def _write_minor_loop(self, config, data):
         try:
             for offset in range(0, len(data), config.dsize):
                 # Before writing to this address verify that there is a valid
@@ -1235,13 +1331,142 @@ class eDMA(MMIOPeripheral):
             config.tcd.active = 0
             del self._pending[config.channel]
 
+            return False
+
+        return True
+
+    def _get_burst_periph(self, addr, off, mod_mask, count):
+        # Return the peripheral and register offsets that are accessed by the
+        # next count major loop iterations if they all access the same
+        # peripheral
+        periph = None
+        offsets = []
+        for _ in range(count):
+            if not self.emu.isValidPointer(addr):
+                return None, None
+
+            dev, offset = self.emu.getMMIODevice(self.emu.mmu.translateDataAddr(addr))
+            if dev is None or (periph is not None and dev is not periph):
+                return None, None
+
+            periph = dev
+            offsets.append(offset)
+            addr = _next_addr(addr, off, mod_mask)
+
+        return periph, offsets
+
+    def _process_burst(self, config):
+        """
+        If the destination or source of a transfer is a peripheral register
+        that supports burst access (the peripheral has a dmaBurstWrite() or
+        dmaBurstRead() function) process as many of the remaining major loop
+        iterations as the peripheral accepts in one call. Each iteration must
+        be a single access of the peripheral register and minor loop channel
+        linking must not be enabled.
+
+        Returns the number of iterations processed, or None if no iterations
+        could be processed as a burst.
+        """
+        if config.linkch is not None:
             return None
 
-        logger.debug("%s[%d:%d] [%x:%r] -> %r -> [%x:%r]", self.devname,
-                        config.channel, config.citer, config.tcd.saddr,
-                        config.ssize, data, config.tcd.daddr,
-                        config.dsize)
+        tcd = config.tcd
+        if config.nbytes == config.dsize:
+            periph, offsets = self._get_burst_periph(tcd.daddr, tcd.doff, config.dmod_mask, config.citer)
+            handler = getattr(periph, 'dmaBurstWrite', None)
+            if handler is not None:
+                return self._burst_write(config, handler, offsets)
+
+        if config.nbytes == config.ssize:
+            periph, offsets = self._get_burst_periph(tcd.saddr, tcd.soff, config.smod_mask, config.citer)
+            handler = getattr(periph, 'dmaBurstRead', None)
+            if handler is not None:
+                return self._burst_read(config, handler, offsets)
+
+        return None
+
+    def _burst_write(self, config, handler, offsets):
+        # Read the source data for each iteration ahead of time, this is only
+        # done for normal memory sources because reading peripheral registers
+        # may change the peripheral state.
+        tcd = config.tcd
+        chunks = []
+        saddr = tcd.saddr
+        for _ in offsets:
+            if not self.emu.isValidPointer(saddr) or \
+                    self.emu.getMMIODevice(self.emu.mmu.translateDataAddr(saddr))[0] is not None:
+                break
+            chunks.append(self.emu.readMemory(saddr, config.nbytes))
+            saddr = _next_addr(saddr, tcd.soff, config.smod_mask)
+
+        if not chunks:
+            return None
+
+        count = handler(offsets[:len(chunks)], chunks)
+        logger.debug('%s[%d:%d] burst wrote %d/%d values to 0x%08x', self.devname,
+                     config.channel, config.citer, count, len(chunks), tcd.daddr)
+
+        for _ in range(count):
+            self._end_major_iteration(config)
+
+        return count or None
+
+    def _burst_read(self, config, handler, offsets):
+        values = handler(offsets, config.ssize)
+        logger.debug('%s[%d:%d] burst read %d/%d values from 0x%08x', self.devname,
+                     config.channel, config.citer, len(values), len(offsets), config.tcd.saddr)
+
+        if not values:
+            return None
+
+        # If writing the destination fails the channel is stopped, the
+        # iterations that completed before the error are still counted
+        count = 0
+        for data in values:
+            config.tcd.active = 1
+            if not self._write_minor_loop(config, data):
+                break
+            self._end_major_iteration(config)
+            count += 1
+
+        return count
+
+    def _process_bulk(self, config):
+        """
+        Copy the data for one major loop iteration directly between the
+        backing buffers of the source and destination memory regions instead
+        of one access per SSIZE/DSIZE chunk. The source and destination of a
+        minor loop are contiguous ranges so each only needs to be translated
+        once.
+
+        This is only possible if the source is RAM or flash and the
+        destination is RAM, transfers to or from other peripherals must keep
+        the per-access behavior.
+
+        Returns True if the iteration was processed.
+        """
+        tcd = config.tcd
+        nbytes = config.nbytes
+
+        src_ea, src_offset, src = self.emu.getMemoryBuffer(tcd.saddr, nbytes)
+        if src is None:
+            return False
+
+        dst_ea, dst_offset, dst = self.emu.getMemoryBuffer(tcd.daddr, nbytes, write=True)
+        if dst is None:
+            return False
+
+        dst[dst_offset:dst_offset+nbytes] = src[src_offset:src_offset+nbytes]
+        self.emu.clearOpcache(dst_ea, nbytes)
+
+        logger.debug("%s[%d:%d] [%x:%r] -> %d bytes -> [%x:%r]", self.devname,
+                     config.channel, config.citer, tcd.saddr, config.ssize,
+                     nbytes, tcd.daddr, config.dsize)
+
+        self._end_major_iteration(config)
+        return True
 
+    def _end_major_iteration(self, config):
         # Now that one major loop is complete, decrement citer, and process any
         # linked channels
         config.citer -= 1
@@ -1333,16 +1558,16 @@ class eDMA(MMIOPeripheral):
 
             if config.tcd.major_e_link == 1:
                 logger.debug('[%s] starting major loop linked transfer %d for current channel %d',
-                             self.devname, config.tcd.major_linkch, channel)
+                             self.devname, config.tcd.major_linkch, config.channel)
                 self.startTransfer(config.tcd.major_linkch)
 
             # Check if scatter-gather is configured for this channel, if so
             # overwrite the current channel and re-start it
             if config.tcd.e_sg == 1:
                 tcd = self.emu.readMemory(config.tcd.dlast_sga, EDMA_TCDx_SIZE)
-                addr = self.baseaddr + EDMA_TCDx_OFFSET + channel * EDMA_TCDx_SIZE
+                addr = self.baseaddr + EDMA_TCDx_OFFSET + config.channel * EDMA_TCDx_SIZE
                 self.emu.writeMemory(addr, tcd)
 
                 logger.debug('[%s] queuing SG transfer in channel %d using TCD from 0x%08x',
-                             self.devname, channel, config.tcd.dlast_sga)
+                             self.devname, config.channel, config.tcd.dlast_sga)
                 self.startTransfer(config.channel)
@@ -7,6 +7,7 @@ import envi.const as e_const
 from ..ppc_vstructs import *
 from ..ppc_peripherals import *
 from ..intc_exc import INTC_EVENT
+from .. import ioproto, waveforms
 
 import logging
 logger = logging.getLogger(__name__)
@@ -16,6 +17,9 @@ __all__  = [
 ]
 
 
+# Size of the eQADC MMIO region
+EQADC_MMIO_SIZE = 0x4000
+
 EQADC_MCR_OFFSET     = 0x0000
 EQADC_ETDFR_OFFSET   = 0x000C
 EQADC_CFPR_OFFSET    = 0x0010
@@ -340,6 +344,11 @@ class ADC_REGS(enum.IntEnum):
 
 ADC_REGS_ALTCNV_RANGE = range(ADC_REGS.ALTCMD1, ADC_REGS.ALTCMD8+1)
 
+# The ACRx[DEST] field selects where alternate configuration results are sent,
+# 0 is the RFIFO and 1-8 are DECFILT_A-H
+ADC_ACR_DEST_MASK  = 0x3C00
+ADC_ACR_DEST_SHIFT = 10
+
 # Convert command to configuration register offset mapping
 ADC_CR_MAP = {
     ADC_REGS.CMD:     ADC_REGS.CR,
@@ -397,9 +406,9 @@ class ADC:
         if not config & 0x8000:
             return None
 
-        vrh = self.eqadc.channels[EQADC_ANALOG_CHAN_VRH]
-        vrl = self.eqadc.channels[EQADC_ANALOG_CHAN_VRL]
-        value = self.eqadc.channels[adc_chan]
+        vrh = self.eqadc.getChannelVoltage(EQADC_ANALOG_CHAN_VRH)
+        vrl = self.eqadc.getChannelVoltage(EQADC_ANALOG_CHAN_VRL)
+        value = self.eqadc.getChannelVoltage(adc_chan)
 
         if cmd_offset in ADC_REGS_ALTCNV_RANGE:
             ressel = (config & 0x00C0) >> 6
@@ -611,6 +620,16 @@ class EQADC_REGISTERS(PeripheralRegisterSet):
         self.redlccr = (EQADC_REDLCCR_OFFSET, EQADC_REDLCCR())
 
 
+# Analog input values are received from external IO clients as EQADC_SAMPLE
+# messages, plain (channel, voltage) tuples are also accepted from in-process
+# sources
+EQADC_SAMPLE = namedtuple('EQADC_SAMPLE', ['channel', 'voltage'])
+
+EQADC_WIRE_FMT = '>Hd'
+ioproto.registerCodec(ioproto.IO_MSG_ADC, EQADC_SAMPLE, EQADC_WIRE_FMT,
+                      from_fields=EQADC_SAMPLE._make)
+
+
 class eQADC(ExternalIOPeripheral):
     """
     Class to emulate the EQADC peripheral.
@@ -627,12 +646,19 @@ class eQADC(ExternalIOPeripheral):
 
     <tx/rx example tbd>
     """
+    _snap_objs = ('adc', 'cfifo')
+
+    # Waveforms are saved by reference, waveforms that are generated from an
+    # iterator are not rewound when a snapshot is restored
+    _snap_refs = ('waveforms',)
+    _snap_ignore = ExternalIOPeripheral._snap_ignore + ('_get_reg_handlers', '_set_reg_handlers')
+
     def __init__(self, devname, emu, mmio_addr):
         """
         EQADC constructor.  Each processor has multiple EQADC peripherals so the
         devname parameter must be unique.
         """
-        super().__init__(emu, devname, mmio_addr, 0x4000,
+        super().__init__(emu, devname, mmio_addr, EQADC_MMIO_SIZE,
                 regsetcls=EQADC_REGISTERS,
                 isrstatus='fisr', isrflags='idcr', isrevents=EQADC_INT_EVENTS)
 
@@ -660,6 +686,15 @@ class eQADC(ExternalIOPeripheral):
         # Voltage inputs, there are 256 possible input channels
         self.channels = None
 
+        # Waveform sources bound to input channels, and the values sampled
+        # for all of the channels converted by the current CFIFO burst
+        self.waveforms = {}
+        self._burst_values = None
+
+        # Results sent to the decimation filters during a CFIFO burst, keyed
+        # by DECFILT peripheral
+        self._decfilt_samples = None
+
         # Each EQADC device has 2 ADC conversion chips that are indirectly
         # accessed and programmed
         self.adc = (ADC(self, 'ADC0'), ADC(self, 'ADC1'))
@@ -674,11 +709,12 @@ class eQADC(ExternalIOPeripheral):
         # modes (one per CBuffer)
         self.mode = [EQADC_MODE.DISABLE for i in range(EQADC_NUM_CBUFFERS)]
 
-        # Each FIFO is 4 entries long (except CFIFO0 which can be 8 long),
-        # implement each FIFO as a bytearray to make it easy to push and pop
-        # data as needed.
-        self.cfifo = tuple(bytearray(EQADC_CFIFO_LEN) if i != 0 else \
-                bytearray(EQADC_CFIFO0_LEN) for i in range(EQADC_NUM_CBUFFERS))
+        # Each CFIFO is 4 entries long (except CFIFO0 which can be 8 long), the
+        # newest command is in CFxR0.  The RFIFOs are implemented as a
+        # bytearray to make it easy to push and pop data as needed.
+        cmd_fill = b'\x00' * EQADC_CMD_SIZE
+        self.cfifo = tuple(RingFIFO(EQADC_CFIFO_LEN, cmd_fill, newest_first=True) if i != 0 else \
+                RingFIFO(EQADC_CFIFO0_LEN, cmd_fill, newest_first=True) for i in range(EQADC_NUM_CBUFFERS))
         self.rfifo = tuple(bytearray(EQADC_RFIFO_LEN) for i in range(EQADC_NUM_CBUFFERS))
 
         # TODO: should the voltage values really be reset?
@@ -723,8 +759,10 @@ class eQADC(ExternalIOPeripheral):
         # Calculate which channel and which FIFO index is being read
         channel = (offset - EQADC_CF0Rw_OFFSET) // EQADC_xFIFO_SIZE
         start = offset - EQADC_CFIFOx_OFFSETS[channel]
-        end = start + size
-        return self.cfifo[channel][start:end]
+
+        # The newest command is in CFxR0, FISRx[TNXTPTR] is the index of the
+        # oldest command
+        return self.cfifo[channel].readBytes(start, size)
 
     def _getRFxRw(self, offset, size):
         # Calculate which channel and which FIFO index is being read
@@ -772,6 +810,7 @@ class eQADC(ExternalIOPeripheral):
         if self.registers.cfcr[idx].cfinv:
             self.registers.cfcr[idx].cfinv = 0
             # reset the CFIFO status
+            self.cfifo[idx].clear()
             self.registers.fisr[idx].vsOverrideValue('cfctr', 0)
             self.registers.fisr[idx].vsOverrideValue('tnxtptr', 0)
             self.registers.fisr[idx].vsOverrideValue('rfctr', 0)
@@ -829,15 +868,47 @@ class eQADC(ExternalIOPeripheral):
             # If the channel is not disabled and there are commands in the fifo,
             # process them now
             if self.mode[channel] != EQADC_MODE.DISABLE and self.registers.fisr[channel].cfctr > 0:
+                # Sample the waveforms of all channels converted by the queued
+                # commands at once
+                if self.waveforms:
+                    self._burst_values = self.sampleWaveforms(self._getBurstChannels(channel))
+
                 # Pull data from the command FIFO until we run out of data or
                 # the EOQ frame is found
-                eoq = 0
-                while not eoq:
-                    # Pull the next object from the Tx FIFO
-                    data = self.popCFIFO(channel)
-                    if data is None:
-                        break
-                    eoq = self.processCommand(channel, data)
+                try:
+                    # Results sent to the decimation filters are filtered as
+                    # one burst after the commands are processed
+                    self._decfilt_samples = {}
+
+                    eoq = 0
+                    while not eoq:
+                        # Pull the next object from the Tx FIFO
+                        data = self.popCFIFO(channel)
+                        if data is None:
+                            break
+                        eoq = self.processCommand(channel, data)
+
+                    self._sendDecfiltSamples()
+                finally:
+                    self._burst_values = None
+                    self._decfilt_samples = None
+
+    def _getBurstChannels(self, channel):
+        # Return the analog channels that will be converted by the commands
+        # queued in a CFIFO up to the next EOQ command
+        endian = self.emu.getEndian()
+        chans = set()
+        for data in self.cfifo[channel]:
+            cmd = parseCommand(data, endian)
+            if isinstance(cmd, ADC_CMD_CONVERT) and cmd.tag < EQADC_NUM_CBUFFERS:
+                chans.add(cmd.chan)
+            if cmd.eoq:
+                break
+
+        # The reference voltages are used by every conversion
+        if chans:
+            chans.update((EQADC_ANALOG_CHAN_VRH, EQADC_ANALOG_CHAN_VRL))
+        return chans
 
     def pushCFIFO(self, channel, data):
         # if this is channel 1 and CFCR0[CFEEE0] is set then CFIFO0 is 8 entries
@@ -847,13 +918,10 @@ class eQADC(ExternalIOPeripheral):
         else:
             max_fifo_size = EQADC_CFIFO_LEN
 
-        fifo_size = self.registers.fisr[channel].cfctr
-        if fifo_size < max_fifo_size:
-            self.cfifo[channel][EQADC_CMD_SIZE:] = self.cfifo[channel][:-EQADC_CMD_SIZE]
-            self.cfifo[channel][:EQADC_CMD_SIZE] = data
-
-            # Increment the FISRx[CFCTR] and FISRx[TNXTPTR] fields
-            fifo_size += 1
+        fifo = self.cfifo[channel]
+        if fifo.push(data, max_fifo_size):
+            # Update the FISRx[CFCTR] and FISRx[TNXTPTR] fields
+            fifo_size = len(fifo)
             self.registers.fisr[channel].vsOverrideValue('cfctr', fifo_size)
 
             # The Tx pointer should point to the oldest item in the Tx FIFO
@@ -862,14 +930,13 @@ class eQADC(ExternalIOPeripheral):
             self.event(channel, 'cfff', fifo_size != max_fifo_size)
 
     def popCFIFO(self, channel):
-        fifo_size = self.registers.fisr[channel].cfctr
+        fifo = self.cfifo[channel]
         data = None
-        if fifo_size > 0:
-            idx = self.registers.fisr[channel].tnxtptr * EQADC_CMD_SIZE
-            data = self.cfifo[channel][idx:idx+EQADC_CMD_SIZE]
+        if fifo:
+            data = fifo.pop()
 
-            # Decrement the SR[RXCTR] and SR[RXNXTPTR] fields
-            fifo_size -= 1
+            # Decrement the FISRx[CFCTR] and FISRx[TNXTPTR] fields
+            fifo_size = len(fifo)
             self.registers.fisr[channel].vsOverrideValue('cfctr', fifo_size)
 
             # The CF pointer should point to the oldest item in the CFIFO (if
@@ -941,6 +1008,109 @@ class eQADC(ExternalIOPeripheral):
         analog_channel, value = obj
         self.channels[analog_channel] = value
 
+    def bindWaveform(self, analog_channel, source, rate=None, **kwargs):
+        """
+        Bind an analog input channel to a waveform so the channel voltage is
+        generated without any external IO messages. The source can be a
+        Waveform object, a sequence or NumPy array of samples taken at a fixed
+        rate (in Hz), a sequence of (time, voltage) points to interpolate
+        between, or a generator that yields a new voltage at a fixed rate.
+        See waveforms.makeWaveform() for details.
+
+        The waveform is evaluated at the current emulated system time when the
+        channel is converted. Values received from external IO clients for
+        this channel are overridden until the waveform is unbound.
+
+        Returns the Waveform object.
+        """
+        if analog_channel < 0 or analog_channel >= EQADC_NUM_ANALOG_CHAN:
+            raise ValueError('%s: invalid analog channel %d' % (self.devname, analog_channel))
+
+        wave = waveforms.makeWaveform(source, rate, **kwargs)
+        self.waveforms[analog_channel] = wave
+        return wave
+
+    def unbindWaveform(self, analog_channel):
+        """
+        Remove the waveform bound to an analog input channel, the channel keeps
+        the last sampled voltage.
+        """
+        self.waveforms.pop(analog_channel, None)
+
+    def sampleWaveforms(self, analog_channels):
+        """
+        Sample the waveforms bound to a set of analog channels at the current
+        emulated system time, returns a dictionary of the sampled voltages.
+        Channels without a waveform are ignored.
+
+        Channels that share a waveform are sampled together with one
+        Waveform.sampleMany() call.
+        """
+        groups = {}
+        for chan in analog_channels:
+            wave = self.waveforms.get(chan)
+            if wave is not None:
+                groups.setdefault(id(wave), (wave, []))[1].append(chan)
+
+        now = self.emu.systime()
+        values = {}
+        for wave, chans in groups.values():
+            for chan, value in zip(chans, wave.sampleMany([now] * len(chans))):
+                values[chan] = value
+                self.channels[chan] = value
+        return values
+
+    def getChannelVoltage(self, analog_channel):
+        """
+        Return the current voltage of an analog input channel
+        """
+        if self.waveforms:
+            if self._burst_values is not None and analog_channel in self._burst_values:
+                return self._burst_values[analog_channel]
+
+            wave = self.waveforms.get(analog_channel)
+            if wave is not None:
+                value = wave.sample(self.emu.systime())
+                self.channels[analog_channel] = value
+                return value
+
+        return self.channels[analog_channel]
+
+    def decfiltSample(self, dest, cmd, result):
+        """
+        Send a conversion result to the decimation filter selected by an
+        ACRx[DEST] value. During a CFIFO burst the results are collected and
+        filtered together when the burst is complete.
+        """
+        if dest > len(self.emu.decfilt):
+            logger.warning('%s: discarding result %r for invalid DECFILT dest %d (cmd %r)',
+                           self.devname, result, dest, cmd)
+            return
+
+        decfilt = self.emu.decfilt[dest - 1]
+        value = e_bits.parsebytes(result, 0, len(result), bigend=self.emu.getEndian())
+        logger.debug('%s: sending result 0x%x to %s (cmd=%r)', self.devname, value, decfilt.devname, cmd)
+
+        if self._decfilt_samples is None:
+            self._returnDecfiltOutputs(decfilt.processSamples([value], [cmd.tag]))
+        else:
+            samples, tags = self._decfilt_samples.setdefault(decfilt, ([], []))
+            samples.append(value)
+            tags.append(cmd.tag)
+
+    def _sendDecfiltSamples(self):
+        for decfilt, (samples, tags) in self._decfilt_samples.items():
+            self._returnDecfiltOutputs(decfilt.processSamples(samples, tags))
+        self._decfilt_samples.clear()
+
+    def _returnDecfiltOutputs(self, outputs):
+        # Decimation filter outputs are 16-bit values returned to the RFIFO
+        # identified by the output tag, padded out to 32 bits the same as
+        # conversion results
+        endian = self.emu.getEndian()
+        for tag, value in outputs:
+            self.pushRFIFO(tag, b'\x00\x00' + e_bits.buildbytes(value, 2, bigend=endian))
+
     def processCommand(self, channel, data):
         cmd = parseCommand(data, self.emu.getEndian())
         logger.debug('%s: new command %r', self.devname, cmd)
@@ -957,26 +1127,26 @@ class eQADC(ExternalIOPeripheral):
                 config = self.adc[cmd.bn].config(cmd.offset)
                 result = self.adc[cmd.bn].convert(cmd.chan, cmd.offset)
                 if result is not None:
-                    # Pad the result out to 32 bits
-                    result = b'\x00\x00' + result
-
                     # If this is an alt config register then the result may be
                     # sent to the DECFILT peripheral
-                    if cmd.offset in ADC_REGS_ALTCNV_RANGE and config & 0x3C00 != 0x0000:
-                        errmsg = '%s[%d] DECFILT dest not supported for result 0x%s, cmd %r (config: 0x%x)' % \
-                                (self.devname, result.hex(), cmd, config)
-                        raise NotImplementedError(errmsg)
-
-                    logger.debug('%s: conversion result = %r (cmd=%r, config=0x%x', self.devname, result, cmd, config)
-                    self.pushRFIFO(cmd.tag, result)
-
-                    # TODO: technically "continuous" scans don't stop processing
-                    # when EOQ happens. For now if the mode is continuous and
-                    # the RFIFO is not full, fill it with copies of the last
-                    # result.
-                    if self.mode[channel] in EQADC_CONTINUOUS_SCAN_TRIGGER_MODES and cmd.eoq:
-                        while self.registers.fisr[channel].rfctr < EQADC_RFIFO_LEN:
-                            self.pushRFIFO(cmd.tag, result)
+                    if cmd.offset in ADC_REGS_ALTCNV_RANGE and config & ADC_ACR_DEST_MASK:
+                        dest = (config & ADC_ACR_DEST_MASK) >> ADC_ACR_DEST_SHIFT
+                        self.decfiltSample(dest, cmd, result)
+
+                    else:
+                        # Pad the result out to 32 bits
+                        result = b'\x00\x00' + result
+
+                        logger.debug('%s: conversion result = %r (cmd=%r, config=0x%x', self.devname, result, cmd, config)
+                        self.pushRFIFO(cmd.tag, result)
+
+                        # TODO: technically "continuous" scans don't stop
+                        # processing when EOQ happens. For now if the mode is
+                        # continuous and the RFIFO is not full, fill it with
+                        # copies of the last result.
+                        if self.mode[channel] in EQADC_CONTINUOUS_SCAN_TRIGGER_MODES and cmd.eoq:
+                            while self.registers.fisr[channel].rfctr < EQADC_RFIFO_LEN:
+                                self.pushRFIFO(cmd.tag, result)
 
                 else:
                     logger.debug('%s: conversion %r result inhibited: 0x%x', self.devname, cmd, config)
@@ -9,9 +9,13 @@ __all__ = [
 ]
 
 
+# Size of the eSCI MMIO region
+ESCI_MMIO_SIZE = 0x4000
+
+
 class eSCI(MMIOPeripheral):
     def __init__(self, devname, emu, mmio_addr):
-        super().__init__(emu, devname, mmio_addr, 0x4000)
+        super().__init__(emu, devname, mmio_addr, ESCI_MMIO_SIZE)
 
     def _getPeriphReg(self, offset, size):
         # return placeholder data
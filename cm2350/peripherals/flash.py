@@ -1,6 +1,14 @@
 import os
 import enum
+import mmap
+import atexit
+import weakref
+import bisect
+import time
+import zlib
+import struct
 import hashlib
+import json
 import os.path
 
 import envi
@@ -117,6 +125,36 @@ FLASH_DEVICE_MMIO_SIZE = {
     FlashDevice.FLASH_B_CONFIG: 0x00004000,
 }
 
+# The shadow flash regions are saved to the same backup file as the main flash,
+# and shadow flash B is saved first mimicking the order they are found on the
+# real device.
+FLASH_BACKUP_OFFSET = {
+    FlashDevice.FLASH_MAIN:     0x00000000,
+    FlashDevice.FLASH_B_SHADOW: 0x00400000,
+    FlashDevice.FLASH_A_SHADOW: 0x00404000,
+}
+FLASH_BACKUP_SIZE = 0x00408000
+
+# Flash backup journal records are a header of the backup file offset, size
+# and CRC32 of the data that follows the header.
+FLASH_JOURNAL_HDR = struct.Struct('>III')
+
+# Granularity of the main flash block index, this is the size of the smallest
+# main flash block
+FLASH_BLOCK_INDEX_SIZE = 0x00004000
+
+# Default number of seconds between syncs of the flash backup file
+FLASH_DEFAULT_SYNC_INTERVAL = 1.0
+
+# Programming or erasing a block only saves the chunks of the block that were
+# changed
+FLASH_SAVE_CHUNK_SIZE = 0x100
+
+# Flash block digests are saved in the digest file as an array of MD5 digests,
+# blocks without a valid digest are saved as all 0's
+FLASH_DIGEST_SIZE = hashlib.md5().digest_size
+FLASH_INVALID_DIGEST = b'\x00' * FLASH_DIGEST_SIZE
+
 
 # Utility
 def getFlashOffsets(filename):
@@ -384,6 +422,68 @@ def _loadFromBlob(blob, offset, size):
 
     return data
 
+def _writeInterleaved(dest, offset, data, second):
+    # Write data into every other 16-byte chunk of dest starting at offset, if
+    # second is True the data is written to the second chunk of each pair
+    # (flash array B).  The chunks are copied as strided slices of 8-byte words
+    # so an entire block is copied without looping over each chunk.
+    with memoryview(dest) as dest_view, memoryview(data) as data_view:
+        words = dest_view[offset:offset + len(data) * 2].cast('Q')
+        src = data_view.cast('Q')
+        first = 2 if second else 0
+        words[first::4] = src[0::2]
+        words[first+1::4] = src[1::2]
+
+def _readInterleaved(src, offset, size, second):
+    # Return size bytes read from every other 16-byte chunk of src starting at
+    # offset, this is the opposite of _writeInterleaved().
+    data = bytearray(size)
+    with memoryview(src) as src_view, memoryview(data) as data_view:
+        words = src_view[offset:offset + size * 2].cast('Q')
+        dest = data_view.cast('Q')
+        first = 2 if second else 0
+        dest[0::2] = words[first::4]
+        dest[1::2] = words[first+1::4]
+    return data
+
+def _changedRanges(old, new, offset):
+    # Return a list of the (start, end) ranges of new that are different than
+    # old starting at offset, compared in FLASH_SAVE_CHUNK_SIZE chunks.
+    # Adjacent changed chunks are merged into one range.
+    ranges = []
+    for start in range(0, len(old), FLASH_SAVE_CHUNK_SIZE):
+        end = min(start + FLASH_SAVE_CHUNK_SIZE, len(old))
+        if old[start:end] != new[offset+start:offset+end]:
+            if ranges and ranges[-1][1] == offset + start:
+                ranges[-1] = (ranges[-1][0], offset + end)
+            else:
+                ranges.append((offset + start, offset + end))
+    return ranges
+
+def _getJournalFilename(backup_filename, flash_hash):
+    # The journal is named so it does not look like a backup file for a
+    # different flash hash
+    return '%s-journal.%s' % (backup_filename, flash_hash)
+
+def _getDigestFilename(backup_filename, flash_hash):
+    return '%s-blocks.%s' % (backup_filename, flash_hash)
+
+def _getSourcesFilename(backup_filename):
+    return '%s-sources' % backup_filename
+
+def _getFileSource(device, filename, offset):
+    # Identifies the contents of a file loaded into flash without reading it
+    st = os.stat(filename)
+    return (device.name, os.path.abspath(filename), offset,
+            st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+def _syncBackups():
+    # The emulator is not always shutdown cleanly when python exits (such as
+    # when ipython exits), ensure that all changes to flash are written to the
+    # backup files.
+    for flash in list(FLASH._backups):
+        flash.sync()
+
 def _loadFromFile(filename, offset, size):
     with open(filename, 'rb') as f:
         # If the filename is larger than the flash for this part only read
@@ -394,6 +494,9 @@ def _loadFromFile(filename, offset, size):
 
 
 class FlashArray:
+    # The register lists are only used to look up registers by offset
+    _snap_ignore = ('_read_registers', '_write_registers')
+
     def __init__(self, flashdev, device, bigend=True):
         self.flashdev = flashdev
         self.device = device
@@ -835,29 +938,22 @@ class FlashArray:
                 logger.debug("%s[%s] programming %s @ 0x%08x (%d bytes)",
                         self.__class__.__name__, self.name, block.name, offset, len(data))
                 if block.value[0] == FlashBlockType.HIGH:
-                    # high blocks are interleaved every 16 bytes. So and write
-                    # the data in 16-byte chunks.
-                    #
-                    # TODO: It seems like there should be a better way
-                    if self.device == FlashDevice.FLASH_B_CONFIG:
-                        flash_offset = offset | 0x00000010
-                    else:
-                        flash_offset = offset
-
-                    for i in range(0, len(data), 16):
-                        start = flash_offset + i
-                        self.flashdev.data[start:start+16] = data[i:i+16]
-                        flash_offset += 16
-
-                    self.flashdev.save(device, offset, size*2)
+                    # high blocks are interleaved every 16 bytes, so write the
+                    # data to every other 16-byte chunk.
+                    old = self.flashdev.data[offset:offset+size*2]
+                    _writeInterleaved(self.flashdev.data, offset, data,
+                                      self.device == FlashDevice.FLASH_B_CONFIG)
+                    self.flashdev.save(device, offset, old=old)
 
                 elif device == FlashDevice.FLASH_MAIN:
+                    old = self.flashdev.data[offset:offset+size]
                     self.flashdev.data[offset:offset+size] = data
-                    self.flashdev.save(device, offset, size)
+                    self.flashdev.save(device, offset, old=old)
 
                 else:
+                    old = self.shadow[offset:offset+size]
                     self.shadow[offset:offset+size] = data
-                    self.flashdev.save(device, offset, size)
+                    self.flashdev.save(device, offset, old=old)
 
             else:
                 # It isn't clear from the documentation what should happen if a
@@ -886,29 +982,20 @@ class FlashArray:
                     if block.value[0] == FlashBlockType.HIGH:
                         # high blocks are interleaved every 16 bytes. So just
                         # erase every other 16-byte chunk.
-                        #
-                        # TODO: It seems like there should be a better way
-                        erased_chunk = _genErasedBytes(16)
-
-                        if self.device == FlashDevice.FLASH_B_CONFIG:
-                            flash_offset = offset | 0x00000010
-                        else:
-                            flash_offset = offset
-
-                        for i in range(0, size, 16):
-                            start = flash_offset + i
-                            self.flashdev.data[start:start+16] = erased_chunk
-                            flash_offset += 16
-
-                        self.flashdev.save(device, offset, size*2)
+                        old = self.flashdev.data[offset:offset+size*2]
+                        _writeInterleaved(self.flashdev.data, offset, _genErasedBytes(size),
+                                          self.device == FlashDevice.FLASH_B_CONFIG)
+                        self.flashdev.save(device, offset, old=old)
 
                     elif device == FlashDevice.FLASH_MAIN:
+                        old = self.flashdev.data[offset:offset+size]
                         self.flashdev.data[offset:offset+size] = _genErasedBytes(size)
-                        self.flashdev.save(device, offset, size)
+                        self.flashdev.save(device, offset, old=old)
 
                     else:
+                        old = self.shadow[offset:offset+size]
                         self.shadow[offset:offset+size] = _genErasedBytes(size)
-                        self.flashdev.save(device, offset, size)
+                        self.flashdev.save(device, offset, old=old)
 
                 else:
                     # It isn't clear from the documentation what should happen if a
@@ -942,16 +1029,8 @@ class FlashArray:
                 if block.value[0] == FlashBlockType.HIGH:
                     # high blocks are interleaved every 16 bytes. So copy every
                     # other 16-byte chunk.
-                    #
-                    # TODO: It seems like there should be a better way
-                    if self.device == FlashDevice.FLASH_B_CONFIG:
-                        block_offset |= 0x00000010
-
-                    block_data = bytearray()
-                    for i in range(0, size, 16):
-                        start = block_offset + i
-                        block_data += self.flashdev.data[start:start+16]
-                        block_offset += 16
+                    block_data = _readInterleaved(self.flashdev.data, block_offset, size,
+                                                  self.device == FlashDevice.FLASH_B_CONFIG)
 
                 elif device == FlashDevice.FLASH_MAIN:
                     block_data = self.flashdev.data[block_offset:block_offset+size]
@@ -993,6 +1072,15 @@ class FLASH(ppc_peripherals.Module, mmio.MMIO_DEVICE):
     Unlike other peripherals this one is staying an MMIO_DEVICE because of how
     weirdly the different memory regions need to work.
     """
+    # FLASH peripherals that have a backup file open, synced when python exits
+    _backups = None
+
+    # Save the state of the flash arrays in emulator snapshots, the block
+    # lookup tables and the backup file maps (the flash data is saved from the
+    # data and shadow attributes) are not saved.
+    _snap_objs = ('A', 'B')
+    _snap_ignore = ('_maps', '_unmapped_changes', 'FLASH_BLOCK_MAP', '_block_index')
+
     def __init__(self, emu, filename=None):
         ppc_peripherals.Module.__init__(self, emu, 'FLASH')
 
@@ -1006,6 +1094,26 @@ class FLASH(ppc_peripherals.Module, mmio.MMIO_DEVICE):
         # No backup loaded yet either
         self._backup = None
 
+        # The hash of the initial flash contents, it is set when the initial
+        # contents are loaded if a backup file is used
+        self.image_hash = None
+
+        # The files the initial flash contents were loaded from, or None if
+        # flash was changed in any other way. If the files have not changed
+        # since the backup file was created the hash of the initial contents
+        # is read from the sources file instead of being calculated.
+        self._image_sources = []
+
+        # The write-ahead journal for the backup file, the backup file regions
+        # that are memory mapped (indexed by device), the changes to unmapped
+        # devices that have not been written to the backup file and when the
+        # backup file was last synced to disk
+        self._journal = None
+        self._maps = {}
+        self._unmapped_changes = []
+        self._sync_interval = FLASH_DEFAULT_SYNC_INTERVAL
+        self._last_sync = 0.0
+
         # Initialize the A and B flash arrays.  These objects handle both the
         # configuration registers and the shadow flash.
         self.A = FlashArray(self, FlashDevice.FLASH_A_CONFIG, bigend=emu.getEndian())
@@ -1085,15 +1193,43 @@ class FLASH(ppc_peripherals.Module, mmio.MMIO_DEVICE):
             (0x00380000, 0x00400000,   None, FlashBlock.H5),
         )
 
+        # Index of the FLASH_BLOCK_MAP entry for each 16K region of main flash so
+        # the block for an address can be found without searching the map.
+        self._block_index = tuple(entry for entry in self.FLASH_BLOCK_MAP
+                                  for _ in range((entry[1] - entry[0]) // FLASH_BLOCK_INDEX_SIZE))
+
+        # The flash contents are hashed in blocks identified by their offset
+        # in the backup file: each main flash block followed by shadow flash B
+        # and A.  A block digest of None means the block has been changed
+        # since the digest was calculated.
+        self._hash_blocks = tuple((start, end) for start, end, _, _ in self.FLASH_BLOCK_MAP) + \
+                tuple((FLASH_BACKUP_OFFSET[d], FLASH_BACKUP_OFFSET[d] + FLASH_DEVICE_MMIO_SIZE[d])
+                      for d in (FlashDevice.FLASH_B_SHADOW, FlashDevice.FLASH_A_SHADOW))
+        self._hash_block_starts = [start for start, _ in self._hash_blocks]
+        self._block_digests = [None] * len(self._hash_blocks)
+        self._digest_filename = None
+
         # Start the main flash as erased, this will probably be overridden when 
         # the initial state of flash is restored.
         flash_size = FLASH_DEVICE_MMIO_SIZE[FlashDevice.FLASH_MAIN]
         self.data = bytearray(_genErasedBytes(flash_size))
 
     def shutdown(self):
-        # Gracefully close the backup file
+        # Write any outstanding changes and gracefully close the backup file
         if self._backup:
+            self.sync()
+            FLASH._backups.discard(self)
+
+            for buf in self._maps.values():
+                buf.close()
+            self._maps = {}
+
+            # The journal is empty after a sync so it can be removed
+            self._journal.close()
+            os.unlink(self._journal.name)
+            self._journal = None
             self._backup.close()
+            self._backup = None
 
     def reset(self, emu):
         # Some flash control registers get their initial values from shadow
@@ -1172,33 +1308,48 @@ class FLASH(ppc_peripherals.Module, mmio.MMIO_DEVICE):
         if isinstance(filename, (bytes, bytearray)):
             # If the filename param is a bytes object assume this is a blob that
             # should be loaded rather than a file that should be opened.
-            data = filename
-
-            if device == FlashDevice.FLASH_MAIN:
-                self.data = bytearray(_loadFromBlob(data, offset, size))
-            elif device == FlashDevice.FLASH_A_SHADOW:
-                self.A.shadow = bytearray(_loadFromBlob(data, offset, size))
-            elif device == FlashDevice.FLASH_B_SHADOW:
-                self.B.shadow = bytearray(_loadFromBlob(data, offset, size))
-            else:
+            if device not in FLASH_BACKUP_OFFSET:
                 raise Exception('Cannot initialize %s from blob' % device.name)
+            data = _loadFromBlob(filename, offset, size)
 
         elif os.path.exists(filename):
-            logger.debug('Loading %s from %s @ 0x%x to 0x%x', device.name, filename, offset, offset + size)
-            if device == FlashDevice.FLASH_MAIN:
-                self.data = bytearray(_loadFromFile(filename, offset, size))
-            elif device == FlashDevice.FLASH_A_SHADOW:
-                self.A.shadow = bytearray(_loadFromFile(filename, offset, size))
-            elif device == FlashDevice.FLASH_B_SHADOW:
-                self.B.shadow = bytearray(_loadFromFile(filename, offset, size))
-            else:
+            if device not in FLASH_BACKUP_OFFSET:
                 raise Exception('Cannot initialize %s from file' % device.name)
+            logger.debug('Loading %s from %s @ 0x%x to 0x%x', device.name, filename, offset, offset + size)
+            data = _loadFromFile(filename, offset, size)
 
         else:
             raise Exception('Cannot initialize %s from %r' % (device.name, filename))
 
+        # Update the flash contents in place, if the device is mapped to the
+        # backup file this writes the new contents directly into the map.
+        sources = self._image_sources
+        self._getDeviceData(device)[:] = data
         self.save(device)
 
+        if sources is not None and not isinstance(filename, (bytes, bytearray)):
+            self._image_sources = sources + [_getFileSource(device, filename, offset)]
+
+    def _getDeviceData(self, device):
+        if device == FlashDevice.FLASH_MAIN:
+            return self.data
+        elif device == FlashDevice.FLASH_A_SHADOW:
+            return self.A.shadow
+        elif device == FlashDevice.FLASH_B_SHADOW:
+            return self.B.shadow
+        else:
+            raise Exception('Invalid flash device %s' % device.name)
+
+    def _setDeviceData(self, device, data):
+        if device == FlashDevice.FLASH_MAIN:
+            self.data = data
+        elif device == FlashDevice.FLASH_A_SHADOW:
+            self.A.shadow = data
+        elif device == FlashDevice.FLASH_B_SHADOW:
+            self.B.shadow = data
+        else:
+            raise Exception('Invalid flash device %s' % device.name)
+
     def get_hash(self):
         flash_hash = hashlib.md5()
         flash_hash.update(self.data)
@@ -1215,10 +1366,14 @@ class FLASH(ppc_peripherals.Module, mmio.MMIO_DEVICE):
 
     def delete_backup(self, backup_filename=None):
         if backup_filename is not None:
-            filename = backup_filename + '.' + self.get_hash().hex()
-            if os.path.exists(filename):
-                logger.debug('Deleting flash backup file %s', filename)
-                os.unlink(filename)
+            flash_hash = self.get_hash().hex()
+            for filename in (backup_filename + '.' + flash_hash,
+                             _getJournalFilename(backup_filename, flash_hash),
+                             _getDigestFilename(backup_filename, flash_hash),
+                             _getSourcesFilename(backup_filename)):
+                if os.path.exists(filename):
+                    logger.debug('Deleting flash backup file %s', filename)
+                    os.unlink(filename)
 
     def load_complete(self, backup_filename=None):
         """
@@ -1233,95 +1388,303 @@ class FLASH(ppc_peripherals.Module, mmio.MMIO_DEVICE):
               calculated) then all flash devices are (re)loaded from the backup
             - If any flash device has not been loaded yet then a default state
               is created for that device
+
+        When a backup file is used the flash devices are memory mapped to the
+        backup file so the contents of flash are not copied when the backup is
+        restored, and changes made by program and erase operations are written
+        back to the backup file by the OS.  Changes are also recorded in a
+        journal file which is replayed the next time the backup is loaded if
+        the emulator did not shut down cleanly.
         """
-        flash_size = FLASH_DEVICE_MMIO_SIZE[FlashDevice.FLASH_MAIN]
-        shadow_A_size = FLASH_DEVICE_MMIO_SIZE[FlashDevice.FLASH_A_SHADOW]
-        shadow_B_size = FLASH_DEVICE_MMIO_SIZE[FlashDevice.FLASH_B_SHADOW]
+        if self._config is not None:
+            self._sync_interval = self._config.get('sync_interval', FLASH_DEFAULT_SYNC_INTERVAL)
 
-        # Start with the assumption that a backup needs to be created
-        backup_valid = False
+        if self.data is None or backup_filename is None:
+            return
 
-        if self.data is not None:
-            # If a backup filename was provided see if a backup file exists that
-            # matches the hash digest that was created
-            if backup_filename is not None:
-                filename = backup_filename + '.' + self.get_hash().hex()
-                if os.path.exists(filename):
-                    logger.debug('Restoring state of system from flash backup file %s', filename)
-                    # use 'r+b' mode with open to avoid truncating the backup
-                    # file
-                    self._backup = open(filename, 'r+b')
-
-                    # Now attempt to restore the contents of flash from the
-                    # backup file we don't use the _loadFrom???() helper
-                    # functions here because if the backup file doesn't have the
-                    # correct size then the backup file is considered to not
-                    # have valid data for that section.
-                    #
-                    # Shadow flash B is first in the backup file
-                    flash_data = self._backup.read(flash_size)
-                    logger.debug('Restoring %s from backup file %s @ 0x%x to 0x%x',
-                                 FlashDevice.FLASH_MAIN, filename, self._backup.tell(),
-                                 self._backup.tell() + flash_size)
-                    shadow_b_data = self._backup.read(shadow_B_size)
-                    logger.debug('Restoring %s from backup file %s @ 0x%x to 0x%x',
-                                 FlashDevice.FLASH_B_SHADOW, filename, self._backup.tell(),
-                                 self._backup.tell() + shadow_B_size)
-                    shadow_a_data = self._backup.read(shadow_A_size)
-                    logger.debug('Restoring %s from backup file %s @ 0x%x to 0x%x',
-                                 FlashDevice.FLASH_A_SHADOW, filename, self._backup.tell(),
-                                 self._backup.tell() + shadow_A_size)
-
-                    if len(flash_data) == flash_size and \
-                            len(shadow_b_data) == shadow_B_size and \
-                            len(shadow_a_data) == shadow_A_size:
-                        backup_valid = True
-
-                        self.data = bytearray(flash_data)
-                        self.B.shadow = bytearray(shadow_b_data)
-                        self.A.shadow = bytearray(shadow_a_data)
-
-                        logger.info('flash restored from backup %r', filename)
-                else:
-                    # Create the backup file
-                    self._backup = open(filename, 'w+b')
+        # If a backup filename was provided see if a backup file exists that
+        # matches the hash digest of the initial flash contents.  If flash was
+        # loaded from the same files as the last time a backup was created the
+        # hash is read from the sources file instead of being calculated.  The
+        # backup file is only considered valid if it is the correct size.
+        flash_hash = self._getSourcesHash(backup_filename)
+        if flash_hash is None:
+            flash_hash = self.get_hash().hex()
+            self._saveSourcesHash(backup_filename, flash_hash)
+        self.image_hash = flash_hash
+        filename = backup_filename + '.' + flash_hash
+        if os.path.exists(filename) and os.path.getsize(filename) == FLASH_BACKUP_SIZE:
+            logger.debug('Restoring state of system from flash backup file %s', filename)
+            # use 'r+b' mode with open to avoid truncating the backup file
+            self._backup = open(filename, 'r+b')
+            backup_valid = True
+        else:
+            # Create the backup file
+            self._backup = open(filename, 'w+b')
+            self._backup.truncate(FLASH_BACKUP_SIZE)
+            backup_valid = False
+
+        # Open the journal without truncating it so any changes that were not
+        # synced before the emulator last exited can be applied.
+        self._journal = open(_getJournalFilename(backup_filename, flash_hash), 'a+b')
+        if FLASH._backups is None:
+            FLASH._backups = weakref.WeakSet()
+            atexit.register(_syncBackups)
+        FLASH._backups.add(self)
+
+        self._digest_filename = _getDigestFilename(backup_filename, flash_hash)
+        if backup_valid:
+            # The block digests of the backup contents are restored from the
+            # digest file, any blocks changed by the journal are rehashed when
+            # they are needed.
+            self._loadBlockDigests()
+            self._replayJournal()
+        else:
+            # Save a copy of the state of flash now.
+            for device, file_offset in FLASH_BACKUP_OFFSET.items():
+                self._backup.seek(file_offset)
+                self._backup.write(self._getDeviceData(device))
+        self._backup.flush()
+        os.fsync(self._backup.fileno())
+        self._journal.truncate(0)
+
+        # Map each flash device to its region of the backup file.  If the
+        # region is not aligned to the allocation granularity of this platform
+        # the device is not mapped and changes are written to the backup file.
+        for device, file_offset in FLASH_BACKUP_OFFSET.items():
+            size = FLASH_DEVICE_MMIO_SIZE[device]
+            if file_offset % mmap.ALLOCATIONGRANULARITY == 0:
+                logger.debug('Mapping %s to backup file %s @ 0x%x to 0x%x',
+                             device.name, filename, file_offset, file_offset + size)
+                buf = mmap.mmap(self._backup.fileno(), size, offset=file_offset)
+                self._maps[device] = buf
+                self._setDeviceData(device, buf)
+            elif backup_valid:
+                logger.debug('Restoring %s from backup file %s @ 0x%x to 0x%x',
+                             device.name, filename, file_offset, file_offset + size)
+                self._backup.seek(file_offset)
+                self._setDeviceData(device, bytearray(self._backup.read(size)))
+
+        if backup_valid:
+            logger.info('flash restored from backup %r', filename)
+
+        self._last_sync = time.monotonic()
+
+    def _replayJournal(self):
+        # Apply the complete records in the journal to the backup file, the
+        # last record may be incomplete if the emulator exited while it was
+        # being written.
+        self._journal.seek(0)
+        count = 0
+        while True:
+            hdr = self._journal.read(FLASH_JOURNAL_HDR.size)
+            if len(hdr) < FLASH_JOURNAL_HDR.size:
+                break
+
+            file_offset, size, crc = FLASH_JOURNAL_HDR.unpack(hdr)
+            data = self._journal.read(size)
+            if len(data) != size or zlib.crc32(data) != crc or \
+                    file_offset + size > FLASH_BACKUP_SIZE:
+                logger.warning('Discarding incomplete flash journal record @ 0x%x', file_offset)
+                break
 
-        # If the backup has not been detected as valid, save a copy of the state
-        # of flash now.
-        if backup_valid != True:
-            self.save(FlashDevice.FLASH_MAIN)
-            self.save(FlashDevice.FLASH_B_SHADOW)
-            self.save(FlashDevice.FLASH_A_SHADOW)
+            self._backup.seek(file_offset)
+            self._backup.write(data)
+            self._markDirty(file_offset, size)
+            count += 1
+
+        if count:
+            logger.info('Applied %d flash journal records to backup', count)
+
+    def save(self, device, start=0, size=None, old=None):
+        # If the previous contents of the changed region are provided only the
+        # parts of the region that are different are saved
+        if old is not None:
+            data = self._getDeviceData(device)
+            for chunk_start, chunk_end in _changedRanges(old, data, start):
+                self.save(device, chunk_start, chunk_end - chunk_start)
+            return
 
-    def save(self, device, start=0, size=None):
         if size is None:
             size = FLASH_DEVICE_MMIO_SIZE[device]
 
-        # The shadow flash regions are saved to the same backup file as the main
-        # flash, and shadow flash B is saved first mimicking the order they are
-        # found on the real device.
+        if device not in FLASH_BACKUP_OFFSET:
+            raise Exception('Cannot save backup of %s' % device.name)
+
+        file_offset = FLASH_BACKUP_OFFSET[device] + start
+        self._markDirty(file_offset, size)
+
         if self._backup is not None:
             logger.debug('Saving %s[0x%08x:0x%08x]', device.name, start, start + size)
 
-            if device == FlashDevice.FLASH_MAIN:
-                file_offset = start
-                data = self.data
+            data = bytes(self._getDeviceData(device)[start:start+size])
 
-            elif device == FlashDevice.FLASH_B_SHADOW:
-                file_offset = FLASH_DEVICE_MMIO_SIZE[FlashDevice.FLASH_MAIN] + start
-                data = self.B.shadow
+            # The change is recorded in the journal, the journal records are
+            # synced to disk as a group by sync() before the backup file is
+            # written.  Mapped devices already hold the new data but the
+            # modified pages are not written back to the backup file until the
+            # mapping is flushed, changes to unmapped devices are written to
+            # the backup file by sync().
+            self._journal.write(FLASH_JOURNAL_HDR.pack(file_offset, len(data), zlib.crc32(data)))
+            self._journal.write(data)
+            if device not in self._maps:
+                self._unmapped_changes.append((file_offset, data))
 
-            elif device == FlashDevice.FLASH_A_SHADOW:
-                file_offset = FLASH_DEVICE_MMIO_SIZE[FlashDevice.FLASH_MAIN] + \
-                        FLASH_DEVICE_MMIO_SIZE[FlashDevice.FLASH_B_SHADOW] + start
-                data = self.A.shadow
+            if self._sync_interval is not None and \
+                    time.monotonic() - self._last_sync >= self._sync_interval:
+                self.sync()
 
-            else:
-                raise Exception('Cannot save backup of %s' % device.name)
+    def sync(self):
+        """
+        Write all changes to flash to disk. The journal is written first so
+        the backup file can be repaired if the emulator exits while the backup
+        file is being written, then the backup file is written and the journal
+        is emptied.
+        """
+        if self._backup is None:
+            return
 
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+        for file_offset, data in self._unmapped_changes:
             self._backup.seek(file_offset)
-            self._backup.write(data[start:start+size])
-            self._backup.flush()
+            self._backup.write(data)
+        self._unmapped_changes = []
+
+        for buf in self._maps.values():
+            buf.flush()
+        self._backup.flush()
+        os.fsync(self._backup.fileno())
+
+        # The block digests must be saved before the journal is emptied so any
+        # blocks changed by the journal are rehashed if the digest file is not
+        # written.
+        self._saveBlockDigests()
+
+        self._journal.truncate(0)
+        self._last_sync = time.monotonic()
+
+    def _getSourcesHash(self, backup_filename):
+        # Returns the hash saved in the sources file if flash was loaded from
+        # the same unchanged files that the saved hash was calculated for
+        if not self._image_sources:
+            return None
+
+        try:
+            with open(_getSourcesFilename(backup_filename), 'r') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        sources = [list(s) for s in self._image_sources]
+        if not isinstance(saved, dict) or saved.get('sources') != sources:
+            return None
+
+        flash_hash = saved.get('hash')
+        if not isinstance(flash_hash, str):
+            return None
+
+        logger.debug('Using saved flash hash %s', flash_hash)
+        return flash_hash
+
+    def _saveSourcesHash(self, backup_filename, flash_hash):
+        filename = _getSourcesFilename(backup_filename)
+        if not self._image_sources:
+            if os.path.exists(filename):
+                os.unlink(filename)
+            return
+
+        data = {'sources': [list(s) for s in self._image_sources], 'hash': flash_hash}
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+
+    def _markDirty(self, file_offset, size):
+        # Any change to flash other than loading a file means the initial
+        # contents can't be identified by the files they were loaded from
+        if self._backup is None:
+            self._image_sources = None
+
+        # Invalidate the digests of the blocks that overlap the changed region
+        idx = bisect.bisect_right(self._hash_block_starts, file_offset) - 1
+        end = file_offset + size
+        while idx < len(self._hash_blocks) and self._hash_blocks[idx][0] < end:
+            self._block_digests[idx] = None
+            idx += 1
+
+    def _loadBlockDigests(self):
+        self._block_digests = [None] * len(self._hash_blocks)
+        try:
+            with open(self._digest_filename, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return
+
+        if len(data) != FLASH_DIGEST_SIZE * len(self._hash_blocks):
+            logger.warning('Ignoring invalid flash digest file %s', self._digest_filename)
+            return
+
+        for idx in range(len(self._hash_blocks)):
+            digest = data[idx*FLASH_DIGEST_SIZE:(idx+1)*FLASH_DIGEST_SIZE]
+            if digest != FLASH_INVALID_DIGEST:
+                self._block_digests[idx] = digest
+
+    def _saveBlockDigests(self):
+        # Write the digests to a temporary file and then replace the digest
+        # file so a partially written digest file is never used
+        data = b''.join(self.getBlockDigests())
+        tmp_filename = self._digest_filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self._digest_filename)
+
+    def getBlockDigests(self):
+        """
+        Returns a list of the MD5 digests of each flash block, in the same
+        order as the blocks are saved in the backup file: the main flash blocks
+        followed by shadow flash B and shadow flash A. Only blocks that have
+        been changed since their digest was last calculated are hashed.
+        """
+        for idx, digest in enumerate(self._block_digests):
+            if digest is None:
+                start, end = self._hash_blocks[idx]
+                for device, file_offset in FLASH_BACKUP_OFFSET.items():
+                    if file_offset <= start < file_offset + FLASH_DEVICE_MMIO_SIZE[device]:
+                        offset = start - file_offset
+                        break
+
+                with memoryview(self._getDeviceData(device)) as view:
+                    digest = hashlib.md5(view[offset:offset+end-start]).digest()
+                self._block_digests[idx] = digest
+
+        return list(self._block_digests)
+
+    def getDigest(self):
+        """
+        Returns a digest of the current contents of all flash devices
+        calculated from the flash block digests.
+
+        Unlike get_hash() (which identifies the initial flash contents that a
+        backup file belongs to) this only requires hashing blocks that have
+        changed since the last time the digest was calculated.
+        """
+        return hashlib.md5(b''.join(self.getBlockDigests())).digest()
+
+    def diffBlocks(self, digests):
+        """
+        Compare the flash block digests with a list of digests returned by
+        getBlockDigests() (such as from another emulator instance), returns a
+        list of the (start, end) backup file offsets of the blocks that are
+        different.
+        """
+        return [block for block, cur, other in zip(self._hash_blocks, self.getBlockDigests(), digests)
+                if cur != other]
 
     def _getArrayBlockOffset(self, offset):
         """
@@ -1345,30 +1708,30 @@ class FLASH(ppc_peripherals.Module, mmio.MMIO_DEVICE):
         and there are no instructions to write values larger than 16 bytes
         interleaving values does not have to be handled during write.
         """
-        for start, end, array, block in self.FLASH_BLOCK_MAP:
-            if offset >= start and offset < end:
-                # Get an offset from the start of the block to the desired
-                # location
-                new_offset = offset - start
-
-                if array is not None:
-                    return (array, block, new_offset)
-                else:
-                    # Figure out the offset for the array to use internally for
-                    # this write
-                    chunk_idx = new_offset // 32
-                    array_offset = (chunk_idx * 16) + (new_offset % 16)
-
-                    # If the array is None it means this is one of the blocks
-                    # that is shared between the A and B arrays.
-                    # Check if bit 4 is set in the offset to see which array to
-                    # write the data to.
-                    if new_offset & 0x00000010:
-                        return (self.B, block, array_offset)
-                    else:
-                        return (self.A, block, array_offset)
+        idx = offset // FLASH_BLOCK_INDEX_SIZE
+        if offset < 0 or idx >= len(self._block_index):
+            raise envi.SegmentationViolation(offset)
+
+        start, end, array, block = self._block_index[idx]
 
-        raise envi.SegmentationViolation(va)
+        # Get an offset from the start of the block to the desired location
+        new_offset = offset - start
+
+        if array is not None:
+            return (array, block, new_offset)
+        else:
+            # Figure out the offset for the array to use internally for this
+            # write
+            chunk_idx = new_offset // 32
+            array_offset = (chunk_idx * 16) + (new_offset % 16)
+
+            # If the array is None it means this is one of the blocks that is
+            # shared between the A and B arrays.  Check if bit 4 is set in the
+            # offset to see which array to write the data to.
+            if new_offset & 0x00000010:
+                return (self.B, block, array_offset)
+            else:
+                return (self.A, block, array_offset)
 
     ##########################################
     # 0x00000000 - 0x00400000  Main Flash
@@ -1455,6 +1818,7 @@ class FLASH(ppc_peripherals.Module, mmio.MMIO_DEVICE):
     def writeMemory(self, addr, data):
         if addr + len(data) <= len(self.data):
             self.data[addr:addr+len(data)] = data
+            self._markDirty(addr, len(data))
         else:
             raise envi.SegmentationViolation(addr)
 
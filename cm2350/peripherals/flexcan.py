@@ -1,4 +1,5 @@
 import enum
+import bisect
 import struct
 from operator import rshift, lshift
 
@@ -7,6 +8,7 @@ import envi.bits as e_bits
 from ..ppc_vstructs import *
 from ..ppc_peripherals import *
 from ..intc_exc import INTC_EVENT
+from .. import ioproto
 
 import logging
 logger = logging.getLogger(__name__)
@@ -16,6 +18,9 @@ __all__  = [
 ]
 
 
+# Size of the FlexCAN MMIO region
+FLEXCAN_MMIO_SIZE = 0x4000
+
 FLEXCAN_MAX_MB = 64
 
 FLEXCAN_RxFIFO_MAX_LEN  = 6
@@ -87,6 +92,9 @@ FLEXCAN_MB8_OFFSET              = 0x0100
 # Each mailbox is made up of 4 32-bit values
 FLEXCAN_MBx_SIZE                = 4 * 4
 
+# The ID is the second 32-bit value of each mailbox
+FLEXCAN_MBx_ID_OFFSETS          = range(4, 8)
+
 # A range to iterate over all of mailboxes
 FLEXCAN_MB_IDX_RANGE            = range(0*FLEXCAN_MBx_SIZE, FLEXCAN_MAX_MB*FLEXCAN_MBx_SIZE, FLEXCAN_MBx_SIZE)
 FLEXCAN_MB_RANGE                = range(FLEXCAN_MAX_MB)
@@ -392,6 +400,114 @@ class FLEXCAN_x_ESR(PeriphRegister):
         self.pad2 = v_const(1)
 
 
+class FlexCANFilterIndex:
+    """
+    Index of (mask, filter) entries used to quickly find the mailboxes that
+    match a received message ID.  Entries are grouped by mask so a message ID
+    only has to be looked up once for each distinct mask value (usually there
+    are only a few), instead of checking every mailbox.
+
+    Matches are returned in priority order, which is the order the entries
+    were added in.  Updating an existing entry does not change its priority.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # key -> (mask, filter, priority)
+        self._entries = {}
+        # mask -> {filter: [(priority, key), ...]}
+        self._groups = {}
+        self._next = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key, mask, filt):
+        """
+        Add a new entry or update the mask and filter of an existing entry
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] == mask and entry[1] == filt:
+                return
+            prio = entry[2]
+            self._unlink(key, entry)
+        else:
+            prio = self._next
+            self._next += 1
+
+        self._entries[key] = (mask, filt, prio)
+        bucket = self._groups.setdefault(mask, {}).setdefault(filt, [])
+        bisect.insort(bucket, (prio, key))
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._unlink(key, entry)
+
+    def _unlink(self, key, entry):
+        mask, filt, prio = entry
+        group = self._groups[mask]
+        bucket = group[filt]
+        bucket.remove((prio, key))
+        if not bucket:
+            del group[filt]
+            if not group:
+                del self._groups[mask]
+
+    def match(self, arbid):
+        """
+        Return the keys of all entries that match the message ID in priority
+        order
+        """
+        found = None
+        for mask, group in self._groups.items():
+            bucket = group.get(arbid & mask)
+            if bucket is not None:
+                if found is None:
+                    found = bucket
+                else:
+                    found = sorted(found + bucket)
+
+        if found is None:
+            return ()
+        return [key for _, key in found]
+
+    def matchFirst(self, arbid):
+        """
+        Return the key of the highest priority entry that matches the message
+        ID, or None
+        """
+        found = None
+        for mask, group in self._groups.items():
+            bucket = group.get(arbid & mask)
+            if bucket is not None and (found is None or bucket[0] < found):
+                found = bucket[0]
+
+        if found is None:
+            return None
+        return found[1]
+
+    def matchAny(self, arbid):
+        """
+        Returns True if any entry matches the message ID
+        """
+        for mask, group in self._groups.items():
+            if (arbid & mask) in group:
+                return True
+        return False
+
+
+# Flags used in the CanMsg external IO wire format
+CANMSG_WIRE_RTR       = 0x01
+CANMSG_WIRE_IDE       = 0x02
+CANMSG_WIRE_TIMESTAMP = 0x04
+
+
 class CanMsg:
     """
     Object used to make it easier to send/recv CAN messages to external IO
@@ -402,6 +518,10 @@ class CanMsg:
     # message that is transmitted.
     _fmt = '>BBHI8s'
 
+    # struct format for the external IO binary wire protocol, the fields are:
+    #   flags, length, arbid, timestamp, data
+    _wire_fmt = '>BBIH8s'
+
     def __init__(self, rtr, ide, arbid, length, data):
         """
         Constructor for the CanMsg class, sets the initial rtr, ide, arbid,
@@ -482,6 +602,34 @@ class CanMsg:
         length_val, ts_val, id_val = self._encode_len_ts_id(prio=prio, timestamp=timestamp)
         return struct.pack(self._fmt, code, length_val, ts_val, id_val, self.data)
 
+    def to_wire(self):
+        """
+        Return the values used to pack this message with the _wire_fmt format
+        """
+        flags = self.rtr | (self.ide << 1)
+        if self.timestamp is not None:
+            flags |= CANMSG_WIRE_TIMESTAMP
+            ts_val = self.timestamp
+        else:
+            ts_val = 0
+        return (flags, self.length, self.arbid, ts_val, self.data)
+
+    @classmethod
+    def from_wire(cls, fields):
+        """
+        Creates a CanMsg object from the values unpacked with the _wire_fmt
+        format
+        """
+        flags, length, arbid, ts_val, data = fields
+        if length > 8:
+            raise ioproto.IOProtocolError('Invalid CAN message length %d' % length)
+
+        msg = cls(rtr=flags & CANMSG_WIRE_RTR, ide=(flags & CANMSG_WIRE_IDE) >> 1,
+                  arbid=arbid, length=length, data=data[:length])
+        if flags & CANMSG_WIRE_TIMESTAMP:
+            msg.timestamp = ts_val
+        return msg
+
     def __eq__(self, other):
         """
         To make it easier to compare msgs during testing
@@ -493,6 +641,12 @@ class CanMsg:
                 self.data == other.data
 
 
+# CanMsg objects are exchanged with external IO clients using the binary wire
+# protocol
+ioproto.registerCodec(ioproto.IO_MSG_CAN, CanMsg, CanMsg._wire_fmt,
+                      CanMsg.to_wire, CanMsg.from_wire)
+
+
 class FLEXCAN_REGISTERS(PeripheralRegisterSet):
     """
     Register set for FlexCAN peripherals.  All registers are handled by this
@@ -544,7 +698,9 @@ class FlexCAN(ExternalIOPeripheral):
       never experiences any errors.
     - The MMIO range is not dynamically adjusted based on MCR[MAXMB]
 
-    Supports sending and receiving pickled CanMsg objects over a TCP connection.
+    Supports sending and receiving CanMsg objects over a TCP connection using
+    the binary wire protocol (or pickled objects if the legacy "pickle"
+    protocol is configured).
     The host and port to use are read from the "project.MPC5674.FlexCAN_?"
     configuration tree. The default configuration values are specified in the
     cm2350.MPC4674F.defconfig dict.
@@ -563,12 +719,17 @@ class FlexCAN(ExternalIOPeripheral):
             print(data)
 
     """
+    # CanMsg objects are not modified once they are queued so the Rx FIFO only
+    # needs to be shallow copied
+    _snap_refs = ('_rx_fifo',)
+    _snap_objs = ('_timer', '_rx_fifo_filters', '_rx_filters', '_rtr_filters')
+
     def __init__(self, devname, emu, mmio_addr):
         """
         FlexCAN constructor.  Each processor has multiple FlexCAN peripherals
         so the devname parameter must be unique.
         """
-        super().__init__(emu, devname, mmio_addr, 0x4000,
+        super().__init__(emu, devname, mmio_addr, FLEXCAN_MMIO_SIZE,
                 regsetcls=FLEXCAN_REGISTERS,
                 isrstatus=FLEXCAN_INT_STATUS_REGS,
                 isrflags=FLEXCAN_INT_FLAG_REGS,
@@ -580,18 +741,17 @@ class FlexCAN(ExternalIOPeripheral):
         self.speed = None
 
         # Queue used to hold messages to be placed in the Rx FIFO. This is sized
-        # so if there is only 1 message it is placed in MB0, and it can hold 7
+        # so if there is only 1 message it is placed in MB0, and it can hold 5
         # more messages.
-        self._rx_fifo = []
+        self._rx_fifo = RingFIFO(FLEXCAN_RxFIFO_MAX_LEN)
 
-        # values used to efficiently generate a list of filters and masks to
-        # check incoming message IDs against. The filter dictionary has an entry
-        # for each mailbox that consists of a tuple of (mask, filter).  If the
-        # RxFIFO is enabled a key of None will be used and will have a list of
-        # filters.  RTR frames have a different filter cache.
-        self._rx_fifo_filters = {0: {0: [], 1: []}, 1: {0: [], 1: []}}
-        self._rx_filters = {0: {}, 1: {}}
-        self._rtr_filters = {0: {}, 1: {}}
+        # Indexes of the filters and masks to check incoming message IDs
+        # against. The Rx and RTR filter indexes have an entry for each mailbox,
+        # indexed by the IDE value of the message.  The RxFIFO filter indexes
+        # are indexed by (RTR << 1) | IDE of the message.
+        self._rx_fifo_filters = tuple(FlexCANFilterIndex() for i in range(4))
+        self._rx_filters = (FlexCANFilterIndex(), FlexCANFilterIndex())
+        self._rtr_filters = (FlexCANFilterIndex(), FlexCANFilterIndex())
 
         # TODO: should we simulate Rx/Tx errors and handle bus off transitions?
 
@@ -637,14 +797,8 @@ class FlexCAN(ExternalIOPeripheral):
         """
         Utility to reset all receive filters back to their defaults (empty)
         """
-        self._rx_fifo_filters[0][0] = []
-        self._rx_fifo_filters[0][1] = []
-        self._rx_fifo_filters[1][0] = []
-        self._rx_fifo_filters[1][1] = []
-        self._rx_filters[0] = {}
-        self._rx_filters[1] = {}
-        self._rtr_filters[0] = {}
-        self._rtr_filters[1] = {}
+        for index in self._rx_fifo_filters + self._rx_filters + self._rtr_filters:
+            index.clear()
 
     def softReset(self):
         """
@@ -666,7 +820,7 @@ class FlexCAN(ExternalIOPeripheral):
         self.registers.iflag2.reset(self.emu)
 
         # also clear out any msgs in the Rx FIFO
-        self._rx_fifo = []
+        self._rx_fifo.clear()
 
         # And the filters
         self._resetFilters()
@@ -683,7 +837,7 @@ class FlexCAN(ExternalIOPeripheral):
         Handle standard core reset and initialization
         """
         # clear the Rx FIFO
-        self._rx_fifo = []
+        self._rx_fifo.clear()
 
         # And the filters
         self._resetFilters()
@@ -730,11 +884,10 @@ class FlexCAN(ExternalIOPeripheral):
             # RxFIFO represents the number of messages that have been received
             # and not read.
             self.normalRx(0, msg)
-            self._rx_fifo.append(None)
+            self._rx_fifo.push(None)
             return True
 
-        elif len(self._rx_fifo) < FLEXCAN_RxFIFO_MAX_LEN:
-            self._rx_fifo.append(msg)
+        elif self._rx_fifo.push(msg):
 
             # According to "23.4.7 Rx FIFO" (MPC5674FRM.pdf page 853):
             #   "A warning interrupt is also generated when 5 frames are
@@ -746,7 +899,7 @@ class FlexCAN(ExternalIOPeripheral):
             # messages not already stored in MB0 as being "in the fifo"? Or
             # perhaps it means if there were 5 messages in the RxFIFO before a
             # new message was queued?
-            if len(self._rx_fifo) == FLEXCAN_RxFIFO_MAX_LEN:
+            if self._rx_fifo.isFull():
                 self.event('msg', 6, FLEXCAN_RxFIFO_WARNING_MASK)
             return True
 
@@ -766,37 +919,34 @@ class FlexCAN(ExternalIOPeripheral):
         last_match = None
         if self.registers.mcr.fen:
             # Check this message against the available RxFIFO filters
-            for mask, filt in self._rx_fifo_filters[obj.rtr][obj.ide]:
-                if (obj.arbid & mask) == filt:
-                    if self.rxFifoRecv(obj):
-                        return
+            if self._rx_fifo_filters[(obj.rtr << 1) | obj.ide].matchAny(obj.arbid):
+                if self.rxFifoRecv(obj):
+                    return
 
-                    # If the RxFIFO was full then search through the reset of
-                    # the available mailboxes to see if one of the non-FIFO
-                    # mailboxes match.
-                    last_match = 0
-                    break
+                # If the RxFIFO was full then search through the reset of
+                # the available mailboxes to see if one of the non-FIFO
+                # mailboxes match.
+                last_match = 0
 
         if obj.rtr:
-            for mb, (mask, filt) in self._rtr_filters[obj.ide].items():
-                if (obj.arbid & mask) == filt:
-                    # Automatically transmit the remote frame
-                    self.normalTx(mb)
-                    return
+            mb = self._rtr_filters[obj.ide].matchFirst(obj.arbid)
+            if mb is not None:
+                # Automatically transmit the remote frame
+                self.normalTx(mb)
+                return
 
-        for mb, (mask, filt) in self._rx_filters[obj.ide].items():
-            if (obj.arbid & mask) == filt:
-                # Ensure this mailbox is empty
-                code = self.getMBCode(mb)
-                if code == FLEXCAN_CODE_RX_EMPTY:
-                    # place the message into the mailbox
-                    self.normalRx(mb, obj)
-                    return
-                else:
-                    # Keep track of the last mailbox that matched but wasn't
-                    # empty so we can mark it as overrun if no other matches
-                    # are found.
-                    last_match = mb
+        for mb in self._rx_filters[obj.ide].match(obj.arbid):
+            # Ensure this mailbox is empty
+            code = self.getMBCode(mb)
+            if code == FLEXCAN_CODE_RX_EMPTY:
+                # place the message into the mailbox
+                self.normalRx(mb, obj)
+                return
+            else:
+                # Keep track of the last mailbox that matched but wasn't
+                # empty so we can mark it as overrun if no other matches
+                # are found.
+                last_match = mb
 
         # If we have reached here it means that no available mailboxes were
         # found. If any matching Rx mailboxes were
@@ -868,12 +1018,15 @@ class FlexCAN(ExternalIOPeripheral):
                 # representing the current message that is in the RxFIFO mailbox
                 # (mailbox 0) already. Clearing the interrupt flag indicates
                 # that the software is finished with the message
-                self._rx_fifo.pop(0)
+                self._rx_fifo.pop()
 
             elif len(self._rx_fifo) > 1:
-                # Leave the placeholder None in index 0 of the RxFIFO and move
-                # the next unread message into the RxFIFO mailbox (mailbox 0)
-                msg = self._rx_fifo.pop(1)
+                # Discard the placeholder of the message that was just read and
+                # move the next unread message into the RxFIFO mailbox (mailbox
+                # 0), leaving a placeholder None in its place.
+                self._rx_fifo.pop()
+                msg = self._rx_fifo[0]
+                self._rx_fifo[0] = None
                 self.normalRx(0, msg)
 
     def mbUpdate(self, thing, idx, size, **kwargs):
@@ -885,6 +1038,9 @@ class FlexCAN(ExternalIOPeripheral):
             RX_EMPTY               : Update RX filters for the current MB
             TX_RTR                 : Update RTR filters for the current MB
             other                  : Remove MB from all filters
+
+        When the ID of a mailbox that is used for Rx or RTR filtering is
+        updated the filter for that mailbox is updated.
         """
         # If this was the mailbox offset that contains the code (byte 0 of 16),
         # check the code to identify what needs to be done
@@ -910,6 +1066,15 @@ class FlexCAN(ExternalIOPeripheral):
                 # filters
                 self.filterRemoveMB(mb)
 
+        elif idx % FLEXCAN_MBx_SIZE in FLEXCAN_MBx_ID_OFFSETS:
+            # If the ID of a mailbox that is currently used for Rx or RTR
+            # filtering is changed update the filter for that mailbox
+            mb = idx // FLEXCAN_MBx_SIZE
+            if mb in self._rx_filters[1]:
+                self.filterAddRxMB(mb)
+            elif mb in self._rtr_filters[1]:
+                self.filterAddRtrMB(mb)
+
     def normalRx(self, mb, msg):
         """
         Take a message object and do the following:
@@ -1090,9 +1255,8 @@ class FlexCAN(ExternalIOPeripheral):
         filter values configured for the corresponding mailboxes.
         """
         # If this is in the RTR list it shouldn't be in the Rx list
-        if mb in self._rx_filters[0]:
-            self._rx_filters[0].pop(mb)
-            self._rx_filters[1].pop(mb)
+        self._rx_filters[0].remove(mb)
+        self._rx_filters[1].remove(mb)
 
         idx = mb * FLEXCAN_MBx_SIZE
 
@@ -1104,7 +1268,7 @@ class FlexCAN(ExternalIOPeripheral):
         # the message ID starts at offset 4 and is 4 bytes long
         ext_filt = self.registers.mb.parsebytes(idx+4, 4, bigend=self.emu.getEndian())
         ext_filt &= FLEXCAN_ID_MASK & ext_mask
-        self._rtr_filters[1][mb] = ext_mask, ext_filt
+        self._rtr_filters[1].add(mb, ext_mask, ext_filt)
 
         # If there are filter mask bits set in the lower 18 bits then this mask
         # is ext 29-bit specific and a std 11-bit filter should not be created
@@ -1113,7 +1277,9 @@ class FlexCAN(ExternalIOPeripheral):
             # standard ID filters
             std_mask = ext_mask >> FLEXCAN_STD_ID_SHIFT
             std_filt = ext_filt >> FLEXCAN_STD_ID_SHIFT
-            self._rtr_filters[0][mb] = std_mask, std_filt
+            self._rtr_filters[0].add(mb, std_mask, std_filt)
+        else:
+            self._rtr_filters[0].remove(mb)
 
     def filterAddRxMB(self, mb):
         """
@@ -1123,9 +1289,8 @@ class FlexCAN(ExternalIOPeripheral):
         values configured for the corresponding mailboxes in the filter list.
         """
         # If this is in the RTR list it shouldn't be in the Rx list
-        if mb in self._rtr_filters[0]:
-            self._rtr_filters[0].pop(mb)
-            self._rtr_filters[1].pop(mb)
+        self._rtr_filters[0].remove(mb)
+        self._rtr_filters[1].remove(mb)
 
         # Convert mailbox ID to offset into a mailbox data offset
         idx = mb * FLEXCAN_MBx_SIZE
@@ -1143,7 +1308,7 @@ class FlexCAN(ExternalIOPeripheral):
         ext_filt = self.registers.mb.parsebytes(idx+4, 4, bigend=self.emu.getEndian())
         # Don't forget to mask out the bits that we care about
         ext_filt &= FLEXCAN_ID_MASK & ext_mask
-        self._rx_filters[1][mb] = ext_mask, ext_filt
+        self._rx_filters[1].add(mb, ext_mask, ext_filt)
 
         # If there are filter mask bits set in the lower 18 bits then this mask
         # is ext 29-bit specific and a std 11-bit filter should not be created
@@ -1152,20 +1317,16 @@ class FlexCAN(ExternalIOPeripheral):
             # standard ID filters
             std_mask = ext_mask >> FLEXCAN_STD_ID_SHIFT
             std_filt = ext_filt >> FLEXCAN_STD_ID_SHIFT
-            self._rx_filters[0][mb] = std_mask, std_filt
+            self._rx_filters[0].add(mb, std_mask, std_filt)
+        else:
+            self._rx_filters[0].remove(mb)
 
     def filterRemoveMB(self, mb):
         """
         Utility function that removes a mailbox from all Rx and RTR filters.
         """
-        if mb in self._rx_filters[0]:
-            self._rx_filters[0].pop(mb)
-        if mb in self._rx_filters[1]:
-            self._rx_filters[1].pop(mb)
-        if mb in self._rtr_filters[0]:
-            self._rtr_filters[0].pop(mb)
-        if mb in self._rtr_filters[1]:
-            self._rtr_filters[1].pop(mb)
+        for index in self._rx_filters + self._rtr_filters:
+            index.remove(mb)
 
     def filterUpdate(self):
         """
@@ -1205,8 +1366,11 @@ class FlexCAN(ExternalIOPeripheral):
                     FLEXCAN_RxFIFO_FILTER_ID_MASKS[mode],
                     FLEXCAN_RxFIFO_FILTER_ID_SHIFTS[mode]))
 
-            # There are 8 filters stored in the MB memory in MB6 and MB7
+            # There are 8 filters stored in the MB memory in MB6 and MB7. Each
+            # filter value can produce multiple entries in the filter indexes,
+            # the key of each entry is just a unique count.
             filters = struct.unpack_from('>8I', self.registers.mb.value, offset=6*FLEXCAN_MBx_SIZE)
+            key = 0
             for mb in range(8):
                 filt_val = filters[mb]
                 mask_val = self.getMaskForMB(mb)
@@ -1235,9 +1399,11 @@ class FlexCAN(ExternalIOPeripheral):
                         filt = id_shift_oper(filt_val & id_mask[0], id_shift)
 
                         if rtr is None or rtr == 0:
-                            self._rx_fifo_filters[0][0].append((mask, filt))
+                            self._rx_fifo_filters[0b00].add(key, mask, filt)
+                            key += 1
                         if rtr is None or rtr == 1:
-                            self._rx_fifo_filters[1][0].append((mask, filt))
+                            self._rx_fifo_filters[0b10].add(key, mask, filt)
+                            key += 1
 
                     if ide is None or ide == 1:
                         # 29-bit (ext)
@@ -1246,9 +1412,11 @@ class FlexCAN(ExternalIOPeripheral):
                         filt = id_shift_oper(filt_val & id_mask[1], id_shift)
 
                         if rtr is None or rtr == 0:
-                            self._rx_fifo_filters[0][1].append((mask, filt))
+                            self._rx_fifo_filters[0b01].add(key, mask, filt)
+                            key += 1
                         if rtr is None or rtr == 1:
-                            self._rx_fifo_filters[1][1].append((mask, filt))
+                            self._rx_fifo_filters[0b11].add(key, mask, filt)
+                            key += 1
 
             # Now add normal message filters starting with MB8
             start_mb = 8
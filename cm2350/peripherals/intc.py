@@ -93,6 +93,11 @@ class INTC_REGISTERS(PeripheralRegisterSet):
 
 
 class INTC(MMIOPeripheral):
+    # Exception objects are not modified once queued, the callbacks are
+    # registered by other peripherals and are not part of the emulated state
+    _snap_refs = ('_cur_exc', '_delayed_excs')
+    _snap_ignore = MMIOPeripheral._snap_ignore + ('_callbacks',)
+
     def __init__(self, emu, mmio_addr):
         # need to hook a MMIO mmiodev at 0xfff38000 of size 0x4000
         super().__init__(emu, 'INTC', mmio_addr, 0x4000, regsetcls=INTC_REGISTERS)
@@ -0,0 +1,116 @@
+import envi
+
+
+__all__ = [
+    'PpcCycleModel',
+    'INSTR_CLASSES',
+]
+
+
+# The instruction classes that can be assigned a custom number of cycles, any
+# instruction that doesn't fall into one of these classes uses the default
+# cycles-per-instruction value.
+INSTR_CLASSES = (
+    'branch',
+    'load',
+    'store',
+    'mul',
+    'div',
+    'sync',
+)
+
+# Flags that identify an instruction as a change of flow instruction
+BRANCH_IFLAGS = envi.IF_BRANCH | envi.IF_CALL | envi.IF_RET
+
+# Memory barrier and synchronization instructions
+SYNC_MNEMS = ('sync', 'isync', 'msync', 'mbar', 'lwsync')
+
+# Instructions that start with 'l' but do not access memory
+LOAD_IMMEDIATE_MNEMS = ('li', 'lis', 'lih', 'lil')
+
+# VLE instruction mnemonic prefixes, these are stripped before the instruction
+# class is determined so VLE and standard PPC instructions are treated the same
+VLE_MNEM_PREFIXES = ('se_', 'e_')
+
+
+class PpcCycleModel:
+    '''
+    Simple instruction timing model used to determine how many system clock
+    cycles an instruction takes to execute.  Each executed instruction moves
+    the emulator system time forward by this number of cycles, because the
+    system time frequency is the CPU clock (as configured by the FMPLL and SIU)
+    the emulated time derived from this model is deterministic and is scaled
+    by the configured clocks.
+
+    This is not intended to be a cycle-accurate pipeline model, instructions
+    are grouped into a few broad classes (see INSTR_CLASSES) and each class can
+    be assigned a different cost.
+    '''
+    def __init__(self, default=1, **cycles):
+        '''
+        Arguments:
+            default     The number of cycles used for any instruction that does
+                        not have a class-specific value.
+            cycles      (optional) The number of cycles to use for each
+                        instruction class. A value of None means the default
+                        value should be used for that class.
+        '''
+        invalid = [name for name in cycles if name not in INSTR_CLASSES]
+        if invalid:
+            raise ValueError('Invalid instruction classes: %s (valid classes are %s)' %
+                             (', '.join(invalid), ', '.join(INSTR_CLASSES)))
+
+        if default < 1:
+            raise ValueError('Invalid default CPI value: %s' % default)
+        self.default = int(default)
+
+        self._cycles = {}
+        for name in INSTR_CLASSES:
+            value = cycles.get(name)
+            self._cycles[name] = self.default if value is None else int(value)
+
+        # If every instruction class uses the default CPI there is no reason to
+        # classify each instruction.
+        self._uniform = all(v == self.default for v in self._cycles.values())
+
+    def __repr__(self):
+        classes = ', '.join('%s=%d' % (n, v) for n, v in self._cycles.items())
+        return '%s(default=%d, %s)' % (self.__class__.__name__, self.default, classes)
+
+    def classify(self, op):
+        '''
+        Return the instruction class of the decoded instruction, or None if the
+        instruction does not match any instruction class.
+        '''
+        if op.iflags & BRANCH_IFLAGS:
+            return 'branch'
+
+        mnem = op.mnem
+        for prefix in VLE_MNEM_PREFIXES:
+            if mnem.startswith(prefix):
+                mnem = mnem[len(prefix):]
+                break
+
+        if mnem in SYNC_MNEMS:
+            return 'sync'
+        elif mnem.startswith('st'):
+            return 'store'
+        elif mnem.startswith('l') and mnem not in LOAD_IMMEDIATE_MNEMS:
+            return 'load'
+        elif mnem.startswith('mul'):
+            return 'mul'
+        elif mnem.startswith('div'):
+            return 'div'
+
+        return None
+
+    def getCycles(self, op):
+        '''
+        Return the number of cycles the decoded instruction should take.  The
+        result should be cached with the decoded instruction so this only needs
+        to be done once per instruction.
+        '''
+        if self._uniform:
+            return self.default
+
+        return self._cycles.get(self.classify(op), self.default)
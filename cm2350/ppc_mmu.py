@@ -318,6 +318,12 @@ class PpcTLBEntry:
 
 
 class PpcMMU(Module):
+    _snap_objs = ('_tlb',)
+
+    # The SPR callback wrappers don't hold any state, the SPR values are saved
+    # with the emulator registers
+    _snap_ignore = ('mmucsr0', 'l1csr0', 'l1csr1')
+
     def __init__(self, emu):
         Module.__init__(self, emu, 'MMU')
 
@@ -1,17 +1,24 @@
+import io
+import copy
+import enum
+import mmap
+import types
+import functools
 import weakref
 import threading
+import collections
 import socket
+import select
 import errno
 import struct
 import pickle
-import select
-import atexit
+import time
 import inspect
 
 import envi.bits as e_bits
 from envi.common import MIRE
 
-from . import mmio
+from . import mmio, ioproto, ioqueue, emutimers
 from .ppc_vstructs import *
 from .intc_src import INTC_EVENT_MAP
 from .intc_exc import AlignmentException, MceWriteBusError, \
@@ -28,7 +35,9 @@ __all__ = [
     'BusPeripheral',
     'BusDevice',
     'PlaceholderBusDevice',
+    'LazyPeripheral',
     'TimerRegister',
+    'RingFIFO',
 ]
 
 
@@ -47,6 +56,153 @@ PPC_MAX_READ_SIZE = 8
 # with this value
 PPC_INVALID_READ_VAL = b'\x00'
 
+# Attribute value types that are automatically saved in module snapshots
+SNAP_DATA_TYPES = (type(None), bool, int, float, complex, str, bytes, bytearray, enum.Enum)
+SNAP_CONTAINER_TYPES = (list, tuple, set, frozenset, collections.deque)
+
+# Attribute value types that are never part of the emulated state: functions
+# and methods, references to the emulator or other objects, threading
+# primitives, files and sockets, and timers (which are saved with the system
+# time by the emulator).  Other modules are saved separately by the emulator.
+SNAP_IGNORE_TYPES = (types.FunctionType, types.MethodType, types.BuiltinFunctionType,
+                     functools.partial, type, weakref.ReferenceType, weakref.ProxyType,
+                     weakref.CallableProxyType, type(threading.Lock()),
+                     type(threading.RLock()), threading.Thread, io.IOBase,
+                     socket.socket, emutimers.EmuTimer)
+
+
+def _isSnapData(value):
+    '''
+    Returns True if the value is simple data (or a container of simple data)
+    that can be safely copied into a snapshot.
+    '''
+    if isinstance(value, SNAP_DATA_TYPES):
+        return True
+    elif isinstance(value, SNAP_CONTAINER_TYPES):
+        return all(_isSnapData(v) for v in value)
+    elif isinstance(value, dict):
+        return all(_isSnapData(k) and _isSnapData(v) for k, v in value.items())
+    return False
+
+
+def _isSnapIgnored(value):
+    # Check the ignored types first, weakref proxies report the class of the
+    # object they refer to
+    return isinstance(value, SNAP_IGNORE_TYPES) or \
+            isinstance(value, (Module, LazyPeripheral))
+
+
+def _copySnapRef(value):
+    # Containers and objects that can copy themselves are shallow copied,
+    # other objects are saved by reference
+    if isinstance(value, SNAP_CONTAINER_TYPES + (dict,)) or hasattr(value, '__copy__'):
+        return copy.copy(value)
+    return value
+
+
+def _getSnapAttrs(obj):
+    # The (refs, objs, ignore) attribute names defined by the class of an
+    # object for getObjectSnap()
+    return (getattr(obj, '_snap_refs', ()), getattr(obj, '_snap_objs', ()),
+            getattr(obj, '_snap_ignore', ()))
+
+
+def getObjectSnap(obj, refs=(), objs=(), ignore=()):
+    '''
+    Returns a snapshot of the attributes of an object:
+    - VStruct attributes (such as peripheral registers) are saved with
+      vsGetSnap()
+    - attributes that are simple data values are copied
+    - attributes named in "refs" are objects (or containers of objects) that
+      are not modified once created, containers are shallow copied and the
+      objects are saved by reference
+    - attributes named in "objs" are objects (or tuples/lists of objects) owned
+      by this object and are saved recursively using the _snap_refs,
+      _snap_objs and _snap_ignore attributes of their class
+    - attributes named in "ignore", and values of the SNAP_IGNORE_TYPES or
+      other modules, are not part of the emulated state and are not saved
+
+    Any other attribute raises a TypeError so state can't be silently left out
+    of a snapshot, it must be added to one of the lists above or handled by the
+    object's getSnap() function.
+    '''
+    snap = {}
+    for name, value in vars(obj).items():
+        if name == 'emu' or name in ignore:
+            continue
+        elif name in refs:
+            snap[name] = _copySnapRef(value)
+        elif name in objs:
+            if isinstance(value, (list, tuple)):
+                snap[name] = tuple(getObjectSnap(o, *_getSnapAttrs(o)) for o in value)
+            else:
+                snap[name] = getObjectSnap(value, *_getSnapAttrs(value))
+        elif _isSnapIgnored(value):
+            continue
+        elif isVstructType(value):
+            snap[name] = vsGetSnap(value)
+        elif isinstance(value, dict) and value and \
+                all(isVstructType(v) for v in value.values()):
+            snap[name] = dict((k, vsGetSnap(v)) for k, v in value.items())
+        elif _isSnapData(value):
+            snap[name] = copy.deepcopy(value)
+        elif isinstance(value, mmap.mmap):
+            # Memory mapped files (such as the flash backup) are saved as bytes
+            snap[name] = value[:]
+        else:
+            raise TypeError('Cannot save %s.%s (%s) in a snapshot' %
+                            (obj.__class__.__name__, name, value.__class__.__name__))
+    return snap
+
+
+def setObjectSnap(obj, snap, refs=(), objs=()):
+    '''
+    Restores the attributes of an object saved with getObjectSnap().  Mutable
+    attributes are updated in place so any other references to them (such as
+    memory maps using a bytearray) see the restored values.
+    '''
+    for name, value in snap.items():
+        cur = getattr(obj, name, None)
+        if name in refs:
+            setattr(obj, name, _copySnapRef(value))
+        elif name in objs:
+            if isinstance(cur, (list, tuple)):
+                for o, osnap in zip(cur, value):
+                    setObjectSnap(o, osnap, *_getSnapAttrs(o)[:2])
+            else:
+                setObjectSnap(cur, value, *_getSnapAttrs(cur)[:2])
+        elif isVstructType(cur):
+            vsSetSnap(cur, value)
+        elif isinstance(cur, dict) and isinstance(value, dict) and cur and \
+                all(isVstructType(v) for v in cur.values()):
+            for k, vsnap in value.items():
+                vsSetSnap(cur[k], vsnap)
+        elif isinstance(cur, (bytearray, mmap.mmap)) and len(cur) == len(value):
+            cur[:] = value
+        elif isinstance(cur, list):
+            cur[:] = copy.deepcopy(value)
+        else:
+            setattr(obj, name, copy.deepcopy(value))
+
+
+def getPeripheralConfig(emu, devname):
+    '''
+    Return the project configuration entry for a peripheral, or None if there
+    is no configuration for the peripheral.
+    '''
+    config = None
+    for project in emu.config.project.getSubConfigNames():
+        project_subcfg = emu.config.project.getSubConfig(project)
+        if config is None:
+            devcfg = project_subcfg.getSubConfig(devname, add=False)
+            if devcfg is not None:
+                config = devcfg
+                break
+        else:
+            raise Exception('ERROR: duplicate project config entries for peripheral %s:\n%s' %
+                    (devname, emu.config.project.reprConfigPaths()))
+    return config
+
 
 class Module:
     """
@@ -65,20 +221,13 @@ class Module:
         # this module to interface with it
         self.emu = None
 
-        self._config = None
-
         # If there is a configuration entry for this peripheral name, save it
         # for easy access
-        for project in emu.config.project.getSubConfigNames():
-            project_subcfg = emu.config.project.getSubConfig(project)
-            if self._config is None:
-                devcfg = project_subcfg.getSubConfig(devname, add=False)
-                if devcfg is not None:
-                    self._config = weakref.proxy(devcfg)
-                    break
-            else:
-                raise Exception('ERROR: duplicate project config entries for peripheral %s:\n%s' %
-                        (devname, emu.config.project.reprConfigPaths()))
+        devcfg = getPeripheralConfig(emu, devname)
+        if devcfg is not None:
+            self._config = weakref.proxy(devcfg)
+        else:
+            self._config = None
 
     def __del__(self):
         self.shutdown()
@@ -124,12 +273,39 @@ class Module:
         """
         pass
 
+    # Attributes of this module that should be saved by reference, saved
+    # recursively, or are not part of the emulated state and should not be
+    # saved when a snapshot is created, see getObjectSnap()
+    _snap_refs = ()
+    _snap_objs = ()
+    _snap_ignore = ()
+
+    def getSnap(self):
+        """
+        Returns a snapshot of the current state of this module, used to create
+        emulator checkpoints.  By default the registers and simple data
+        attributes are saved, modules that have other internal state must
+        list those attributes in _snap_refs or _snap_objs (or _snap_ignore if
+        they are not part of the emulated state), or extend this function.
+        A TypeError is raised for any attribute that isn't covered.
+        """
+        return getObjectSnap(self, self._snap_refs, self._snap_objs, self._snap_ignore)
+
+    def setSnap(self, snap):
+        """
+        Restore the state of this module from a snapshot created by getSnap().
+        """
+        setObjectSnap(self, snap, self._snap_refs, self._snap_objs)
+
 
 class MMIOPeripheral(Module, mmio.MMIO_DEVICE):
     """
     A peripheral class that implements read/write functions to connect this
     object as an MMIO device to an emulator.
     """
+    # The DMA request register fields are part of the peripheral registers
+    _snap_ignore = ('dmaevents',)
+
     def __init__(self, emu, devname, mapaddr, mapsize, regsetcls=None,
             isrstatus=None, isrflags=None, isrevents=None, **kwargs):
         """
@@ -156,13 +332,7 @@ class MMIOPeripheral(Module, mmio.MMIO_DEVICE):
         # is used the read/write functions in this base class can be used
         # unmodified.
         if regsetcls is not None:
-            # Try to initialize it using the bigend param, if that fails use the 
-            # vsSetEndian() function.
-            try:
-                self.registers = regsetcls(bigend=emu.getEndian())
-            except TypeError:
-                self.registers = regsetcls()
-                self.registers.vsSetEndian(emu.getEndian())
+            self.registers = newRegisterSet(regsetcls, emu.getEndian())
         else:
             self.registers = None
 
@@ -683,8 +853,8 @@ class MMIOPeripheral(Module, mmio.MMIO_DEVICE):
                                    self.devname, channel)
 
 
-# Utilities used by the ExternalIOPeripheral class, these are separate to make
-# it easier to re-use them in the test ExternalIOClient test class below.
+# Utilities used by the ExternalIOClient class below to send and receive
+# length-prefixed messages.
 
 def _recvData(sock):
     """
@@ -724,58 +894,47 @@ def _sendData(sock, data):
     else:
         sock.sendall(size + data)
 
-def _recvObj(sock):
+def _recvObjs(sock, protocol='binary'):
     """
-    Utility to recreate an object from received data. The default method
-    used here is to unpickle the data.
+    Utility to recreate the objects from received data. By default the data
+    is decoded with the binary wire protocol (see the ioproto module), if the
+    legacy "pickle" protocol is used the data is unpickled.
     """
-    # TODO: Don't use pickle for packing/unpacking message data
     data = _recvData(sock)
-    obj = pickle.loads(data)
-    return obj
+    if protocol == 'pickle':
+        return [pickle.loads(data)]
+    return ioproto.decode(data)
 
-def _sendObj(sock, obj):
+def _sendObjs(sock, objs, protocol='binary'):
     """
-    Utility to serialize an object into the data form necessary for
-    transmitting over the network. The default method used here is
-    to pickle the object.
+    Utility to serialize objects into the data form necessary for transmitting
+    over the network. With the binary wire protocol all objects are batched
+    into one message, with the legacy "pickle" protocol each object is pickled
+    and sent as a separate message.
     """
-    # TODO: Don't use pickle for packing/unpacking message data
-    data = pickle.dumps(obj)
-    _sendData(sock, data)
+    if protocol == 'pickle':
+        for obj in objs:
+            _sendData(sock, pickle.dumps(obj))
+    else:
+        _sendData(sock, ioproto.encode(objs))
 
 
 class ExternalIOPeripheral(MMIOPeripheral):
     """
     A peripheral class that supports external IO connections.
-    """
-    # Sometimes python gets stupid about not calling thread destructors when
-    # ipython exits, so just to be keep track of any ExternalIOPeripheral
-    # objects allocated and ensure they are cleaned up
-    _tasks = None
-    _task_lock = threading.RLock()
 
-    @classmethod
-    def _kill_tasks(cls):
-        """
-        Used to try and ensure all threads shut down cleanly, the goal is to
-        ensure that all client connections can be cleanly shutdown and are not
-        left hanging.
-        """
-        # Classes could be being deallocated now, so play nice with the lock
-        with cls._task_lock:
-            while cls._tasks:
-                task = cls._tasks.pop()
-                del task
-
-    # TODO: Eventually I'd like to either have one single socket for _all_
-    # client data to come through and be directed to the correct thread
-    # OR
-    # Figure out how to mix peripheral configs with the primary VivProject
-    # object so the peripheral port/type/style/whatever is defined in the
-    # config, and the correct configuration values and defaults could be defined
-    # in the peripheral class itself.
+    All client connections are serviced by the emulator's IO hub (see the
+    iohub module) instead of a thread per peripheral.  If the IO frontend is
+    enabled (see the iofrontend module) the client connections are serviced by
+    a separate process instead.
+    """
+    # TODO: Figure out how to mix peripheral configs with the primary
+    # VivProject object so the peripheral port/type/style/whatever is defined
+    # in the config, and the correct configuration values and defaults could be
+    # defined in the peripheral class itself.
     #
+    _snap_ignore = MMIOPeripheral._snap_ignore + ('_hub',)
+
     def __init__(self, emu, devname, mapaddr, mapsize, regsetcls=None,
                  isrstatus=None, isrflags=None, isrevents=None, **kwargs):
         """
@@ -796,182 +955,140 @@ class ExternalIOPeripheral(MMIOPeripheral):
                                 isrstatus=isrstatus, isrflags=isrflags,
                                 isrevents=isrevents, **kwargs)
 
+        # In test mode there are no clients, transmitted data is saved so it
+        # can be retrieved with getTransmittedObjs()
+        self._test_mode = emu.vw.getTransMeta('ProjectMode') == 'test'
+
         # Get the server configuration from the peripheral config (if a config
         # was found)
-        if self._config is not None:
-            # Check if the IO thread should be created or not
-            if emu.vw.getTransMeta('ProjectMode') == 'test':
-                self._server_args = None
-                logger.log(MIRE, 'Test mode enabled, not creating IO thread for IO module %s',
-                           self.devname)
-            elif self._config['port'] is None:
-                self._server_args = None
-                logger.log(MIRE, 'No port configured, not creating IO thread for IO module %s',
-                           self.devname)
-            else:
-                # If the host IP address is empty default to localhost
-                if self._config['host'] is None:
-                    self._server_args = ('localhost', self._config['port'])
-                else:
-                    self._server_args = (self._config['host'], self._config['port'])
+        self._server_addr = self.getServerAddr(emu, devname, self._config)
 
-                logger.debug('Using %s:%s for IO module %s',
-                        self._server_args[0], self._server_args[1], self.devname)
+        # The protocol used to exchange messages with clients
+        if self._config is not None:
+            self._protocol = self._config.get('protocol', 'binary')
         else:
-            logger.warning('Could not locate configuration for IO module %s', self.devname)
-            self._server_args = None
+            self._protocol = 'binary'
 
-        self._server = None
-        self._clients = []
+        if self._protocol not in ioproto.IO_PROTOCOLS:
+            raise ValueError('Invalid IO protocol for %s: %s (valid protocols are %s)' %
+                             (self.devname, self._protocol, ', '.join(ioproto.IO_PROTOCOLS)))
 
-        # Used for communication between the main and IO threads
-        self._io_thread_sock = None
-        self._io_thread_tx_sock = None
-        self._io_thread_rx_sock = None
+        # The size of the queue of received messages waiting to be processed
+        # and the policy used when the queue is full
+        if self._config is not None:
+            self._queue_size = self._config.get('queue_size', ioqueue.DEFAULT_QUEUE_SIZE)
+            self._queue_policy = self._config.get('queue_policy', ioqueue.DEFAULT_QUEUE_POLICY)
+        else:
+            self._queue_size = ioqueue.DEFAULT_QUEUE_SIZE
+            self._queue_policy = ioqueue.DEFAULT_QUEUE_POLICY
 
-        # Don't create the IO thread yet
-        self._io_thread = None
+        if self._queue_policy not in ioqueue.IO_QUEUE_POLICIES:
+            raise ValueError('Invalid IO queue policy for %s: %s (valid policies are %s)' %
+                             (self.devname, self._queue_policy, ', '.join(ioqueue.IO_QUEUE_POLICIES)))
 
-        # Keep track of allocated ExternalIOPeripheral objects
-        with ExternalIOPeripheral._task_lock:
-            if ExternalIOPeripheral._tasks is None:
-                ExternalIOPeripheral._tasks = []
-                atexit.register(ExternalIOPeripheral._kill_tasks)
+        # The IO hub and the ID assigned to this peripheral by the hub
+        self._hub = None
+        self.io_id = 0
 
-            ExternalIOPeripheral._tasks.append(self)
+        # Transmitted data saved in test mode
+        self._tx_saved = collections.deque()
 
-    def __del__(self):
-        self.shutdown()
-
-        # Close the client connections
-        for sock in self._clients:
-            try:
-                sock.shutdown(socket.SHUT_RDWR)
-                sock.close()
-            except OSError:
-                pass
+    @staticmethod
+    def getServerAddr(emu, devname, config):
+        """
+        Return the address the IO server for a peripheral should listen on
+        based on the peripheral configuration, or None if no server should be
+        created.
+        """
+        if config is not None:
+            # Check if the server should be created or not
+            if emu.vw.getTransMeta('ProjectMode') == 'test':
+                server_addr = None
+                logger.log(MIRE, 'Test mode enabled, not creating server for IO module %s',
+                           devname)
+            elif emu.ioReplayEnabled():
+                server_addr = None
+                logger.log(MIRE, 'IO replay enabled, not creating server for IO module %s',
+                           devname)
+            elif config.get('path') is not None:
+                # Unix domain socket
+                server_addr = config['path']
+                logger.debug('Using %s for IO module %s', server_addr, devname)
+            elif config['port'] is None:
+                server_addr = None
+                logger.log(MIRE, 'No port configured, not creating server for IO module %s',
+                           devname)
+            else:
+                # If the host IP address is empty default to localhost
+                if config['host'] is None:
+                    server_addr = ('localhost', config['port'])
+                else:
+                    server_addr = (config['host'], config['port'])
 
-        # Now close the server socket
-        if self._server is not None:
-            try:
-                self._server.shutdown(socket.SHUT_RDWR)
-                self._server.close()
-            except OSError:
-                pass
+                logger.debug('Using %s:%s for IO module %s',
+                        server_addr[0], server_addr[1], devname)
+        else:
+            logger.warning('Could not locate configuration for IO module %s', devname)
+            server_addr = None
 
-        # Remove this object from the list of tasks that need cleaned up
-        with ExternalIOPeripheral._task_lock:
-            try:
-                ExternalIOPeripheral._tasks.remove(self)
-            except ValueError:
-                # Probably means not fully initialized, ignore the error
-                pass
+        return server_addr
 
     def shutdown(self):
         """
-        Stop the IO thread from running, but don't close the client sockets
+        The client connections are closed when the emulator shuts down the
+        IO hub.
         """
-        if self._io_thread is not None:
-            # Close the sockets used for communication between the main thread
-            # and the IO thread, that should signal the IO thread to exit
-            if self._io_thread_tx_sock is not None:
-                self._io_thread_tx_sock.shutdown(socket.SHUT_RDWR)
-                self._io_thread_tx_sock.close()
+        self._hub = None
 
-            self._io_thread.join(1)
+    def init(self, emu):
+        """
+        Handle all one-time initialization that needs to be done
+        """
+        self._hub = emu.getIOHub()
+        self.io_id = self._hub.register(self)
+        emu.external_io.configure(self.devname, self._queue_size, self._queue_policy)
 
-            # Now close the thread end of the socket
-            self._io_thread_rx_sock.shutdown(socket.SHUT_RDWR)
-            self._io_thread_rx_sock.close()
+        # If analysis-only mode is enabled don't create sockets and attempt to
+        # do network things. The server socket persists across emulator
+        # resets.
+        if self._server_addr is not None:
+            self._hub.addServer(self, self._server_addr)
 
-            # If the thread has not exited, something has gone wrong
-            if self._io_thread.is_alive():
-                logger.error('Failed to stop %s IO thread', self.devname)
-            else:
-                self._io_thread = None
+        super().init(emu)
 
-        # These should all be closed, but just to avoid weird errors during
-        # shutdown ensure they are closed now
-        if self._io_thread_sock is not None:
-            try:
-                self._io_thread_sock.close()
-            except OSError:
-                pass
-            self._io_thread_sock = None
+    def connect(self):
+        """
+        Create an in-process client connection to this peripheral, returns the
+        client end of a socketpair.
+        """
+        return self._hub.connectPair(self)
 
-        if self._io_thread_tx_sock is not None:
-            try:
-                self._io_thread_tx_sock.close()
-            except OSError:
-                pass
-            self._io_thread_tx_sock = None
+    def encodeObj(self, obj):
+        """
+        Encode an object with the protocol configured for this peripheral
+        """
+        if self._protocol == 'pickle':
+            return pickle.dumps(obj)
+        return ioproto.encode((obj,), self.io_id)
 
-        if self._io_thread_rx_sock is not None:
+    def decodeRecords(self, data):
+        """
+        Used by the IO hub to decode data received from a client into a list
+        of (peripheral ID, objects) tuples.
+        """
+        if self._protocol == 'pickle':
             try:
-                self._io_thread_rx_sock.close()
-            except OSError:
-                pass
-            self._io_thread_rx_sock = None
+                return [(0, [pickle.loads(data)])]
+            except Exception as exc:
+                raise ioproto.IOProtocolError('Invalid pickle data: %s' % exc)
+        return ioproto.decodeRecords(data)
 
-    def init(self, emu):
+    def batchTransmitData(self):
         """
-        Handle all one-time initialization that needs to be done
+        Indicates if the IO hub can combine multiple transmitted messages into
+        one, this is only possible with the binary protocol.
         """
-        # create the socket pair that will be used for the peripheral
-        # functions run in the main thread to send output data to the IO
-        # thread It'd be a lot more convenient to just use a queue for this
-        # but if we did that we couldn't use select() in the IO thread to
-        # listen for all incoming messages
-        self._io_thread_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._io_thread_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        self._io_thread_sock.bind(('', 0))
-        self._io_thread_sock.listen(1)
-        io_addr = self._io_thread_sock.getsockname()
-
-        # Create the socket to transmit data to the IO thread
-        self._io_thread_tx_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._io_thread_tx_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        self._io_thread_tx_sock.connect(io_addr)
-
-        # Now get the socket to receive data on the IO thread
-        self._io_thread_rx_sock, _ = self._io_thread_sock.accept()
-        self._io_thread_rx_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-
-        # If analysis-only mode is enabled don't create sockets and attempt to
-        # do network things
-        if self._server_args is not None:
-            # Create the server socket to listen for client connections, this
-            # should persist across emulator resets
-            # TODO: support IPv6 (AF_INET6)?
-            self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self._server.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            self._server.bind(self._server_args)
-            self._server.listen(0)
-
-            # Create the server thread for this peripheral if the server args
-            # are defined.
-            args = {
-                'name': '%s-IO' % self.devname,
-                'target': self._io_handler,
-
-                # For some bizzare reason ipython just absolutely will hang up
-                # when exiting unless these are marked as daemon threads. There
-                # is some sort of check happening in check in
-                # /usr/lib/python3.9/threading.py that is run before the atexit
-                # handler and is halting cleanup. This is some sort of weird
-                # behavior with ipython + SimpleQueue + Threads. However we have
-                # no need to add "task tracking" to this design so we don't want
-                # to add in the extra complexity of using full Queues.
-                #
-                # So to work around this we just set the daemon flag, even
-                # though I don't like it.
-                'daemon': True,
-            }
-            self._io_thread = threading.Thread(**args)
-            self._io_thread.start()
-
-        super().init(emu)
+        return self._protocol == 'binary'
 
     def transmit(self, obj):
         """
@@ -980,34 +1097,57 @@ class ExternalIOPeripheral(MMIOPeripheral):
         modifications necessary when transmit happens.
         """
         logger.info('%s: TRANSMIT %r', self.devname, obj)
-        _sendObj(self._io_thread_tx_sock, obj)
+
+        if self._hub is not None and self._hub.isRunning():
+            self._hub.send(self, self.encodeObj(obj))
+        elif self._test_mode:
+            self._tx_saved.append(self.encodeObj(obj))
+
+        # Otherwise there are no clients that can receive the message (such as
+        # when replaying recorded IO) so it is dropped.
+
+    def setFlowControl(self, paused):
+        """
+        Called when the queue of received messages for this peripheral becomes
+        full (paused is True) or has space again (paused is False) to signal
+        clients to stop or resume sending.
+        """
+        logger.debug('%s: flow control %s', self.devname, 'paused' if paused else 'resumed')
+        if self._hub is not None and self._hub.isRunning():
+            self._hub.send(self, self.encodeObj(ioproto.FlowControl(paused)))
 
     def getTransmittedObjs(self):
         """
         Utility that is useful during testing to manually read transmitted
-        objects/messages from the inter-thread socket. This is needed during
-        testing when the separate IO thread is not running.
+        objects/messages. This is needed during testing when there are no
+        client connections.
         """
-        # To get around the weird and various python/OS/socket issues to get
-        # reliable non-blocking sockets, just use select() with a timeout of 0
-        # to check for available data
         objs = []
-        while True:
-            pending_inputs, _, _ = select.select([self._io_thread_rx_sock], [], [], 0.0)
-            if self._io_thread_rx_sock in pending_inputs:
-                objs.append(_recvObj(self._io_thread_rx_sock))
-            else:
-                break
+        while self._tx_saved:
+            data = self._tx_saved.popleft()
+            for _, record_objs in self.decodeRecords(data):
+                objs.extend(record_objs)
         return objs
 
-    def receive(self, obj):
+    def receive(self, obj, block=True):
         """
-        Used by the io_thread to queue a received message for later processing.
+        Used by the IO hub to queue a received message for later processing.
         Can also be used by a peripheral to force receive values (such as if
         the peripheral should receive messages it transmits).
+
+        The IO hub uses block=False so it never waits for a full queue, it
+        uses notifyWhenReady() to stop reading from the client instead.
         """
         logger.info('%s: RECEIVE %r', self.devname, obj)
-        self.emu.putIO(self.devname, obj)
+        self.emu.putIO(self.devname, obj, block=block)
+
+    def notifyWhenReady(self, callback):
+        """
+        Returns True if the queue of received messages has space, otherwise
+        callback is called once the emulator has processed enough messages
+        that there is space.
+        """
+        return self.emu.external_io.notifyWhenReady(self.devname, callback)
 
     def processReceivedData(self, obj):
         """
@@ -1022,75 +1162,6 @@ class ExternalIOPeripheral(MMIOPeripheral):
         #       raise PeripheralSpecificInterrupt()
         raise NotImplementedError('%s class should implement this method' % self.__class__.__name__)
 
-    def _io_handler(self):
-        """
-        Standard IO thread that runs select() on the current list of sockets
-        and handles inputs:
-
-        * If input is pending on the server socket, then a new client
-          connection is accepted the list of client sockets is updated.
-        * If input is pending on the socket created to receive outgoing data
-          from the peripheral (sent with the transmit() function), then that
-          data is received and broadcast to to all clients.
-        * If a client connection has disconnected (OSError is received when
-          attempting to read from the socket) disconnects then that socket is
-          removed from the client socket list.
-        * If data is received from the client connection it is placed in the
-          emulator's main IO queue using the receive() function.
-        """
-        # Create the default list of sockets to watch for messages
-        inputs = [self._io_thread_rx_sock, self._server] + self._clients
-        outputs = []
-        excs = []
-
-        while True:
-            # select should work on windows as long as we are waiting on
-            # sockets
-            pending_inputs, _, _ = select.select(inputs, outputs, excs)
-
-            for sock in pending_inputs:
-                if sock == self._io_thread_rx_sock:
-                    try:
-                        data = _recvData(self._io_thread_rx_sock)
-                        # Send to all available client sockets
-                        _sendData(self._clients, data)
-                    except OSError as exc:
-                        # If an OSError happens while receiving from the
-                        # internal main-to-IO thread socket it means this thread
-                        # should exit
-                        if len(exc.args) >= 1 and exc.args[0] == errno.EAGAIN:
-                            # If this indicates a connection lost (EAGAIN), 
-                            # don't print the exception information.
-                            logger.log(MIRE, 'Lost connection to main thread, exiting')
-                        else:
-                            logger.log(MIRE, 'Lost connection to main thread, exiting', exc_info=1)
-                        return
-
-                elif sock == self._server:
-                    # Currently not using the address returned by accept
-                    client_sock, _ = self._server.accept()
-                    client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-                    self._clients.append(client_sock)
-                    inputs.append(client_sock)
-
-                else:
-                    try:
-                        # receive data from client and send to the main thread
-                        obj = _recvObj(sock)
-                        self.receive(obj)
-                    except OSError as exc:
-                        # If an OSError occurs while receiving from a client
-                        # thread, the client has disconnected, remove the socket
-                        # from the list of inputs to receive data from
-                        if len(exc.args) >= 1 and exc.args[0] == errno.EAGAIN:
-                            # If this indicates a connection lost (EAGAIN), 
-                            # don't print the exception information.
-                            logger.log(MIRE, 'client sock %r disconnected', sock)
-                        else:
-                            logger.log(MIRE, 'client sock %r disconnected', sock, exc_info=1)
-                        self._clients.remove(sock)
-                        inputs.remove(sock)
-
 
 class BusPeripheral(ExternalIOPeripheral):
     """
@@ -1104,6 +1175,9 @@ class BusPeripheral(ExternalIOPeripheral):
       unique device address
     - PCI devices would register against a PCI bus with a unique memory address
     """
+    # Bus devices are external to the emulator and are not saved in snapshots
+    _snap_ignore = ExternalIOPeripheral._snap_ignore + ('devices',)
+
     def __init__(self, emu, devname, mapaddr, mapsize, regsetcls=None,
                  isrstatus=None, isrflags=None, isrevents=None, **kwargs):
         ExternalIOPeripheral.__init__(self, emu=emu, devname=devname,
@@ -1112,8 +1186,8 @@ class BusPeripheral(ExternalIOPeripheral):
                                       isrflags=isrflags, isrevents=isrevents,
                                       **kwargs)
 
-        # Ensure the server arguments are clear so the io thread is not started
-        self._server_args = None
+        # Ensure the server address is clear so no server is started
+        self._server_addr = None
 
         # Add a dictionary to lookup SPI bus peripheral devices
         self.devices = {}
@@ -1154,6 +1228,32 @@ class BusPeripheral(ExternalIOPeripheral):
             # indicated
             logger.warning('%s TRANSMIT %s: %s (NO DEVICE)', self.devname, key, value)
 
+    def transmitBurst(self, key, values):
+        """
+        Transmit a sequence of values to a client device with one call to the
+        device's receiveBurst() function. Any values returned by the device
+        are sent back to the bus peripheral as one message with the device's
+        transmitBurst() function.
+        """
+        device = self.devices.get(key)
+        if device is not None:
+            logger.log(MIRE, '%s -> %s: %s', self.devname, device.name, values)
+            results = device.receiveBurst(values)
+            if results:
+                logger.log(MIRE, '%s <- %s: %s', self.devname, device.name, results)
+                device.transmitBurst(results)
+        else:
+            logger.warning('%s TRANSMIT %s: %d values (NO DEVICE)', self.devname, key, len(values))
+
+    def receiveBurst(self, values):
+        """
+        Queue a sequence of values received from a client device. The values
+        are queued as a single list object so the whole burst is recorded and
+        delivered to processReceivedData() as one IO message, bus peripherals
+        that use transmitBurst() must accept lists in processReceivedData().
+        """
+        self.receive(list(values))
+
 
 class BusDevice:
     """
@@ -1184,6 +1284,26 @@ class BusDevice:
         """
         self.bus.receive(value)
 
+    def receiveBurst(self, values):
+        """
+        Handle a sequence of values sent from the bus peripheral in one call,
+        returns a list of the response values. The default implementation
+        calls receive() for each value, devices that can process a whole burst
+        more efficiently should override this function.
+        """
+        results = []
+        for value in values:
+            result = self.receive(value)
+            if result is not None:
+                results.append(result)
+        return results
+
+    def transmitBurst(self, values):
+        """
+        Send a sequence of values back to the bus peripheral as one message.
+        """
+        self.bus.receiveBurst(values)
+
 
 class PlaceholderBusDevice(BusDevice):
     """
@@ -1199,6 +1319,120 @@ class PlaceholderBusDevice(BusDevice):
         """
         return self.value
 
+    def receiveBurst(self, values):
+        """
+        Return the initialized value for each value received
+        """
+        return [self.value] * len(values)
+
+
+class LazyPeripheral:
+    """
+    Placeholder for an MMIO peripheral that is not constructed until it is
+    first used. The placeholder registers the peripheral's module name and
+    MMIO region, the first time the MMIO region is accessed or any other
+    attribute of the peripheral is used the placeholder constructs the
+    peripheral in place (so all references to the placeholder become
+    references to the peripheral) and initializes it if the emulator has
+    already been initialized.
+
+    Until it is constructed the peripheral is in its reset state, so emulator
+    resets do nothing and snapshots of the placeholder are None.  External IO
+    peripherals that have an IO server configured are constructed when the
+    emulator is initialized so the server is available to clients, the others
+    are registered with the IO hub when the emulator is initialized so their
+    IO IDs don't depend on the order the peripherals are used in.
+
+    The peripheral class constructor must take the device name, emulator, and
+    MMIO address as its arguments.
+    """
+    _lazy_lock = threading.RLock()
+
+    def __init__(self, cls, mapsize, devname, emu, mapaddr):
+        self._lazy_cls = cls
+        self._lazy_args = (devname, mapaddr)
+        self._lazy_emu = weakref.ref(emu)
+        self._lazy_initialized = False
+        self.devname = devname
+
+        emu.installModule(devname, self)
+        emu.addMMIO(mapaddr, mapsize, devname, self._lazy_mmio_read, self._lazy_mmio_write)
+
+    def __repr__(self):
+        return '<%s %s (%s)>' % (self.__class__.__name__, self.devname, self._lazy_cls.__name__)
+
+    def __getattr__(self, name):
+        # Only called for attributes the placeholder doesn't have. Don't
+        # construct the peripheral for special attributes that may be checked
+        # by copy or pickle.
+        if name.startswith('__') or name.startswith('_lazy_'):
+            raise AttributeError(name)
+        self._lazyConstruct()
+        return getattr(self, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_lazy_') or name == 'devname':
+            object.__setattr__(self, name, value)
+        else:
+            self._lazyConstruct()
+            setattr(self, name, value)
+
+    def _lazyConstruct(self):
+        with self._lazy_lock:
+            # Another thread may have constructed the peripheral already
+            if not isinstance(self, LazyPeripheral):
+                return
+
+            cls = self._lazy_cls
+            devname, mapaddr = self._lazy_args
+            emu = self._lazy_emu()
+            initialized = self._lazy_initialized
+            logger.debug('Constructing %s', devname)
+
+            # The peripheral adds its own MMIO region
+            emu.delMMIO(mapaddr)
+
+            self.__dict__.clear()
+            object.__setattr__(self, '__class__', cls)
+            cls.__init__(self, devname, emu, mapaddr)
+
+            if initialized:
+                self.init(emu)
+
+    def _lazy_mmio_read(self, va, offset, size):
+        self._lazyConstruct()
+        return self._mmio_read(va, offset, size)
+
+    def _lazy_mmio_write(self, va, offset, data):
+        self._lazyConstruct()
+        return self._mmio_write(va, offset, data)
+
+    def init(self, emu):
+        self._lazy_initialized = True
+
+        if issubclass(self._lazy_cls, ExternalIOPeripheral):
+            config = getPeripheralConfig(emu, self.devname)
+            if config is not None and \
+                    self._lazy_cls.getServerAddr(emu, self.devname, config) is not None:
+                self._lazyConstruct()
+            else:
+                # Register the placeholder now so the IO IDs are assigned in
+                # module order. The placeholder becomes the peripheral when it
+                # is constructed, so it keeps the same ID.
+                emu.getIOHub().register(self)
+
+    def reset(self, emu):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def getSnap(self):
+        return None
+
+    def setSnap(self, snap):
+        pass
+
 
 class TimerRegister:
     """
@@ -1285,21 +1519,230 @@ class TimerRegister:
         self._timer_offset = self.emu.systime() - offset
 
 
+class RingFIFO:
+    """
+    Fixed-capacity FIFO used to emulate the hardware FIFOs of peripherals.
+    Entries are stored in a circular buffer so pushing and popping entries
+    does not move any of the other entries.
+
+    Indexing a RingFIFO accesses the queued entries in the order they were
+    pushed, index 0 is the oldest entry (the next to be popped) and index -1
+    is the newest entry.
+
+    Many peripherals can limit the usable depth of a FIFO based on their
+    configuration, so the push() and isFull() functions accept an optional
+    limit that is used instead of the FIFO capacity.
+
+    Peripherals also make the FIFO entries visible through registers with
+    getEntry() and readBytes().  Like the hardware FIFOs, entries that have
+    been popped or cleared are not erased so the registers that are not in
+    use still show stale data, entries that have never been written read as
+    the fill value.  There are two register layouts:
+    - oldest first (such as the DSPI RXFRx registers): the oldest entry is in
+      register 0, new entries are placed after the last queued entry and
+      popping shifts the remaining entries down by one register.
+    - newest first (such as the DSPI TXFRx registers): every pushed entry
+      shifts the existing entries up by one register and is placed in
+      register 0, the oldest queued entry is in register len(fifo) - 1 which
+      is the "next pointer" value the peripheral reports.
+    """
+    def __init__(self, capacity, fill=None, newest_first=False):
+        """
+        Constructor for the RingFIFO class, the capacity is the maximum number
+        of entries the FIFO can hold and newest_first selects the register
+        layout used by getEntry() and readBytes().
+        """
+        self.capacity = capacity
+        self.newest_first = newest_first
+        self._fill = fill
+        self._buf = [fill] * capacity
+        self._head = 0
+        self._count = 0
+
+        # The largest number of entries that have been queued at once
+        self.high_water = 0
+
+    def __copy__(self):
+        new = self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        new._buf = list(self._buf)
+        return new
+
+    def __repr__(self):
+        return '%s(%d/%d: %r)' % (self.__class__.__name__, self._count, self.capacity, list(self))
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        buf = self._buf
+        capacity = self.capacity
+        for i in range(self._head, self._head + self._count):
+            yield buf[i % capacity]
+
+    def __bytes__(self):
+        return b''.join(self)
+
+    def _index(self, idx):
+        if idx < 0:
+            idx += self._count
+        if idx < 0 or idx >= self._count:
+            raise IndexError('%s index out of range' % self.__class__.__name__)
+        return (self._head + idx) % self.capacity
+
+    def __getitem__(self, idx):
+        return self._buf[self._index(idx)]
+
+    def __setitem__(self, idx, value):
+        self._buf[self._index(idx)] = value
+
+    def clear(self):
+        """
+        Remove all entries from the FIFO, the FIFO registers are unchanged.
+        """
+        if self.newest_first:
+            self._head = (self._head + self._count) % self.capacity
+        self._count = 0
+
+    def resetStats(self):
+        self.high_water = self._count
+
+    def isEmpty(self):
+        return self._count == 0
+
+    def isFull(self, limit=None):
+        """
+        Returns True if the FIFO holds the maximum number of entries, or the
+        number of entries specified by limit.
+        """
+        if limit is None:
+            limit = self.capacity
+        return self._count >= limit
+
+    def space(self, limit=None):
+        """
+        Returns the number of entries that can be pushed before the FIFO is
+        full.
+        """
+        if limit is None:
+            limit = self.capacity
+        return max(limit - self._count, 0)
+
+    def push(self, value, limit=None):
+        """
+        Add an entry to the FIFO, returns False if the FIFO is full and the
+        value was not added.
+        """
+        if limit is None or limit > self.capacity:
+            limit = self.capacity
+        if self._count >= limit:
+            return False
+
+        self._buf[(self._head + self._count) % self.capacity] = value
+        self._count += 1
+        if self._count > self.high_water:
+            self.high_water = self._count
+        return True
+
+    def pop(self):
+        """
+        Remove and return the oldest entry in the FIFO, raises IndexError if
+        the FIFO is empty.
+        """
+        if self._count == 0:
+            raise IndexError('pop from empty %s' % self.__class__.__name__)
+
+        buf = self._buf
+        head = self._head
+        value = buf[head]
+        if not self.newest_first:
+            # Shifting the registers down leaves the last register unchanged,
+            # which is now the entry before the new head of the FIFO
+            buf[head] = buf[head - 1]
+        self._head = (head + 1) % self.capacity
+        self._count -= 1
+        return value
+
+    def peek(self, idx=0):
+        """
+        Return an entry without removing it from the FIFO, or None if there is
+        no entry at that index.
+        """
+        if idx < 0:
+            idx += self._count
+        if idx < 0 or idx >= self._count:
+            return None
+        return self._buf[(self._head + idx) % self.capacity]
+
+    def getEntry(self, idx):
+        """
+        Returns the value of FIFO register idx, which may be a stale entry if
+        idx is not less than the number of queued entries.
+        """
+        if idx < 0 or idx >= self.capacity:
+            raise IndexError('%s register index out of range' % self.__class__.__name__)
+        if self.newest_first:
+            return self._buf[(self._head + self._count - 1 - idx) % self.capacity]
+        return self._buf[(self._head + idx) % self.capacity]
+
+    def readBytes(self, offset, size):
+        """
+        Read size bytes starting at offset from a FIFO of fixed-size bytes
+        entries as if the entries were contiguous FIFO registers, see
+        getEntry() for details.
+        """
+        entry_size = len(self._fill)
+        idx, start = divmod(offset, entry_size)
+        data = b''
+        while len(data) < size:
+            data += self.getEntry(idx)[start:]
+            idx += 1
+            start = 0
+        return data[:size]
+
+
 class ExternalIOClient:
     """
     Utility to make connecting to an ExternalIOPeripheral's server port and
     receive data easier
     """
-    def __init__(self, host, port):
+    def __init__(self, host, port, protocol='binary'):
         """
         Constructor for ExternalIOClient, uses the host and port parameters to
-        connect as a TCP client to the server.
+        connect as a TCP client to the server. If port is None the host is the
+        path of a Unix domain socket. The protocol must match the protocol
+        configured for the peripheral.
         """
         self._sock = None
 
-        if host is None:
-            host = 'localhost'
-        self._addr = (host, port)
+        if protocol not in ioproto.IO_PROTOCOLS:
+            raise ValueError('Invalid IO protocol: %s (valid protocols are %s)' %
+                             (protocol, ', '.join(ioproto.IO_PROTOCOLS)))
+        self._protocol = protocol
+
+        # Objects that have been received but not yet returned by recv()
+        self._pending = collections.deque()
+
+        # Set when the peripheral has signaled that its receive queue is full
+        self._paused = False
+
+        if port is None:
+            self._addr = host
+        else:
+            if host is None:
+                host = 'localhost'
+            self._addr = (host, port)
+
+    @classmethod
+    def fromSocket(cls, sock, protocol='binary'):
+        """
+        Create a client from an already connected socket, such as the socket
+        returned by ExternalIOPeripheral.connect().
+        """
+        client = cls(None, None, protocol)
+        client._addr = sock.getsockname()
+        client._sock = sock
+        return client
 
     def __del__(self):
         self.close()
@@ -1309,8 +1752,11 @@ class ExternalIOClient:
         Opens the client connection
         """
         if self._sock is None:
-            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if isinstance(self._addr, str):
+                self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            else:
+                self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self._sock.connect(self._addr)
 
     def close(self):
@@ -1324,22 +1770,112 @@ class ExternalIOClient:
             except OSError:
                 pass
             self._sock = None
+        self._paused = False
 
     def send(self, obj):
         """
-        Sends an object to the server using the _sendObj() utility
+        Sends an object to the server using the _sendObjs() utility
         """
         logger.debug('Sending %r to %r', obj, self._addr)
-        _sendObj(self._sock, obj)
+        _sendObjs(self._sock, (obj,), self._protocol)
+
+    def sendBatch(self, objs):
+        """
+        Sends a sequence of objects to the server, with the binary protocol
+        the objects are sent in one message.
+        """
+        logger.debug('Sending %d objects to %r', len(objs), self._addr)
+        _sendObjs(self._sock, objs, self._protocol)
 
     def recv(self):
         """
-        Receives an object from the server using the _recvObj() utility
+        Receives an object from the server using the _recvObjs() utility
         """
-        try:
-            obj = _recvObj(self._sock)
-            logger.debug('Received %r from %r', obj, self._addr)
-            return obj
-        except OSError:
-            logger.debug('Connection closed %r', self._addr, exc_info=1)
-            self.close()
+        while not self._pending:
+            objs = self.recvBatch()
+            if objs is None:
+                return None
+            self._pending.extend(objs)
+
+        obj = self._pending.popleft()
+        logger.debug('Received %r from %r', obj, self._addr)
+        return obj
+
+    def recvBatch(self):
+        """
+        Receives all objects in the next message from the server. If there
+        are objects that have already been received but not returned by recv()
+        those are returned instead.
+        """
+        if self._pending:
+            objs = list(self._pending)
+            self._pending.clear()
+            return objs
+
+        while True:
+            try:
+                objs = _recvObjs(self._sock, self._protocol)
+            except (OSError, ioproto.IOProtocolError):
+                logger.debug('Connection closed %r', self._addr, exc_info=1)
+                self.close()
+                return None
+
+            # Don't return messages that only contained flow control signals
+            data_objs = self._handleFlowControl(objs)
+            if data_objs or len(data_objs) == len(objs):
+                return data_objs
+
+    def _handleFlowControl(self, objs):
+        data_objs = []
+        for obj in objs:
+            if isinstance(obj, ioproto.FlowControl):
+                logger.debug('Flow control from %r: %s', self._addr, obj)
+                self._paused = obj.paused
+            else:
+                data_objs.append(obj)
+        return data_objs
+
+    def _pollFlowControl(self, timeout):
+        # Read any messages that are available within the timeout to check for
+        # flow control signals, other objects are saved to be returned by
+        # recv()
+        if self._sock is None:
+            return
+
+        readable, _, _ = select.select([self._sock], [], [], timeout)
+        while readable:
+            try:
+                objs = _recvObjs(self._sock, self._protocol)
+            except (OSError, ioproto.IOProtocolError):
+                logger.debug('Connection closed %r', self._addr, exc_info=1)
+                self.close()
+                return
+            self._pending.extend(self._handleFlowControl(objs))
+            readable, _, _ = select.select([self._sock], [], [], 0)
+
+    def isPaused(self):
+        """
+        Returns True if the peripheral has signaled that its receive queue is
+        full and clients should stop sending.
+        """
+        self._pollFlowControl(0)
+        return self._paused
+
+    def waitReady(self, timeout=None):
+        """
+        Wait until the peripheral can accept new messages, returns False if
+        the peripheral's receive queue is still full after the timeout.
+        """
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        self._pollFlowControl(0)
+        while self._paused:
+            if timeout is None:
+                self._pollFlowControl(None)
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0.0:
+                    return False
+                self._pollFlowControl(remaining)
+        return True
@@ -1,4 +1,5 @@
 import bisect
+import pickle
 import struct
 import operator
 import itertools
@@ -48,6 +49,13 @@ __all__ = [
     # Not a VStruct but behaves like BitFieldSPR without requiring a full 
     # VBitField object behind it.
     'PpcSprCallbackWrapper',
+
+    # Utilities to save and restore the state of VStruct objects
+    'vsGetSnap',
+    'vsSetSnap',
+
+    # Register set construction from per-class templates
+    'newRegisterSet',
 ]
 
 
@@ -773,6 +781,11 @@ class PeriphRegister(VBitField):
         super().__init__()
         self._vs_defaults = {}
 
+        # Precomputed list of field setters and default values used by reset(),
+        # generated the first time the register is reset and invalidated any
+        # time a field is added.
+        self._vs_reset_image = None
+
         # Default the size to 0
         self._vs_bitwidth = 0
         self._vs_size = 0
@@ -857,6 +870,7 @@ class PeriphRegister(VBitField):
         super().vsAddField(name, value)
         if not isinstance(value, PlaceholderRegister):
             self._vs_defaults[name] = value.vsGetValue()
+        self._vs_reset_image = None
 
         # Update the size for this register
         self._vs_bitwidth += value._vs_bitwidth
@@ -892,19 +906,34 @@ class PeriphRegister(VBitField):
         Reset function, used to return a peripheral register to the correct
         initial state.
         """
-        # For any items with defaults set them now
-        for name, value in self._vs_defaults.items():
-            # Set values directly instead of using the vsSetField() function
-            # to make it easier to reset w1c fields to their default values.  We
-            # could use vsOverrideValue() but the normal v_bits() fields don't
-            # have this function.
-            self.vsOverrideValue(name, value)
+        if self._vs_reset_image is None:
+            self._vs_reset_image = self._vsBuildResetImage()
+        defaults, subfields = self._vs_reset_image
+
+        # For any items with defaults set them now.  Set values directly
+        # instead of using the vsSetField() function to make it easier to reset
+        # w1c fields to their default values.
+        for override, value in defaults:
+            override(value)
 
         # If there are any fields that have their own reset function, call it
         # now
-        for name, value in self:
-            if name not in self._vs_defaults and hasattr(value, 'reset'):
-                value.reset(emu)
+        for field in subfields:
+            field.reset(emu)
+
+    def _vsBuildResetImage(self):
+        """
+        Generates the reset image for this register: a tuple of the override
+        functions and default values for every field with a default, and a
+        tuple of the fields that have their own reset function.  Looking these
+        up once saves having to walk the register fields by name every time the
+        register is reset.
+        """
+        defaults = tuple((self._vs_values[name].vsOverrideValue, value)
+                for name, value in self._vs_defaults.items())
+        subfields = tuple(value for name, value in self
+                if name not in self._vs_defaults and hasattr(value, 'reset'))
+        return (defaults, subfields)
 
     # More efficient versions of VBitField vsEmit and vsParse functions that
     # take advantage of expected limitations in valid peripheral register
@@ -1224,6 +1253,10 @@ class PeripheralRegisterSet(VStruct):
 
         self._vs_field_offset = {}
 
+        # Precomputed list of fields with reset functions, generated the first
+        # time the register set is reset and invalidated when a field is added
+        self._vs_reset_image = None
+
         # Regenerated each time a field is added, makes it faster to find the
         # field to emit from or parse into
         self._vs_field_by_offset = {}
@@ -1389,6 +1422,7 @@ class PeripheralRegisterSet(VStruct):
 
         self._vs_field_offset[name] = offset
         self._rebuildFieldOffsetLookup()
+        self._vs_reset_image = None
 
     def __len__(self):
         """
@@ -1532,13 +1566,27 @@ class PeripheralRegisterSet(VStruct):
                 value.init(emu)
 
     def reset(self, emu):
+        if self._vs_reset_image is None:
+            self._vs_reset_image = self._vsBuildResetImage()
+
+        for field in self._vs_reset_image:
+            field.reset(emu)
+
+    def _vsBuildResetImage(self):
+        """
+        Returns a tuple of all fields (and VArray elements) in this register set
+        that have a reset function so reset() doesn't need to search for them
+        every time.
+        """
+        fields = []
         for _, value in self:
             if hasattr(value, 'reset') and callable(value.reset):
-                value.reset(emu)
+                fields.append(value)
             elif isinstance(value, VArray):
                 for _, elem in value:
                     if hasattr(elem, 'reset') and callable(elem.reset):
-                        elem.reset(emu)
+                        fields.append(elem)
+        return tuple(fields)
 
     def vsGetPrintInfo(self, offset=0, indent=0, top=True):
         """
@@ -1686,3 +1734,90 @@ class PpcSprCallbackWrapper:
         if self._write:
             value = self._write(value)
         emu.setRegister(self._reg, value)
+
+
+def vsGetSnap(vsobj):
+    """
+    Returns a copy of the raw values of a VStruct object (and all of it's
+    fields) that can be restored later with vsSetSnap().  The field values are
+    copied directly instead of using the vsEmit() function so the values of
+    read-only, write-only and w1c fields are saved exactly.
+    """
+    if isinstance(vsobj, v_bytearray):
+        return bytes(vsobj._vs_value)
+    elif isinstance(vsobj, VStruct):
+        return tuple(vsGetSnap(field) for _, field in vsobj)
+    else:
+        return vsobj._vs_value
+
+
+def vsSetSnap(vsobj, snap):
+    """
+    Restores the raw values of a VStruct object that were saved with
+    vsGetSnap().  Values are set directly so no parse callbacks are called.
+    """
+    if isinstance(vsobj, v_bytearray):
+        vsobj._vs_value[:] = snap
+    elif isinstance(vsobj, VStruct):
+        for (_, field), fsnap in zip(vsobj, snap):
+            vsSetSnap(field, fsnap)
+    else:
+        vsobj._vs_value = snap
+
+
+# Pickled copies of newly constructed register sets, indexed by register set
+# class and endianness. If a register set class can't be pickled the template
+# is None and the register set is constructed normally.
+_regset_templates = {}
+
+
+def _constructRegisterSet(cls, bigend):
+    # Try to initialize it using the bigend param, if that fails use the
+    # vsSetEndian() function.
+    try:
+        return cls(bigend=bigend)
+    except TypeError:
+        regs = cls()
+        regs.vsSetEndian(bigend)
+        return regs
+
+
+def newRegisterSet(cls, bigend):
+    """
+    Create a new register set object. The first time a PeripheralRegisterSet
+    class is created a template is saved with the layout, field offsets and
+    reset values of the register set, and the reset image used by reset().
+    Additional register sets of the same class are cloned from the template
+    instead of running the constructors of every register and field again.
+
+    The register set must not be modified (such as adding callbacks) until
+    after it has been created.
+    """
+    if not issubclass(cls, PeripheralRegisterSet):
+        return _constructRegisterSet(cls, bigend)
+
+    key = (cls, bool(bigend))
+    try:
+        template = _regset_templates[key]
+    except KeyError:
+        regs = _constructRegisterSet(cls, bigend)
+
+        # Build the reset image now so it is part of the template
+        regs._vs_reset_image = regs._vsBuildResetImage()
+        for field in regs._vs_reset_image:
+            if isinstance(field, PeriphRegister) and field._vs_reset_image is None:
+                field._vs_reset_image = field._vsBuildResetImage()
+
+        try:
+            template = pickle.dumps(regs, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as exc:
+            logger.debug('Unable to create %s template: %s', cls.__name__, exc)
+            template = None
+
+        _regset_templates[key] = template
+        return regs
+
+    if template is None:
+        return _constructRegisterSet(cls, bigend)
+
+    return pickle.loads(template)
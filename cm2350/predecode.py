@@ -0,0 +1,135 @@
+import multiprocessing
+
+import envi
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__all__ = [
+    'Predecoder',
+    'decodeRegion',
+]
+
+
+# Default size of the memory regions that are decoded by each worker task
+DEFAULT_REGION_SIZE = 0x10000
+
+# Architecture names of the full PPC and VLE disassemblers, indexed by the VLE
+# flag the same as the opcache
+ARCH_NAMES = ('ppc32-embedded', 'ppc-vle')
+
+# The architecture modules used by a worker process, created when the worker
+# starts
+_archmods = None
+
+
+def _initWorker():
+    global _archmods
+    _archmods = tuple(envi.getArchModule(name) for name in ARCH_NAMES)
+
+
+def decodeRegion(start, vle, data):
+    '''
+    Decode the instructions in a region of memory with a linear sweep and
+    return a list of (address, opcode) tuples. Erased (0xFF) memory and bytes
+    that do not decode to a valid instruction are skipped.
+
+    The decode for an address only depends on the bytes at that address, so
+    the results are valid even if the sweep decodes data as instructions, the
+    extra opcodes are only used if the address is executed.
+    '''
+    if _archmods is None:
+        _initWorker()
+    archmod = _archmods[vle]
+
+    # VLE instructions are 2 or 4 bytes, full PPC instructions are 4 bytes
+    step = 2 if vle else 4
+    erased = b'\xff' * step
+
+    ops = []
+    offset = 0
+    end = len(data) - step + 1
+    while offset < end:
+        if data.startswith(erased, offset):
+            offset += step
+            continue
+
+        try:
+            op = archmod.archParseOpcode(data, offset, start + offset)
+        except Exception:
+            offset += step
+            continue
+
+        ops.append((start + offset, op))
+        offset += op.size
+
+    return ops
+
+
+class Predecoder:
+    '''
+    Decodes regions of memory in a pool of worker processes so the opcache can
+    be populated before the instructions are executed.  Decoding runs in the
+    background, the results are retrieved with results() once they are ready.
+
+    The contents of each region are saved when decoding is started, the
+    results for a region should only be used if memory has not changed since
+    then.
+    '''
+    def __init__(self, workers=None):
+        self.workers = workers
+        self._pool = None
+        self._result = None
+        self._regions = None
+
+    def start(self, regions):
+        '''
+        Start decoding a list of (address, vle, bytes) regions.
+        '''
+        self._regions = list(regions)
+
+        # Use the spawn start method because the emulator has threads running
+        # that should not be copied into the worker processes
+        ctx = multiprocessing.get_context('spawn')
+        self._pool = ctx.Pool(self.workers, initializer=_initWorker)
+        self._result = self._pool.starmap_async(decodeRegion, self._regions)
+        logger.debug('Started decoding %d regions', len(self._regions))
+
+    def ready(self):
+        return self._result is not None and self._result.ready()
+
+    def results(self, wait=False):
+        '''
+        Return a list of (address, vle, bytes, opcodes) tuples for each region,
+        or None if decoding is not complete and wait is False.  Once the
+        results are returned the worker processes are stopped.  If decoding
+        failed an empty list is returned.
+        '''
+        if self._result is None or (not wait and not self._result.ready()):
+            return None
+
+        try:
+            decoded = self._result.get()
+        except Exception as exc:
+            logger.warning('Unable to decode instructions: %s', exc)
+            decoded = [[] for _ in self._regions]
+
+        results = [r + (ops,) for r, ops in zip(self._regions, decoded)]
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+        self._result = None
+        self._regions = None
+        return results
+
+    def stop(self):
+        '''
+        Stop the worker processes without waiting for decoding to complete.
+        '''
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+        self._pool = None
+        self._result = None
+        self._regions = None
@@ -1,5 +1,7 @@
 import sys
 import time
+import pickle
+import hashlib
 import logging
 import os.path
 import weakref
@@ -34,6 +36,11 @@ logging.getLogger('asyncio').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
+# Version of the cached workspace file format, cache files with a different
+# version are ignored.
+WORKSPACE_CACHE_VERSION = 1
+
+
 def merge_dict(base, update):
     if not (isinstance(base, dict) and isinstance(update, dict)):
         raise Exception('Cannot merge %r and %r' % (base, update))
@@ -93,6 +100,7 @@ class VivProject(metaclass=VivProjectMeta):
             'platform': 'unknown',
             'arch': 'unknown',
             'bigend': False,
+            'cache': True,
         }
     }
 
@@ -103,6 +111,7 @@ class VivProject(metaclass=VivProjectMeta):
             'platform': 'What platform is this project',
             'arch': 'The architecture for the project',
             'bigend': 'Is the architecture Big-Endian (MSB)?',
+            'cache': 'Cache loaded files and decoded instructions in the project directory',
         }
     }
 
@@ -245,7 +254,10 @@ class VivProject(metaclass=VivProjectMeta):
             else:
                 parsemod = parsed_args.parsemod
 
-            vw.loadFromFile(fname, fmtname=parsemod)
+            if not self._loadCachedFile(vw, fname, parsemod):
+                first_event = len(vw.exportWorkspace())
+                vw.loadFromFile(fname, fmtname=parsemod)
+                self._saveCachedFile(fname, parsemod, vw.exportWorkspace()[first_event:])
 
             end = time.time()
             logger.info('Loaded (%.4f sec) %s', (end - start), fname)
@@ -296,6 +308,58 @@ class VivProject(metaclass=VivProjectMeta):
         else:
             return os.path.normpath(os.path.join(self.home, filename))
 
+    def _getCacheFilename(self, fname, parsemod):
+        # Loaded files are cached in the project directory, if there is no
+        # project directory or caching is disabled files are not cached.
+        if self.home is None or not os.path.isdir(self.home) or \
+                not self.config.project.cache:
+            return None
+
+        key = hashlib.md5(repr((os.path.abspath(fname), parsemod)).encode()).hexdigest()
+        return os.path.join(self.home, 'workspace.%s.cache' % key)
+
+    def _loadCachedFile(self, vw, fname, parsemod):
+        '''
+        If the workspace events created when a file was last loaded are cached
+        and the file has not changed (same size and modification time) add the
+        cached events to the workspace instead of parsing the file.
+        '''
+        cache_filename = self._getCacheFilename(fname, parsemod)
+        if cache_filename is None:
+            return False
+
+        try:
+            info = os.stat(fname)
+            with open(cache_filename, 'rb') as f:
+                version, size, mtime, events = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as exc:
+            logger.warning('Unable to load cached workspace %s: %s', cache_filename, exc)
+            return False
+
+        if version != WORKSPACE_CACHE_VERSION or size != info.st_size or mtime != info.st_mtime_ns:
+            return False
+
+        logger.info('Loading %s from cached workspace %s', fname, cache_filename)
+        vw.importWorkspace(events)
+        return True
+
+    def _saveCachedFile(self, fname, parsemod, events):
+        cache_filename = self._getCacheFilename(fname, parsemod)
+        if cache_filename is None:
+            return
+
+        tmp_filename = cache_filename + '.tmp'
+        try:
+            info = os.stat(fname)
+            with open(tmp_filename, 'wb') as f:
+                pickle.dump((WORKSPACE_CACHE_VERSION, info.st_size, info.st_mtime_ns, events),
+                            f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_filename, cache_filename)
+        except Exception as exc:
+            logger.warning('Unable to save cached workspace %s: %s', cache_filename, exc)
+
     def get_project_config(self, path=None):
         if path is None:
             path = ''
@@ -15,6 +15,7 @@ import envi.archs.ppc.regs as eapr
 import envi.archs.ppc.const as eapc
 
 from .. import CM2350
+from ..workqueue import PRIORITY_NORMAL
 
 import logging
 logger = logging.getLogger(__name__)
@@ -179,6 +180,7 @@ DEFAULT_PROJECT_CONFIG['project'] = {
     'platform': 'CM2350',
     'arch': 'ppc32-embedded',
     'bigend': True,
+    'cache': True,
     'format': 'blob',
     'CM2350': { 'p89': 1, 'p90': 1, 'p91': 0, 'p92': 0},
     'MPC5674': {
@@ -191,23 +193,62 @@ DEFAULT_PROJECT_CONFIG['project'] = {
             'shadowAOffset': 0,
             'shadowBFilename': None,
             'shadowBOffset': 0,
-            'backup': 'backup.flash'
+            'backup': 'backup.flash',
+            'sync_interval': 1.0,
         },
         'SRAM': {
             'addr': 0x40000000,
             'size': 0x40000,
             'standby_size': 0x8000,
         },
-        'FlexCAN_A': {'host': None, 'port': None},
-        'FlexCAN_B': {'host': None, 'port': None},
-        'FlexCAN_C': {'host': None, 'port': None},
-        'FlexCAN_D': {'host': None, 'port': None},
+        'CPI': {
+            'default': 1,
+            'branch': None,
+            'load': None,
+            'store': None,
+            'mul': None,
+            'div': None,
+            'sync': None,
+        },
+        'Pacing': {
+            'enabled': False,
+            'scaling': 1.0,
+            'max_lead': 0.01,
+        },
+        'Checkpoints': {
+            'enabled': False,
+            'interval': 100000,
+            'max_memory': 256 * 1024 * 1024,
+            'max_latency': 0.5,
+        },
+        'IOFrontend': {
+            'enabled': False,
+            'ring_size': 0x100000,
+            'poll_interval': 1000,
+        },
+        'Predecode': {
+            'enabled': False,
+            'workers': None,
+            'region_size': 0x10000,
+        },
+        'eDMA_A': {'budget': None, 'priority': PRIORITY_NORMAL},
+        'eDMA_B': {'budget': None, 'priority': PRIORITY_NORMAL},
+        'FlexCAN_A': {'host': None, 'port': None, 'path': None, 'protocol': 'binary',
+                      'queue_size': 1024, 'queue_policy': 'block'},
+        'FlexCAN_B': {'host': None, 'port': None, 'path': None, 'protocol': 'binary',
+                      'queue_size': 1024, 'queue_policy': 'block'},
+        'FlexCAN_C': {'host': None, 'port': None, 'path': None, 'protocol': 'binary',
+                      'queue_size': 1024, 'queue_policy': 'block'},
+        'FlexCAN_D': {'host': None, 'port': None, 'path': None, 'protocol': 'binary',
+                      'queue_size': 1024, 'queue_policy': 'block'},
         'DSPI_A': {'host': None, 'port': None},
         'DSPI_B': {'host': None, 'port': None},
         'DSPI_C': {'host': None, 'port': None},
         'DSPI_D': {'host': None, 'port': None},
-        'eQADC_A': {'host': None, 'port': None},
-        'eQADC_B': {'host': None, 'port': None},
+        'eQADC_A': {'host': None, 'port': None, 'path': None, 'protocol': 'binary',
+                    'queue_size': 1024, 'queue_policy': 'block'},
+        'eQADC_B': {'host': None, 'port': None, 'path': None, 'protocol': 'binary',
+                    'queue_size': 1024, 'queue_policy': 'block'},
     }
 }
 
@@ -565,7 +606,16 @@ class CM2350_CLI(unittest.TestCase):
             shutil.rmtree(config)
         elif backup_file is not None and initialized:
             # If the configuration shouldn't be deleted, cleanup the backup file
+            # and the flash block digests saved with it
             os.unlink(backup_file)
+            digest_file = os.path.join(config, '%s-blocks.%s' % (BACKUP_FILENAME, hash_value.hex()))
+            if os.path.exists(digest_file):
+                os.unlink(digest_file)
+
+            # And any cached files or decoded instructions
+            for cache_file in glob.glob(os.path.join(config, 'workspace.*.cache')) + \
+                    glob.glob(os.path.join(config, 'instructions.*')):
+                os.unlink(cache_file)
 
         # If the config was EXISTING_CONFIG and the mode is INIT_FLASH restore
         # the original test flash and config files
@@ -0,0 +1,125 @@
+import os
+import struct
+import hashlib
+import tempfile
+import unittest
+import unittest.mock
+
+from ..parsers import xcal
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def ihex_record(code, addr=0, data=b''):
+    record = struct.pack('>BHB', len(data), addr, code) + data
+    record += bytes([-sum(record) & 0xFF])
+    return b':' + record.hex().upper().encode() + b'\n'
+
+
+TEST_DATA = (
+    b'file header\n' +
+    ihex_record(xcal.CODE.EXT_LINEAR_ADDR, data=b'\x00\x01') +
+    ihex_record(xcal.CODE.DATA, 0x0000, b'\x01\x02\x03\x04') +
+    ihex_record(xcal.CODE.DATA, 0x0004, b'\x05\x06\x07\x08') +
+    ihex_record(xcal.CODE.DATA, 0x0100, b'\x09\x0a') +
+    ihex_record(xcal.CODE.START_LINEAR_ADDR, data=b'\x00\x01\x00\x00') +
+    ihex_record(xcal.CODE.EOF) +
+    b'file trailer\n'
+)
+
+TEST_BLOCKS = {
+    0x00010000: b'\x01\x02\x03\x04\x05\x06\x07\x08',
+    0x00010100: b'\x09\x0a',
+}
+
+
+class CM2350_XCAL(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'test.xcal')
+        with open(self.filename, 'wb') as f:
+            f.write(TEST_DATA)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_xcal_parse_lines(self):
+        # Contiguous data records are combined and non-ihex lines are ignored
+        blocks, entrypoints = xcal.parseLines(TEST_DATA.splitlines())
+        self.assertEqual(blocks, TEST_BLOCKS)
+        self.assertEqual(entrypoints, [0x00010000])
+
+        # str lines can also be parsed
+        blocks, entrypoints = xcal.parseLines(TEST_DATA.decode().splitlines())
+        self.assertEqual(blocks, TEST_BLOCKS)
+        self.assertEqual(entrypoints, [0x00010000])
+
+    def test_xcal_start_seg_addr(self):
+        data = ihex_record(xcal.CODE.DATA, 0x0000, b'\x01\x02') + \
+                ihex_record(xcal.CODE.START_SEG_ADDR, data=b'\x12\x34\x00\x10') + \
+                ihex_record(xcal.CODE.EOF)
+        blocks, entrypoints = xcal.parseLines(data.splitlines())
+        self.assertEqual(blocks, {0x0000: b'\x01\x02'})
+        self.assertEqual(entrypoints, [0x12350])
+
+    def test_xcal_parse_image(self):
+        image = xcal.parseImage(self.filename)
+        self.assertEqual(image.blocks, TEST_BLOCKS)
+        self.assertEqual(image.entrypoints, [0x00010000])
+
+        # The hashes include the lines after the EOF record
+        ihex = b''.join(l for l in TEST_DATA.splitlines(keepends=True) if l.startswith(b':'))
+        self.assertEqual(image.md5, hashlib.md5(TEST_DATA).digest())
+        self.assertEqual(image.sha256, hashlib.sha256(TEST_DATA).digest())
+        self.assertEqual(image.sha256_ihex, hashlib.sha256(ihex).digest())
+        self.assertEqual(xcal.fileDigest(self.filename), image.md5)
+
+    def test_xcal_cache(self):
+        self.assertIsNone(xcal.loadCache(self.filename))
+
+        image = xcal.parseImage(self.filename)
+        xcal.saveCache(self.filename, image)
+        self.assertTrue(os.path.exists(self.filename + xcal.CACHE_SUFFIX))
+
+        # The cached image matches the parsed image
+        cached = xcal.loadCache(self.filename)
+        self.assertEqual(cached, image)
+
+    def test_xcal_cache_changed(self):
+        image = xcal.parseImage(self.filename)
+        xcal.saveCache(self.filename, image)
+
+        # Change the contents of the file without changing its size or
+        # modification time, the cache is not used
+        info = os.stat(self.filename)
+        with open(self.filename, 'wb') as f:
+            f.write(TEST_DATA.replace(b'header', b'HEADER'))
+        os.utime(self.filename, ns=(info.st_atime_ns, info.st_mtime_ns))
+        self.assertEqual(os.stat(self.filename).st_size, info.st_size)
+        self.assertIsNone(xcal.loadCache(self.filename))
+
+        # Restoring the original contents and modification time makes the
+        # cache valid again
+        with open(self.filename, 'wb') as f:
+            f.write(TEST_DATA)
+        os.utime(self.filename, ns=(info.st_atime_ns, info.st_mtime_ns))
+        self.assertEqual(xcal.loadCache(self.filename), image)
+
+        # Changing only the modification time invalidates the cache
+        os.utime(self.filename, ns=(info.st_atime_ns, info.st_mtime_ns + 1000000000))
+        self.assertIsNone(xcal.loadCache(self.filename))
+
+    def test_xcal_parse_file(self):
+        vw = unittest.mock.MagicMock()
+        vw.config.viv.parsers.ihex.arch = ''
+
+        # The first time the file is parsed the cache is created, the second
+        # time the cache is used
+        with unittest.mock.patch.object(xcal, 'parseImage', wraps=xcal.parseImage) as parse:
+            xcal.parseFile(vw, self.filename)
+            xcal.parseFile(vw, self.filename)
+            self.assertEqual(parse.call_count, 1)
+
+        self.assertEqual(vw.addMemoryMap.call_count, 2 * len(TEST_BLOCKS))
+        vw.addEntryPoint.assert_called_with(0x00010000)
@@ -0,0 +1,193 @@
+import envi.archs.ppc.regs as eapr
+
+from ..ppc_peripherals import LazyPeripheral
+from ..peripherals.edma import TCDConfig
+
+from .helpers import MPC5674_Test
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+SRAM_ADDR = 0x40000000
+
+
+class MPC5674_Checkpoints_Test(MPC5674_Test):
+    def setUp(self):
+        super().setUp()
+
+        # Fill in a sequence of instructions that increments r3 and writes it
+        # to the start of SRAM after every 7 increments:
+        #
+        #   0x00000000:  38630001  addi r3,r3,1
+        #   ...
+        #   0x00000018:  38630001  addi r3,r3,1
+        #   0x0000001c:  90640000  stw r3,0(r4)
+        #   ...
+        #   0x000000fc:  90640000  stw r3,0(r4)
+        #
+        self.start_pc = self.emu.getProgramCounter()
+        instrs = b''.join(([b'\x38\x63\x00\x01'] * 7 + [b'\x90\x64\x00\x00']) * 8)
+        self.assertEqual(len(instrs), 0x100)
+        self.emu.flash.data[self.start_pc:self.start_pc+len(instrs)] = instrs
+
+        self.emu.setRegister(eapr.REG_R3, 0)
+        self.emu.setRegister(eapr.REG_R4, SRAM_ADDR)
+
+        self.emu.enableCheckpoints(interval=10)
+        self.start = self.emu.getStepCount()
+
+    def get_state(self):
+        return (self.emu.getStepCount(),
+                self.emu.getProgramCounter(),
+                self.emu.getRegister(eapr.REG_R3),
+                self.emu.readMemValue(SRAM_ADDR, 4),
+                self.emu.systicks())
+
+    def test_checkpoint_reverse_stepi(self):
+        states = [self.get_state()]
+        for i in range(40):
+            self.emu.stepi()
+            states.append(self.get_state())
+
+        self.assertEqual(states[-1][:4], (self.start + 40, self.start_pc + 40*4, 35, 35))
+
+        # Step backwards one instruction at a time
+        ckpts = self.emu.checkpoints
+        for expected in reversed(states[:-1]):
+            ckpts.reverseStepi()
+            self.assertEqual(self.get_state(), expected)
+            self.assertTrue(ckpts.replaying())
+
+        # Can't go back past the first checkpoint
+        ckpts.reverseStepi()
+        self.assertEqual(self.get_state(), states[0])
+
+        # Jump to a position in the middle and then execute forward, the
+        # results should match the original execution
+        ckpts.gotoPosition(self.start + 17)
+        self.assertEqual(self.get_state(), states[17])
+        for expected in states[18:]:
+            self.emu.stepi()
+            self.assertEqual(self.get_state(), expected)
+
+        # Once the end of the history is reached the checkpoints should go
+        # back to normal execution
+        self.emu.stepi()
+        self.assertFalse(ckpts.replaying())
+        self.assertEqual(self.get_state()[:4], (self.start + 41, self.start_pc + 41*4, 36, 35))
+
+    def test_checkpoint_reverse_continue(self):
+        for i in range(40):
+            self.emu.stepi()
+
+        ckpts = self.emu.checkpoints
+
+        # Reverse continue stops before the most recent write to SRAM
+        reason, addr = ckpts.reverseContinue(watchpoints=[(SRAM_ADDR, 4)])
+        self.assertEqual((reason, addr), ('watchpoint', SRAM_ADDR))
+        self.assertEqual(self.get_state()[:4], (self.start + 39, self.start_pc + 39*4, 35, 28))
+
+        # Reverse continue to a breakpoint
+        bp = self.start_pc + 0x8
+        reason, addr = ckpts.reverseContinue(breakpoints={bp})
+        self.assertEqual((reason, addr), ('breakpoint', bp))
+        self.assertEqual(self.get_state()[:4], (self.start + 2, bp, 2, 0))
+
+        # If no earlier breakpoints are hit execution goes back to the start
+        self.assertEqual(ckpts.reverseContinue(breakpoints={bp}), (None, None))
+        self.assertEqual(self.get_state()[:4], (self.start, self.start_pc, 0, 0))
+
+    def test_checkpoint_modify(self):
+        for i in range(20):
+            self.emu.stepi()
+
+        # Go back and change a register, the rest of the history is discarded
+        ckpts = self.emu.checkpoints
+        ckpts.gotoPosition(self.start + 10)
+        self.assertTrue(ckpts.replaying())
+        self.emu.setRegister(eapr.REG_R3, 100)
+        ckpts.stateModified()
+        self.assertFalse(ckpts.replaying())
+        self.assertEqual(ckpts.last(), self.start + 10)
+
+        for i in range(10):
+            self.emu.stepi()
+        self.assertEqual(self.get_state()[:4], (self.start + 20, self.start_pc + 20*4, 109, 105))
+
+        # Going back to the modified position includes the modification
+        ckpts.gotoPosition(self.start + 10)
+        self.assertEqual(self.get_state()[:4], (self.start + 10, self.start_pc + 10*4, 100, 7))
+
+    def test_checkpoint_history_memory(self):
+        for i in range(20):
+            self.emu.stepi()
+
+        ckpts = self.emu.checkpoints
+        self.assertEqual(ckpts.first(), self.start)
+        memory = ckpts.memory
+
+        # The IO history is counted in the checkpoint memory, when most of the
+        # memory is used by the history the oldest checkpoints are discarded
+        # along with the history before the next checkpoint
+        pos = self.emu.getStepCount()
+        ckpts.history.append((pos, 'FlexCAN_A', b'\x00' * (memory * 4)))
+        ckpts.max_memory = memory * 2
+        for i in range(10):
+            self.emu.stepi()
+
+        self.assertEqual(ckpts.first(), self.start + 30)
+        self.assertEqual(ckpts.history, [])
+        self.assertLessEqual(ckpts.memory, ckpts.max_memory)
+
+    def test_checkpoint_module_coverage(self):
+        # Construct all of the lazy peripherals so the state of every module
+        # is included in the snapshot
+        for module in list(self.emu.modules.values()):
+            if isinstance(module, LazyPeripheral):
+                module._lazyConstruct()
+
+        # Every attribute of every module must be handled by the snapshot
+        snap = self.emu.getEmuSnap()
+        for name, module in self.emu.modules.items():
+            if name != 'GDBSTUB':
+                self.assertIsNotNone(snap['modules'][name], name)
+
+        for i in range(20):
+            self.emu.stepi()
+        self.emu.setEmuSnap(snap)
+        self.assertEqual(self.get_state()[:4], (self.start, self.start_pc, 0, 0))
+
+        # Attributes that aren't covered by the snapshot are an error
+        siu = self.emu.modules['SIU']
+        siu._unknown = object()
+        with self.assertRaises(TypeError):
+            siu.getSnap()
+        with self.assertRaises(TypeError):
+            self.emu.getEmuSnap()
+
+        # Unless they are listed as not being part of the emulated state
+        siu._snap_ignore = ('_unknown',)
+        self.assertNotIn('_unknown', siu.getSnap())
+
+    def test_checkpoint_edma_transfers(self):
+        dma = self.emu.modules['eDMA_A']
+        config = TCDConfig(3, dma.registers.tcd[3], dma.registers.mcr.emlm)
+        dma._pending = {3: config}
+        dma._active = config
+        snap = dma.getSnap()
+
+        # The transfer state saved in the snapshot is not modified by later
+        # changes to the transfers
+        config.citer = 5
+        dma._pending = {}
+        dma._active = None
+        self.assertEqual(snap['_pending'][3].citer, 0)
+
+        # The active transfer is restored as one of the pending transfers, and
+        # still refers to the TCD registers
+        dma.setSnap(snap)
+        self.assertIs(dma._active, dma._pending[3])
+        self.assertIsNot(dma._active, config)
+        self.assertIsNot(dma._active, snap['_pending'][3])
+        self.assertIs(dma._active.tcd, dma.registers.tcd[3])
@@ -1,3 +1,6 @@
+from ..ppc_peripherals import LazyPeripheral
+from ..peripherals.decfilt import DECFILT
+
 from .helpers import MPC5674_Test
 
 
@@ -37,6 +40,56 @@ DECFILT_MCR_DEFAULT_BYTES = b'\x00\x00\x80\x00'
 
 class MPC5674_DECFILT_Test(MPC5674_Test):
 
+    def test_decfilt_lazy(self):
+        # The DECFILT peripherals are not constructed until they are used
+        for dev in range(len(DECFILT_DEVICES)):
+            devname, baseaddr = DECFILT_DEVICES[dev]
+            self.assertIsInstance(self.emu.decfilt[dev], LazyPeripheral, msg=devname)
+            self.assertIs(self.emu.modules[devname], self.emu.decfilt[dev], msg=devname)
+
+        snap = self.emu.getEmuSnap()
+        self.assertIsNone(snap['modules']['DECFILT_A'])
+
+        # Reading from the peripheral constructs it in place
+        devname, baseaddr = DECFILT_DEVICES[0]
+        addr = baseaddr + DECFILT_MCR_OFFSET
+        self.assertEqual(self.emu.readMemory(addr, 4), DECFILT_MCR_DEFAULT_BYTES)
+        self.assertIsInstance(self.emu.decfilt[0], DECFILT)
+        self.assertIs(self.emu.modules[devname], self.emu.decfilt[0])
+        self.assertIsInstance(self.emu.decfilt[1], LazyPeripheral)
+
+        # Using a peripheral attribute also constructs it
+        self.assertEqual(self.emu.decfilt[1].registers.mcr.idis, 1)
+        self.assertIsInstance(self.emu.decfilt[1], DECFILT)
+
+        # Restoring a snapshot from before the peripheral was constructed
+        # returns it to its reset state
+        self.emu.writeMemValue(addr, 0, 4)
+        self.assertEqual(self.emu.readMemValue(addr, 4), 0)
+        self.emu.setEmuSnap(snap)
+        self.assertEqual(self.emu.readMemory(addr, 4), DECFILT_MCR_DEFAULT_BYTES)
+
+
+    def test_decfilt_registers_cloned(self):
+        # All DECFILT register sets after the first are cloned from a template,
+        # make sure each peripheral has its own registers
+        regs = [dev.registers for dev in self.emu.decfilt]
+        self.assertEqual(len(set(id(r) for r in regs)), len(DECFILT_DEVICES))
+        self.assertEqual(len(set(id(r.mcr) for r in regs)), len(DECFILT_DEVICES))
+
+        devname, baseaddr = DECFILT_DEVICES[0]
+        self.emu.writeMemValue(baseaddr + DECFILT_MCR_OFFSET, 0, 4)
+        for dev in range(1, len(DECFILT_DEVICES)):
+            devname, baseaddr = DECFILT_DEVICES[dev]
+            self.assertEqual(self.emu.readMemory(baseaddr + DECFILT_MCR_OFFSET, 4),
+                             DECFILT_MCR_DEFAULT_BYTES, msg=devname)
+
+        # The reset image restores the cloned registers
+        self.emu.reset()
+        devname, baseaddr = DECFILT_DEVICES[0]
+        self.assertEqual(self.emu.readMemory(baseaddr + DECFILT_MCR_OFFSET, 4),
+                         DECFILT_MCR_DEFAULT_BYTES)
+
     ##################################################
     # Simple Register Tests
     ##################################################
@@ -251,3 +304,66 @@ class MPC5674_DECFILT_Test(MPC5674_Test):
             self.assertEqual(self.emu.readMemory(addr, 4), b'\x00\x00\x00\x00', msg=devname)
             self.assertEqual(self.emu.readMemValue(addr, 4), 0x00000000, msg=devname)
             self.assertEqual(self.emu.decfilt[dev].registers.cintcnt.count, 0, msg=devname)
+
+    ##################################################
+    # Filter Tests
+    ##################################################
+
+    def test_decfilt_fir(self):
+        devname, baseaddr = DECFILT_DEVICES[0]
+        decfilt = self.emu.decfilt[0]
+
+        # 2 sample moving average (coefficients of 0.5) that produces an output
+        # for every other input
+        self.emu.writeMemValue(baseaddr + DECFILT_COEF_RANGE[0], 0x00400000, 4)
+        self.emu.writeMemValue(baseaddr + DECFILT_COEF_RANGE[1], 0x00400000, 4)
+        self.emu.writeMemValue(baseaddr + DECFILT_COEF_RANGE[2], 0x00C00000, 4)
+        self.assertEqual(self.emu.readMemValue(baseaddr + DECFILT_COEF_RANGE[2], 4), 0xFFC00000)
+        self.emu.writeMemValue(baseaddr + DECFILT_COEF_RANGE[2], 0x00000000, 4)
+
+        # DEC_RATE = 1, IDIS = 0 (enable the integrator)
+        self.emu.writeMemValue(baseaddr + DECFILT_MCR_OFFSET, 0x00000100, 4)
+
+        addr = baseaddr + DECFILT_IB_OFFSET
+        self.emu.writeMemValue(addr, 0x01000064, 4)
+        self.assertEqual(decfilt.registers.msr.dec_counter, 1)
+        self.assertEqual(decfilt.registers.msr.odf, 0)
+        self.assertEqual(decfilt.registers.msr.ibif, 1)
+        self.assertEqual(decfilt.registers.tap[0].value, 100)
+
+        self.emu.writeMemValue(addr, 0x020000C8, 4)
+        self.assertEqual(decfilt.registers.msr.dec_counter, 0)
+        self.assertEqual(decfilt.registers.msr.odf, 1)
+        self.assertEqual(decfilt.registers.msr.obif, 1)
+        self.assertEqual(self.emu.readMemValue(baseaddr + DECFILT_OB_OFFSET, 4), 0x00020096)
+
+        # A second output before OBIF is cleared is an overrun
+        self.emu.writeMemValue(addr, 0x0300FF38, 4)
+        self.emu.writeMemValue(addr, 0x0400FE70, 4)
+        self.assertEqual(decfilt.registers.msr.ovr, 1)
+        self.assertEqual(self.emu.readMemValue(baseaddr + DECFILT_OB_OFFSET, 4), 0x0004FED4)
+
+        # The integrator has accumulated both outputs (150 + -300)
+        self.assertEqual(self.emu.readMemValue(baseaddr + DECFILT_FINTVAL_OFFSET, 4), 0xFFFFFF6A)
+        self.assertEqual(self.emu.readMemValue(baseaddr + DECFILT_FINTCNT_OFFSET, 4), 2)
+        self.emu.writeMemValue(baseaddr + DECFILT_MXCR_OFFSET, 0x00020000, 4)
+        self.assertEqual(self.emu.readMemValue(baseaddr + DECFILT_CINTVAL_OFFSET, 4), 0xFFFFFF6A)
+        self.assertEqual(self.emu.readMemValue(baseaddr + DECFILT_CINTCNT_OFFSET, 4), 2)
+        self.assertEqual(decfilt.registers.mxsr.sdf, 1)
+        self.emu.writeMemValue(baseaddr + DECFILT_MXCR_OFFSET, 0x00010000, 4)
+        self.assertEqual(self.emu.readMemValue(baseaddr + DECFILT_FINTVAL_OFFSET, 4), 0)
+        self.assertEqual(self.emu.readMemValue(baseaddr + DECFILT_FINTCNT_OFFSET, 4), 0)
+
+        # A burst of samples produces the same outputs as writing each sample
+        # to the IB register
+        samples = [(i * 1000) & 0xFFFF for i in range(-16, 16)]
+        outputs = decfilt.processSamples(samples, list(range(len(samples))))
+        expected = [(i, (((i - 17) * 1000 + (i - 16) * 1000) >> 1) & 0xFFFF) for i in range(1, len(samples), 2)]
+        self.assertEqual(outputs, expected)
+        self.assertEqual(decfilt.registers.tap[0].value, samples[-1])
+
+        # A soft reset clears the TAPs
+        self.emu.writeMemValue(baseaddr + DECFILT_MCR_OFFSET, 0x08000100, 4)
+        self.assertEqual(decfilt.registers.mcr.sres, 0)
+        self.assertEqual(decfilt.registers.msr.ovr, 0)
+        self.assertEqual([decfilt.registers.tap[i].value for i in range(DECFILT_NUM_TAP)], [0] * DECFILT_NUM_TAP)
@@ -1061,7 +1061,7 @@ class MPC5674_DSPI_Test(MPC5674_Test):
                 # Check the contents of the shift register
                 rx_fifo_data = struct.pack('>IIIII',
                         msgs[1], msgs[2], msgs[3], msgs[4], msgs[5])
-                self.assertEqual(self.emu.dspi[dev]._rx_fifo, rx_fifo_data, msg=testmsg)
+                self.assertEqual(bytes(self.emu.dspi[dev]._rx_fifo), rx_fifo_data, msg=testmsg)
 
                 # receive 1 more msg, nothing changes, shift register is not
                 # overwritten, but the RFOF interrupt has been set
@@ -1075,7 +1075,7 @@ class MPC5674_DSPI_Test(MPC5674_Test):
                 ]
                 self.assertEqual(self._getPendingExceptions(), expected_excs, msg=testmsg)
                 self.assertEqual(self.emu.dspi[dev].registers.sr.rxctr, 4)
-                self.assertEqual(self.emu.dspi[dev]._rx_fifo, rx_fifo_data, msg=testmsg)
+                self.assertEqual(bytes(self.emu.dspi[dev]._rx_fifo), rx_fifo_data, msg=testmsg)
 
                 # Clear the RFOF interrupt flag
                 self.emu.writeMemValue(sr_addr, DSPI_SR_RFOF_MASK, 4)
@@ -1118,7 +1118,7 @@ class MPC5674_DSPI_Test(MPC5674_Test):
                 # Check the contents of the shift register
                 rx_fifo_data = struct.pack('>IIIII',
                         msgs[1], msgs[2], msgs[3], msgs[4], msgs[7])
-                self.assertEqual(self.emu.dspi[dev]._rx_fifo, rx_fifo_data, msg=testmsg)
+                self.assertEqual(bytes(self.emu.dspi[dev]._rx_fifo), rx_fifo_data, msg=testmsg)
 
                 # Expected order that messages will be read from the POPR
                 # register, and the RXCTR values after they are read
@@ -1156,6 +1156,61 @@ class MPC5674_DSPI_Test(MPC5674_Test):
                 self.emu.writeMemValue(rser_addr, 0, 4)
 
 
+    def test_dspi_burst(self):
+        dev = 1
+        devname, baseaddr = DSPI_DEVICES[dev]
+        periph = TestPeriph(self.emu, devname)
+        dspi_dev = self.emu.dspi[dev]
+
+        mcr_addr = baseaddr + DSPI_MCR_OFFSET
+        rser_addr = baseaddr + DSPI_RSER_OFFSET
+
+        # Use 16-bit frames and enable controller mode
+        self.emu.writeMemValue(baseaddr + DSPI_CTAR_RANGE[0], 15 << DSPI_CTAR_FMSZ_SHIFT, 4)
+        self.emu.writeMemValue(mcr_addr, DSPI_MCR_MSTR_MASK, 4)
+        self.assertEqual(dspi_dev.registers.sr.txrxs, 1)
+
+        # Clear the TFFF event and enable the TCF and EOQF interrupts
+        self.emu.writeMemValue(baseaddr + DSPI_SR_OFFSET, DSPI_SR_TFFF_MASK, 4)
+        self.emu.writeMemValue(rser_addr, DSPI_RSER_TCF_MASK | DSPI_RSER_EOQF_MASK, 4)
+        self.assertEqual(self._getPendingExceptions(), [])
+
+        # Transmit 10 frames in one burst, the EOQ flag is set on the 8th
+        # frame so the last 2 frames are not sent
+        frames = []
+        for i in range(10):
+            val = DSPI_PUSHR_CS0_MASK | 0xA500 | i
+            if i == 7:
+                val |= DSPI_PUSHR_EOQ_MASK
+            frames.append(struct.pack('>I', val))
+
+        self.assertEqual(dspi_dev.transmitFrames(frames), 8)
+        self.assertEqual(periph.getMsgs(), [0xA500 | i for i in range(8)])
+        self.assertEqual(dspi_dev.registers.tcr.spi_tcnt, 8)
+
+        # The TCF and EOQF events are only signaled once for the burst and Tx/Rx
+        # is stopped
+        self.assertEqual(dspi_dev.registers.sr.tcf, 1)
+        self.assertEqual(dspi_dev.registers.sr.eoqf, 1)
+        self.assertEqual(dspi_dev.registers.sr.txrxs, 0)
+        self.assertEqual(dspi_dev.registers.mcr.halt, 1)
+        self.assertEqual(self._getPendingExceptions(), [get_int(dev, 'tcf'), get_int(dev, 'eoqf')])
+
+        # Responses to a burst are accepted after the EOQ frame. With RFDF DMA
+        # requests enabled the frames that don't fit in the Rx FIFO are held
+        # until the Rx FIFO is drained.
+        self.emu.writeMemValue(rser_addr, DSPI_RSER_RFDF_MASK | DSPI_RSER_RFDF_DIRS_MASK, 4)
+        msgs = [random.randrange(0x0001, 0xFFFF + 1) for i in range(8)]
+        dspi_dev.processReceivedData(msgs)
+        self.assertEqual(dspi_dev.registers.sr.rxctr, 4)
+        self.assertEqual(dspi_dev.registers.sr.rfof, 0)
+
+        values = dspi_dev.dmaBurstRead([DSPI_POPR_OFFSET + 2] * 10, 2)
+        self.assertEqual(values, [struct.pack('>H', m) for m in msgs])
+        self.assertEqual(dspi_dev.registers.sr.rxctr, 0)
+        self.assertEqual(self._getPendingExceptions(), [])
+
+
     @unittest.skip('Implement test after DSPI DSI mode is supported')
     def test_dspi_peripheral_dsi(self):
         pass
@@ -4,6 +4,7 @@ import struct
 import unittest
 
 from cm2350 import intc_exc, mmio
+from cm2350.workqueue import PRIORITY_HIGH
 import envi.bits as e_bits
 
 from .helpers import MPC5674_Test
@@ -1203,6 +1204,125 @@ class MPC5674_eDMA_Test(MPC5674_Test):
             # The HRS flag should have been cleared
             self.assertEqual(self.emu.readMemValue(hrsh_addr, 4), 0)
 
+    def test_edma_flash_to_ram(self):
+        devname, baseaddr = EDMA_DEVICES[0]
+        chan = random.randrange(self.emu.dma[0].num_channels)
+        tcd_addr = baseaddr + EDMA_TCDx_OFFSET + (32 * chan)
+
+        # Copy from main flash into RAM, flash is read directly from the
+        # backing buffer without going through the flash MMIO functions
+        tcd = TCD(self.emu, saddr=0x00200000, ssize=4, daddr=0x40001000,
+                  dsize=8, nbytes=64, biter=4, start=1)
+
+        sdata = os.urandom(tcd.size())
+        with mmio.supervisorMode(self.emu):
+            self.emu.writeMemory(tcd.saddr, sdata)
+
+        ddata_empty = os.urandom(tcd.size() + 4)
+        self.emu.writeMemory(tcd.daddr, ddata_empty)
+
+        pc = self.emu.getProgramCounter()
+        with mmio.supervisorMode(self.emu):
+            self.emu.writeMemory(pc, b'\x60\x00\x00\x00' * tcd.biter)
+
+        tcd.write(self.emu, tcd_addr)
+        self.assertTrue(chan in self.emu.dma[0]._pending, msg=devname)
+
+        for citer in reversed(range(tcd.biter)):
+            self.emu.stepi()
+            copied = tcd.nbytes * (tcd.biter - citer)
+            expected = sdata[:copied] + ddata_empty[copied:]
+            self.assertEqual(self.emu.readMemory(tcd.daddr, len(ddata_empty)), expected, msg=citer)
+
+        self.assertEqual(self.emu.dma[0].registers.tcd[chan].done, 1, msg=devname)
+        self.assertEqual(self.emu.dma[0].registers.tcd[chan].citer, tcd.biter, msg=devname)
+        self.assertEqual(self.emu.dma[0].registers.tcd[chan].saddr, tcd.saddr, msg=devname)
+        self.assertEqual(self.emu.dma[0].registers.tcd[chan].daddr, tcd.daddr, msg=devname)
+        self.assertEqual(self.emu.dma[0]._pending, {}, msg=devname)
+
+    def test_edma_budget(self):
+        devname, baseaddr = EDMA_DEVICES[0]
+        dma = self.emu.dma[0]
+        chan = random.randrange(dma.num_channels)
+        tcd_addr = baseaddr + EDMA_TCDx_OFFSET + (32 * chan)
+
+        tcd = TCD(self.emu, nbytes=32, biter=4, start=1)
+        sdata = os.urandom(tcd.size())
+        self.emu.writeMemory(tcd.saddr, sdata)
+
+        pc = self.emu.getProgramCounter()
+        with mmio.supervisorMode(self.emu):
+            self.emu.writeMemory(pc, b'\x60\x00\x00\x00' * 2)
+
+        # Allow the entire transfer to be completed in one step
+        self.emu.configureExtraProcessing(dma.processActiveTransfers,
+                                          name=devname, budget=tcd.size())
+        self.emu.resetExtraProcessingStats()
+
+        tcd.write(self.emu, tcd_addr)
+        self.assertEqual(self.emu.extra_processing, [dma.processActiveTransfers], msg=devname)
+
+        self.emu.stepi()
+        self.assertEqual(self.emu.readMemory(tcd.daddr, tcd.size()), sdata, msg=devname)
+        self.assertEqual(dma.registers.tcd[chan].done, 1, msg=devname)
+        self.assertEqual(dma._pending, {}, msg=devname)
+
+        stats = self.emu.getExtraProcessingStats()[devname]
+        self.assertEqual(stats['runs'], tcd.biter, msg=devname)
+        self.assertEqual(stats['work'], tcd.size(), msg=devname)
+        self.assertEqual(stats['max_latency'], 0, msg=devname)
+
+        # The function was re-queued after the last major loop, it will clear
+        # itself on the next step
+        self.assertEqual(self.emu.extra_processing, [dma.processActiveTransfers], msg=devname)
+        self.emu.stepi()
+        self.assertEqual(self.emu.extra_processing, [], msg=devname)
+
+    def test_edma_burst_work(self):
+        devname, baseaddr = EDMA_DEVICES[0]
+        dma = self.emu.dma[0]
+        chan = random.randrange(dma.num_channels)
+        tcd_addr = baseaddr + EDMA_TCDx_OFFSET + (32 * chan)
+
+        # Put DSPI A in controller mode with 16-bit frames so frames written
+        # to PUSHR by the eDMA are transmitted as a burst
+        dspi_a_mcr_addr     = 0XFFF90000
+        dspi_a_ctar0_addr   = 0XFFF9000C
+        dspi_a_pushr_addr   = 0XFFF90034
+        self.emu.writeMemValue(dspi_a_ctar0_addr, 15 << 27, 4)
+        self.emu.writeMemValue(dspi_a_mcr_addr, 0x80000000, 4)
+        self.assertEqual(self.emu.dspi[0].registers.sr.txrxs, 1)
+
+        tcd = TCD(self.emu, saddr=0x40000000, ssize=4, daddr=dspi_a_pushr_addr,
+                  dsize=4, doff=0, dlast_sga=0, nbytes=4, biter=8, start=1)
+        frames = b''.join(struct.pack('>I', 0x00010000 | i) for i in range(tcd.biter))
+        self.emu.writeMemory(tcd.saddr, frames)
+        tcd.write(self.emu, tcd_addr)
+
+        # All of the major loop iterations are transferred at once, and the
+        # bytes transferred by all iterations are reported
+        self.assertEqual(dma.processActiveTransfers(), tcd.size(), msg=devname)
+        self.assertEqual(dma.registers.tcd[chan].done, 1, msg=devname)
+        self.assertEqual(self.emu.dspi[0].registers.tcr.spi_tcnt, tcd.biter, msg=devname)
+
+    def test_edma_priority(self):
+        dma_a, dma_b = self.emu.dma
+        self.emu.addExtraProcessing(dma_a.processActiveTransfers)
+        self.emu.addExtraProcessing(dma_b.processActiveTransfers)
+        self.assertEqual(self.emu.extra_processing,
+                         [dma_a.processActiveTransfers, dma_b.processActiveTransfers])
+
+        # Changing the priority of queued work changes the order it is run in
+        self.emu.configureExtraProcessing(dma_b.processActiveTransfers,
+                                          name=dma_b.devname, priority=PRIORITY_HIGH)
+        self.assertEqual(self.emu.extra_processing,
+                         [dma_b.processActiveTransfers, dma_a.processActiveTransfers])
+        self.assertEqual(self.emu.getExtraProcessingStats()[dma_b.devname]['priority'], PRIORITY_HIGH)
+
+        # One function is run each step
+        self.emu.stepi()
+        self.assertEqual(self.emu.extra_processing, [dma_a.processActiveTransfers])
+
     @unittest.skip('implement')
     def test_edma_channel_linking(self):
         pass
@@ -1,8 +1,9 @@
 import os
 import random
+import tempfile
 import unittest
 
-from cm2350 import intc_exc
+from cm2350 import intc_exc, ioproto
 from cm2350.peripherals import eqadc
 
 from .helpers import MPC5674_Test
@@ -159,10 +160,10 @@ class MPC5674_EQADC_Test(MPC5674_Test):
 
                 self.assertEqual(self.emu.readMemory(addr, size), b'\x00' * size, msg=msg)
                 self.assertEqual(self.emu.readMemValue(addr, size), 0, msg=msg)
-                self.assertEqual(self.emu.eqadc[dev].cfifo[channel][:size], b'\x00' * size, msg=msg)
+                self.assertEqual(len(self.emu.eqadc[dev].cfifo[channel]), 0, msg=msg)
 
                 rand_data = os.urandom(size)
-                self.emu.eqadc[dev].cfifo[channel][:size] = rand_data
+                self.emu.eqadc[dev].cfifo[channel].push(rand_data)
 
                 # Reads of the CFPR register should always be 0
                 self.assertEqual(self.emu.readMemValue(addr, size), 0, msg=msg)
@@ -418,6 +419,56 @@ class MPC5674_EQADC_Test(MPC5674_Test):
     # Functionality tests
     ##################################################
 
+    def test_eqadc_cfifo(self):
+        for dev in range(len(EQADC_DEVICES)):
+            devname, baseaddr = EQADC_DEVICES[dev]
+            cfpr_range, _ = EQADC_CFPR
+            cfcr_range, _ = EQADC_CFCR
+            cfxrw_range, _ = EQADC_CFxRw
+
+            for channel in range(EQADC_NUM_CHANNELS):
+                msg = '%s[%d]' % (devname, channel)
+                fisr = self.emu.eqadc[dev].registers.fisr[channel]
+
+                # All channels are disabled so commands written to CFPR are
+                # queued in the CFIFO
+                cmds = [os.urandom(4) for i in range(EQADC_NUM_CFIFO_SIZE + 1)]
+                for i, cmd in enumerate(cmds[:EQADC_NUM_CFIFO_SIZE]):
+                    self.emu.writeMemory(baseaddr + cfpr_range[channel], cmd)
+                    self.assertEqual(fisr.cfctr, i + 1, msg=msg)
+                    self.assertEqual(fisr.tnxtptr, i, msg=msg)
+
+                # The CFIFO is full so the next command is discarded
+                self.emu.writeMemory(baseaddr + cfpr_range[channel], cmds[-1])
+                self.assertEqual(fisr.cfctr, EQADC_NUM_CFIFO_SIZE, msg=msg)
+                self.assertEqual(fisr.tnxtptr, EQADC_NUM_CFIFO_SIZE - 1, msg=msg)
+
+                # The newest command is in CFxR0 and TNXTPTR is the index of
+                # the oldest command
+                expected = b''.join(reversed(cmds[:EQADC_NUM_CFIFO_SIZE]))
+                addr = baseaddr + cfxrw_range[channel]
+                self.assertEqual(self.emu.readMemory(addr, len(expected)), expected, msg=msg)
+
+                # Popping a command doesn't change the CFxRw registers
+                self.assertEqual(self.emu.eqadc[dev].popCFIFO(channel), cmds[0], msg=msg)
+                self.assertEqual(fisr.cfctr, EQADC_NUM_CFIFO_SIZE - 1, msg=msg)
+                self.assertEqual(fisr.tnxtptr, EQADC_NUM_CFIFO_SIZE - 2, msg=msg)
+                self.assertEqual(self.emu.readMemory(addr, len(expected)), expected, msg=msg)
+
+                # Pushing a command shifts the CFxRw registers
+                self.emu.writeMemory(baseaddr + cfpr_range[channel], cmds[-1])
+                self.assertEqual(fisr.cfctr, EQADC_NUM_CFIFO_SIZE, msg=msg)
+                expected = cmds[-1] + expected[:-4]
+                self.assertEqual(self.emu.readMemory(addr, len(expected)), expected, msg=msg)
+
+                # Invalidating the CFIFO discards the queued commands but the
+                # CFxRw registers are unchanged
+                self.emu.writeMemValue(baseaddr + cfcr_range[channel], 0x0200, 2)
+                self.assertEqual(fisr.cfctr, 0, msg=msg)
+                self.assertEqual(fisr.tnxtptr, 0, msg=msg)
+                self.assertEqual(self.emu.eqadc[dev].popCFIFO(channel), None, msg=msg)
+                self.assertEqual(self.emu.readMemory(addr, len(expected)), expected, msg=msg)
+
     @unittest.skip('implement test after accepting pre-programmed inputs is implemented')
     def test_eqadc_single_scan_sw_trigger(self):
         pass
@@ -433,3 +484,153 @@ class MPC5674_EQADC_Test(MPC5674_Test):
     @unittest.skip('implement after single and continuous result tests are written')
     def test_eqadc_events(self):
         pass
+
+    def test_eqadc_io_wire_format(self):
+        samples = [eqadc.EQADC_SAMPLE(5, 1.25), eqadc.EQADC_SAMPLE(255, 4.5)]
+        decoded = ioproto.decode(ioproto.encode(samples))
+        self.assertEqual(decoded, samples)
+        self.assertIsInstance(decoded[0], eqadc.EQADC_SAMPLE)
+
+        # Received samples set the analog channel voltage
+        self.emu.eqadc[0].processReceivedData(decoded[0])
+        self.assertEqual(self.emu.eqadc[0].channels[5], 1.25)
+
+    def test_eqadc_io_id(self):
+        # The IO IDs are assigned when the emulator is initialized, even if
+        # the peripherals have not been constructed yet, so using eQADC_B
+        # before eQADC_A does not change the IDs
+        hub = self.emu.getIOHub()
+        ids = [hub.register(self.emu.eqadc[i]) for i in range(len(self.emu.eqadc))]
+        self.assertEqual(ids, sorted(ids))
+
+        self.emu.eqadc[1].processReceivedData(eqadc.EQADC_SAMPLE(5, 1.25))
+        self.emu.eqadc[0].processReceivedData(eqadc.EQADC_SAMPLE(5, 2.5))
+        self.assertEqual([self.emu.eqadc[i].io_id for i in range(len(self.emu.eqadc))], ids)
+        self.assertEqual(self.emu.eqadc[1].channels[5], 1.25)
+
+    def test_eqadc_io_record_replay(self):
+        logfile = os.path.join(tempfile.mkdtemp(), 'eqadc_io.log')
+
+        # Record two analog inputs delivered at different times
+        self.emu.startIORecord(logfile)
+        self.emu.reset()
+
+        self.emu.tick(100)
+        self.emu.putIO('eQADC_A', (5, 1.25))
+        self.emu.processIO()
+        self.emu.tick(50)
+        self.emu.putIO('eQADC_B', (7, 3.5))
+        self.emu.processIO()
+        self.emu.stopIORecord()
+
+        # Clear the inputs and replay the recorded IO
+        self.emu.startIOReplay(logfile)
+        self.emu.reset()
+        self.assertTrue(self.emu.ioReplayEnabled())
+        self.assertEqual(self.emu.eqadc[0].channels[5], 0.0)
+        self.assertEqual(self.emu.eqadc[1].channels[7], 0.0)
+
+        # New IO is ignored while replaying
+        self.emu.putIO('eQADC_A', (6, 2.0))
+
+        self.emu.tick(99)
+        self.emu.processIO()
+        self.assertEqual(self.emu.eqadc[0].channels[5], 0.0)
+
+        self.emu.tick(1)
+        self.emu.processIO()
+        self.assertEqual(self.emu.eqadc[0].channels[5], 1.25)
+        self.assertEqual(self.emu.eqadc[0].channels[6], 0.0)
+        self.assertEqual(self.emu.eqadc[1].channels[7], 0.0)
+
+        self.emu.tick(50)
+        self.emu.processIO()
+        self.assertEqual(self.emu.eqadc[1].channels[7], 3.5)
+
+        self.emu.stopIOReplay()
+        self.assertFalse(self.emu.ioReplayEnabled())
+
+    def test_eqadc_waveforms(self):
+        eqadc_a = self.emu.eqadc[0]
+        start = self.emu.systime()
+
+        # Ramp channel 5 from 0V to 5V over 1 second
+        eqadc_a.bindWaveform(5, [(start, 0.0), (start + 1.0, 5.0)])
+
+        # Channel 6 is sampled at 1 kHz
+        eqadc_a.bindWaveform(6, [0.5, 1.0, 1.5, 2.0], rate=1000, start=start)
+
+        # Channel 7 is generated at 1 kHz
+        def ramp():
+            value = 0.0
+            while True:
+                yield value
+                value += 0.25
+        eqadc_a.bindWaveform(7, ramp(), rate=1000, start=start)
+
+        self.assertEqual(eqadc_a.getChannelVoltage(5), 0.0)
+        self.assertEqual(eqadc_a.getChannelVoltage(6), 0.5)
+        self.assertEqual(eqadc_a.getChannelVoltage(7), 0.0)
+
+        # Move the system time forward 3.5 msec
+        self.emu.systime(0.0035)
+        self.assertAlmostEqual(eqadc_a.getChannelVoltage(5), 0.0175)
+        self.assertEqual(eqadc_a.getChannelVoltage(6), 2.0)
+        self.assertEqual(eqadc_a.getChannelVoltage(7), 0.75)
+        self.assertEqual(eqadc_a.channels[6], 2.0)
+
+        # Sampling several channels at once uses the same time for all of
+        # them
+        values = eqadc_a.sampleWaveforms((5, 6, 7, 8))
+        self.assertEqual(sorted(values), [5, 6, 7])
+        self.assertEqual(values[6], 2.0)
+
+        # Conversions use the waveform value: 2.0V / 5.0V * 0xFFF
+        eqadc_a.adc[0][eqadc.ADC_REGS.CR] = 0x8000
+        self.assertEqual(eqadc_a.adc[0].convert(6), b'\x06\x66')
+
+        # Values from external IO clients are overridden by the waveform until
+        # it is unbound
+        eqadc_a.processReceivedData((6, 4.0))
+        self.assertEqual(eqadc_a.getChannelVoltage(6), 2.0)
+        eqadc_a.unbindWaveform(6)
+        eqadc_a.processReceivedData((6, 4.0))
+        self.assertEqual(eqadc_a.getChannelVoltage(6), 4.0)
+
+    def test_eqadc_decfilt(self):
+        devname, baseaddr = EQADC_DEVICES[0]
+        eqadc_a = self.emu.eqadc[0]
+        decfilt_a = self.emu.decfilt[0]
+        cfpr_range, _ = EQADC_CFPR
+        cfcr_range, _ = EQADC_CFCR
+        rfpr_range, _ = EQADC_RFPR
+
+        # Configure DECFILT_A as a 2 sample moving average (coefficients of
+        # 0.5) that produces an output for every other input
+        decfilt_base = 0xFFF88000
+        self.emu.writeMemValue(decfilt_base + 0x0020, 0x00400000, 4)
+        self.emu.writeMemValue(decfilt_base + 0x0024, 0x00400000, 4)
+        self.emu.writeMemValue(decfilt_base + 0x0000, 0x00000100, 4)
+
+        # 2.0V / 5.0V * 0xFFF = 0x666, 4.0V / 5.0V * 0xFFF = 0xCCC
+        eqadc_a.processReceivedData((5, 2.0))
+        eqadc_a.processReceivedData((6, 4.0))
+
+        # Enable CFIFO0 in single scan software trigger mode so commands
+        # written to CFPR0 are processed immediately
+        self.emu.writeMemValue(baseaddr + cfcr_range[0], 0x0010, 2)
+
+        # Send the commands:
+        #   - write ACR1 = 0x8400 (conversion results enabled, DEST = DECFILT_A)
+        #   - convert channel 5 with ALTCMD1
+        #   - convert channel 6 with ALTCMD1 and EOQ
+        for cmd in (0x00840030, 0x00000508, 0x80000608):
+            self.emu.writeMemValue(baseaddr + cfpr_range[0], cmd, 4)
+        self.assertEqual(eqadc_a.adc[0][eqadc.ADC_REGS.ACR1], 0x8400)
+
+        # The conversion results are filtered and only the decimated output
+        # (0x666 + 0xCCC) / 2 is returned to RFIFO0, padded out to 32 bits
+        self.assertEqual(eqadc_a.registers.fisr[0].rfctr, 1)
+        self.assertEqual(self.emu.readMemory(baseaddr + rfpr_range[0], 4), b'\x00\x00\x09\x99')
+        self.assertEqual(eqadc_a.registers.fisr[0].rfctr, 0)
+        self.assertEqual(decfilt_a.registers.tap[0].value, 0xCCC)
@@ -1,5 +1,7 @@
 import os
 import random
+import tempfile
+import unittest.mock
 
 import envi.bits as e_bits
 from ..peripherals import flash as flashperiph
@@ -534,6 +536,135 @@ class MPC5674_Flash_Test(MPC5674_Test):
         self.assertEqual(self.emu.flash.data, expected_data)
         self.assertEqual(self.emu.readMemory(FLASH_MAIN_ADDR, FLASH_MAIN_SIZE), expected_data)
 
+    def test_flash_backup(self):
+        flash = self.emu.flash
+        with tempfile.TemporaryDirectory() as tmpdir:
+            backup = os.path.join(tmpdir, 'backup.flash')
+            flash_hash = flash.get_hash().hex()
+            backup_file = '%s.%s' % (backup, flash_hash)
+            journal_file = '%s-journal.%s' % (backup, flash_hash)
+
+            # Once the backup is loaded flash is mapped to the backup file
+            flash.load_complete(backup)
+            self.assertEqual(os.stat(backup_file).st_size, 0x408000)
+            self.assertEqual(os.stat(journal_file).st_size, 0)
+
+            with open(backup_file, 'rb') as f:
+                self.assertEqual(f.read(FLASH_MAIN_SIZE), bytes(flash.data))
+
+            # Changes are recorded in the journal until the backup is synced
+            flash._sync_interval = None
+            rand_data = os.urandom(4096)
+            flash.load(flashperiph.FlashDevice.FLASH_MAIN, rand_data, 0)
+            self.assertEqual(self.emu.readMemory(FLASH_MAIN_ADDR, len(rand_data)), rand_data)
+
+            flash._journal.flush()
+            self.assertEqual(os.stat(journal_file).st_size,
+                             flashperiph.FLASH_JOURNAL_HDR.size + FLASH_MAIN_SIZE)
+
+            flash.sync()
+            self.assertEqual(os.stat(journal_file).st_size, 0)
+            with open(backup_file, 'rb') as f:
+                self.assertEqual(f.read(len(rand_data)), rand_data)
+
+            # If the previous contents are provided only the changed chunks
+            # are recorded in the journal
+            chunk_size = flashperiph.FLASH_SAVE_CHUNK_SIZE
+            old = flash.data[0:len(rand_data)]
+            flash.data[chunk_size + 4:chunk_size + 8] = os.urandom(4)
+            flash.data[chunk_size * 3:chunk_size * 3 + 4] = os.urandom(4)
+            flash.save(flashperiph.FlashDevice.FLASH_MAIN, 0, old=old)
+            flash._journal.flush()
+            self.assertEqual(os.stat(journal_file).st_size,
+                             (flashperiph.FLASH_JOURNAL_HDR.size + chunk_size) * 2)
+
+            flash.sync()
+            self.assertEqual(os.stat(journal_file).st_size, 0)
+            with open(backup_file, 'rb') as f:
+                self.assertEqual(f.read(len(rand_data)), bytes(flash.data[0:len(rand_data)]))
+
+            # The backup is synced when python exits even if the emulator is
+            # not shutdown
+            self.assertIn(flash, flashperiph.FLASH._backups)
+            rand_data = os.urandom(4096)
+            flash.load(flashperiph.FlashDevice.FLASH_MAIN, rand_data, 0)
+            flashperiph._syncBackups()
+            self.assertEqual(os.stat(journal_file).st_size, 0)
+            with open(backup_file, 'rb') as f:
+                self.assertEqual(f.read(len(rand_data)), rand_data)
+
+            # The journal is removed when the emulator shuts down
+            flash.shutdown()
+            self.assertNotIn(flash, flashperiph.FLASH._backups)
+            self.assertFalse(os.path.exists(journal_file))
+            self.assertTrue(os.path.exists(backup_file))
+
+    def test_flash_backup_sources(self):
+        flash = self.emu.flash
+        main = flashperiph.FlashDevice.FLASH_MAIN
+        with tempfile.TemporaryDirectory() as tmpdir:
+            backup = os.path.join(tmpdir, 'backup.flash')
+            firmware = os.path.join(tmpdir, 'firmware.bin')
+            with open(firmware, 'wb') as f:
+                f.write(os.urandom(4096))
+
+            def restart():
+                # Return flash to the state it is in before any files are loaded
+                flash.shutdown()
+                for device, size in ((main, FLASH_MAIN_SIZE),
+                                     (flashperiph.FlashDevice.FLASH_A_SHADOW, FLASH_A_SHADOW_SIZE),
+                                     (flashperiph.FlashDevice.FLASH_B_SHADOW, FLASH_B_SHADOW_SIZE)):
+                    flash._setDeviceData(device, bytearray(b'\xFF' * size))
+                flash._image_sources = []
+                flash.load(main, firmware, 0)
+
+            # The hash is calculated when a new backup file is created
+            restart()
+            flash_hash = flash.get_hash().hex()
+            flash.load_complete(backup)
+            self.assertEqual(flash.image_hash, flash_hash)
+
+            # If the same unchanged file is loaded the saved hash is used
+            restart()
+            with unittest.mock.patch.object(flash, 'get_hash', side_effect=AssertionError):
+                flash.load_complete(backup)
+            self.assertEqual(flash.image_hash, flash_hash)
+
+            # Changing the file means the hash has to be calculated
+            with open(firmware, 'wb') as f:
+                f.write(os.urandom(4096))
+            st = os.stat(firmware)
+            os.utime(firmware, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+            restart()
+            flash.load_complete(backup)
+            self.assertNotEqual(flash.image_hash, flash_hash)
+            flash_hash = flash.image_hash
+
+            # Any other change to flash also means the hash has to be calculated
+            restart()
+            flash.writeMemory(0, b'\x00' * 4)
+            flash.load_complete(backup)
+            self.assertNotEqual(flash.image_hash, flash_hash)
+            flash.shutdown()
+
+    def test_flash_block_digests(self):
+        flash = self.emu.flash
+        digests = flash.getBlockDigests()
+        digest = flash.getDigest()
+
+        # Only the blocks that are changed should have different digests
+        rand_data = os.urandom(4096)
+        flash.load(flashperiph.FlashDevice.FLASH_MAIN, rand_data, 0x00204000)
+        self.assertEqual(flash.diffBlocks(digests), [(0x00200000, 0x00280000)])
+        self.assertNotEqual(flash.getDigest(), digest)
+
+        flash.load(flashperiph.FlashDevice.FLASH_A_SHADOW, rand_data, 0)
+        self.assertEqual(flash.diffBlocks(digests), [(0x00200000, 0x00280000), (0x00404000, 0x00408000)])
+
+        # Restoring the original contents restores the original digest
+        flash.load(flashperiph.FlashDevice.FLASH_MAIN, b'', 0)
+        self.assertEqual(flash.diffBlocks(digests), [(0x00404000, 0x00408000)])
+
     ############################################
     # Confirm Flash controller A gets initial values from shadow flash
     ############################################
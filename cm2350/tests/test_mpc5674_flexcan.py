@@ -2,9 +2,12 @@ import os
 import time
 import random
 import struct
+import socket
+import asyncio
 import unittest
 
-from .. import intc_exc, mmio
+from .. import intc_exc, mmio, ioproto, aioclient, iohub, iofrontend
+from ..aioclient import AsyncIOClient
 from ..peripherals import flexcan
 from ..ppc_peripherals import ExternalIOClient
 
@@ -1368,6 +1371,385 @@ class MPC5674_FlexCAN_Test(MPC5674_Test):
     def test_flexcan_rtr_fifo(self):
         pass
 
+    def test_flexcan_filter_index(self):
+        self.set_baudrates()
+
+        devname, baseaddr = FLEXCAN_DEVICES[0]
+        mcr_addr = baseaddr + FLEXCAN_MCR_OFFSET
+        can = self.emu.can[0]
+
+        # Configure MB3 and MB5 to receive extended ID 0x123 and 0x456 using
+        # the default RXGMASK (all ID bits must match)
+        for mb, arbid in ((3, 0x123), (5, 0x456)):
+            addr = baseaddr + FLEXCAN_MB_OFFSET + (mb * FLEXCAN_MBx_SIZE)
+            self.emu.writeMemValue(addr + 4, arbid, 4)
+            self.emu.writeMemValue(addr, flexcan.FLEXCAN_CODE_RX_EMPTY, 1)
+
+        self.emu.writeMemValue(mcr_addr, 0, 4)
+        self.assertEqual(can.mode, flexcan.FLEXCAN_MODE.NORMAL)
+
+        msg = flexcan.CanMsg(rtr=0, ide=1, arbid=0x456, length=1, data=b'\x01')
+        can.processReceivedData(msg)
+        self.assertEqual(can.getMBCode(3), flexcan.FLEXCAN_CODE_RX_EMPTY)
+        self.assertEqual(can.getMBCode(5), flexcan.FLEXCAN_CODE_RX_FULL)
+
+        # Changing the ID of MB3 updates only the filter of that mailbox,
+        # messages with the old ID are now discarded
+        addr = baseaddr + FLEXCAN_MB_OFFSET + (3 * FLEXCAN_MBx_SIZE)
+        self.emu.writeMemValue(addr + 4, 0x456, 4)
+
+        msg = flexcan.CanMsg(rtr=0, ide=1, arbid=0x123, length=1, data=b'\x02')
+        can.processReceivedData(msg)
+        self.assertEqual(can.getMBCode(3), flexcan.FLEXCAN_CODE_RX_EMPTY)
+
+        msg = flexcan.CanMsg(rtr=0, ide=1, arbid=0x456, length=1, data=b'\x03')
+        can.processReceivedData(msg)
+        self.assertEqual(can.getMBCode(3), flexcan.FLEXCAN_CODE_RX_FULL)
+        self.assertEqual(flexcan.CanMsg.from_mb(can.registers.mb.value, 3 * FLEXCAN_MBx_SIZE), msg)
+
+        # When both mailboxes are full the last matching mailbox is overrun
+        can.processReceivedData(msg)
+        self.assertEqual(can.getMBCode(3), flexcan.FLEXCAN_CODE_RX_FULL)
+        self.assertEqual(can.getMBCode(5), flexcan.FLEXCAN_CODE_RX_OVERRUN)
+
+        # Standard ID messages don't match the extended ID filters
+        self.assertEqual(can._rx_filters[0].match(0x456 >> 18), ())
+        self.assertEqual(can._rx_filters[1].match(0x456), [3, 5])
+
+    def test_flexcan_wire_protocol(self):
+        msgs = [generate_msg() for i in range(100)]
+        msgs[0].timestamp = 0x1234
+
+        # All messages should be batched into a single record
+        data = ioproto.encode(msgs)
+        self.assertEqual(len(data), ioproto.IO_RECORD_HDR.size + len(msgs) * 16)
+
+        decoded = ioproto.decode(data)
+        self.assertEqual(decoded, msgs)
+        self.assertEqual(decoded[0].timestamp, 0x1234)
+        self.assertEqual([m.timestamp for m in decoded[1:]], [None] * 99)
+
+        # Truncated messages and unknown protocol versions are rejected
+        with self.assertRaises(ioproto.IOProtocolError):
+            ioproto.decode(data[:-1])
+        with self.assertRaises(ioproto.IOProtocolError):
+            ioproto.decode(b'\x02' + data[1:])
+
+    def test_flexcan_io_socketpair(self):
+        # Connect an in-process client to FlexCAN_A through the IO hub
+        client = ExternalIOClient.fromSocket(self.emu.can[0].connect())
+
+        rx_msgs = [generate_msg() for i in range(10)]
+        client.sendBatch(rx_msgs)
+        for msg in rx_msgs:
+            devname, obj = self.emu.external_io.get(timeout=1)
+            self.assertEqual(devname, 'FlexCAN_A')
+            self.assertEqual(obj, msg)
+
+        # Once the hub is running transmitted messages go to the client
+        tx_msg = generate_msg()
+        self.emu.can[0].transmit(tx_msg)
+        self.assertEqual(client.recv(), tx_msg)
+        self.assertEqual(self.emu.can[0].getTransmittedObjs(), [])
+
+        client.close()
+
+    def test_flexcan_io_queue_limits(self):
+        client = ExternalIOClient.fromSocket(self.emu.can[0].connect())
+        self.emu.external_io.configure('FlexCAN_A', 4, 'drop_newest')
+        self.emu.resetIOQueueStats()
+
+        rx_msgs = [generate_msg() for i in range(6)]
+        client.sendBatch(rx_msgs)
+
+        # When the queue is full the client is signaled to stop sending
+        self.assertFalse(client.waitReady(timeout=1))
+        self.assertTrue(client.isPaused())
+
+        stats = self.emu.getIOQueueStats('FlexCAN_A')
+        self.assertEqual(stats, {
+            'size': 4,
+            'maxsize': 4,
+            'policy': 'drop_newest',
+            'enqueued': 6,
+            'dropped': 2,
+            'high_water': 4,
+        })
+
+        # The newest messages were dropped
+        received = [self.emu.external_io.get(timeout=1) for i in range(2)]
+        self.assertEqual(received, [('FlexCAN_A', msg) for msg in rx_msgs[:2]])
+
+        # Once the queue has drained to half of the maximum size the client can
+        # send again
+        self.assertTrue(client.waitReady(timeout=1))
+        received = [self.emu.external_io.get(timeout=1) for i in range(2)]
+        self.assertEqual(received, [('FlexCAN_A', msg) for msg in rx_msgs[2:4]])
+        self.assertTrue(self.emu.external_io.empty())
+
+        # With the drop_oldest policy the oldest messages are dropped
+        self.emu.external_io.configure('FlexCAN_A', 4, 'drop_oldest')
+        for msg in rx_msgs:
+            self.emu.can[0].receive(msg)
+        received = [self.emu.external_io.get(timeout=1) for i in range(4)]
+        self.assertEqual(received, [('FlexCAN_A', msg) for msg in rx_msgs[2:]])
+        self.assertEqual(self.emu.getIOQueueStats('FlexCAN_A')['dropped'], 4)
+
+        client.close()
+
+    def test_flexcan_io_queue_block(self):
+        client_a = ExternalIOClient.fromSocket(self.emu.can[0].connect())
+        client_b = ExternalIOClient.fromSocket(self.emu.can[1].connect())
+        self.emu.external_io.configure('FlexCAN_A', 4, 'block')
+        self.emu.resetIOQueueStats()
+
+        # When the queue is full the client is signaled to stop sending
+        rx_msgs_a = [generate_msg() for i in range(8)]
+        client_a.sendBatch(rx_msgs_a[:4])
+        self.assertFalse(client_a.waitReady(timeout=1))
+
+        # The IO hub stops reading from the FlexCAN_A client until there is
+        # space in the queue, messages from other clients are still received
+        client_a.sendBatch(rx_msgs_a[4:])
+        rx_msg_b = generate_msg()
+        client_b.send(rx_msg_b)
+
+        start = time.time()
+        while self.emu.getIOQueueStats('FlexCAN_B')['size'] == 0 and time.time() - start < 1:
+            time.sleep(0.01)
+        self.assertEqual(self.emu.getIOQueueStats('FlexCAN_A')['size'], 4)
+        self.assertEqual(self.emu.getIOQueueStats('FlexCAN_B')['size'], 1)
+
+        # Once the emulator processes the queued messages the FlexCAN_A client
+        # is read again and no messages are dropped
+        received = [self.emu.external_io.get(timeout=1) for i in range(9)]
+        self.assertEqual(received[:4], [('FlexCAN_A', msg) for msg in rx_msgs_a[:4]])
+        self.assertEqual(received[4], ('FlexCAN_B', rx_msg_b))
+        self.assertEqual(received[5:], [('FlexCAN_A', msg) for msg in rx_msgs_a[4:]])
+        self.assertEqual(self.emu.getIOQueueStats('FlexCAN_A')['dropped'], 0)
+        self.assertTrue(client_a.waitReady(timeout=1))
+
+        client_a.close()
+        client_b.close()
+
+    def test_flexcan_io_slow_client(self):
+        # A client that doesn't read the messages sent to it does not stop
+        # the other clients from receiving messages
+        slow_sock = self.emu.can[0].connect()
+        sock = self.emu.can[0].connect()
+        sock.settimeout(5)
+        client = ExternalIOClient.fromSocket(sock)
+
+        tx_msgs = [generate_msg() for i in range(20000)]
+        for msg in tx_msgs:
+            self.emu.can[0].transmit(msg)
+        self.assertEqual([client.recv() for i in range(len(tx_msgs))], tx_msgs)
+
+        client.close()
+        slow_sock.close()
+
+    def test_flexcan_io_asyncio(self):
+        # Connect asyncio clients to all FlexCAN peripherals through the IO hub
+        clients = [AsyncIOClient.fromSocket(dev.connect(), name=dev.devname)
+                   for dev in self.emu.can]
+        rx_msgs = dict((c.name, [generate_msg() for i in range(10)]) for c in clients)
+        tx_msgs = dict((c.name, [generate_msg() for i in range(10)]) for c in clients)
+
+        async def run():
+            await asyncio.gather(*(c.open() for c in clients))
+            for client in clients:
+                for msg in rx_msgs[client.name]:
+                    client.send(msg)
+            await asyncio.gather(*(c.flush() for c in clients))
+
+            # Wait for the messages in a thread so the event loop isn't blocked
+            def get_received():
+                return [self.emu.external_io.get(timeout=1) for i in range(40)]
+            received = await asyncio.get_running_loop().run_in_executor(None, get_received)
+
+            for dev in self.emu.can:
+                for msg in tx_msgs[dev.devname]:
+                    dev.transmit(msg)
+
+            events = []
+            async for event in aioclient.merge(*clients):
+                events.append(event)
+                if len(events) == 40:
+                    break
+
+            await asyncio.gather(*(c.close() for c in clients))
+            return received, events
+
+        received, events = asyncio.run(run())
+
+        for name, msgs in rx_msgs.items():
+            self.assertEqual([obj for n, obj in received if n == name], msgs)
+
+        start = time.time()
+        for name, msgs in tx_msgs.items():
+            self.assertEqual([e.obj for e in events if e.client.name == name], msgs)
+        for event in events:
+            self.assertLessEqual(event.timestamp, start)
+
+        for client in clients:
+            self.assertEqual((client.sent, client.received), (10, 10))
+
+
+class MPC5674_FlexCAN_IOFrontend(MPC5674_Test):
+    args = [
+        '-c',
+        '-O', 'project.MPC5674.IOFrontend.enabled=True',
+        '-O', 'project.MPC5674.IOFrontend.poll_interval=1',
+        '-O', 'project.MPC5674.FlexCAN_A.port=10005',
+    ]
+
+    def test_flexcan_io_frontend(self):
+        self.assertTrue(self.emu.getIOHub().isRunning())
+
+        # The frontend process may take a moment to start
+        client = ExternalIOClient(None, 10005)
+        start = time.time()
+        while True:
+            try:
+                client.open()
+                break
+            except ConnectionRefusedError:
+                client.close()
+                if time.time() - start > 10:
+                    raise
+                time.sleep(0.1)
+
+        # Received messages are placed in the external IO queue when the
+        # emulator polls the frontend
+        rx_msgs = [generate_msg() for i in range(10)]
+        client.sendBatch(rx_msgs)
+        received = []
+        start = time.time()
+        while len(received) < len(rx_msgs) and time.time() - start < 5:
+            self.emu.getIOHub().poll()
+            while not self.emu.external_io.empty():
+                received.append(self.emu.external_io.get())
+        self.assertEqual(received, [('FlexCAN_A', msg) for msg in rx_msgs])
+
+        # Transmitted messages are sent to the client by the frontend process
+        tx_msg = generate_msg()
+        self.emu.can[0].transmit(tx_msg)
+        self.assertEqual(client.recv(), tx_msg)
+
+        client.close()
+
+    def test_flexcan_io_frontend_pair(self):
+        # In-process connections are serviced by the frontend process
+        client = ExternalIOClient.fromSocket(self.emu.can[1].connect())
+
+        rx_msgs = [generate_msg() for i in range(10)]
+        client.sendBatch(rx_msgs)
+        received = []
+        start = time.time()
+        while len(received) < len(rx_msgs) and time.time() - start < 5:
+            self.emu.getIOHub().poll()
+            while not self.emu.external_io.empty():
+                received.append(self.emu.external_io.get())
+        self.assertEqual(received, [('FlexCAN_B', msg) for msg in rx_msgs])
+
+        tx_msg = generate_msg()
+        self.emu.can[1].transmit(tx_msg)
+        self.assertEqual(client.recv(), tx_msg)
+
+        client.close()
+
+    def test_flexcan_io_frontend_block(self):
+        client = ExternalIOClient.fromSocket(self.emu.can[0].connect())
+        self.emu.external_io.configure('FlexCAN_A', 4, 'block')
+        self.emu.resetIOQueueStats()
+
+        # Once the queue is full the emulator stops reading the receive ring,
+        # the remaining messages wait in the ring
+        rx_msgs = [generate_msg() for i in range(8)]
+        for msg in rx_msgs:
+            client.send(msg)
+        frontend = self.emu.getIOHub()
+        start = time.time()
+        while self.emu.getIOQueueStats('FlexCAN_A')['size'] < 4 and time.time() - start < 5:
+            frontend.poll()
+        time.sleep(0.1)
+        frontend.poll()
+        self.assertEqual(self.emu.getIOQueueStats('FlexCAN_A')['size'], 4)
+        self.assertTrue(frontend._rx.pending())
+
+        # Once the emulator processes the queued messages the ring is read
+        # again and no messages are dropped
+        received = [self.emu.external_io.get() for i in range(4)]
+        start = time.time()
+        while len(received) < len(rx_msgs) and time.time() - start < 5:
+            frontend.poll()
+            while not self.emu.external_io.empty():
+                received.append(self.emu.external_io.get())
+        self.assertEqual(received, [('FlexCAN_A', msg) for msg in rx_msgs])
+        self.assertEqual(self.emu.getIOQueueStats('FlexCAN_A')['dropped'], 0)
+
+        client.close()
+
+    def test_flexcan_io_frontend_slow_client(self):
+        # A client that doesn't read the messages sent to it does not stop
+        # the frontend process from sending messages to the other clients
+        slow_sock = self.emu.can[0].connect()
+        slow_client = ExternalIOClient.fromSocket(slow_sock)
+        sock = self.emu.can[0].connect()
+        sock.settimeout(5)
+        client = ExternalIOClient.fromSocket(sock)
+
+        # Wait until the frontend process has started servicing both clients
+        slow_client.send(generate_msg())
+        client.send(generate_msg())
+        received = 0
+        start = time.time()
+        while received < 2 and time.time() - start < 5:
+            self.emu.getIOHub().poll()
+            while not self.emu.external_io.empty():
+                self.emu.external_io.get()
+                received += 1
+        self.assertEqual(received, 2)
+
+        # Send the messages in groups so the transmit ring doesn't fill up
+        for i in range(50):
+            tx_msgs = [generate_msg() for i in range(1000)]
+            for msg in tx_msgs:
+                self.emu.can[0].transmit(msg)
+            self.assertEqual([client.recv() for i in range(len(tx_msgs))], tx_msgs)
+        self.assertEqual(self.emu.getIOHub().tx_dropped, 0)
+
+        client.close()
+        slow_client.close()
+
+    def test_flexcan_io_frontend_oversized(self):
+        # Run the frontend process side of a separate IOFrontend in this
+        # process so the dropped message warning can be checked
+        frontend = iofrontend.IOFrontend(ring_size=0x1000)
+        proc = iofrontend.IOFrontendProcess(frontend._rx.name, frontend._tx.name, [],
+                                            os.getpid(), frontend._ctrl_child)
+        client_sock, frontend_sock = socket.socketpair()
+        proc._addClient(1, frontend_sock)
+        client = proc._clients[1][0]
+
+        # Messages too large for the receive ring are dropped with a warning,
+        # the following messages are still forwarded
+        msgs = (b'\x00' * frontend._rx.max_record, b'\x01\x02\x03')
+        client_sock.sendall(b''.join(iohub.IO_MSG_LEN.pack(len(m)) + m for m in msgs))
+        with self.assertLogs('cm2350.iofrontend', logging.WARNING) as logs:
+            proc._handleClient(client)
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn('dropping %d byte message' % frontend._rx.max_record, logs.output[0])
+
+        self.assertEqual(frontend._rx.get(), b'\x01\x01\x02\x03')
+        self.assertIsNone(frontend._rx.get())
+
+        client_sock.close()
+        proc._removeClient(client)
+        proc._rx.close()
+        proc._tx.close()
+        frontend.shutdown()
+
 
 class MPC5674_FlexCAN_RealIO(MPC5674_Test):
     accurate_timing = True
@@ -637,6 +637,83 @@ SVR            0x0                 0
         self.assertIn(pc, range(0x00000004, 0x00000100))
         self.assertEqual(self.emu.getRegister(eapr.REG_PC), pc)
 
+    def test_gdb_reverse_stepi(self):
+        # Save checkpoints so execution can be reversed
+        self.emu.enableCheckpoints(interval=10)
+
+        for i in range(3):
+            self.write('stepi')
+            self.read(until='(gdb) ', timeout=1)
+        self.write('p/x $pc')
+        out = self.read(timeout=0.1)
+        self.assertEqual(out, '''$1 = 0xc
+(gdb) ''')
+        self.assertEqual(self.emu.getRegister(eapr.REG_PC), 0x0000000c)
+
+        # reverse-stepi sends the "bs" packet
+        self.write('reverse-stepi')
+        self.read(until='(gdb) ', timeout=1)
+        self.write('p/x $pc')
+        out = self.read(timeout=0.1)
+        self.assertEqual(out, '''$2 = 0x8
+(gdb) ''')
+        self.assertEqual(self.emu.getRegister(eapr.REG_PC), 0x00000008)
+        self.assertTrue(self.emu.checkpoints.replaying())
+
+        # Stepping forward again replays the execution history
+        self.write('stepi')
+        self.read(until='(gdb) ', timeout=1)
+        self.write('p/x $pc')
+        out = self.read(timeout=0.1)
+        self.assertEqual(out, '''$3 = 0xc
+(gdb) ''')
+        self.assertEqual(self.emu.getRegister(eapr.REG_PC), 0x0000000c)
+
+    def test_gdb_reverse_continue(self):
+        # Save checkpoints so execution can be reversed
+        self.emu.enableCheckpoints(interval=10)
+
+        self.write('break *0x50')
+        self.read(until='(gdb) ', timeout=1)
+        self.write('continue')
+        self.read(until='(gdb) ', timeout=1)
+
+        # Step past the lis and the branch
+        for i in range(3):
+            self.write('stepi')
+            self.read(until='(gdb) ', timeout=1)
+        self.write('p/x $pc')
+        out = self.read(timeout=0.1)
+        self.assertEqual(out, '''$1 = 0x60
+(gdb) ''')
+        self.assertEqual(self.emu.getRegister(eapr.REG_PC), 0x00000060)
+        self.assertEqual(self.emu.getRegister(eapr.REG_R3), 0x40000000)
+
+        # reverse-continue sends the "bc" packet, execution goes back to the
+        # breakpoint before r3 was modified
+        self.write('reverse-continue')
+        self.read(until='(gdb) ', timeout=1)
+        self.write('p/x $pc')
+        out = self.read(timeout=0.1)
+        self.assertEqual(out, '''$2 = 0x50
+(gdb) ''')
+        self.write('p/x $r3')
+        out = self.read(timeout=0.1)
+        self.assertEqual(out, '''$3 = 0x0
+(gdb) ''')
+        self.assertEqual(self.emu.getRegister(eapr.REG_PC), 0x00000050)
+        self.assertEqual(self.emu.getRegister(eapr.REG_R3), 0x00000000)
+
+        # There are no earlier breakpoints so execution goes back to the start
+        # of the execution history
+        self.write('reverse-continue')
+        self.read(until='(gdb) ', timeout=1)
+        self.write('p/x $pc')
+        out = self.read(timeout=0.1)
+        self.assertEqual(out, '''$4 = 0x0
+(gdb) ''')
+        self.assertEqual(self.emu.getRegister(eapr.REG_PC), 0x00000000)
+
     def test_gdb_set_bitfield_spr(self):
         # Testing the registers defined as "BitFieldSPR" objects to ensure that 
         # GDB can write and read them and the correct values will be reflected 
@@ -0,0 +1,65 @@
+import os
+import tempfile
+
+import envi.archs.ppc.regs as eapr
+
+from ..instrstore import InstructionStore
+
+from .helpers import MPC5674_Test
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+FLASH_MAIN_SIZE = 0x00400000
+
+# addi r3,r3,1
+ADDI_1 = b'\x38\x63\x00\x01'
+# addi r3,r3,2
+ADDI_2 = b'\x38\x63\x00\x02'
+
+
+class MPC5674_InstrStore_Test(MPC5674_Test):
+    def run_instrs(self, count):
+        self.emu.setProgramCounter(self.start_pc)
+        for i in range(count):
+            self.emu.stepi()
+
+    def test_instr_store(self):
+        self.start_pc = self.emu.getProgramCounter()
+        instrs = ADDI_1 * 4
+        self.emu.flash.data[self.start_pc:self.start_pc+len(instrs)] = instrs
+        self.emu.setRegister(eapr.REG_R3, 0)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'instructions')
+
+            # The first time the instructions are run they are decoded and
+            # added to the store
+            store = InstructionStore(filename, [(0, FLASH_MAIN_SIZE)])
+            self.emu.setInstructionStore(store)
+            self.run_instrs(4)
+            self.assertEqual(self.emu.getRegister(eapr.REG_R3), 4)
+            self.assertEqual(len(store), 4)
+            self.assertEqual(store.hits, 0)
+            store.save()
+            self.assertTrue(os.path.exists(filename))
+
+            # When the saved instructions are loaded they are used instead of
+            # decoding the instructions again
+            self.emu.clearOpcache(self.start_pc, len(instrs))
+            store = InstructionStore(filename, [(0, FLASH_MAIN_SIZE)])
+            self.emu.setInstructionStore(store)
+            self.assertEqual(len(store), 4)
+            self.run_instrs(4)
+            self.assertEqual(self.emu.getRegister(eapr.REG_R3), 8)
+            self.assertEqual((store.hits, store.misses), (4, 0))
+
+            # Saved instructions that no longer match memory are not used
+            self.emu.flash.data[self.start_pc:self.start_pc+4] = ADDI_2
+            self.emu.clearOpcache(self.start_pc, len(instrs))
+            self.run_instrs(4)
+            self.assertEqual(self.emu.getRegister(eapr.REG_R3), 13)
+            self.assertEqual((store.hits, store.misses), (7, 1))
+
+            self.emu.setInstructionStore(None)
@@ -0,0 +1,55 @@
+import envi.archs.ppc.regs as eapr
+
+from ..predecode import decodeRegion
+
+from .helpers import MPC5674_Test
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# addi r3,r3,1
+ADDI_1 = b'\x38\x63\x00\x01'
+# addi r3,r3,2
+ADDI_2 = b'\x38\x63\x00\x02'
+
+
+class MPC5674_Predecode_Test(MPC5674_Test):
+    def test_decode_region(self):
+        # Erased flash is skipped
+        data = ADDI_1 + b'\xff' * 8 + ADDI_2
+        ops = decodeRegion(0x1000, 0, data)
+        self.assertEqual([ea for ea, op in ops], [0x1000, 0x100c])
+        self.assertEqual([op.va for ea, op in ops], [0x1000, 0x100c])
+        self.assertEqual([op.mnem for ea, op in ops], ['addi', 'addi'])
+
+    def test_predecode(self):
+        start_pc = self.emu.getProgramCounter()
+        _, vle = self.emu.mmu.translateInstrAddr(start_pc)
+
+        instrs = ADDI_1 * 4
+        self.emu.flash.data[start_pc:start_pc+len(instrs)] = instrs
+        self.emu.clearOpcache(start_pc, len(instrs))
+        self.emu.setRegister(eapr.REG_R3, 0)
+
+        region_start = start_pc & ~0xFFFF
+        self.emu.startPredecode([(region_start, region_start + 0x10000)], workers=1)
+        self.emu._mergePredecoded(wait=True)
+        self.assertIsNone(self.emu._predecoder)
+        for addr in range(start_pc, start_pc + len(instrs), 4):
+            self.assertIn(addr, self.emu.opcache[vle])
+            op = self.emu.opcache[vle][addr]
+            self.assertEqual(op.cycles, self.emu.getCycleModel().getCycles(op))
+
+        # The predecoded instructions are executed normally
+        for i in range(4):
+            self.emu.stepi()
+        self.assertEqual(self.emu.getRegister(eapr.REG_R3), 4)
+
+        # Decoded instructions for a region that was modified after decoding
+        # started are not used
+        self.emu.clearOpcache(start_pc, len(instrs))
+        self.emu.startPredecode([(region_start, region_start + 0x10000)], workers=1)
+        self.emu.flash.data[start_pc:start_pc+4] = ADDI_2
+        self.emu._mergePredecoded(wait=True)
+        self.assertNotIn(start_pc, self.emu.opcache[vle])
@@ -1,6 +1,10 @@
+import time
+
 import envi.bits as e_bits
 import envi.archs.ppc.regs as eapr
 
+from .. import mmio, ppc_cycles
+
 from .helpers import MPC5674_Test
 
 
@@ -248,3 +252,78 @@ class MPC5674_SPRHOOKS_Test(MPC5674_Test):
         self.assertEqual(self.emu.getTimebase(), 0x10000000000000000 + tbl)
         self.assertEqual(self.emu.getTimebase(), 0x10000000000000000 + tb)
         self.assert_timer_within_range(self.emu.getTimebase(), expected_tb, margin)
+
+    def test_instr_cycles(self):
+        # Fill in some NOPs (0x60000000: ori r0,r0,0) followed by some branches
+        # to the next instruction (0x48000004: b .+4) starting at the current PC
+        pc = self.emu.getProgramCounter()
+        instrs = b'\x60\x00\x00\x00' * 4 + b'\x48\x00\x00\x04' * 4
+        with mmio.supervisorMode(self.emu):
+            self.emu.writeMemory(pc, instrs)
+
+        # By default every instruction takes 1 cycle
+        start = self.emu.systicks()
+        self.emu.stepi()
+        self.assertEqual(self.emu.systicks(), start + 1)
+
+        # Change the default CPI and make branches more expensive
+        self.emu.setCycleModel(ppc_cycles.PpcCycleModel(2, branch=5))
+
+        start = self.emu.systicks()
+        for i in range(3):
+            self.emu.stepi()
+        self.assertEqual(self.emu.systicks(), start + 6)
+
+        start = self.emu.systicks()
+        for i in range(4):
+            self.emu.stepi()
+        self.assertEqual(self.emu.systicks(), start + 20)
+        self.assertEqual(self.emu.getProgramCounter(), pc + len(instrs))
+
+        # Instructions placed directly in the opcache (such as by the GDB stub
+        # when breakpoints are installed and removed) also have a cycle count
+        self.emu.setProgramCounter(pc + 4*4)
+        ea, vle, op, _ = self.emu.getInstrInfo(pc + 4*4, skipcache=True)
+        self.emu.updateOpcache(ea, vle, op)
+        start = self.emu.systicks()
+        self.emu.stepi()
+        self.assertEqual(self.emu.systicks(), start + 5)
+
+        # Invalid instruction classes and CPI values are not allowed
+        with self.assertRaises(ValueError):
+            ppc_cycles.PpcCycleModel(1, foo=2)
+        with self.assertRaises(ValueError):
+            ppc_cycles.PpcCycleModel(0)
+
+    def test_realtime_pacing(self):
+        self.assertFalse(self.emu.pacingEnabled())
+        self.assertEqual(self.emu.getPacingStats(), None)
+
+        self.emu.enablePacing(scaling=1.0, max_lead=0.005)
+        self.assertTrue(self.emu.pacingEnabled())
+
+        # Move emulated time forward 0.1 seconds in chunks of 1000 cycles, the
+        # wall clock time should be about the same
+        ticks = int(0.1 * self.emu.getSystemFreq())
+        start = time.monotonic()
+        for i in range(ticks // 1000):
+            self.emu.tick(1000)
+        elapsed = time.monotonic() - start
+
+        self.assertGreaterEqual(elapsed, 0.1 - 0.005)
+
+        stats = self.emu.getPacingStats()
+        self.assertGreater(stats['wall_time'], 0.0)
+        self.assertGreater(stats['sleep_time'], 0.0)
+        self.assertLessEqual(stats['behind_percent'], 100.0)
+
+        # Halting time stops pacing
+        self.emu.halt_time()
+        start = time.monotonic()
+        for i in range(ticks // 1000):
+            self.emu.tick(1000)
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.emu.resume_time()
+
+        self.emu.disablePacing()
+        self.assertFalse(self.emu.pacingEnabled())
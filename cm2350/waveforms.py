@@ -0,0 +1,190 @@
+import bisect
+import collections.abc
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__all__ = [
+    'Waveform',
+    'SampledWaveform',
+    'PiecewiseLinearWaveform',
+    'GeneratorWaveform',
+    'makeWaveform',
+]
+
+
+class Waveform:
+    '''
+    Base class for analog input sources. A waveform returns the input value
+    (usually a voltage) at an emulated system time in seconds.
+    '''
+    def sample(self, t):
+        raise NotImplementedError()
+
+    def sampleMany(self, times):
+        '''
+        Return a list of the waveform values at each of the times
+        '''
+        return [self.sample(t) for t in times]
+
+
+class SampledWaveform(Waveform):
+    '''
+    A waveform defined by an array of samples taken at a fixed rate (in Hz).
+    Before the start time the first sample is used, after the last sample the
+    last value is held unless repeat is True.
+
+    If NumPy is available the samples are stored as a NumPy array and
+    sampleMany() looks up all of the times in one operation.
+    '''
+    def __init__(self, samples, rate, start=0.0, repeat=False):
+        if rate <= 0:
+            raise ValueError('Invalid waveform sample rate: %s' % rate)
+        if len(samples) == 0:
+            raise ValueError('Waveform must have at least 1 sample')
+
+        if numpy is not None:
+            self.samples = numpy.asarray(samples, dtype=float)
+        else:
+            self.samples = [float(s) for s in samples]
+        self.rate = rate
+        self.start = start
+        self.repeat = repeat
+
+    def _index(self, t):
+        idx = int((t - self.start) * self.rate)
+        if idx < 0:
+            return 0
+        elif self.repeat:
+            return idx % len(self.samples)
+        else:
+            return min(idx, len(self.samples) - 1)
+
+    def sample(self, t):
+        return float(self.samples[self._index(t)])
+
+    def sampleMany(self, times):
+        if numpy is None:
+            return super().sampleMany(times)
+
+        idx = ((numpy.asarray(times, dtype=float) - self.start) * self.rate).astype(numpy.int64)
+        numpy.maximum(idx, 0, out=idx)
+        if self.repeat:
+            idx %= len(self.samples)
+        else:
+            numpy.minimum(idx, len(self.samples) - 1, out=idx)
+        return self.samples[idx].tolist()
+
+
+class PiecewiseLinearWaveform(Waveform):
+    '''
+    A waveform defined by a table of (time, value) points, values between the
+    points are linearly interpolated.  Before the first point and after the
+    last point the value of the closest point is used.  If repeat is True the
+    table repeats with a period of the last point's time.
+    '''
+    def __init__(self, points, repeat=False):
+        points = sorted(points)
+        if not points:
+            raise ValueError('Waveform must have at least 1 point')
+
+        self.times = [float(p[0]) for p in points]
+        self.values = [float(p[1]) for p in points]
+        self.repeat = repeat
+        if repeat and self.times[-1] <= 0.0:
+            raise ValueError('Repeating waveform must end after time 0')
+
+    def sample(self, t):
+        times = self.times
+        values = self.values
+        if self.repeat:
+            t %= times[-1]
+
+        idx = bisect.bisect_right(times, t)
+        if idx == 0:
+            return values[0]
+        elif idx == len(times):
+            return values[-1]
+
+        t0 = times[idx-1]
+        t1 = times[idx]
+        v0 = values[idx-1]
+        return v0 + (values[idx] - v0) * (t - t0) / (t1 - t0)
+
+    def sampleMany(self, times):
+        if numpy is None:
+            return super().sampleMany(times)
+
+        times = numpy.asarray(times, dtype=float)
+        if self.repeat:
+            times = times % self.times[-1]
+        return numpy.interp(times, self.times, self.values).tolist()
+
+
+class GeneratorWaveform(Waveform):
+    '''
+    A waveform produced by a Python iterator (such as a generator) that yields
+    a new value at a fixed rate (in Hz). Values are only pulled from the
+    iterator as emulated time advances, the value before the first sample is
+    the initial value. Once the iterator is exhausted the last value is held.
+
+    Iterators can't be rewound, if the emulated time moves backwards (such as
+    when a checkpoint is restored) the current value is held until the
+    emulated time catches up.
+    '''
+    def __init__(self, iterator, rate, start=0.0, initial=0.0):
+        if rate <= 0:
+            raise ValueError('Invalid waveform sample rate: %s' % rate)
+
+        self.iterator = iter(iterator)
+        self.rate = rate
+        self.start = start
+        self.value = initial
+        self._index = -1
+
+    def sample(self, t):
+        target = int((t - self.start) * self.rate)
+        if target > self._index and self.iterator is not None:
+            # Skip any values that were produced between the last sample time
+            # and now
+            value = self.value
+            try:
+                while self._index < target:
+                    value = next(self.iterator)
+                    self._index += 1
+            except StopIteration:
+                self.iterator = None
+            self.value = float(value)
+        return self.value
+
+
+def makeWaveform(source, rate=None, **kwargs):
+    '''
+    Create a Waveform from a source:
+    - Waveform objects are returned unchanged
+    - an iterator or generator is a GeneratorWaveform, rate is required
+    - a sequence of (time, value) pairs is a PiecewiseLinearWaveform
+    - any other sequence (or NumPy array) of values is a SampledWaveform, rate
+      is required
+    Any extra keyword arguments are passed to the Waveform constructor.
+    '''
+    if isinstance(source, Waveform):
+        return source
+
+    if isinstance(source, collections.abc.Iterator):
+        if rate is None:
+            raise ValueError('rate is required for generator waveforms')
+        return GeneratorWaveform(source, rate, **kwargs)
+
+    if len(source) and isinstance(source[0], (tuple, list)):
+        return PiecewiseLinearWaveform(source, **kwargs)
+
+    if rate is None:
+        raise ValueError('rate is required for sampled waveforms')
+    return SampledWaveform(source, rate, **kwargs)
@@ -0,0 +1,259 @@
+import heapq
+import itertools
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__all__ = [
+    'PRIORITY_HIGH',
+    'PRIORITY_NORMAL',
+    'PRIORITY_LOW',
+    'DeferredWorkQueue',
+]
+
+
+# Priorities of deferred work functions, lower values are run first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 10
+PRIORITY_LOW = 20
+
+
+class WorkSource:
+    '''
+    The scheduling configuration and statistics for one deferred work
+    function. The budget is the amount of work the function may do each time
+    the queue is run, if the budget is None the function is only called once.
+    '''
+    def __init__(self, name, priority=PRIORITY_NORMAL, budget=None):
+        self.name = name
+        self.priority = priority
+        self.budget = budget
+        self.resetStats()
+
+    def resetStats(self):
+        self.runs = 0
+        self.work = 0
+        self.total_latency = 0
+        self.max_latency = 0
+
+    def getStats(self):
+        if self.runs:
+            avg_latency = self.total_latency / self.runs
+        else:
+            avg_latency = 0.0
+
+        return {
+            'priority': self.priority,
+            'budget': self.budget,
+            'runs': self.runs,
+            'work': self.work,
+            'avg_latency': avg_latency,
+            'max_latency': self.max_latency,
+        }
+
+
+class DeferredWorkQueue:
+    '''
+    Scheduler for work that peripherals defer until the next instruction step
+    (such as processing eDMA transfers).
+
+    Queued functions are run in priority order, functions of the same
+    priority are run in the order they were queued.  A function is only
+    queued once, queueing a function that is already pending does nothing.
+
+    Each time run() is called the next function is called.  If that function
+    has a budget and requeues itself it is called again until the amount of
+    work it returns adds up to the budget, or a higher priority function is
+    queued.  Work functions that don't return a value count as 1 unit of
+    work.
+
+    The queue latency (the number of system ticks between when a function is
+    queued and when it is run) is tracked for each function so the amount of
+    work done each step can be tuned to trade the accuracy of bus timing
+    against emulator throughput.
+    '''
+    def __init__(self, clock):
+        '''
+        Constructor for DeferredWorkQueue, the clock is a function that
+        returns the current system tick count.
+        '''
+        self._clock = clock
+        self._lock = threading.RLock()
+
+        # Heap of [priority, sequence, func, queued tick] entries, and the
+        # pending entry for each function
+        self._heap = []
+        self._entries = {}
+        self._seq = itertools.count()
+
+        # Scheduling configuration for each work function, functions that have
+        # not been configured are added with the default configuration when
+        # they are first queued.
+        self._sources = {}
+
+    def configure(self, func, name=None, priority=PRIORITY_NORMAL, budget=None):
+        '''
+        Set the priority and budget of a work function. The name is used to
+        identify the function in the queue statistics.  If the function is
+        already queued it is requeued with the new priority.
+        '''
+        if budget is not None and budget <= 0:
+            raise ValueError('Invalid deferred work budget for %s: %s' % (name, budget))
+
+        if name is None:
+            name = getattr(func, '__qualname__', repr(func))
+
+        with self._lock:
+            source = self._sources.get(func)
+            if source is None:
+                self._sources[func] = WorkSource(name, priority, budget)
+            else:
+                source.name = name
+                source.priority = priority
+                source.budget = budget
+
+            entry = self._entries.get(func)
+            if entry is not None and entry[0] != priority:
+                # Replace the pending entry with one that has the new priority
+                entry[2] = None
+                self._push(func, entry[3])
+
+    def _getSource(self, func):
+        # Must be called with the lock held
+        source = self._sources.get(func)
+        if source is None:
+            source = WorkSource(getattr(func, '__qualname__', repr(func)))
+            self._sources[func] = source
+        return source
+
+    def add(self, func, queued=None):
+        '''
+        Queue a function to be run
+        '''
+        with self._lock:
+            if func in self._entries:
+                return
+
+            if queued is None:
+                queued = self._clock()
+            self._push(func, queued)
+
+    def _push(self, func, queued):
+        # Must be called with the lock held
+        source = self._getSource(func)
+        entry = [source.priority, next(self._seq), func, queued]
+        self._entries[func] = entry
+        heapq.heappush(self._heap, entry)
+
+    def _pop(self, func=None):
+        # Must be called with the lock held, returns the next pending entry
+        # (removing any cancelled entries). If func is specified the entry is
+        # only returned if it is for that function.
+        while self._heap:
+            entry = self._heap[0]
+            if entry[2] is None:
+                heapq.heappop(self._heap)
+                continue
+
+            if func is not None and entry[2] != func:
+                return None
+
+            heapq.heappop(self._heap)
+            del self._entries[entry[2]]
+            return entry
+
+        return None
+
+    def run(self):
+        '''
+        Run the next queued function, and keep running it while it requeues
+        itself until its budget is used.
+        '''
+        with self._lock:
+            entry = self._pop()
+            if entry is None:
+                return
+
+            func = entry[2]
+            source = self._sources[func]
+            used = 0
+            while True:
+                latency = self._clock() - entry[3]
+                source.runs += 1
+                source.total_latency += latency
+                if latency > source.max_latency:
+                    source.max_latency = latency
+
+                work = func()
+                if work is None:
+                    work = 1
+                source.work += work
+                used += work
+
+                if source.budget is None or used >= source.budget:
+                    break
+
+                # Only continue if the function requeued itself and it is still
+                # the highest priority pending work
+                entry = self._pop(func)
+                if entry is None:
+                    break
+
+    def pending(self):
+        '''
+        Return a list of the queued functions in the order they will be run
+        '''
+        with self._lock:
+            return [e[2] for e in sorted(self._heap) if e[2] is not None]
+
+    def clear(self):
+        '''
+        Remove all queued functions, the function configurations and statistics
+        are not changed.
+        '''
+        with self._lock:
+            self._heap = []
+            self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def getSnap(self):
+        '''
+        Return the queued functions along with the system tick when they were
+        queued.
+        '''
+        with self._lock:
+            return [(e[2], e[3]) for e in sorted(self._heap) if e[2] is not None]
+
+    def setSnap(self, snap):
+        with self._lock:
+            self.clear()
+            for func, queued in snap:
+                self._push(func, queued)
+
+    def getStats(self, func=None):
+        '''
+        Return the scheduling statistics for one work function, or a
+        dictionary of the statistics for all work functions (indexed by name)
+        if func is None:
+            priority            The function priority
+            budget              The amount of work the function may do each
+                                step (None means it is run once per step)
+            runs                Number of times the function was called
+            work                Total amount of work done by the function
+            avg_latency         Average number of system ticks between when
+                                the function was queued and when it ran
+            max_latency         The largest queue latency
+        '''
+        with self._lock:
+            if func is not None:
+                return self._getSource(func).getStats()
+            return dict((s.name, s.getStats()) for s in self._sources.values())
+
+    def resetStats(self):
+        with self._lock:
+            for source in self._sources.values():
+                source.resetStats()